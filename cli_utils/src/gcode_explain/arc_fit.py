@@ -0,0 +1,281 @@
+"""Arc fitting: runs of short G1 moves of a G-code program replaced by G2 / G3 arcs.
+
+CAM posts often linearize curves into many G1 moves of a few microns (e.g. the ramps of
+gcode_files/2dcfhp1_T2_15mm_2-5mm_flat.cnc). Each move is a block the controller must plan, and when the
+blocks are shorter than the distance travelled during the look-ahead, the block buffer runs dry and the
+feed drops. The arc fitter rewrites a program, 1 line at a time:
+    * consecutive G1 blocks, in the XY plane, in absolute mm coordinates and at the same feed, are collected
+      into a run. Any other line (a comment, a rapid, a tool change, ...) ends the run.
+    * the longest prefix of the run that stays within the tolerance of an arc is replaced by a single
+      G2 / G3 block. The arc goes through the first, middle and last points of the prefix, every point must
+      be within the tolerance of it, every chord must bulge less than the tolerance from it and all the
+      moves must turn the same way. Moves that also change Z become a helical arc, when Z changes linearly
+      with the angle around the arc.
+    * the moves that do not fit an arc are written unchanged
+    * the modal state is kept correct: a G1 is added to the first unchanged line that relied on a modal G1,
+      after an arc, and the F word of the replaced moves is written on the arc
+Only the current run is held in memory (at most max_moves moves), so programs of any size can be rewritten.
+"""
+import math
+from collections import deque, namedtuple
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from gcode_explain.min_gcode_parser import CCW_ARC, COMMENT_RE, CW_ARC, LINEAR, WORD_RE, GcodeParser
+
+# Tuple with the counts of an arc fitting
+#   blocks_in       - the number of blocks (lines with G-code words) read
+#   blocks_out      - the number of blocks written
+#   arcs            - the number of arcs that replaced runs of G1 moves
+#   moves_replaced  - the number of G1 moves replaced by the arcs
+ArcFitStats = namedtuple("ArcFitStats", ["blocks_in", "blocks_out", "arcs", "moves_replaced"])
+
+# Tuple describing a fitted arc
+#   cx, cy - the center of the arc
+#   ccw    - True for a counterclockwise (G3) arc
+ArcFit = namedtuple("ArcFit", ["cx", "cy", "ccw"])
+
+
+def fmt_coord(value: float, decimals: int) -> str:
+    """Format a coordinate with up to a number of decimal places, without trailing zeros."""
+    text = f"{value:.{decimals}f}".rstrip("0").rstrip(".")
+    return "0" if text in ("-0", "") else text
+
+
+def run_move(parser: GcodeParser, line: str) -> bool:
+    """Return True if a line, already parsed, is a plain G1 move in the XY plane, in absolute mm coordinates.
+
+    :param parser: the parser that parsed the line, holds the modal state after it
+    :param line: the text of the line
+    """
+    if "(" in line or ";" in line or parser.motion != LINEAR or parser.plane != 17:
+        return False
+    if not parser.absolute or parser.scale != 1.0:
+        return False
+    words = WORD_RE.findall(line.upper())
+    return all(letter in "XYZF" or (letter == "G" and float(value) == 1) for letter, value in words)
+
+
+def fit_arc(
+    points: np.ndarray,
+    tolerance: float,
+    min_radius: float,
+    max_radius: float,
+) -> ArcFit | None:
+    """Fit an arc to a polyline.
+
+    :param points: the x, y, z points of the polyline, as a (n, 3) array, the first one is the start point
+    :param tolerance: the largest distance between the polyline and the arc
+    :param min_radius: arcs with a smaller radius are rejected
+    :param max_radius: arcs with a larger radius are rejected (the polyline is almost straight)
+    :return: the arc, or None if the polyline does not fit one
+    """
+    (x0, y0), (x1, y1), (x2, y2) = points[0, :2], points[len(points) // 2, :2], points[-1, :2]
+    # the center of the circle through the first, middle & last points
+    det = 2 * ((x1 - x0) * (y2 - y0) - (y1 - y0) * (x2 - x0))
+    if abs(det) < 1e-12:
+        return None
+    sq1, sq2 = (x1 - x0) ** 2 + (y1 - y0) ** 2, (x2 - x0) ** 2 + (y2 - y0) ** 2
+    cx = x0 + ((y2 - y0) * sq1 - (y1 - y0) * sq2) / det
+    cy = y0 + ((x1 - x0) * sq2 - (x2 - x0) * sq1) / det
+    radius = math.hypot(x0 - cx, y0 - cy)
+    if not min_radius <= radius <= max_radius:
+        return None
+
+    rel_x, rel_y = points[:, 0] - cx, points[:, 1] - cy
+    radial_err = np.abs(np.hypot(rel_x, rel_y) - radius)
+    # the angle turned by each move around the center, all the moves must turn the same way
+    turns = np.arctan2(rel_x[:-1] * rel_y[1:] - rel_y[:-1] * rel_x[1:], rel_x[:-1] * rel_x[1:] + rel_y[:-1] * rel_y[1:])
+    ccw = det > 0
+    if np.any(turns <= 0 if ccw else turns >= 0):
+        return None
+    angles = np.cumsum(np.abs(turns))
+    if angles[-1] >= 2 * math.pi - 1e-6:
+        return None
+    # the sagitta: how far the arc bulges out of each chord (the original move)
+    chords = np.hypot(points[1:, 0] - points[:-1, 0], points[1:, 1] - points[:-1, 1])
+    sagitta = radius - np.sqrt(np.maximum(radius**2 - (chords / 2) ** 2, 0.0))
+    if radial_err.max() + sagitta.max() > tolerance:
+        return None
+    # a helical arc moves Z in proportion to the angle turned
+    z_fit = points[0, 2] + (points[-1, 2] - points[0, 2]) * angles / angles[-1]
+    if np.abs(points[1:, 2] - z_fit).max() > tolerance:
+        return None
+    return ArcFit(cx, cy, bool(ccw))
+
+
+class ArcFitter:
+    """Streaming arc fitter, rewrites a program 1 line at a time."""
+
+    def __init__(
+        self,
+        tolerance: float = 0.005,
+        min_moves: int = 3,
+        max_moves: int = 200,
+        max_radius: float = 1000.0,
+        decimals: int = 3,
+    ):
+        """Create an arc fitter.
+
+        :param tolerance: the largest distance, in mm, between the original moves and the arcs
+        :param min_moves: the smallest number of G1 moves replaced by an arc
+        :param max_moves: the largest number of G1 moves replaced by an arc, bounds the memory & the time
+            spent fitting each arc
+        :param max_radius: runs that only fit arcs of a larger radius are left as G1 moves
+        :param decimals: the number of decimal places of the coordinates written
+        """
+        self.tolerance = tolerance
+        self.min_moves = max(min_moves, 2)
+        self.max_moves = max_moves
+        self.max_radius = max_radius
+        self.decimals = decimals
+        self.parser = GcodeParser()
+        # the run: the start point, then the x, y, z, line & F word flag of each G1 move
+        self.run: list[tuple[float, float, float, str | None, bool]] = []
+        self.pending: deque = deque()  # the moves of the run that are still to be fitted
+        self.fitted: tuple[int, ArcFit] | None = None  # the moves of the run that fit an arc, and the arc
+        self.run_feed = float("nan")
+        self.out_motion = None  # the modal motion of the lines written, as a reader of the output sees it
+        self.out: list[str] = []
+        self.blocks_in = self.blocks_out = self.arcs = self.moves_replaced = 0
+
+    @property
+    def stats(self) -> ArcFitStats:
+        """Return the counts of the lines processed so far."""
+        return ArcFitStats(self.blocks_in, self.blocks_out, self.arcs, self.moves_replaced)
+
+    def process(self, lines: Iterable[str]) -> Iterator[str]:
+        """Rewrite the lines of a program, yielding the lines of the rewritten program, without line ends."""
+        for ln_nbr, line in enumerate(lines, 1):
+            line = line.rstrip("\r\n")
+            start = (self.parser.x, self.parser.y, self.parser.z)
+            move = self.parser.parse_line(ln_nbr, line)
+            if WORD_RE.search(COMMENT_RE.sub(" ", line).upper()):
+                self.blocks_in += 1
+            if move is not None and run_move(self.parser, line) and not any(math.isnan(value) for value in start):
+                if self.run and self.parser.feed != self.run_feed:
+                    self.flush()
+                if not self.run:
+                    self.run = [(*start, None, False)]
+                    self.run_feed = self.parser.feed
+                self.pending.append((move.x, move.y, move.z, line, "F" in line.upper()))
+                self.fit_pending()
+            else:
+                self.flush()
+                self.write_line(line, self.parser.motion)
+            yield from self.out
+            self.out.clear()
+        self.flush()
+        yield from self.out
+        self.out.clear()
+
+    def fit_pending(self) -> None:
+        """Add the pending moves to the run, writing the moves that can not be part of the arc being fitted."""
+        while self.pending:
+            self.run.append(self.pending.popleft())
+            count = len(self.run) - 1
+            if count < self.min_moves:
+                continue
+            if count <= self.max_moves:
+                points = np.array([point[:3] for point in self.run])
+                arc = fit_arc(points, self.tolerance, self.tolerance, self.max_radius)
+                if arc:
+                    self.fitted = (count, arc)
+                    continue
+            # the last move broke the arc: write what was fitted before it, then fit the rest of the run again
+            self.write_run_start()
+
+    def write_run_start(self) -> None:
+        """Write the fitted arc of the run, or its first move if none fits, and put the rest back to be fitted."""
+        count = self.fitted[0] if self.fitted else 1
+        if self.fitted:
+            self.write_arc(self.run[:count + 1], self.fitted[1])
+        else:
+            self.write_line(self.run[1][3], LINEAR)
+        self.pending.extendleft(reversed(self.run[count + 1:]))
+        self.run = [self.run[count]]
+        self.fitted = None
+
+    def flush(self) -> None:
+        """Write all the moves of the run."""
+        while len(self.run) > 1 or self.pending:
+            if self.fitted and self.fitted[0] == len(self.run) - 1 and not self.pending:
+                self.write_arc(self.run, self.fitted[1])
+                self.run = self.run[-1:]
+                self.fitted = None
+            elif len(self.run) > 1:
+                self.write_run_start()
+                self.fit_pending()
+            else:
+                self.fit_pending()
+        self.run = []
+
+    def write_line(self, line: str, motion: int) -> None:
+        """Write a line unchanged, adding the G word of its motion if it relied on a modal motion that changed.
+
+        :param line: the line
+        :param motion: the modal motion of the input program after the line
+        """
+        words = WORD_RE.findall(COMMENT_RE.sub(" ", line).upper())
+        motion_word = any(letter == "G" and float(value) in (0, 1, 2, 3) for letter, value in words)
+        axis_word = any(letter in "XYZ" for letter, _ in words)
+        if axis_word and not motion_word and motion != self.out_motion:
+            line = f"G{motion} {line}"
+        if axis_word or motion_word:
+            self.out_motion = motion
+        if words:
+            self.blocks_out += 1
+        self.out.append(line)
+
+    def write_arc(self, run: list[tuple], arc: ArcFit) -> None:
+        """Write the G2 / G3 block that replaces the moves of a run.
+
+        :param run: the start point of the run, then its moves
+        :param arc: the arc fitted to the moves
+        """
+        (x0, y0, z0, _, _), (x, y, z, _, _) = run[0], run[-1]
+        motion = CCW_ARC if arc.ccw else CW_ARC
+        words = [] if motion == self.out_motion else [f"G{motion}"]
+        words += [f"X{fmt_coord(x, self.decimals)}", f"Y{fmt_coord(y, self.decimals)}"]
+        if round(z, self.decimals) != round(z0, self.decimals):
+            words.append(f"Z{fmt_coord(z, self.decimals)}")
+        words += [f"I{fmt_coord(arc.cx - x0, self.decimals)}", f"J{fmt_coord(arc.cy - y0, self.decimals)}"]
+        if any(move[4] for move in run[1:]):
+            words.append(f"F{fmt_coord(self.run_feed, self.decimals)}")
+        self.out.append(" ".join(words))
+        self.out_motion = motion
+        self.blocks_out += 1
+        self.arcs += 1
+        self.moves_replaced += len(run) - 1
+
+
+def fit_arcs_file(
+    gcode_fn: str,
+    out_fn: str,
+    tolerance: float = 0.005,
+    **kwargs,
+) -> ArcFitStats:
+    """Rewrite a G-code file with its runs of G1 moves replaced by arcs.
+
+    :param gcode_fn: the file name path of the G-code file to read
+    :param out_fn: the file name path of the G-code file to write
+    :param tolerance: the largest distance, in mm, between the original moves and the arcs
+    :param kwargs: the other parameters of ArcFitter
+    :return: the counts of the blocks read & written
+    """
+    fitter = ArcFitter(tolerance, **kwargs)
+    with open(gcode_fn) as gcode_fh, open(out_fn, "w", buffering=1 << 16) as out_fh:
+        for line in fitter.process(gcode_fh):
+            out_fh.write(line + "\n")
+    return fitter.stats
+
+
+def output_arc_fit_report(stats: ArcFitStats) -> None:
+    """Prints out the block count reduction of an arc fitting.
+
+    :param stats: the counts returned by fit_arcs_file or ArcFitter.stats
+    """
+    saved = 1 - stats.blocks_out / stats.blocks_in if stats.blocks_in else 0.0
+    print(f"blocks: {stats.blocks_in} -> {stats.blocks_out}   ({saved:.1%} fewer)")
+    print(f"\t{stats.moves_replaced} G1 moves replaced by {stats.arcs} arcs")
@@ -0,0 +1,278 @@
+"""Machining time estimate of a parsed G-code program, with acceleration aware motion planning.
+
+The nominal time of a program (the length of each move divided by its feed rate) is misleading: short moves
+never reach their feed rate, the machine slows down at every corner, and Fusion's personal use license even
+throttles the rapids to the cutting feed rate (see the note at the top of gcode_files/1001.cnc). The
+estimate plans the moves the way the controller does:
+    * each move has a nominal speed: its feed rate (or the rapid speed), limited by the speed limits of the
+      axes it moves along. Arcs are also limited by their centripetal acceleration.
+    * the speed at the junction between 2 moves is limited by the junction deviation: the largest speed at
+      which the corner can be taken along a circle that deviates from the corner by the junction deviation,
+      with the machine's acceleration (the model of grbl & Smoothieware)
+    * the speed at each junction is then the largest speed that can still be slowed down to the speed of
+      every junction after it, and reached from the speed of every junction before it. These backward &
+      forward passes are min-plus recurrences over the squared speeds, so both are a cumulative minimum
+      over the whole program, in NumPy.
+    * each move is a trapezoid (or a triangle) of constant acceleration, cruise, and constant deceleration
+
+The machine's speed limits can be read from the machine-v2 JSON of a Fusion post dump (.dmp file), its
+acceleration & junction deviation are not in the dump, they default to the Carvera's firmware settings.
+"""
+import json
+import math
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from gcode_explain.min_gcode_parser import CCW_ARC, CW_ARC, RAPID, GcodeProgram, arc_sweeps, plane_axes
+
+# Tuple describing the motion limits of a machine
+#   max_feed           - the largest cutting feed rate, in mm/min
+#   max_rapid          - the rapid speed, in mm/min
+#   axis_max_speed     - the largest speed of each axis (X, Y & Z), in mm/min, 0 for no limit
+#   acceleration       - the acceleration of the X & Y axes, in mm/s²
+#   z_acceleration     - the acceleration of the Z axis, in mm/s²
+#   junction_deviation - the junction deviation, in mm
+#   tool_change_time   - the time of a tool change, in seconds
+MachineProfile = namedtuple(
+    "MachineProfile",
+    [
+        "max_feed",
+        "max_rapid",
+        "axis_max_speed",
+        "acceleration",
+        "z_acceleration",
+        "junction_deviation",
+        "tool_change_time",
+    ],
+)
+CARVERA_PROFILE = MachineProfile(4000.0, 4000.0, (0.0, 0.0, 0.0), 500.0, 300.0, 0.05, 30.0)
+
+# Tuple with the results of the estimate, all the times are in seconds
+#   total        - the estimated time of the program, tool changes included
+#   nominal      - the time of the moves at their nominal speed, without accelerations
+#   rapid        - the estimated time of the rapid moves
+#   feed         - the estimated time of the feed moves
+#   tool_changes - the time of the tool changes
+#   sections     - dictionary of the estimated time of each section (by section name)
+#   tools        - dictionary of the estimated time of each tool (by tool number)
+#   move_times   - the estimated time of each move
+CycleTime = namedtuple(
+    "CycleTime", ["total", "nominal", "rapid", "feed", "tool_changes", "sections", "tools", "move_times"]
+)
+
+MACHINE_V2_RE = re.compile(r"onParameter\('machine-v2', '(.*?)'\)\s*$", re.DOTALL | re.MULTILINE)
+
+
+def machine_profile_from_dmp(dmp_fn: str, defaults: MachineProfile = CARVERA_PROFILE) -> MachineProfile:
+    """Read the speed limits of a machine from the machine-v2 JSON of a Fusion post dump.
+
+    :param dmp_fn: the file name path of the .dmp file
+    :param defaults: the profile whose values are kept for the limits the dump does not set (a value of 0)
+    :return: the machine profile
+    """
+    with open(dmp_fn, "r") as dmp_fh:
+        match = MACHINE_V2_RE.search(dmp_fh.read())
+    if not match:
+        raise ValueError(f"No machine-v2 parameter found in the post dump: {dmp_fn}")
+    machine = json.loads(match.group(1))
+    config = machine.get("controller", {}).get("synced_configuration", {})
+    parts = config.get("parts", {})
+
+    max_feed = config.get("max_normal_speed") or defaults.max_feed
+    rapid_speeds = [parts.get(axis, {}).get("max_rapid_speed", 0) for axis in "XYZ"]
+    max_rapid = max(rapid_speeds) or max_feed
+    axis_max_speed = tuple(
+        float(parts.get(axis, {}).get("max_normal_speed", 0) or default)
+        for axis, default in zip("XYZ", defaults.axis_max_speed)
+    )
+    tool_change_time = machine.get("machining", {}).get("default", {}).get("tool_change_time")
+    return defaults._replace(
+        max_feed=float(max_feed),
+        max_rapid=float(max_rapid),
+        axis_max_speed=axis_max_speed,
+        tool_change_time=float(tool_change_time or defaults.tool_change_time),
+    )
+
+
+def move_geometry(moves: dict[str, np.ndarray]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Return the length, the start & end unit tangents, and the radius (0 for lines) of each move.
+
+    :param moves: the columns of the moves, as returned by the G-code parser
+    :return: tuple of: the lengths, the start tangents (n x 3), the end tangents (n x 3), the arc radii
+    """
+    ends = np.column_stack((moves["x"], moves["y"], moves["z"]))
+    # the moves start at the end of the move before them, an axis not known yet does not move
+    starts = np.vstack((ends[:1], ends[:-1]))
+    starts = np.where(np.isnan(starts), ends, starts)
+    ends = np.where(np.isnan(ends), starts, ends)
+    ends, starts = np.nan_to_num(ends), np.nan_to_num(starts)
+    delta = ends - starts
+    lengths = np.linalg.norm(delta, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        start_tan = np.nan_to_num(delta / lengths[:, None])
+    end_tan = start_tan.copy()
+    radii = np.zeros(len(lengths))
+
+    arcs = np.flatnonzero((moves["motion"] == CW_ARC) | (moves["motion"] == CCW_ARC))
+    if len(arcs):
+        # the 2 in-plane axes (p, q) and the normal axis (n) of each arc's plane
+        p_axis, q_axis, n_axis = plane_axes(moves["plane"][arcs])
+        offsets = np.column_stack((moves["i"][arcs], moves["j"][arcs], moves["k"][arcs]))
+        rows = np.arange(len(arcs))
+        arc_starts, arc_ends = starts[arcs], ends[arcs]
+        cp = arc_starts[rows, p_axis] + offsets[rows, p_axis]
+        cq = arc_starts[rows, q_axis] + offsets[rows, q_axis]
+        sp, sq = arc_starts[rows, p_axis] - cp, arc_starts[rows, q_axis] - cq
+        ep, eq = arc_ends[rows, p_axis] - cp, arc_ends[rows, q_axis] - cq
+        radius = np.hypot(sp, sq)
+        ccw = moves["motion"][arcs] == CCW_ARC
+        angle_0, angle_1 = np.arctan2(sq, sp), np.arctan2(eq, ep)
+        sweep = arc_sweeps(angle_0, angle_1, ccw)
+        rise = arc_ends[rows, n_axis] - arc_starts[rows, n_axis]
+        arc_len = np.hypot(radius * sweep, rise)
+        lengths[arcs] = arc_len
+        radii[arcs] = radius
+
+        # the tangents: perpendicular to the radius in the plane, plus the helix's rise along the normal
+        direction = np.where(ccw, 1.0, -1.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            planar = np.nan_to_num(radius * sweep / arc_len)
+            along = np.nan_to_num(rise / arc_len)
+            for tangents, (rel_p, rel_q) in ((start_tan, (sp, sq)), (end_tan, (ep, eq))):
+                arc_tan = np.zeros((len(arcs), 3))
+                arc_tan[rows, p_axis] = np.nan_to_num(-rel_q / radius) * direction * planar
+                arc_tan[rows, q_axis] = np.nan_to_num(rel_p / radius) * direction * planar
+                arc_tan[rows, n_axis] = along
+                tangents[arcs] = arc_tan
+    return lengths, start_tan, end_tan, radii
+
+
+def trapezoid_times(
+    lengths: np.ndarray,
+    v_entry: np.ndarray,
+    v_exit: np.ndarray,
+    v_cruise: np.ndarray,
+    accel: np.ndarray,
+) -> np.ndarray:
+    """Return the time of each move of a trapezoidal speed profile (all the arguments are per move).
+
+    :param lengths: the length of each move, in mm
+    :param v_entry: the speed at the start of each move, in mm/s
+    :param v_exit: the speed at the end of each move, in mm/s
+    :param v_cruise: the nominal speed of each move, in mm/s
+    :param accel: the acceleration of each move, in mm/s²
+    """
+    accel_dist = (v_cruise ** 2 - v_entry ** 2) / (2 * accel)
+    decel_dist = (v_cruise ** 2 - v_exit ** 2) / (2 * accel)
+    cruise_dist = lengths - accel_dist - decel_dist
+    with np.errstate(invalid="ignore", divide="ignore"):
+        trapezoid = (v_cruise - v_entry) / accel + (v_cruise - v_exit) / accel + cruise_dist / v_cruise
+        # the move is too short to reach its nominal speed, it peaks in between
+        v_peak = np.sqrt(np.maximum((2 * accel * lengths + v_entry ** 2 + v_exit ** 2) / 2, 0.0))
+        triangle = (v_peak - v_entry) / accel + (v_peak - v_exit) / accel
+    times = np.where(cruise_dist >= 0, trapezoid, triangle)
+    return np.where(lengths > 0, np.nan_to_num(times), 0.0)
+
+
+def estimate_cycle_time(program: GcodeProgram, profile: MachineProfile = CARVERA_PROFILE) -> CycleTime:
+    """Estimate the machining time of a parsed G-code program.
+
+    :param program: the program, as returned by parse_gcode_arrays
+    :param profile: the motion limits of the machine
+    :return: the estimate
+    """
+    moves = program.moves
+    count = len(moves["motion"])
+    lengths, start_tan, end_tan, radii = move_geometry(moves)
+
+    # the acceleration of each move, limited by the axes it moves along
+    abs_tan = np.maximum(np.abs(start_tan), np.abs(end_tan))
+    with np.errstate(divide="ignore"):
+        accel = np.minimum(
+            profile.acceleration / np.maximum(abs_tan[:, 0], abs_tan[:, 1]), profile.z_acceleration / abs_tan[:, 2]
+        )
+    accel = np.where(np.isfinite(accel), accel, profile.acceleration)
+
+    # the nominal speed of each move, in mm/s
+    feeds = np.nan_to_num(moves["feed"], nan=profile.max_feed)
+    speed = np.where(moves["motion"] == RAPID, profile.max_rapid, np.minimum(feeds, profile.max_feed)) / 60
+    for axis, axis_max in enumerate(profile.axis_max_speed):
+        if axis_max > 0:
+            with np.errstate(divide="ignore"):
+                speed = np.minimum(speed, axis_max / 60 / abs_tan[:, axis])
+    speed = np.where(radii > 0, np.minimum(speed, np.sqrt(accel * radii)), speed)
+    speed = np.maximum(speed, 1e-6)
+
+    # the squared speed limit at each junction: the start of the program, between the moves, and its end
+    cos_theta = -np.einsum("ij,ij->i", end_tan[:-1], start_tan[1:])
+    sin_half = np.sqrt(np.clip((1 - cos_theta) / 2, 0.0, 1.0))
+    junction_accel = np.minimum(accel[:-1], accel[1:])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corner = junction_accel * profile.junction_deviation * sin_half / (1 - sin_half)
+    corner = np.where(sin_half >= 1 - 1e-9, np.inf, corner)
+    limits = np.concatenate(([0.0], np.minimum(corner, np.minimum(speed[:-1], speed[1:]) ** 2), [0.0]))
+    # the machine stops for each tool change, and at the moves that do not move
+    stops = np.flatnonzero(np.diff(moves["tool"]) != 0) + 1 if count else np.zeros(0, dtype=np.int64)
+    limits[stops] = 0.0
+    limits[np.flatnonzero(lengths == 0)] = 0.0
+    limits[np.flatnonzero(lengths == 0) + 1] = 0.0
+
+    # backward pass: w[k] <= w[k + 1] + 2 a L, forward pass: w[k + 1] <= w[k] + 2 a L (w the squared speed)
+    reach = np.concatenate(([0.0], np.cumsum(2 * accel * lengths)))
+    limits = np.minimum.accumulate((limits + reach)[::-1])[::-1] - reach
+    limits = np.minimum.accumulate(limits - reach) + reach
+    v_junction = np.sqrt(np.maximum(limits, 0.0))
+
+    move_times = trapezoid_times(lengths, v_junction[:-1], v_junction[1:], speed, accel)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        nominal = float(np.sum(np.where(lengths > 0, lengths / speed, 0.0)))
+    rapid = moves["motion"] == RAPID
+    tool_change_time = len(program.tool_changes) * profile.tool_change_time
+
+    sections = {}
+    for section_nbr, name in enumerate(program.sections):
+        sections[name] = sections.get(name, 0.0) + float(move_times[moves["section"] == section_nbr].sum())
+    tools = {}
+    for tool in np.unique(moves["tool"]):
+        tools[int(tool)] = float(move_times[moves["tool"] == tool].sum())
+    for _, tool in program.tool_changes:
+        tools[tool] = tools.get(tool, 0.0) + profile.tool_change_time
+
+    return CycleTime(
+        float(move_times.sum()) + tool_change_time,
+        nominal,
+        float(move_times[rapid].sum()),
+        float(move_times[~rapid].sum()),
+        tool_change_time,
+        sections,
+        tools,
+        move_times,
+    )
+
+
+def fmt_duration(seconds: float) -> str:
+    """Return a duration formatted as h:mm:ss.s"""
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{int(hours)}:{int(minutes):02}:{seconds:04.1f}"
+
+
+def output_cycle_time_report(cycle_time: CycleTime) -> None:
+    """Prints out the machining time estimate of a program.
+
+    :param cycle_time: the estimate returned by estimate_cycle_time
+    """
+    print(f"estimated time: {fmt_duration(cycle_time.total)}   nominal time: {fmt_duration(cycle_time.nominal)}")
+    print(
+        f"\trapid: {fmt_duration(cycle_time.rapid)}   feed: {fmt_duration(cycle_time.feed)}"
+        f"   tool changes: {fmt_duration(cycle_time.tool_changes)}"
+    )
+    for name, seconds in cycle_time.sections.items():
+        print(f"\tsection {name:<30} {fmt_duration(seconds)}")
+    for tool, seconds in sorted(cycle_time.tools.items()):
+        print(f"\ttool T{tool:<29} {fmt_duration(seconds)}")
+    moves_time = cycle_time.rapid + cycle_time.feed
+    if not math.isclose(cycle_time.nominal, 0.0):
+        print(f"\tmoves slowed down by the accelerations: {moves_time / cycle_time.nominal - 1:.1%}")
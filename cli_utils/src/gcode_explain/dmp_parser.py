@@ -0,0 +1,339 @@
+"""Parser of the Fusion post processor dumps (.dmp files, see gcode_files/1001.dmp), and cross-check with a program.
+
+Fusion's "dump" post processor writes the calls Fusion makes to a post processor, 1 per line, each prefixed
+with the number of the record it comes from, e.g.:
+    415: onLinear(13.975815773010254, 13.077116012573242, 15, 1000)
+    418: onCircular(false, 12.499789237976074, 12.4999361038208, 2.3902440071105957, 11.379459381103516, ...)
+The lines indented below a call describe the state of the post, only the normal of the arcs is used. The calls
+used are:
+    * onParameter(name, value): the parameters of the program & of each operation, the machine-v2 parameter
+      is the JSON description of the machine, written over many lines
+    * onSection() / onSectionEnd(): the start & end of an operation, named by its operation-comment parameter
+    * onMovement(kind): the kind of the moves that follow (cutting, lead in, helix ramp...)
+    * onRapid(x, y, z), onLinear(x, y, z, feed) and onCircular(clockwise, cx, cy, cz, x, y, z, feed): the moves,
+      at full precision. The plane of an arc is given by the normal below it, e.g. "normal: X=0 Y=0 Z=1 (XY)":
+      arcs in other planes than XY, ZX & YZ (e.g. the lead outs that leave the cut vertically along a curve) can
+      not be written in G-code, the posts write them as straight moves.
+
+parse_dmp rebuilds the toolpath of a dump as columns, the same as the G-code parsers (see
+gcode_explain.min_gcode_parser), so the dump can be analyzed like a program (e.g. by the cycle time
+estimate). cross_check compares it with the program a post wrote from it, move by move: this validates a post
+(or one of our generators) against Fusion's reference output. The program may split a move of the dump into
+several moves (e.g. a positioning move into an XY and a Z move), as long as each of the pieces lies on the move.
+"""
+import math
+import re
+from collections import namedtuple
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from gcode_explain.min_gcode_parser import CCW_ARC, CW_ARC, LINEAR, RAPID, GcodeMove, GcodeProgram, moves_to_arrays
+
+# Tuple with the content of a post dump
+#   parameters   - dictionary of the value of each parameter (the last value set), numbers as floats
+#   moves        - the columns of the moves, keyed by the GcodeMove field names, plus the movement column: the
+#                  index of each move's movement kind, in movements, and the nx, ny & nz columns: the normal of
+#                  the plane of each arc (0 for the other moves). The ln_nbr column has the line numbers of the
+#                  calls in the dump file, the plane column is 0 for the arcs in other planes than XY, ZX & YZ.
+#   sections     - the name of each section (operation), in order
+#   tool_changes - list of tuples of: the line number of the section that changes the tool, and the new tool number
+#   movements    - the names of the movement kinds, in order of their first use, e.g. MOVEMENT_CUTTING
+#   section_parameters - the parameters at the start of each section (its operation: parameters, e.g. the tool)
+DmpDump = namedtuple(
+    "DmpDump", ["parameters", "moves", "sections", "tool_changes", "movements", "section_parameters"]
+)
+
+# Tuple describing 1 difference between a post dump and a program
+#   dmp_ln_nbr   - the line number of the move in the dump, -1 for a move of the program only
+#   gcode_ln_nbr - the line number of the move in the program, -1 for a move of the dump only
+#   kind         - the kind of difference: "position", "motion", "center", "feed", "missing" (a move of the dump
+#                  not in the program) or "extra" (a move of the program not in the dump)
+#   deviation    - the size of the difference: a distance in mm, a feed rate in mm/min, 0 for the others
+Divergence = namedtuple("Divergence", ["dmp_ln_nbr", "gcode_ln_nbr", "kind", "deviation"])
+
+# Tuple with the result of a cross-check
+#   dmp_moves   - the number of moves of the dump
+#   gcode_moves - the number of moves of the program
+#   matched     - the number of moves of the dump found in the program
+#   split       - the number of moves of the dump written as several moves of the program
+#   linearized  - the number of arcs of the dump written as straight moves of the program
+#   divergences - list of the differences found, in order
+CrossCheck = namedtuple("CrossCheck", ["dmp_moves", "gcode_moves", "matched", "split", "linearized", "divergences"])
+
+CALL_RE = re.compile(r"^-?\d+: (on\w+)\((.*)$", re.DOTALL)
+PARAMETER_RE = re.compile(r"^'([^']*)', (.*)\)$", re.DOTALL)
+JS_COMMENT_RE = re.compile(r"/\*.*?\*/")
+# the plane of an arc, from the label of its normal, 0 for the other planes
+NORMAL_PLANES = {"(XY)": 17, "(ZX)": 18, "(YZ)": 19}
+PLANE_NORMALS = {17: (0, 0, 1), 18: (0, 1, 0), 19: (1, 0, 0)}
+NORMAL_RE = re.compile(r"normal: X=(\S+) Y=(\S+) Z=(\S+)")
+
+
+def parse_value(text: str) -> float | str:
+    """Return the value of an argument of a call: a float, a bool as 0 or 1, a string without its quotes."""
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] == "'":
+        return text[1:-1]
+    if text in ("true", "false"):
+        return float(text == "true")
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def iter_dmp_calls(lines: Iterable[str]) -> Iterator[tuple[int, str, str]]:
+    """Yield the calls of a post dump, as tuples of: the line number of the call, its name, and its arguments.
+
+    The arguments are the text between the parentheses of the call, which can span several lines (the machine-v2
+    parameter); the JavaScript comments are removed from the other calls. The lines of the state of the post are
+    yielded with an empty name, their text as the arguments.
+    """
+    pending = None
+    for ln_nbr, line in enumerate(lines, 1):
+        if pending is not None:
+            call_ln_nbr, name, text = pending
+            text += line
+            if text.rstrip().endswith("')"):
+                pending = None
+                yield call_ln_nbr, name, text.rstrip()[:-1]
+            else:
+                pending = call_ln_nbr, name, text
+            continue
+        match = CALL_RE.match(line)
+        if not match:
+            yield ln_nbr, "", line.strip()  # the state of the post, indented below a call
+            continue
+        name, text = match.groups()
+        text = text.rstrip()
+        if not text.endswith(")"):
+            pending = ln_nbr, name, text + "\n"
+            continue
+        yield ln_nbr, name, JS_COMMENT_RE.sub("", text[:-1]) if name != "onParameter" else text[:-1]
+
+
+def parse_dmp(dmp_fn: str) -> DmpDump:
+    """Parse a post dump file into its parameters and the columns of its moves.
+
+    :param dmp_fn: the file name path of the .dmp file
+    :return: the parameters, moves, sections, tool changes and movement kinds of the dump
+    """
+    parameters: dict[str, float | str] = {}
+    sections, tool_changes, movements, section_parameters = [], [], [], []
+    moves, movement_col, normals = [], [], []
+    position = (math.nan, math.nan, math.nan)
+    movement, section, tool = -1, -1, 0
+    with open(dmp_fn, "r", buffering=1 << 16) as dmp_fh:
+        for ln_nbr, name, text in iter_dmp_calls(dmp_fh):
+            if not name:
+                match = NORMAL_RE.match(text)
+                if match and moves and moves[-1].motion in (CW_ARC, CCW_ARC):
+                    moves[-1] = moves[-1]._replace(plane=NORMAL_PLANES.get(text.split()[-1], 0))
+                    normals[-1] = tuple(float(value) for value in match.groups())
+            elif name == "onParameter":
+                match = PARAMETER_RE.match(text + ")")
+                if not match:
+                    raise ValueError(f"Invalid onParameter call at line {ln_nbr} of the post dump: {dmp_fn}")
+                parameters[match.group(1)] = parse_value(match.group(2))
+            elif name == "onSection":
+                sections.append(str(parameters.get("operation-comment", f"Section {len(sections) + 1}")))
+                section = len(sections) - 1
+                section_parameters.append(dict(parameters))
+                new_tool = int(parameters.get("operation:tool_number", tool))
+                if new_tool != tool:
+                    tool = new_tool
+                    tool_changes.append((ln_nbr, tool))
+            elif name == "onMovement":
+                kind = text.strip()
+                if kind not in movements:
+                    movements.append(kind)
+                movement = movements.index(kind)
+            elif name in ("onRapid", "onLinear", "onCircular"):
+                args = [parse_value(arg) for arg in text.split(",")]
+                if name == "onCircular":
+                    clockwise, cx, cy, cz, x, y, z, feed = args
+                    motion, plane = (CW_ARC if clockwise else CCW_ARC), 17  # until the normal is read
+                    normals.append((0.0, 0.0, 1.0))
+                    i, j, k = cx - position[0], cy - position[1], cz - position[2]
+                else:
+                    x, y, z = args[:3]
+                    motion, plane, i, j, k = (RAPID if name == "onRapid" else LINEAR), 17, 0.0, 0.0, 0.0
+                    feed = args[3] if name == "onLinear" else math.nan
+                    normals.append((0.0, 0.0, 0.0))
+                moves.append(GcodeMove(ln_nbr, motion, x, y, z, i, j, k, plane, feed, tool, section))
+                movement_col.append(movement)
+                position = (x, y, z)
+    columns = moves_to_arrays(moves)
+    columns["movement"] = np.array(movement_col, dtype=np.int64)
+    normal_columns = np.array(normals, dtype=np.float64).reshape(-1, 3)
+    for name, column in zip(("nx", "ny", "nz"), normal_columns.T):
+        columns[name] = column
+    return DmpDump(parameters, columns, sections, tool_changes, movements, section_parameters)
+
+
+def dmp_program(dump: DmpDump) -> GcodeProgram:
+    """Return the toolpath of a dump as a parsed program, e.g. for gcode_explain.cycle_time.estimate_cycle_time."""
+    return GcodeProgram(dump.moves, dump.sections, dump.tool_changes)
+
+
+def distance_to_move(
+    point: np.ndarray,
+    start: np.ndarray,
+    end: np.ndarray,
+    center: np.ndarray | None = None,
+    plane: int = 17,
+) -> float:
+    """Return the distance of a point to a move: to its segment, or to the circle of an arc.
+
+    :param point: the x, y, z of the point
+    :param start: the x, y, z of the start of the move, nan when unknown (any point is then on the move)
+    :param end: the x, y, z of the end of the move
+    :param center: the x, y, z of the center of an arc, None for a straight move
+    :param plane: the plane of an arc: 17, 18 or 19, 0 for another plane (the plane of its start, end & center)
+    """
+    if np.any(np.isnan(start)):
+        # the first move of a program, from an unknown position, e.g. written as an XY then a Z move
+        return 0.0
+    if center is None:
+        seg = end - start
+        rel = point - start
+        seg_sq = float(seg @ seg)
+        t = min(max(float(rel @ seg) / seg_sq, 0.0), 1.0) if seg_sq > 0 else 0.0
+        return float(np.linalg.norm(rel - t * seg))
+    rel = point - center
+    radius_vec = end - center
+    if plane in PLANE_NORMALS:
+        # the distance in the plane, a helix rises along the normal
+        normal = np.array(PLANE_NORMALS[plane], dtype=np.float64)
+        rel = rel - (rel @ normal) * normal
+        radius_vec = radius_vec - (radius_vec @ normal) * normal
+        return abs(float(np.linalg.norm(rel)) - float(np.linalg.norm(radius_vec)))
+    normal = np.cross(start - center, radius_vec)
+    normal = normal / np.linalg.norm(normal) if np.linalg.norm(normal) > 1e-12 else np.zeros(3)
+    height = float(rel @ normal)
+    return math.hypot(height, float(np.linalg.norm(rel - height * normal)) - float(np.linalg.norm(radius_vec)))
+
+
+def cross_check(
+    dump: DmpDump,
+    program: GcodeProgram,
+    tol: float = 0.002,
+    feed_tol: float = 0.5,
+    max_split: int = 100,
+    resync: int = 50,
+) -> CrossCheck:
+    """Compare the moves of a post dump with the moves of the program written from it.
+
+    Each move of the dump is matched with the next moves of the program: the last one must end at the end of
+    the dump's move, and the ones before it (when the post split the move) must end on it. The motions must
+    agree: arcs in the same direction, around the same center, straight moves with straight moves (a rapid may be
+    written as a feed move, Fusion's personal use license writes the rapids as feed moves at the cutting feed).
+    An arc of the dump may also be written as straight moves (linearized), e.g. an arc out of the XY, ZX & YZ
+    planes, or a small arc. A move shorter than the tolerance may be dropped. When a move of the dump is not
+    found, the moves of the program are searched ahead for its end point, to resynchronize: the moves skipped are
+    reported as extra, or the dump's move as missing if its end is not found.
+
+    :param dump: the parsed post dump
+    :param program: the parsed program
+    :param tol: the largest distance between the positions of the dump and of the program, in mm (the posts round
+        the coordinates to 3 decimals)
+    :param feed_tol: the largest difference between the feed rates, in mm/min
+    :param max_split: the largest number of moves of the program a move of the dump can be split into
+    :param resync: the number of moves of the program searched ahead to resynchronize
+    :return: the counts of the moves matched, and the differences found
+    """
+    dmp, gcode = dump.moves, program.moves
+    dmp_xyz = np.column_stack([dmp["x"], dmp["y"], dmp["z"]])
+    dmp_ijk = np.column_stack([dmp["i"], dmp["j"], dmp["k"]])
+    gcode_xyz = np.column_stack([gcode["x"], gcode["y"], gcode["z"]])
+    dmp_count, gcode_count = len(dmp_xyz), len(gcode_xyz)
+    divergences = []
+    matched = split = linearized = 0
+
+    def ends_at(nbr: int, point: np.ndarray) -> bool:
+        """Return True if the move nbr of the program ends at the point (the axes not known yet never match)."""
+        return bool(np.all(np.abs(gcode_xyz[nbr] - point) <= tol))
+
+    start = np.full(3, np.nan)
+    gcode_nbr = 0
+    for nbr in range(dmp_count):
+        end = dmp_xyz[nbr]
+        motion = int(dmp["motion"][nbr])
+        arc = motion in (CW_ARC, CCW_ARC)
+        center = start + dmp_ijk[nbr] if arc else None
+        dmp_ln_nbr = int(dmp["ln_nbr"][nbr])
+        # the moves of the program the dump's move was written as
+        last = gcode_nbr
+        while last < min(gcode_nbr + max_split, gcode_count) and not ends_at(last, end):
+            if distance_to_move(gcode_xyz[last], start, end, center, int(dmp["plane"][nbr])) > tol:
+                break
+            last += 1
+        if (last >= gcode_count or not ends_at(last, end)) and np.all(np.abs(end - start) <= tol):
+            matched += 1  # a move shorter than the rounding of the coordinates, the post may drop it
+            start = end
+            continue
+        if last >= gcode_count or not ends_at(last, end):
+            ahead = [
+                later for later in range(gcode_nbr, min(gcode_nbr + resync, gcode_count)) if ends_at(later, end)
+            ]
+            if gcode_nbr < gcode_count:
+                deviation = float(np.nanmax(np.abs(gcode_xyz[gcode_nbr] - end)))
+                divergences.append(Divergence(dmp_ln_nbr, int(gcode["ln_nbr"][gcode_nbr]), "position", deviation))
+            if not ahead:
+                divergences.append(Divergence(dmp_ln_nbr, -1, "missing", 0.0))
+                start = end
+                continue
+            for extra in range(gcode_nbr, ahead[0]):
+                divergences.append(Divergence(-1, int(gcode["ln_nbr"][extra]), "extra", 0.0))
+            gcode_nbr = last = ahead[0]
+        matched += 1
+        split += last > gcode_nbr
+        pieces = range(gcode_nbr, last + 1)
+        gcode_motions = [int(gcode["motion"][piece]) for piece in pieces]
+        if arc and all(gcode_motion in (RAPID, LINEAR) for gcode_motion in gcode_motions):
+            linearized += 1
+            gcode_motions = [motion] * len(pieces)  # the pieces were checked to be on the arc
+        for piece, gcode_motion in zip(pieces, gcode_motions):
+            gcode_ln_nbr = int(gcode["ln_nbr"][piece])
+            if gcode_motion != motion and (arc or gcode_motion in (CW_ARC, CCW_ARC)):
+                divergences.append(Divergence(dmp_ln_nbr, gcode_ln_nbr, "motion", 0.0))
+            elif arc and int(gcode["motion"][piece]) == motion:
+                piece_start = gcode_xyz[piece - 1] if piece else np.full(3, np.nan)
+                offset = (gcode["i"][piece], gcode["j"][piece])
+                deviation = float(np.max(np.abs(piece_start[:2] + offset - center[:2])))
+                if not deviation <= tol:
+                    divergences.append(Divergence(dmp_ln_nbr, gcode_ln_nbr, "center", deviation))
+            if gcode_motion != RAPID and motion != RAPID:
+                deviation = abs(float(gcode["feed"][piece]) - float(dmp["feed"][nbr]))
+                if deviation > feed_tol:
+                    divergences.append(Divergence(dmp_ln_nbr, gcode_ln_nbr, "feed", deviation))
+        gcode_nbr = last + 1
+        start = end
+    for extra in range(gcode_nbr, gcode_count):
+        divergences.append(Divergence(-1, int(gcode["ln_nbr"][extra]), "extra", 0.0))
+    return CrossCheck(dmp_count, gcode_count, matched, split, linearized, divergences)
+
+
+def output_cross_check_report(check: CrossCheck, max_lines: int = 20) -> None:
+    """Prints out the result of a cross-check of a post dump with a program.
+
+    :param check: the result of cross_check
+    :param max_lines: the largest number of differences listed
+    """
+    print(f"dump moves: {check.dmp_moves}, program moves: {check.gcode_moves}")
+    print(f"\t{check.matched} moves matched, {check.split} of them split into several moves of the program")
+    print(f"\t{check.linearized} arcs written as straight moves")
+    if not check.divergences:
+        print("\tno divergence")
+        return
+    kinds: dict[str, int] = {}
+    for divergence in check.divergences:
+        kinds[divergence.kind] = kinds.get(divergence.kind, 0) + 1
+    print("\tdivergences: " + ", ".join(f"{count} {kind}" for kind, count in kinds.items()))
+    for divergence in check.divergences[:max_lines]:
+        dmp_at = f"dump line {divergence.dmp_ln_nbr}" if divergence.dmp_ln_nbr >= 0 else "not in the dump"
+        gcode_at = f"program line {divergence.gcode_ln_nbr}" if divergence.gcode_ln_nbr >= 0 else "not in the program"
+        print(f"\t{divergence.kind:>8}: {dmp_at:>18}, {gcode_at:>20}   {divergence.deviation:.4f}")
+    if len(check.divergences) > max_lines:
+        print(f"\t... {len(check.divergences) - max_lines} more")
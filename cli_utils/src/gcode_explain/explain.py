@@ -0,0 +1,409 @@
+"""G-code Explain: explains what each line of a G-code program does, in (hopefully) more clear English.
+
+The explainer streams a program 1 line at a time through the GcodeParser of gcode_explain.min_gcode_parser,
+so a program of any size can be explained in constant memory. For each line it explains:
+    * the moves: rapid or feed move, the end point, the delta from the previous point and the length. Arcs
+      also get their direction, center offsets, absolute center and radius, their length is measured along
+      the arc (and the helix).
+    * the modal state: units, plane, distance mode, work offset, spindle speed, and the feed rate changes
+    * the tool changes, the spindle start / stop and the program control codes
+    * the sections (operations), named by the comment line before their first block, and the comments
+
+The options suppress or display subsets of the lines, the same as the options of grbr-exp. Nothing is
+formatted for the lines that are not displayed, so a 50k line program is explained in a fraction of a second
+with the line output suppressed (e.g. --quiet --sect-sum, to only display the totals of each section).
+"""
+import argparse
+import math
+import os
+import re
+import sys
+from collections import namedtuple
+from typing import Iterable, TextIO
+
+from gcode_explain.min_gcode_parser import (
+    CCW_ARC,
+    COMMENT_RE,
+    CW_ARC,
+    MOTION_CODES,
+    PLANE_AXES,
+    RAPID,
+    WORD_RE,
+    GcodeMove,
+    GcodeParser,
+    arc_sweep,
+    comment_text,
+)
+
+# Tuple of the options that select the lines explained
+#   rapid_disp   - display the rapid moves (G0)
+#   feed_disp    - display the feed moves (G1, G2 & G3)
+#   state_disp   - display the modal state: units, plane, distance mode, work offset, spindle speed & feed rate
+#   tool_disp    - display the tool changes, the spindle start / stop and the program control codes
+#   comment_disp - display the comments
+#   section_disp - display the start of each section
+#   section_sum  - display the totals of each section after the program is explained
+ExplainOptions = namedtuple(
+    "ExplainOptions",
+    ["rapid_disp", "feed_disp", "state_disp", "tool_disp", "comment_disp", "section_disp", "section_sum"],
+    defaults=[True, True, True, True, False, True, False],
+)
+
+# Tuple with the totals of 1 section of a program
+#   name         - the name of the section, from the comment before its first block
+#   tool         - the number of the tool in the spindle at the end of the section
+#   moves        - the number of moves
+#   rapid_moves  - the number of rapid moves
+#   rapid_length - the length of the rapid moves, in mm
+#   feed_length  - the length of the feed moves, in mm
+#   feed_time    - the time of the feed moves at their feed rate, without accelerations, in seconds
+SectionTotals = namedtuple(
+    "SectionTotals", ["name", "tool", "moves", "rapid_moves", "rapid_length", "feed_length", "feed_time"]
+)
+
+# the text of the non modal & the program control codes that are explained
+G_CODE_TEXT = {
+    28: "return home (G28)",
+    40: "cutter radius compensation off (G40)",
+    43: "tool length offset (G43)",
+    49: "tool length offset cancel (G49)",
+    53: "move in machine coordinates (G53)",
+    54: "work offset 1 (G54)",
+    55: "work offset 2 (G55)",
+    56: "work offset 3 (G56)",
+    57: "work offset 4 (G57)",
+    58: "work offset 5 (G58)",
+    59: "work offset 6 (G59)",
+    80: "canned cycle cancel (G80)",
+    93: "feed rate mode to: inverse time (G93)",
+    94: "feed rate mode to: units per minute (G94)",
+}
+M_CODE_TEXT = {
+    0: "program stop (M0)",
+    1: "optional program stop (M1)",
+    2: "end of program (M2)",
+    3: "spindle on, clockwise (M3)",
+    4: "spindle on, counterclockwise (M4)",
+    5: "spindle stop (M5)",
+    7: "mist coolant on (M7)",
+    8: "flood coolant on (M8)",
+    9: "coolant off (M9)",
+    30: "end of program, rewind (M30)",
+}
+PLANE_TEXT = {17: "XY (G17)", 18: "ZX (G18)", 19: "YZ (G19)"}
+# the lines with codes that are explained from their words: M, S & T words, G codes other than the motions
+CODES_RE = re.compile(r"[MST]|G\s*0*[1-9]\d")
+# the number of explanation lines written out at a time
+WRITE_BATCH = 4096
+
+
+def fmt(value: float) -> str:
+    """Return a coordinate formatted in a 10 characters column, ? for a position that is not known yet."""
+    return f"{value:>10.3f}" if not math.isnan(value) else f"{'?':>10}"
+
+
+def arc_geometry(start: tuple[float, float, float], move: GcodeMove) -> tuple[list[float], float, float]:
+    """Return the center, the radius and the length of an arc move.
+
+    :param start: the x, y, z of the start of the arc
+    :param move: the arc move
+    :return: tuple of: the x, y, z of the center (at the start's height along the plane's normal), the radius,
+        the length along the arc
+    """
+    p_axis, q_axis, n_axis = PLANE_AXES.get(move.plane, PLANE_AXES[17])
+    end = (move.x, move.y, move.z)
+    offsets = (move.i, move.j, move.k)
+    cp, cq = start[p_axis] + offsets[p_axis], start[q_axis] + offsets[q_axis]
+    radius = math.hypot(start[p_axis] - cp, start[q_axis] - cq)
+    angle_0 = math.atan2(start[q_axis] - cq, start[p_axis] - cp)
+    angle_1 = math.atan2(end[q_axis] - cq, end[p_axis] - cp)
+    sweep = arc_sweep(angle_0, angle_1, move.motion == CCW_ARC)
+    center = list(start)
+    center[p_axis], center[q_axis] = cp, cq
+    return center, radius, math.hypot(radius * sweep, end[n_axis] - start[n_axis])
+
+
+class GcodeExplainer:
+    """Streaming G-code explainer, writes the explanation of each line of a program as it is read."""
+
+    def __init__(self, options: ExplainOptions = ExplainOptions(), out: TextIO | None = None):
+        """Create an explainer.
+
+        :param options: the options that select the lines explained
+        :param out: the text file the explanations are written to, defaults to stdout
+        """
+        self.options = options
+        self.out = out or sys.stdout
+        self.parser = GcodeParser()
+        self.buffer: list[str] = []
+        self.section = -1
+        self.totals: dict[int, list] = {}
+
+    @property
+    def section_totals(self) -> list[SectionTotals]:
+        """Return the totals of each section explained so far, in order, only kept with options.section_sum."""
+        return [SectionTotals(*totals) for _, totals in sorted(self.totals.items())]
+
+    def explain_lines(self, lines: Iterable[str]) -> None:
+        """Explain the lines of a program, writing out the explanations as they are made."""
+        for ln_nbr, line in enumerate(lines, 1):
+            self.explain_line(ln_nbr, line)
+            if len(self.buffer) >= WRITE_BATCH:
+                self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        """Write out the explanations made so far."""
+        if self.buffer:
+            self.out.write("\n".join(self.buffer) + "\n")
+            self.buffer.clear()
+
+    def explain_line(self, ln_nbr: int, line: str) -> None:
+        """Explain 1 line of a program, and add its move to the totals of its section.
+
+        :param ln_nbr: the line number of the line
+        :param line: the text of the line
+        """
+        options, parser = self.options, self.parser
+        start = (parser.x, parser.y, parser.z)
+        feed = parser.feed
+        move = parser.parse_line(ln_nbr, line)
+
+        if parser.section != self.section:
+            self.section = parser.section
+            if options.section_disp:
+                self.buffer.append(f"[{ln_nbr:0>3}] SECTION: {parser.sections[self.section]}")
+        has_comment = "(" in line or ";" in line
+        if options.comment_disp and has_comment:
+            self.buffer.append(f"[{ln_nbr:0>3}] COMMENT: {comment_text(line)}")
+        if options.state_disp and parser.feed != feed and not math.isnan(parser.feed):
+            self.buffer.append(f"[{ln_nbr:0>3}] SET: feed rate to {parser.feed:g} mm/min")
+        if options.state_disp or options.tool_disp:
+            code = COMMENT_RE.sub(" ", line).upper() if has_comment else line.upper()
+            # most lines are moves, their words are only explained again when they have other codes
+            if move is None or CODES_RE.search(code):
+                self.explain_codes(ln_nbr, code)
+        # the moves are only measured to be displayed or added to the section totals
+        if move is not None and (options.rapid_disp or options.feed_disp or options.section_sum):
+            self.add_move(ln_nbr, start, move)
+
+    def explain_codes(self, ln_nbr: int, code: str) -> None:
+        """Explain the codes of a line (without comments), other than the motions, the axes & the feed rate."""
+        options, parser = self.options, self.parser
+        for letter, value in WORD_RE.findall(code):
+            if letter == "G" and options.state_disp:
+                number = float(value)
+                if number in PLANE_TEXT:
+                    self.buffer.append(f"[{ln_nbr:0>3}] SET: arc plane to {PLANE_TEXT[number]}")
+                elif number in (20, 21):
+                    self.buffer.append(f"[{ln_nbr:0>3}] SET: units to {'inch (G20)' if number == 20 else 'mm (G21)'}")
+                elif number in (90, 91):
+                    distance = "absolute (G90)" if number == 90 else "incremental (G91)"
+                    self.buffer.append(f"[{ln_nbr:0>3}] SET: distance mode to {distance}")
+                elif number in G_CODE_TEXT:
+                    self.buffer.append(f"[{ln_nbr:0>3}] SET: {G_CODE_TEXT[number]}")
+                elif number not in MOTION_CODES:
+                    self.buffer.append(f"[{ln_nbr:0>3}] SET: G{value} (not explained)")
+            elif letter == "S" and options.state_disp:
+                self.buffer.append(f"[{ln_nbr:0>3}] SET: spindle speed to {parser.spindle_speed:g} rpm")
+            elif letter == "T" and options.tool_disp:
+                self.buffer.append(f"[{ln_nbr:0>3}] TOOL: select tool T{parser.next_tool}")
+            elif letter == "M" and options.tool_disp:
+                number = int(float(value))
+                if number == 6:
+                    self.buffer.append(f"[{ln_nbr:0>3}] TOOL: change to tool T{parser.tool} (M6)")
+                elif number in M_CODE_TEXT:
+                    self.buffer.append(f"[{ln_nbr:0>3}] PROGRAM: {M_CODE_TEXT[number]}")
+                else:
+                    self.buffer.append(f"[{ln_nbr:0>3}] PROGRAM: M{number} (not explained)")
+
+    def add_move(self, ln_nbr: int, start: tuple[float, float, float], move: GcodeMove) -> None:
+        """Add a move to its section's totals (with section_sum), and explain it if its kind of move is displayed."""
+        options = self.options
+        rapid = move.motion == RAPID
+        displayed = options.rapid_disp if rapid else options.feed_disp
+        if not (displayed or options.section_sum):
+            return
+        arc = move.motion in (CW_ARC, CCW_ARC)
+        if arc:
+            center, radius, length = arc_geometry(start, move)
+        else:
+            end = (move.x, move.y, move.z)
+            length = math.dist(start, end)
+            if math.isnan(length):
+                # the axes whose position is not known yet do not move
+                length = math.hypot(*(value - begin for begin, value in zip(start, end) if not math.isnan(begin)))
+        length = 0.0 if math.isnan(length) else length
+        if options.section_sum:
+            self.add_totals(move, rapid, length)
+
+        if not displayed:
+            return
+        x, y, z = move.x, move.y, move.z
+        position = f"{fmt(x)}, {fmt(y)}, {fmt(z)}"
+        delta = f"{fmt(x - start[0])}, {fmt(y - start[1])}, {fmt(z - start[2])}"
+        if rapid:
+            self.buffer.append(f"[{ln_nbr:0>3}] RAPID to: {position}  {delta}     len: {length:.3f}")
+        elif not arc:
+            self.buffer.append(f"[{ln_nbr:0>3}] FEED to:  {position}  {delta}     len: {length:.3f}   F{move.feed:g}")
+        else:
+            direction = "CW " if move.motion == CW_ARC else "CCW"
+            # the arcs in the XY plane only have I & J offsets, their center is shown in x, y
+            axes = 3 if move.plane != 17 else 2
+            offsets = ", ".join(f"{value:g}" for value in (move.i, move.j, move.k)[:axes])
+            center_text = ", ".join(f"{value:.3f}" for value in center[:axes])
+            self.buffer.append(
+                f"[{ln_nbr:0>3}] ARC {direction}:  {position}  {delta}     len: {length:.3f}   F{move.feed:g}"
+                f"     (offset: {offsets}  center: {center_text}  radius: {radius:.3f})"
+            )
+
+    def add_totals(self, move: GcodeMove, rapid: bool, length: float) -> None:
+        """Add a move, of a length in mm, to the totals of its section."""
+        totals = self.totals.get(move.section)
+        if totals is None:
+            name = self.parser.sections[move.section] if move.section >= 0 else "(before the first section)"
+            totals = self.totals[move.section] = [name, move.tool, 0, 0, 0.0, 0.0, 0.0]
+        totals[1] = move.tool
+        totals[2] += 1
+        if rapid:
+            totals[3] += 1
+            totals[4] += length
+        else:
+            totals[5] += length
+            if move.feed > 0:
+                totals[6] += length / move.feed * 60
+
+
+
+def output_section_summary(section_totals: list[SectionTotals]) -> None:
+    """Prints out the totals of each section of a program.
+
+    :param section_totals: the totals, as returned by GcodeExplainer.section_totals
+    """
+    print("-" * 100)
+    print(
+        f"{'section':<30} {'tool':>4} {'moves':>8} {'rapids':>8} {'rapid len':>12} {'feed len':>12} {'feed time':>10}"
+    )
+    for totals in section_totals:
+        minutes, seconds = divmod(totals.feed_time, 60)
+        print(
+            f"{totals.name[:30]:<30} {'T' + str(totals.tool):>4} {totals.moves:>8} {totals.rapid_moves:>8} "
+            f"{totals.rapid_length:>12.3f} {totals.feed_length:>12.3f} {int(minutes):>4}:{seconds:06.3f}"
+        )
+    if len(section_totals) > 1:
+        feed_time = sum(totals.feed_time for totals in section_totals)
+        minutes, seconds = divmod(feed_time, 60)
+        print(
+            f"{'total':<30} {'':>4} {sum(totals.moves for totals in section_totals):>8} "
+            f"{sum(totals.rapid_moves for totals in section_totals):>8} "
+            f"{sum(totals.rapid_length for totals in section_totals):>12.3f} "
+            f"{sum(totals.feed_length for totals in section_totals):>12.3f} {int(minutes):>4}:{seconds:06.3f}"
+        )
+
+
+def get_args(args_list: list[str] | None = None) -> argparse.Namespace:
+    """Get the command line arguments passed in.
+
+    :param args_list: for testing/development only
+    :return: the list of arguments passed in
+
+    there is 1 required positional argument, and that is the G-code file name path to be explained.
+    There are a number of options that select what is output, they mirror the options of grbr-exp.
+    """
+    parser = argparse.ArgumentParser(
+        prog="G-code To English",
+        description="will explain what each line of a G-code file does",
+        epilog="Its better to burn out than fade away...",
+    )
+    parser.add_argument("gcode_filename", help="The Name of the G-code File to explain")
+    parser.add_argument(
+        "-r",
+        "--no-rapid",
+        action="store_false",
+        dest="rapid_disp",
+        help="pass --no-rapid to suppress the display of rapid moves (G0)",
+    )
+    parser.add_argument(
+        "-e",
+        "--no-feed",
+        action="store_false",
+        dest="feed_disp",
+        help="pass --no-feed to suppress the display of feed moves (G1, G2 & G3)",
+    )
+    parser.add_argument(
+        "-s",
+        "--no-state",
+        action="store_false",
+        dest="state_disp",
+        help="pass --no-state to suppress the display of modal state changes (units, plane, offset, feed, speed)",
+    )
+    parser.add_argument(
+        "-m",
+        "--no-tool",
+        action="store_false",
+        dest="tool_disp",
+        help="pass --no-tool to suppress the display of tool changes, spindle & program control codes",
+    )
+    parser.add_argument(
+        "-c", "--with-cmnt", action="store_true", dest="comment_disp", help="pass --with-cmnt to display comments"
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        dest="quiet",
+        help="pass --quiet to suppress the display of every line, e.g. to only display the section totals",
+    )
+    parser.add_argument(
+        "-O",
+        "--sect-sum",
+        action="store_true",
+        dest="section_sum",
+        help="pass --sect-sum to display the totals of each section after the file is explained",
+    )
+    return parser.parse_args(args_list)
+
+
+def options_from_args(args: argparse.Namespace) -> ExplainOptions:
+    """Return the explain options selected by the command line arguments."""
+    shown = not args.quiet
+    return ExplainOptions(
+        rapid_disp=args.rapid_disp and shown,
+        feed_disp=args.feed_disp and shown,
+        state_disp=args.state_disp and shown,
+        tool_disp=args.tool_disp and shown,
+        comment_disp=args.comment_disp and shown,
+        section_disp=shown,
+        section_sum=args.section_sum,
+    )
+
+
+def explain_gcode_file(gcode_fn: str, options: ExplainOptions = ExplainOptions(), out: TextIO | None = None):
+    """Explain a G-code file, 1 line at a time.
+
+    :param gcode_fn: the file name path of the G-code file
+    :param options: the options that select the lines explained
+    :param out: the text file the explanations are written to, defaults to stdout
+    :return: the explainer, with the totals of each section when options.section_sum is set
+    """
+    explainer = GcodeExplainer(options, out)
+    with open(gcode_fn, "r", buffering=1 << 16) as gcode_fh:
+        explainer.explain_lines(gcode_fh)
+    return explainer
+
+
+def main(args_list: list[str] | None = None):
+    args = get_args(args_list)
+    options = options_from_args(args)
+
+    print("-" * 100)
+    print(f"Explaining G-code file: {os.path.basename(args.gcode_filename)}")
+    print("-" * 100)
+    explainer = explain_gcode_file(args.gcode_filename, options)
+
+    if options.section_sum:
+        output_section_summary(explainer.section_totals)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""Offline check of a G-code program against the travel of the machine, the stock and the depth of its tools.
+
+Before a job is sent to the machine, the checker flags the moves that would crash or ruin it, with their
+exact line numbers:
+    * the moves outside the work envelope: the travel of the machine, in work coordinates (see
+      work_envelope), arcs included by the extremes of their sweep
+    * the moves below the ZMIN of their tool, from the tool comments of the program header, e.g.
+      (T1  D=3.175 CR=0 - ZMIN=-12 - flat end mill)
+    * the rapid moves (G0) that go below the safe height while over the stock: the segment of each rapid is
+      clipped against the box of the stock up to the safe height. The rapids straight up (retracts) are not
+      flagged.
+The program is parsed in batch mode (see gcode_explain.min_gcode_parser.parse_gcode_arrays) and every check
+runs on the columns of all the moves at once, so a program is checked at about the speed it is parsed.
+check_gcode_files checks the files of a pipeline in parallel, 1 worker process per file.
+"""
+import math
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from gcode_explain.min_gcode_parser import (
+    CCW_ARC,
+    CW_ARC,
+    MM_PER_INCH,
+    RAPID,
+    arc_sweeps,
+    parse_gcode_arrays,
+    plane_axes,
+)
+
+# the tool comments of the program header, with the tool number & the lowest z of the tool
+TOOL_ZMIN_RE = re.compile(rb"\(T(\d+)\s[^)\n]*?ZMIN=([-+\d.]+)")
+UNITS_RE = re.compile(rb"G\s*0*(2[01])(?!\d)")
+# the travel of the Carvera's axes, in mm
+CARVERA_TRAVEL = (360.0, 240.0, 140.0)
+
+# Tuple describing what a program is checked against, the coordinates are work coordinates, in mm
+#   envelope_min - the lowest x, y, z the machine can reach, None to not check the envelope
+#   envelope_max - the highest x, y, z the machine can reach
+#   stock_min    - the lowest x, y, z of the stock's box, None to not check the rapids
+#   stock_max    - the highest x, y, z of the stock's box
+#   safe_z       - the lowest z of the rapids over the stock, None for the top of the stock
+#   tol          - the distance a move can go past a limit without being flagged
+CheckLimits = namedtuple(
+    "CheckLimits",
+    ["envelope_min", "envelope_max", "stock_min", "stock_max", "safe_z", "tol"],
+    defaults=[None, None, None, None, None, 0.001],
+)
+
+# Tuple describing a move that fails a check
+#   ln_nbr - the line number of the move
+#   kind   - the check that failed: "envelope", "zmin" or "rapid"
+#   axis   - the axis of the value: "X", "Y" or "Z"
+#   value  - the value past the limit: the coordinate outside the envelope, the lowest z of the move, or the
+#            lowest z of the rapid over the stock
+#   limit  - the limit that was passed
+Violation = namedtuple("Violation", ["ln_nbr", "kind", "axis", "value", "limit"])
+
+# Tuple with the results of the check of a program
+#   lines      - the number of lines of the program
+#   moves      - the number of moves
+#   tool_zmins - dictionary of the ZMIN of each tool of the header, in mm
+#   violations - the moves that failed a check, in line order
+CheckResult = namedtuple("CheckResult", ["lines", "moves", "tool_zmins", "violations"])
+
+
+def work_envelope(
+    work_zero: tuple[float, float, float],
+    travel: tuple[float, float, float] = CARVERA_TRAVEL,
+) -> tuple[tuple[float, float, float], tuple[float, float, float]]:
+    """Return the work envelope of a machine: the travel of its axes, in work coordinates.
+
+    :param work_zero: the position of the work zero: its x & y from the low end of the x & y travel, and its
+        depth below the top of the z travel
+    :param travel: the travel of the x, y & z axes
+    :return: tuple of: the lowest x, y, z and the highest x, y, z
+    """
+    (zero_x, zero_y, depth), (travel_x, travel_y, travel_z) = work_zero, travel
+    return (-zero_x, -zero_y, depth - travel_z), (travel_x - zero_x, travel_y - zero_y, depth)
+
+
+def move_bounds(moves: dict[str, np.ndarray]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the start point and the box around the path of each move, arcs included by their sweep.
+
+    The start point of a move is the end point of the move before it, which was checked with that move: the
+    box of a linear move is its end point, the box of an arc also has the extremes of its sweep.
+
+    :param moves: the columns of the moves, as returned by the G-code parser
+    :return: tuple of: the start points (nan for the axes not known yet), the lowest x, y, z and the highest
+        x, y, z of each move (n x 3)
+    """
+    ends = np.column_stack((moves["x"], moves["y"], moves["z"]))
+    starts = np.vstack((np.full((1, 3), np.nan), ends[:-1]))
+    low, high = ends.copy(), ends.copy()
+
+    arcs = np.flatnonzero((moves["motion"] == CW_ARC) | (moves["motion"] == CCW_ARC))
+    arcs = arcs[~np.isnan(starts[arcs]).any(axis=1)]
+    if len(arcs):
+        # the 2 in-plane axes (p, q) of each arc's plane
+        p_axis, q_axis, _ = plane_axes(moves["plane"][arcs])
+        rows = np.arange(len(arcs))
+        offsets = np.column_stack((moves["i"][arcs], moves["j"][arcs], moves["k"][arcs]))
+        arc_starts, arc_ends = starts[arcs], ends[arcs]
+        (p_0, q_0), (p_1, q_1) = ((points[rows, p_axis], points[rows, q_axis]) for points in (arc_starts, arc_ends))
+        cp, cq = p_0 + offsets[rows, p_axis], q_0 + offsets[rows, q_axis]
+        radius = np.hypot(p_0 - cp, q_0 - cq)
+        angle_0, angle_1 = np.arctan2(q_0 - cq, p_0 - cp), np.arctan2(q_1 - cq, p_1 - cp)
+        ccw = moves["motion"][arcs] == CCW_ARC
+        sweep = arc_sweeps(angle_0, angle_1, ccw)
+
+        def passes(angle: float) -> np.ndarray:
+            """Return True for the arcs whose sweep passes an angle, where they reach the extreme of an axis."""
+            return np.where(ccw, angle - angle_0, angle_0 - angle) % (2 * math.pi) <= sweep
+
+        arc_low, arc_high = arc_ends.copy(), arc_ends.copy()
+        arc_high[rows, p_axis] = np.where(passes(0.0), np.fmax(p_1, cp + radius), p_1)
+        arc_high[rows, q_axis] = np.where(passes(0.5 * math.pi), np.fmax(q_1, cq + radius), q_1)
+        arc_low[rows, p_axis] = np.where(passes(math.pi), np.fmin(p_1, cp - radius), p_1)
+        arc_low[rows, q_axis] = np.where(passes(1.5 * math.pi), np.fmin(q_1, cq - radius), q_1)
+        low[arcs], high[arcs] = arc_low, arc_high
+    return starts, low, high
+
+
+def rapid_over_stock(
+    starts: np.ndarray,
+    ends: np.ndarray,
+    box_min: np.ndarray,
+    box_max: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Clip the straight segments of moves against a box, all the segments at once (Liang-Barsky).
+
+    :param starts: the start points of the segments (n x 3), a segment with an unknown start is its end point
+    :param ends: the end points of the segments (n x 3)
+    :param box_min: the lowest x, y, z of the box
+    :param box_max: the highest x, y, z of the box
+    :return: tuple of: True for the segments that go into the box, and the lowest z of each segment in it
+    """
+    starts = np.where(np.isnan(starts), ends, starts)
+    delta = ends - starts
+    t_in, t_out = np.zeros(len(ends)), np.ones(len(ends))
+    for axis in range(3):
+        d = delta[:, axis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_0 = (box_min[axis] - starts[:, axis]) / d
+            t_1 = (box_max[axis] - starts[:, axis]) / d
+        moving = d != 0
+        inside = (starts[:, axis] >= box_min[axis]) & (starts[:, axis] <= box_max[axis])
+        t_in = np.where(moving, np.fmax(t_in, np.fmin(t_0, t_1)), np.where(inside, t_in, np.inf))
+        t_out = np.where(moving, np.fmin(t_out, np.fmax(t_0, t_1)), t_out)
+    hit = t_in <= t_out
+    # z is linear along the segment, its lowest point in the box is at one of the clipped ends
+    z_in = starts[:, 2] + np.clip(t_in, 0, 1) * delta[:, 2]
+    z_out = starts[:, 2] + np.clip(t_out, 0, 1) * delta[:, 2]
+    return hit, np.fmin(z_in, z_out)
+
+
+def header_tool_zmins(data: bytes) -> dict[int, float]:
+    """Return the ZMIN of each tool of the tool comments of a program, in mm.
+
+    :param data: the bytes of the program
+    :return: dictionary of the ZMIN by tool number
+    """
+    units = UNITS_RE.search(data)
+    scale = MM_PER_INCH if units and units.group(1) == b"20" else 1.0
+    return {int(tool): float(zmin) * scale for tool, zmin in TOOL_ZMIN_RE.findall(data)}
+
+
+def check_gcode_file(gcode_fn: str, limits: CheckLimits) -> CheckResult:
+    """Check a G-code program against the work envelope, the ZMIN of its tools and the stock.
+
+    :param gcode_fn: the file name path of the G-code file
+    :param limits: what the program is checked against
+    :return: the results of the check
+    """
+    with open(gcode_fn, "rb") as gcode_fh:
+        data = gcode_fh.read()
+    tool_zmins = header_tool_zmins(data)
+    moves = parse_gcode_arrays(gcode_fn, data).moves
+    ln_nbrs = moves["ln_nbr"]
+    starts, low, high = move_bounds(moves)
+    ends = np.column_stack((moves["x"], moves["y"], moves["z"]))
+    tol = limits.tol
+    found = []  # tuples of: the indexes of the moves, kind, axis, values, limits
+
+    if limits.envelope_min is not None:
+        for axis, letter in enumerate("XYZ"):
+            for values, limit, past in (
+                (low[:, axis], limits.envelope_min[axis], low[:, axis] < limits.envelope_min[axis] - tol),
+                (high[:, axis], limits.envelope_max[axis], high[:, axis] > limits.envelope_max[axis] + tol),
+            ):
+                nbrs = np.flatnonzero(past)
+                found.append((nbrs, "envelope", letter, values[nbrs], np.full(len(nbrs), limit)))
+
+    if tool_zmins:
+        tools = np.array(sorted(tool_zmins))
+        zmin_lkp = np.full(tools.max() + 1, np.nan)
+        zmin_lkp[tools] = [tool_zmins[tool] for tool in tools]
+        tool_col = np.clip(moves["tool"], 0, len(zmin_lkp) - 1)
+        zmins = np.where(moves["tool"] < len(zmin_lkp), zmin_lkp[tool_col], np.nan)
+        nbrs = np.flatnonzero(low[:, 2] < zmins - tol)
+        found.append((nbrs, "zmin", "Z", low[nbrs, 2], zmins[nbrs]))
+
+    if limits.stock_min is not None:
+        safe_z = limits.stock_max[2] if limits.safe_z is None else limits.safe_z
+        rapids = np.flatnonzero(moves["motion"] == RAPID)
+        box_min = np.array((*limits.stock_min[:2], -np.inf))
+        box_max = np.array((*limits.stock_max[:2], safe_z - tol))
+        hit, lowest = rapid_over_stock(starts[rapids], ends[rapids], box_min, box_max)
+        # a rapid straight up is a retract, out of the stock
+        retract = (starts[rapids, 0] == ends[rapids, 0]) & (starts[rapids, 1] == ends[rapids, 1])
+        retract &= starts[rapids, 2] < ends[rapids, 2]
+        hit &= ~np.isnan(ends[rapids]).any(axis=1) & ~retract
+        found.append((rapids[hit], "rapid", "Z", lowest[hit], np.full(int(hit.sum()), safe_z)))
+
+    violations = [
+        Violation(int(ln_nbrs[nbr]), kind, axis, float(value), float(limit))
+        for nbrs, kind, axis, values, limit_values in found
+        for nbr, value, limit in zip(nbrs.tolist(), values.tolist(), limit_values.tolist())
+    ]
+    violations.sort(key=lambda violation: violation.ln_nbr)
+    return CheckResult(data.count(b"\n") + (not data.endswith(b"\n")), len(ln_nbrs), tool_zmins, violations)
+
+
+def check_gcode_files(
+    gcode_fns: list[str],
+    limits: CheckLimits,
+    max_workers: int | None = None,
+) -> dict[str, CheckResult]:
+    """Check several G-code programs in parallel, 1 worker process per file.
+
+    :param gcode_fns: the file name paths of the G-code files
+    :param limits: what the programs are checked against
+    :param max_workers: the number of worker processes, None for the number of CPUs, 1 to check the files in
+        this process
+    :return: dictionary of the results of each file, in the order of the files
+    """
+    if max_workers == 1 or len(gcode_fns) < 2:
+        return {gcode_fn: check_gcode_file(gcode_fn, limits) for gcode_fn in gcode_fns}
+    with ProcessPoolExecutor(max_workers) as executor:
+        return dict(zip(gcode_fns, executor.map(check_gcode_file, gcode_fns, [limits] * len(gcode_fns))))
+
+
+def output_check_report(result: CheckResult, max_violations: int = 20) -> None:
+    """Prints out the results of the check of a program.
+
+    :param result: the results returned by check_gcode_file
+    :param max_violations: the number of violations listed, of each kind
+    """
+    counts = {kind: sum(v.kind == kind for v in result.violations) for kind in ("envelope", "zmin", "rapid")}
+    status = "FAILED" if result.violations else "ok"
+    print(f"lines: {result.lines}   moves: {result.moves}   {status}")
+    print("\t" + "   ".join(f"{kind}: {count}" for kind, count in counts.items()))
+    listed = dict.fromkeys(counts, 0)
+    for violation in result.violations:
+        if listed[violation.kind] >= max_violations:
+            continue
+        listed[violation.kind] += 1
+        print(
+            f"\t[{violation.ln_nbr:0>3}] {violation.kind:<8} {violation.axis} {violation.value:>10.3f}"
+            f"   limit: {violation.limit:.3f}"
+        )
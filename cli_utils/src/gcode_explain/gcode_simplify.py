@@ -0,0 +1,143 @@
+"""Polyline simplification of G-code: the G1 moves that do not change the toolpath beyond a tolerance dropped.
+
+The simplifier rewrites a program 1 line at a time, like the arc fitter (see gcode_explain.arc_fit):
+    * consecutive G1 blocks, in the XY plane, in absolute mm coordinates and at the same feed, form a
+      polyline (in x, y & z), which is streamed through a window of a PolylineSimplifier
+    * the blocks of the points that are dropped are not written. The blocks that carry a G or an F word are
+      always kept, so the modal state does not change.
+    * the modal coordinates are kept correct: when a dropped block changed an axis that the next block
+      written does not have, the axis is added to it
+Only a window of moves is held in memory, so programs of any size can be simplified.
+"""
+import math
+from collections import namedtuple
+from typing import Iterable, Iterator
+
+from gcode_explain.arc_fit import run_move
+from gcode_explain.min_gcode_parser import COMMENT_RE, WORD_RE, GcodeParser
+from grbr_explain.simplify import PolylineSimplifier
+
+# Tuple with the counts of a G-code simplification
+#   blocks_in     - the number of blocks (lines with G-code words) read
+#   blocks_out    - the number of blocks written
+#   moves_removed - the number of G1 moves dropped
+#   max_deviation - the largest distance between the end point of a dropped move and the new toolpath
+GcodeSimplifyStats = namedtuple("GcodeSimplifyStats", ["blocks_in", "blocks_out", "moves_removed", "max_deviation"])
+
+
+class GcodeSimplifier:
+    """Streaming G-code simplifier, rewrites a program 1 line at a time."""
+
+    def __init__(self, tol: float = 0.002, method: str = "dp", window: int = 1000):
+        """Create a simplifier.
+
+        :param tol: the tolerance, in mm (see grbr_explain.simplify.simplify_points)
+        :param method: "dp" for Douglas-Peucker or "vw" for Visvalingam-Whyatt
+        :param window: the number of moves simplified at a time
+        """
+        self.simplifier = PolylineSimplifier(tol, method, window)
+        self.parser = GcodeParser()
+        self.in_run = False
+        self.run_feed = float("nan")
+        self.position = (math.nan, math.nan, math.nan)  # the position after the last line written
+        self.axis_text: dict[str, str] = {}  # the text of the last X, Y & Z words read
+        self.out: list[str] = []
+        self.blocks_in = self.blocks_out = self.moves_in = self.moves_out = 0
+
+    @property
+    def stats(self) -> GcodeSimplifyStats:
+        """Return the counts of the lines processed so far."""
+        return GcodeSimplifyStats(
+            self.blocks_in, self.blocks_out, self.moves_in - self.moves_out, self.simplifier.max_deviation
+        )
+
+    def process(self, lines: Iterable[str]) -> Iterator[str]:
+        """Rewrite the lines of a program, yielding the lines of the rewritten program, without line ends."""
+        for ln_nbr, line in enumerate(lines, 1):
+            line = line.rstrip("\r\n")
+            start = (self.parser.x, self.parser.y, self.parser.z)
+            move = self.parser.parse_line(ln_nbr, line)
+            words = WORD_RE.findall(COMMENT_RE.sub(" ", line).upper())
+            if words:
+                self.blocks_in += 1
+            if move is not None and run_move(self.parser, line) and not any(math.isnan(value) for value in start):
+                if self.in_run and self.parser.feed != self.run_feed:
+                    self.flush()
+                if not self.in_run:
+                    self.simplifier.push(start)  # the start of the run was written already
+                    self.in_run = True
+                    self.run_feed = self.parser.feed
+                self.moves_in += 1
+                keep = any(letter not in "XYZ" for letter, _ in words)
+                self.axis_text.update((letter, value) for letter, value in words if letter in "XYZ")
+                self.write_moves(self.simplifier.push((move.x, move.y, move.z), (line, dict(self.axis_text)), keep))
+            else:
+                self.flush()
+                self.axis_text.update((letter, value) for letter, value in words if letter in "XYZ")
+                self.position = (self.parser.x, self.parser.y, self.parser.z)
+                self.blocks_out += bool(words)
+                self.out.append(line)
+            yield from self.out
+            self.out.clear()
+        self.flush()
+        yield from self.out
+        self.out.clear()
+
+    def flush(self) -> None:
+        """Write the rest of the current run."""
+        if self.in_run:
+            self.write_moves(self.simplifier.finish())
+            self.in_run = False
+
+    def write_moves(self, moves: list[tuple[tuple, tuple[str, dict[str, str]] | None]]) -> None:
+        """Write the blocks of the moves kept, adding the axes changed by the moves dropped before them.
+
+        :param moves: the moves kept, as tuples of: the point, and the line of the move with the text of the
+            X, Y & Z words at the move (None for the start of a run, which was written already)
+        """
+        for point, item in moves:
+            if item is None:
+                continue
+            line, axis_text = item
+            letters = {letter for letter, _ in WORD_RE.findall(line.upper())}
+            # the axis words are copied as they were read, so they keep their precision
+            missing = [
+                f"{letter}{axis_text[letter]}"
+                for letter, value, before in zip("XYZ", point, self.position)
+                if letter not in letters and not abs(value - before) <= 1e-9
+            ]
+            self.out.append(" ".join([line] + missing))
+            self.position = point
+            self.blocks_out += 1
+            self.moves_out += 1
+
+
+def simplify_gcode_file(
+    gcode_fn: str,
+    out_fn: str,
+    tol: float = 0.002,
+    **kwargs,
+) -> GcodeSimplifyStats:
+    """Rewrite a G-code file with the G1 moves within the tolerance of the toolpath dropped.
+
+    :param gcode_fn: the file name path of the G-code file to read
+    :param out_fn: the file name path of the G-code file to write
+    :param tol: the tolerance, in mm
+    :param kwargs: the other parameters of GcodeSimplifier
+    :return: the counts of the blocks read & written
+    """
+    simplifier = GcodeSimplifier(tol, **kwargs)
+    with open(gcode_fn) as gcode_fh, open(out_fn, "w", buffering=1 << 16) as out_fh:
+        for line in simplifier.process(gcode_fh):
+            out_fh.write(line + "\n")
+    return simplifier.stats
+
+
+def output_simplify_report(stats: GcodeSimplifyStats) -> None:
+    """Prints out the block count reduction of a G-code simplification.
+
+    :param stats: the counts returned by simplify_gcode_file or GcodeSimplifier.stats
+    """
+    saved = 1 - stats.blocks_out / stats.blocks_in if stats.blocks_in else 0.0
+    print(f"blocks: {stats.blocks_in} -> {stats.blocks_out}   ({saved:.1%} fewer)")
+    print(f"\t{stats.moves_removed} G1 moves removed, max deviation: {stats.max_deviation:.4f} mm")
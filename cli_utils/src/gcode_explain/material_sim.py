@@ -0,0 +1,361 @@
+"""2.5D material removal simulation of a G-code program, on a height field.
+
+The stock is a height field: a raster grid of the x & y plane (see grbr_explain.raster, row 0 is the lowest y)
+with the height of the top of the material over each pixel, the stock's top before the program runs. Each
+move sweeps the flat bottom of its tool (the tool's disk, its diameter from the tool comments of the program
+header, e.g. (T1  D=3.175 CR=0 - ZMIN=-12 - flat end mill)) along its path, and lowers the pixels whose center
+is under the disk to the height of the tool:
+    * the arcs, helical or not and in any plane, are replaced by straight moves within a tolerance, and the
+      moves that go up or down (ramps, helices, plunges) are split into pieces that move z by less than a
+      z tolerance. Each piece cuts at its lowest z, rounded up to the z tolerance.
+    * the footprint of a straight piece is a capsule (the disk swept along the piece). It is computed exactly
+      on each row of pixels it covers, as the span of columns whose pixel centers are in it, for all the
+      pieces & rows at once. The spans lower the pixels through a sparse table of blocks of 2^k pixels (see
+      simulate_band): the cost does not grow with the number of times the tool passes over a pixel.
+    * the grid is cut into bands of rows, simulated independently: in parallel, 1 worker process per band
+The corner radius of a tool is not modelled, the tool cuts as a flat end mill of its diameter. The moves above
+the stock's top (the rapids, the clearance moves) do not cut.
+
+The heights can be compared with the mask of the material to remove, e.g. the target of
+pcb_cam.rest_machining, simulated on the grid of the mask (see removal_diff).
+"""
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from gcode_explain.gcode_checker import UNITS_RE
+from gcode_explain.min_gcode_parser import CCW_ARC, CW_ARC, MM_PER_INCH, arc_sweeps, parse_gcode_arrays, plane_axes
+from grbr_explain.raster import RasterGrid, grid_for_bbox
+
+# the tool comments of the program header, with the tool number & the diameter of the tool
+TOOL_DIA_RE = re.compile(rb"\(T(\d+)\s[^)\n]*?D=([-+\d.]+)")
+
+# Tuple with the pieces of the moves that cut, each piece is a straight move of the tool at a height, n values
+#   x0, y0 - the start of each piece
+#   x1, y1 - the end of each piece
+#   z      - the height of the tool along each piece, the lowest z of the piece
+#   radius - the radius of the tool of each piece
+SimPieces = namedtuple("SimPieces", ["x0", "y0", "x1", "y1", "z", "radius"])
+
+# Tuple with the results of a simulation
+#   grid       - the raster grid of the height field
+#   heights    - the height of the material over each pixel, float32 array of the grid's shape
+#   stock_top  - the height of the stock's top, the heights of the pixels that were not cut
+#   tool_dias  - dictionary of the diameter of each tool, in mm
+#   pieces     - the number of straight pieces the moves that cut were split into
+SimResult = namedtuple("SimResult", ["grid", "heights", "stock_top", "tool_dias", "pieces"])
+
+
+def header_tool_diameters(data: bytes) -> dict[int, float]:
+    """Return the diameter of each tool of the tool comments of a program, in mm.
+
+    :param data: the bytes of the program
+    :return: dictionary of the diameter by tool number
+    """
+    units = UNITS_RE.search(data)
+    scale = MM_PER_INCH if units and units.group(1) == b"20" else 1.0
+    return {int(tool): float(dia) * scale for tool, dia in TOOL_DIA_RE.findall(data)}
+
+
+def split_counts(counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the row of each piece of rows split into counts pieces, and the fraction 1 / n ... 1 it ends at."""
+    source = np.repeat(np.arange(len(counts)), counts)
+    first = np.cumsum(counts) - counts
+    return source, (np.arange(len(source)) - first[source] + 1) / counts[source]
+
+
+def cut_pieces(
+    moves: dict[str, np.ndarray],
+    tool_dias: dict[int, float],
+    stock_top: float,
+    tolerance: float,
+    z_tol: float,
+) -> SimPieces:
+    """Return the straight pieces of the moves that go below the stock's top.
+
+    :param moves: the columns of the moves, as returned by the G-code parser
+    :param tool_dias: dictionary of the diameter of each tool, in mm
+    :param stock_top: the height of the stock's top
+    :param tolerance: the largest distance between an arc and its straight pieces
+    :param z_tol: the largest change of z along a piece
+    :return: the pieces
+    """
+    ends = np.column_stack((moves["x"], moves["y"], moves["z"]))
+    starts = np.vstack((np.full((1, 3), np.nan), ends[:-1]))
+    known = ~np.isnan(starts).any(axis=1) & ~np.isnan(ends).any(axis=1)
+    cutting = known & (np.fmin(starts[:, 2], ends[:, 2]) < stock_top)
+    arcs = ((moves["motion"] == CW_ARC) | (moves["motion"] == CCW_ARC)) & known
+    cutting |= arcs  # an arc out of the XY plane can dip below its end points
+    nbrs = np.flatnonzero(cutting)
+    tools = moves["tool"][nbrs]
+    unknown = sorted(set(np.unique(tools).tolist()) - set(tool_dias))
+    if unknown:
+        raise ValueError(f"The diameter of the tools {unknown} is not known, add them to the tool diameters")
+    starts, ends, arcs = starts[nbrs], ends[nbrs], arcs[nbrs]
+
+    # the arcs are replaced by straight pieces, all the arcs at a time, in the 2 axes (p, q) of their plane.
+    # The 3rd axis of a helical arc moves linearly.
+    arc_nbrs = np.flatnonzero(arcs)
+    p_axis, q_axis, _ = plane_axes(moves["plane"][nbrs[arc_nbrs]])
+    offsets = np.column_stack((moves["i"], moves["j"], moves["k"]))[nbrs[arc_nbrs]]
+    rows = np.arange(len(arc_nbrs))
+    arc_starts, arc_ends = starts[arc_nbrs], ends[arc_nbrs]
+    cp = arc_starts[rows, p_axis] + offsets[rows, p_axis]
+    cq = arc_starts[rows, q_axis] + offsets[rows, q_axis]
+    radii = np.hypot(arc_starts[rows, p_axis] - cp, arc_starts[rows, q_axis] - cq)
+    start_angles = np.arctan2(arc_starts[rows, q_axis] - cq, arc_starts[rows, p_axis] - cp)
+    end_angles = np.arctan2(arc_ends[rows, q_axis] - cq, arc_ends[rows, p_axis] - cp)
+    ccw = moves["motion"][nbrs[arc_nbrs]] == CCW_ARC
+    sweeps = arc_sweeps(start_angles, end_angles, ccw)
+    sweeps = np.where(ccw, sweeps, -sweeps)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        steps = 2 * np.arccos(np.clip(1 - tolerance / radii, -1.0, 1.0))
+        arc_counts = np.nan_to_num(np.ceil(np.abs(sweeps) / steps), nan=1.0, posinf=1.0)
+    counts = np.ones(len(nbrs), dtype=np.int64)
+    counts[arc_nbrs] = np.where(radii > 1e-9, np.maximum(arc_counts, 1), 1)
+    source, t = split_counts(counts)
+    out_ends = ends[source]
+    out_arcs = np.flatnonzero(arcs[source] & (t < 1))
+    if len(out_arcs):
+        # the index of the arc of each piece, the last piece of an arc ends exactly at the arc's end
+        arc_idx = np.searchsorted(arc_nbrs, source[out_arcs])
+        angles = start_angles[arc_idx] + sweeps[arc_idx] * t[out_arcs]
+        arc_rows = arc_nbrs[arc_idx]
+        out_ends[out_arcs] = starts[arc_rows] + (ends[arc_rows] - starts[arc_rows]) * t[out_arcs, None]
+        out_ends[out_arcs, p_axis[arc_idx]] = cp[arc_idx] + radii[arc_idx] * np.cos(angles)
+        out_ends[out_arcs, q_axis[arc_idx]] = cq[arc_idx] + radii[arc_idx] * np.sin(angles)
+    first = np.r_[True, source[1:] != source[:-1]]
+    out_starts = np.vstack((out_ends[:1], out_ends[:-1]))
+    out_starts[first] = starts[source[first]]
+
+    # the pieces that move z are split, each piece cuts at its lowest z rounded up to a multiple of the z
+    # tolerance: the pieces of the turns of a helix merge at the same heights. A piece is not split shorter
+    # than the tolerance in x & y, a plunge cuts the disk of the tool at its lowest z.
+    deltas = out_ends - out_starts
+    splits = np.fmin(np.ceil(np.abs(deltas[:, 2]) / z_tol), np.ceil(np.hypot(deltas[:, 0], deltas[:, 1]) / tolerance))
+    splits = np.maximum(splits, 1).astype(np.int64)
+    rows, fractions = split_counts(splits)
+    piece_ends = out_starts[rows] + fractions[:, None] * deltas[rows]
+    piece_starts = piece_ends - deltas[rows] / splits[rows, None]
+    z = np.fmin(piece_starts[:, 2], piece_ends[:, 2])
+    z = np.where(deltas[rows, 2] != 0, np.ceil(z / z_tol - 1e-6) * z_tol, z)
+    below = z < stock_top
+    numbers = np.array(sorted(tool_dias), dtype=np.int64)
+    tool_radii = np.array([tool_dias[number] / 2 for number in numbers.tolist()], dtype=np.float64)
+    radius = tool_radii[np.searchsorted(numbers, tools)][source[rows]]
+    return SimPieces(
+        piece_starts[below, 0],
+        piece_starts[below, 1],
+        piece_ends[below, 0],
+        piece_ends[below, 1],
+        z[below],
+        radius[below],
+    )
+
+
+def capsule_spans(
+    y: np.ndarray,
+    x0: np.ndarray,
+    y0: np.ndarray,
+    x1: np.ndarray,
+    y1: np.ndarray,
+    radius: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the span of x of horizontal lines in capsules: the disks swept along straight pieces.
+
+    The capsule is convex, its span on a line is the hull of the chords of its 2 end disks and of the
+    crossings of its 2 sides, the sides of the piece offset by the radius.
+
+    :param y: the y of each line
+    :param x0: the x of the start of the piece of each line
+    :param y0: the y of the start of the piece of each line
+    :param x1: the x of the end of the piece of each line
+    :param y1: the y of the end of the piece of each line
+    :param radius: the radius of the disk of each line
+    :return: tuple of: the lowest and the highest x of each span, nan for the lines that miss their capsule
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # the chords of the end disks, nan on the lines that miss a disk
+        r_sq = radius * radius
+        half = np.sqrt(r_sq - (y - y0) ** 2)
+        low, high = x0 - half, x0 + half
+        half = np.sqrt(r_sq - (y - y1) ** 2)
+        low, high = np.fmin(low, x1 - half), np.fmax(high, x1 + half)
+        # the sides are the piece moved by +/- the normal of the length of the radius, each crosses the line at
+        # the fraction t of its length
+        dx, dy = x1 - x0, y1 - y0
+        scale = radius / np.hypot(dx, dy)
+        normal_x, normal_y = -dy * scale, dx * scale
+        rel_y = y - y0
+        for side in (1.0, -1.0):
+            t = (rel_y - side * normal_y) / dy
+            x = np.where((t >= 0) & (t <= 1), x0 + side * normal_x + t * dx, np.nan)
+            low, high = np.fmin(low, x), np.fmax(high, x)
+    return low, high
+
+
+def simulate_band(grid: RasterGrid, row_0: int, row_1: int, pieces: SimPieces, stock_top: float) -> np.ndarray:
+    """Return the heights of a band of rows of the grid, cut by the pieces.
+
+    :param grid: the raster grid of the height field
+    :param row_0: the first row of the band
+    :param row_1: the row after the last row of the band
+    :param pieces: the pieces that cut, at least the pieces over the band
+    :param stock_top: the height of the stock's top
+    :return: the heights of the band's rows, float32 array of (row_1 - row_0) x the grid's columns
+    """
+    cols = grid.shape[1]
+    # the rows of pixels whose center may be in the capsule of each piece
+    first = np.ceil((np.fmin(pieces.y0, pieces.y1) - pieces.radius - grid.origin_y) / grid.px - 0.5)
+    last = np.floor((np.fmax(pieces.y0, pieces.y1) + pieces.radius - grid.origin_y) / grid.px - 0.5) + 1
+    first = np.clip(first, row_0, row_1).astype(np.int64)
+    counts = np.clip(last, row_0, row_1).astype(np.int64) - first
+    counts = np.maximum(counts, 0)
+    source = np.repeat(np.arange(len(counts)), counts)
+    if not len(source):
+        return np.full((row_1 - row_0, cols), stock_top, dtype=np.float32)
+    rows = np.arange(len(source)) + np.repeat(first - (np.cumsum(counts) - counts), counts)
+    # the spans are computed in float32 pixel units from the grid's origin, exact to a thousandth of a pixel
+    # on grids of up to 10^4 pixels
+    scale = 1 / grid.px
+    x0, x1 = ((np.vstack((pieces.x0, pieces.x1)) - grid.origin_x) * scale).astype(np.float32)
+    y0, y1 = ((np.vstack((pieces.y0, pieces.y1)) - grid.origin_y) * scale).astype(np.float32)
+    low, high = capsule_spans(
+        (rows + 0.5).astype(np.float32),
+        x0[source],
+        y0[source],
+        x1[source],
+        y1[source],
+        (pieces.radius * scale).astype(np.float32)[source],
+    )
+    with np.errstate(invalid="ignore"):
+        col_0 = np.ceil(low - 0.5)
+        col_1 = np.floor(high - 0.5) + 1
+    keep = (col_0 < col_1) & (col_1 > 0) & (col_0 < cols)
+    rows, z = rows[keep] - row_0, pieces.z[source[keep]].astype(np.float32)
+    col_0 = np.clip(col_0[keep], 0, cols).astype(np.int64)
+    col_1 = np.clip(col_1[keep], 0, cols).astype(np.int64)
+
+    # each span lowers the 2 blocks of 2^k pixels that cover it (2^k <= its length < 2^(k + 1)) in level k
+    # of a sparse table, then the blocks of each level lower the 2 halves of their pixels in the level below.
+    # Level 0 is the lowest height of each pixel: the cost is the number of spans plus the number of pixels
+    # times the number of levels, however many spans overlap.
+    levels = int(np.max(col_1 - col_0, initial=1)).bit_length()
+    table = np.full((levels, row_1 - row_0, cols), np.inf, dtype=np.float32)
+    level = np.frexp(col_1 - col_0)[1] - 1
+    offsets = (level * (row_1 - row_0) + rows) * cols
+    flat = table.reshape(-1)
+    np.minimum.at(flat, offsets + col_0, z)
+    np.minimum.at(flat, offsets + col_1 - (1 << level), z)
+    for level in range(levels - 1, 0, -1):
+        half, blocks = 1 << (level - 1), cols - (1 << level) + 1
+        if blocks > 0:
+            np.minimum(table[level - 1, :, :blocks], table[level, :, :blocks], out=table[level - 1, :, :blocks])
+            below = table[level - 1, :, half : half + blocks]
+            np.minimum(below, table[level, :, :blocks], out=below)
+    return np.minimum(table[0], np.float32(stock_top))
+
+
+def simulate_gcode_file(
+    gcode_fn: str,
+    px: float = 0.02,
+    stock_top: float = 0.0,
+    grid: RasterGrid | None = None,
+    tool_dias: dict[int, float] | None = None,
+    tolerance: float | None = None,
+    z_tol: float = 0.01,
+    band_rows: int = 128,
+    max_workers: int | None = None,
+) -> SimResult:
+    """Simulate the material removed by a G-code program, on a height field.
+
+    :param gcode_fn: the file name path of the G-code file
+    :param px: the pixel size of the height field, in mm, when the grid is not given
+    :param stock_top: the height of the stock's top, in work coordinates
+    :param grid: the raster grid of the height field, e.g. the grid of a mask to compare with, None for a grid
+        covering the moves that cut
+    :param tool_dias: dictionary of the diameter of the tools, in mm, added to the diameters of the header
+    :param tolerance: the largest distance between an arc and its straight pieces, None for half a pixel
+    :param z_tol: the largest change of z of a piece, the heights of ramps and helices are within it
+    :param band_rows: the number of rows of the bands simulated independently
+    :param max_workers: the number of worker processes, None for the number of CPUs, 1 to simulate the bands
+        in this process
+    :return: the results of the simulation
+    """
+    if z_tol <= 0:
+        raise ValueError(f"The z tolerance must be greater than 0, got: {z_tol}")
+    with open(gcode_fn, "rb") as gcode_fh:
+        dias = header_tool_diameters(gcode_fh.read())
+    dias.update(tool_dias or {})
+    moves = parse_gcode_arrays(gcode_fn).moves
+    tolerance = (grid.px if grid else px) / 2 if tolerance is None else tolerance
+    pieces = cut_pieces(moves, dias, stock_top, tolerance, z_tol)
+    if grid is None:
+        if len(pieces.z):
+            reach = float(pieces.radius.max())
+            bbox = (
+                float(np.fmin(pieces.x0, pieces.x1).min()),
+                float(np.fmin(pieces.y0, pieces.y1).min()),
+                float(np.fmax(pieces.x0, pieces.x1).max()),
+                float(np.fmax(pieces.y0, pieces.y1).max()),
+            )
+        else:
+            reach, bbox = 0.0, (0.0, 0.0, 0.0, 0.0)
+        grid = grid_for_bbox(bbox, px, reach + px)
+
+    # the pieces over each band, the band's rows are simulated with only these pieces
+    bands = [(row, min(row + band_rows, grid.shape[0])) for row in range(0, grid.shape[0], band_rows)]
+    y_low = np.fmin(pieces.y0, pieces.y1) - pieces.radius
+    y_high = np.fmax(pieces.y0, pieces.y1) + pieces.radius
+    band_pieces = []
+    for row_0, row_1 in bands:
+        over = (y_low <= grid.origin_y + row_1 * grid.px) & (y_high >= grid.origin_y + row_0 * grid.px)
+        band_pieces.append(SimPieces(*(values[over] for values in pieces)))
+    args = ([grid] * len(bands), [row_0 for row_0, _ in bands], [row_1 for _, row_1 in bands], band_pieces)
+    if max_workers == 1 or len(bands) < 2:
+        band_heights = list(map(simulate_band, *args, [stock_top] * len(bands)))
+    else:
+        with ProcessPoolExecutor(max_workers) as executor:
+            band_heights = list(executor.map(simulate_band, *args, [stock_top] * len(bands)))
+    heights = np.vstack(band_heights) if band_heights else np.full(grid.shape, stock_top, dtype=np.float32)
+    return SimResult(grid, heights, stock_top, dias, len(pieces.z))
+
+
+def removal_diff(result: SimResult, target: np.ndarray, depth: float = 0.0) -> tuple[np.ndarray, np.ndarray]:
+    """Compare the material removed by a program with the mask of the material to remove.
+
+    :param result: the results of the simulation, on the grid of the mask
+    :param target: the mask of the material to remove
+    :param depth: a pixel is removed when it is cut deeper than this depth below the stock's top
+    :return: tuple of: the mask of the material left that should have been removed, and the mask of the
+        material removed that should have been left
+    """
+    if target.shape != result.heights.shape:
+        raise ValueError(f"The mask's shape {target.shape} is not the height field's {result.heights.shape}")
+    removed = result.heights < result.stock_top - depth
+    return target & ~removed, removed & ~target
+
+
+def output_sim_report(result: SimResult) -> None:
+    """Prints out the results of a simulation.
+
+    :param result: the results returned by simulate_gcode_file
+    """
+    grid, heights = result.grid, result.heights
+    cut = heights < result.stock_top
+    pixel_area = grid.px * grid.px
+    print(
+        f"grid: {grid.shape[1]} x {grid.shape[0]} px of {grid.px:.3f} mm   origin: {grid.origin_x:.3f}, "
+        f"{grid.origin_y:.3f}   pieces: {result.pieces}"
+    )
+    print("\ttools: " + "   ".join(f"T{tool} D={dia:.3f}" for tool, dia in sorted(result.tool_dias.items())))
+    if not cut.any():
+        print("\tno material removed")
+        return
+    removed = float(np.sum(result.stock_top - heights[cut], dtype=np.float64)) * pixel_area
+    print(
+        f"\tcut area: {cut.sum() * pixel_area:.2f} mm2   removed volume: {removed:.2f} mm3   "
+        f"lowest z: {float(heights.min()):.3f}"
+    )
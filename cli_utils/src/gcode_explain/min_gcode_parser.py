@@ -0,0 +1,403 @@
+"""Minimal G-code parser for the .cnc programs written by the Fusion Carvera post (see gcode_files/).
+
+The parser understands the subset of G-code the post writes:
+    * comments in parentheses (and ; comments to the end of the line), the comment line just before the
+      first block of an operation names the operation's section, e.g. (2D Adaptive1)
+    * the modal groups: motion G0 / G1 / G2 / G3, plane G17 / G18 / G19, distance G90 / G91 and units
+      G20 / G21 (inch coordinates are converted to mm)
+    * the modal X, Y, Z and F words, I, J & K arc center offsets (helical arcs move Z in the G17 plane)
+    * tool changes (T1 M6)
+
+There are 2 ways to parse a program:
+    * GcodeParser is a streaming parser: it reads 1 line at a time and yields a GcodeMove record for each
+      line that moves the machine, so a program of any size can be processed in constant memory
+    * parse_gcode_arrays is the batch mode: it parses a whole file with NumPy, without a Python loop over
+      the lines or the words, and returns the moves as columns. Programs in incremental mode (G91) fall
+      back to the streaming parser.
+"""
+import math
+import re
+from collections import namedtuple
+from typing import Iterable, Iterator, TextIO
+
+import numpy as np
+
+# the motion modes, the same values as the move kinds of pcb_cam.toolpath
+RAPID, LINEAR, CW_ARC, CCW_ARC = 0, 1, 2, 3
+MM_PER_INCH = 25.4
+# the axes of each arc plane, as indexes in x, y, z: the 2 in-plane axes (p, q), counterclockwise seen from
+# the plane's normal, and the normal axis (n). G17 XY, G18 ZX, G19 YZ.
+PLANE_AXES = {17: (0, 1, 2), 18: (2, 0, 1), 19: (1, 2, 0)}
+
+# Tuple describing 1 move of a program, the coordinates are absolute, in mm
+#   ln_nbr  - the line number of the block in the file
+#   motion  - the motion mode: RAPID, LINEAR, CW_ARC or CCW_ARC
+#   x, y, z - the end point of the move, nan for an axis whose position is not known yet
+#   i, j, k - the offsets from the start point to the center of an arc, 0 for the other moves
+#   plane   - the arc plane: 17 (XY), 18 (ZX) or 19 (YZ)
+#   feed    - the feed rate, in mm/min, nan before the first F word
+#   tool    - the number of the tool in the spindle, 0 before the first tool change
+#   section - the index of the move's section (operation), in the parser's sections, -1 before the first one
+GcodeMove = namedtuple(
+    "GcodeMove", ["ln_nbr", "motion", "x", "y", "z", "i", "j", "k", "plane", "feed", "tool", "section"]
+)
+
+# Tuple with the result of the batch mode
+#   moves        - the columns of the moves, keyed by the GcodeMove field names, as NumPy arrays
+#   sections     - the name of each section, in order
+#   tool_changes - list of tuples of: the line number of the tool change, and the new tool number
+GcodeProgram = namedtuple("GcodeProgram", ["moves", "sections", "tool_changes"])
+
+COMMENT_RE = re.compile(r"\(([^)]*)\)|;(.*)$")
+WORD_RE = re.compile(r"([A-Z])\s*([-+]?[0-9.]+)")
+
+# the G codes of each modal group that is tracked
+MOTION_CODES = (0, 1, 2, 3)
+PLANE_CODES = (17, 18, 19)
+DISTANCE_CODES = (90, 91)
+UNITS_CODES = (20, 21)
+# an operation's section starts with a block that has one of these M codes or a motion
+SECTION_M_CODES = (3, 4, 6)
+
+
+def comment_text(line: str) -> str:
+    """Return the text of the comments of a line, without the parentheses and the surrounding spaces."""
+    return " ".join((a or b).strip() for a, b in COMMENT_RE.findall(line.rstrip("\r\n")))
+
+
+class GcodeParser:
+    """Streaming G-code parser, holds the modal state of the machine between lines."""
+
+    def __init__(self):
+        """Create a parser in the power-on state: G0, G17, G90, G21, at an unknown position."""
+        self.x = self.y = self.z = float("nan")
+        self.feed = float("nan")
+        self.motion = RAPID
+        self.plane = 17
+        self.absolute = True
+        self.scale = 1.0  # the factor that converts the program's units to mm
+        self.tool = 0
+        self.next_tool = 0  # the tool selected by the last T word, loaded by the next M6
+        self.spindle_speed = 0.0
+        self.section = -1
+        self.sections: list[str] = []
+        self.tool_changes: list[tuple[int, int]] = []
+        self.pending_comment: str | None = None  # the last whole line comment since the last block
+
+    def parse_line(self, ln_nbr: int, line: str) -> GcodeMove | None:
+        """Parse 1 line of a program and update the modal state.
+
+        :param ln_nbr: the line number of the line
+        :param line: the text of the line
+        :return: the move made by the line, None if the line does not move the machine
+        """
+        if "(" in line or ";" in line:
+            code = COMMENT_RE.sub(" ", line)
+            if not code.strip():
+                self.pending_comment = comment_text(line)
+                return None
+            line = code
+        words = WORD_RE.findall(line.upper())
+        if not words:
+            return None
+
+        axes: dict[str, float] = {}
+        m_codes = []
+        motion_word = False
+        for letter, value in words:
+            if letter in "XYZIJK":
+                axes[letter] = float(value)
+            elif letter == "G":
+                code = float(value)
+                if code in MOTION_CODES:
+                    self.motion, motion_word = int(code), True
+                elif code in PLANE_CODES:
+                    self.plane = int(code)
+                elif code in DISTANCE_CODES:
+                    self.absolute = code == 90
+                elif code in UNITS_CODES:
+                    self.scale = MM_PER_INCH if code == 20 else 1.0
+            elif letter == "F":
+                self.feed = float(value) * self.scale
+            elif letter == "T":
+                self.next_tool = int(float(value))
+            elif letter == "S":
+                self.spindle_speed = float(value)
+            elif letter == "M":
+                m_codes.append(int(float(value)))
+
+        if 6 in m_codes:
+            self.tool = self.next_tool
+            self.tool_changes.append((ln_nbr, self.tool))
+        moves = "X" in axes or "Y" in axes or "Z" in axes
+        if self.pending_comment is not None and (moves or motion_word or any(m in SECTION_M_CODES for m in m_codes)):
+            self.sections.append(self.pending_comment)
+            self.section = len(self.sections) - 1
+        self.pending_comment = None
+        if not moves:
+            return None
+
+        for letter, axis in (("X", "x"), ("Y", "y"), ("Z", "z")):
+            if letter in axes:
+                value = axes[letter] * self.scale
+                setattr(self, axis, value if self.absolute else value + getattr(self, axis))
+        if self.motion in (CW_ARC, CCW_ARC):
+            i, j, k = axes.get("I", 0.0) * self.scale, axes.get("J", 0.0) * self.scale, axes.get("K", 0.0) * self.scale
+        else:
+            i = j = k = 0.0
+        return GcodeMove(
+            ln_nbr, self.motion, self.x, self.y, self.z, i, j, k, self.plane, self.feed, self.tool, self.section
+        )
+
+    def iter_moves(self, lines: Iterable[str]) -> Iterator[GcodeMove]:
+        """Parse the lines of a program, yielding the move of each line that moves the machine."""
+        for ln_nbr, line in enumerate(lines, 1):
+            move = self.parse_line(ln_nbr, line)
+            if move is not None:
+                yield move
+
+
+def iter_gcode_moves(gcode_fh: TextIO) -> Iterator[GcodeMove]:
+    """Stream the moves of a G-code program from an open text file."""
+    yield from GcodeParser().iter_moves(gcode_fh)
+
+
+def moves_to_arrays(moves: Iterable[GcodeMove]) -> dict[str, np.ndarray]:
+    """Return move records as columns, keyed by the GcodeMove field names."""
+    columns = list(zip(*moves)) or [()] * len(GcodeMove._fields)
+    int_fields = ("ln_nbr", "motion", "plane", "tool", "section")
+    return {
+        name: np.array(column, dtype=np.int64 if name in int_fields else np.float64)
+        for name, column in zip(GcodeMove._fields, columns)
+    }
+
+
+def plane_axes(planes: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the in-plane axes (p, q) and the normal axis (n) of the arc plane of each move, see PLANE_AXES.
+
+    :param planes: the arc planes of the moves: 17, 18 or 19, other values are treated as 17
+    :return: tuple of: the p, q and n axis of each move, as indexes in x, y, z
+    """
+    conditions = [planes == 18, planes == 19]
+    return tuple(
+        np.select(conditions, [PLANE_AXES[18][axis], PLANE_AXES[19][axis]], PLANE_AXES[17][axis]) for axis in range(3)
+    )
+
+
+def arc_sweeps(start_angles: np.ndarray, end_angles: np.ndarray, ccw: np.ndarray) -> np.ndarray:
+    """Return the unsigned sweep angle of arcs, from the angles of their start & end points around the center.
+
+    :param start_angles: the angles of the start points, in radians
+    :param end_angles: the angles of the end points, in radians
+    :param ccw: True for the counterclockwise arcs, False for the clockwise ones
+    :return: the sweep angles, in ]0, 2 pi]: an arc that ends where it starts is a full circle
+    """
+    sweeps = np.where(ccw, end_angles - start_angles, start_angles - end_angles) % (2 * np.pi)
+    return np.where(sweeps < 1e-9, 2 * np.pi, sweeps)
+
+
+def arc_sweep(start_angle: float, end_angle: float, ccw: bool) -> float:
+    """Return the unsigned sweep angle of 1 arc, the same as arc_sweeps without the cost of NumPy for a scalar.
+
+    :param start_angle: the angle of the start point, in radians
+    :param end_angle: the angle of the end point, in radians
+    :param ccw: True for a counterclockwise arc, False for a clockwise one
+    :return: the sweep angle, in ]0, 2 pi]: an arc that ends where it starts is a full circle
+    """
+    sweep = (end_angle - start_angle if ccw else start_angle - end_angle) % (2 * math.pi)
+    return 2 * math.pi if sweep < 1e-9 else sweep
+
+
+def blank_comments(data: bytes) -> tuple[bytes, list[tuple[int, bytes]]]:
+    """Replace the comments of a program with spaces, so the positions of the other bytes do not change.
+
+    :param data: the bytes of the program
+    :return: tuple of: the program without its comments, and list of tuples of: the position of each
+        comment and its text
+    """
+    buf = bytearray(data)
+    comments = []
+    for opening, closing in ((b"(", b")"), (b";", b"\n")):
+        pos = buf.find(opening)
+        while pos >= 0:
+            line_end = buf.find(b"\n", pos)
+            line_end = len(buf) if line_end < 0 else line_end
+            # a comment in parentheses ends at its closing parenthesis, or at the end of the line
+            end = buf.find(closing, pos + 1)
+            end = line_end if end < 0 or end > line_end else end
+            comments.append((pos, bytes(buf[pos + 1:end])))
+            blank_end = end + 1 if end < line_end else end
+            buf[pos:blank_end] = b" " * (blank_end - pos)
+            pos = buf.find(opening, blank_end)
+    return bytes(buf), sorted(comments)
+
+
+# the bytes that make up numbers
+NUMBER_BYTES = b"0123456789.-+"
+# the numbers of up to 15 digits are parsed exactly: their digits make an integer below 2 ** 53
+MAX_DIGITS = 15
+POWERS_OF_10 = 10.0 ** np.arange(MAX_DIGITS + 1)
+
+
+def parse_gcode_words(data: bytes) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None:
+    """Split a program into its words and parse their values, without a Python loop over the words.
+
+    :param data: the bytes of the program, without comments
+    :return: tuple of: the line index of each word, the letter (ASCII code) of each word, the value of each
+        word, and the position of each newline. None if some letter is not followed by a number (or some
+        number has no letter), which the batch mode does not handle.
+
+    The numbers of all the words are read together, 1 column of bytes at a time, until each one reaches a
+    byte that is not a digit or its decimal point. The digits make an integer, which is divided by the power
+    of 10 of its decimals, so the values are the same as float()'s.
+    """
+    buf = np.frombuffer(data + b" " * (MAX_DIGITS + 2), dtype=np.uint8)
+    letter_pos = np.flatnonzero((buf | 32) - np.uint8(97) < 26)
+    pos = letter_pos + 1
+    negative, positive = buf[pos] == ord("-"), buf[pos] == ord("+")
+    pos += negative | positive
+    digits, lengths, decimals = np.zeros(len(pos)), np.zeros(len(pos), np.uint8), np.zeros(len(pos), np.uint8)
+    reading, after_dot = np.ones(len(pos), dtype=bool), np.zeros(len(pos), dtype=bool)
+    for _ in range(MAX_DIGITS + 1):
+        byte = buf[pos]
+        digit = byte - np.uint8(48)
+        is_digit = (digit < 10) & reading
+        is_dot = (byte == ord(".")) & reading & ~after_dot
+        # in place, without a temporary of the values: x 10 + digit for the digits, x 1 + 0 for the others
+        digits *= is_digit.view(np.uint8) * np.uint8(9) + np.uint8(1)
+        digits += digit * is_digit
+        decimals += is_digit & after_dot
+        after_dot |= is_dot
+        reading = is_digit | is_dot
+        if not reading.any():
+            break
+        lengths += reading
+        pos += 1
+    # each number must have 1 to 15 digits, and every byte of the numbers must be read: each letter is directly
+    # followed by its number, each number follows a letter and has 1 sign in front and 1 decimal point at most
+    digit_count = lengths - after_dot
+    number_bytes = np.sum(lengths, dtype=np.int64) + np.count_nonzero(negative) + np.count_nonzero(positive)
+    if (
+        reading.any()
+        or np.any((digit_count == 0) | (digit_count > MAX_DIGITS))
+        or number_bytes != len(data) - len(data.translate(None, NUMBER_BYTES))
+    ):
+        return None
+    values = digits / POWERS_OF_10[decimals]
+    np.negative(values, out=values, where=negative)
+    newline_pos = np.flatnonzero(buf == 10)
+    # the words before each newline give the line of each word
+    line_words = np.diff(np.searchsorted(letter_pos, newline_pos), prepend=0, append=len(letter_pos))
+    return np.repeat(np.arange(len(line_words)), line_words), buf[letter_pos] & np.uint8(0xDF), values, newline_pos
+
+
+def line_marks(word_lines: np.ndarray, line_count: int) -> np.ndarray:
+    """Return the number of the last word of each line, counting from 1, 0 for the lines without a word.
+
+    :param word_lines: the line index of each word, in line order
+    :param line_count: the number of lines of the program
+    """
+    marks = np.zeros(line_count, dtype=np.int64)
+    marks[word_lines] = np.arange(1, len(word_lines) + 1)
+    return marks
+
+
+def has_words(word_lines: np.ndarray, lines: np.ndarray) -> np.ndarray:
+    """Return True for each line with a word, from the line index of each word, in line order."""
+    return np.append(word_lines, -1)[np.searchsorted(word_lines, lines)] == lines
+
+
+def unique_lines(word_lines: np.ndarray) -> np.ndarray:
+    """Return the line indexes of words in line order, without the repeats."""
+    return word_lines[np.append(0, np.flatnonzero(word_lines[1:] != word_lines[:-1]) + 1)[:len(word_lines)]]
+
+
+def parse_gcode_arrays(gcode_fn: str, data: bytes | None = None) -> GcodeProgram:
+    """Parse a G-code program in batch, into the columns of its moves.
+
+    :param gcode_fn: the file name path of the G-code file
+    :param data: the bytes of the file, None to read them
+    :return: the moves, sections and tool changes of the program, the same as the streaming parser's
+
+    The words are grouped by letter, and the modal value of a letter on each line is the value of its last
+    word on or before the line, so only the lines of the moves are looked up.
+    """
+    if data is None:
+        with open(gcode_fn, "rb") as gcode_fh:
+            data = gcode_fh.read()
+    code, comments = blank_comments(data)
+    words = parse_gcode_words(code)
+    # incremental mode (G91) needs the position of each move to compute the next one
+    if words is None or np.any((words[1] == ord("G")) & (words[2] == 91)):
+        with open(gcode_fn, "r") as gcode_fh:
+            parser = GcodeParser()
+            moves = moves_to_arrays(parser.iter_moves(gcode_fh))
+        return GcodeProgram(moves, parser.sections, parser.tool_changes)
+    word_line, letters, values, newline_pos = words
+    line_count = len(newline_pos) + (1 if not data.endswith(b"\n") else 0)
+    # the words of each letter are contiguous once sorted by letter, and stay in line order
+    order = np.argsort(letters, kind="stable")
+    letter_bounds = np.searchsorted(letters[order], np.arange(ord("A"), ord("Z") + 2))
+    sorted_lines, sorted_values = word_line[order], values[order]
+
+    def letter_words(letter: str, codes: tuple | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Return the line indexes and the values of a letter's words (with one of the codes)."""
+        index = ord(letter) - ord("A")
+        word_lines = sorted_lines[letter_bounds[index]:letter_bounds[index + 1]]
+        letter_values = sorted_values[letter_bounds[index]:letter_bounds[index + 1]]
+        if codes is None:
+            return word_lines, letter_values
+        selected = np.flatnonzero(np.isin(letter_values, codes))
+        return word_lines[selected], letter_values[selected]
+
+    def modal(words: tuple[np.ndarray, np.ndarray], at: np.ndarray, initial: float) -> np.ndarray:
+        """Return the value in effect on each line: the value of the last word on or before it."""
+        return np.append(initial, words[1])[np.maximum.accumulate(line_marks(words[0], line_count))[at]]
+
+    def on_line(words: tuple[np.ndarray, np.ndarray], at: np.ndarray, missing: float) -> np.ndarray:
+        """Return the value of the word on each line, or the missing value."""
+        return np.append(missing, words[1])[line_marks(words[0], line_count)[at]]
+
+    units = letter_words("G", UNITS_CODES)
+
+    def mm_words(letter: str) -> tuple[np.ndarray, np.ndarray]:
+        """Return the line indexes and the values of a letter's words, inch values converted to mm."""
+        word_lines, letter_values = letter_words(letter)
+        if np.any(units[1] == 20):
+            letter_values = letter_values * np.where(modal(units, word_lines, 21.0) == 20, MM_PER_INCH, 1.0)
+        return word_lines, letter_values
+
+    # tool changes: the T word selects the tool, the M6 loads it
+    change_lines = unique_lines(letter_words("M", (6,))[0])
+    next_tool = modal(letter_words("T"), change_lines, 0.0)
+    tool_changes = [(int(line) + 1, int(tool)) for line, tool in zip(change_lines, next_tool)]
+
+    # the moves: the lines with an axis word
+    lines = unique_lines(word_line[np.flatnonzero((letters >= ord("X")) & (letters <= ord("Z")))])
+    motion_words = letter_words("G", MOTION_CODES)
+    motion = modal(motion_words, lines, float(RAPID)).astype(np.int64)
+    arc = (motion == CW_ARC) | (motion == CCW_ARC)
+    moves = {
+        "ln_nbr": lines + 1,
+        "motion": motion,
+        **{name: modal(mm_words(name.upper()), lines, np.nan) for name in "xyz"},
+        **{name: np.where(arc, on_line(mm_words(name.upper()), lines, 0.0), 0.0) for name in "ijk"},
+        "plane": modal(letter_words("G", PLANE_CODES), lines, 17.0).astype(np.int64),
+        "feed": modal(mm_words("F"), lines, np.nan),
+        "tool": modal((change_lines, next_tool), lines, 0.0).astype(np.int64),
+    }
+
+    # sections: the last whole line comment before a block with a motion, or a spindle / tool M code
+    comment_texts: dict[int, list[str]] = {}
+    for pos, text in comments:
+        comment_texts.setdefault(int(np.searchsorted(newline_pos, pos)), []).append(text.decode(errors="replace"))
+    comment_lines = np.array(list(comment_texts), dtype=np.int64)
+    comment_lines = comment_lines[~has_words(word_line, comment_lines)]
+    following = np.append(word_line, line_count)[np.searchsorted(word_line, comment_lines)]
+    start_lines = (motion_words[0], letter_words("M", SECTION_M_CODES)[0], lines)
+    starts = (following < np.append(comment_lines[1:], line_count)) & np.any(
+        [has_words(word_lines, following) for word_lines in start_lines], axis=0
+    )
+    sections = [" ".join(text.strip() for text in comment_texts[line]) for line in comment_lines[starts].tolist()]
+    moves["section"] = np.searchsorted(following[starts], lines, "right") - 1
+    return GcodeProgram(moves, sections, tool_changes)
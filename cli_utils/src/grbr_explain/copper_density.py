@@ -0,0 +1,234 @@
+"""Copper area and copper density map of a parsed gerber layer.
+
+Two measures are provided:
+    * the exact area of each graphic object, computed from its geometry: the aperture's shape for flashes,
+      the swept area of the aperture for draws and arcs, and the area enclosed by the contours (including
+      the circular segments of their arcs) for regions
+    * a density map: the board is divided into square cells of a configurable size, and the fraction of
+      each cell covered by copper is measured by rasterizing the layer with several samples per cell. The
+      raster honors overlapping objects and clear polarity, which the sum of the object areas does not.
+
+The cells are computed in parallel: the rows of cells are split into bands and each band is rasterized
+by its own worker process. The density map is returned as a NumPy array, so a job planner can query the
+copper area of any region of the board cheaply, without re-parsing the layer.
+"""
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from grbr_explain.grbr_geom import arc_angles, calc_radius, obj_bbox, stroke_width
+from grbr_explain.min_gerber_parser import GrbrArc, GrbrDraw, GrbrFlash, GrbrPlot, GrbrRegion
+from grbr_explain.raster import RasterGrid, rasterize_objs
+
+
+def flash_area(aperture_def: tuple[str, list[str]] | None) -> float:
+    """Return the area of a flash of a standard aperture, less the area of its hole.
+
+    :param aperture_def: the aperture's definition: (name, modifiers)
+    :return: the area, 0 for aperture macros whose geometry is not known
+    """
+    if not aperture_def:
+        return 0.0
+    aperture_type, params = aperture_def
+    params = [float(p) for p in params]
+    if aperture_type == "C" and params:
+        area, hole_idx = math.pi * params[0] ** 2 / 4, 1
+    elif aperture_type == "R" and len(params) >= 2:
+        area, hole_idx = params[0] * params[1], 2
+    elif aperture_type == "O" and len(params) >= 2:
+        # a rectangle with 2 semicircles replacing its corners on the short sides
+        radius = min(params[0], params[1]) / 2
+        area, hole_idx = params[0] * params[1] - (4 - math.pi) * radius**2, 2
+    elif aperture_type == "P" and len(params) >= 2:
+        vertices = int(params[1])
+        area, hole_idx = vertices / 2 * (params[0] / 2) ** 2 * math.sin(2 * math.pi / vertices), 3
+    else:
+        return 0.0
+    if len(params) > hole_idx:
+        area -= math.pi * params[hole_idx] ** 2 / 4
+    return area
+
+
+def stroke_area(obj: GrbrDraw | GrbrArc, aperture_def: tuple[str, list[str]] | None) -> float:
+    """Return the area swept by the aperture of a draw or arc.
+
+    :param obj: the draw or arc
+    :param aperture_def: the aperture's definition: (name, modifiers)
+
+    For a circular aperture the area is the stroke's length times the aperture's diameter, plus a full
+    circle for the 2 round ends. A draw of a rectangular aperture sweeps the rectangle along the segment,
+    which covers the rectangle plus the parallelogram spanned by the segment and the rectangle's sides.
+
+    An arc whose radius is smaller than half the stroke width overlaps itself around its center, this
+    overlap is counted twice.
+    """
+    if not aperture_def:
+        return 0.0
+    aperture_type, params = aperture_def
+    if aperture_type == "R" and isinstance(obj, GrbrDraw) and len(params) >= 2:
+        width, height = float(params[0]), float(params[1])
+        return width * height + abs(obj.x2 - obj.x1) * height + abs(obj.y2 - obj.y1) * width
+    width = stroke_width(aperture_def)
+    if isinstance(obj, GrbrArc):
+        _, sweep = arc_angles(obj)
+        length = abs(sweep) * (obj.radius or calc_radius(obj))
+    else:
+        length = math.hypot(obj.x2 - obj.x1, obj.y2 - obj.y1)
+    return length * width + math.pi * width**2 / 4
+
+
+def contour_area(contour: list[GrbrDraw | GrbrArc]) -> float:
+    """Return the signed area enclosed by a region's contour (positive for counterclockwise contours).
+
+    :param contour: the segments that make up the contour
+
+    The area is the shoelace formula over the segment end points, plus for each arc the signed area of
+    the circular segment between the arc and its chord: r^2 / 2 * (sweep - sin(sweep)).
+    """
+    area = 0.0
+    for segment in contour:
+        area += (segment.x1 * segment.y2 - segment.x2 * segment.y1) / 2
+        if isinstance(segment, GrbrArc):
+            _, sweep = arc_angles(segment)
+            radius = segment.radius or calc_radius(segment)
+            area += radius**2 / 2 * (sweep - math.sin(sweep))
+    return area
+
+
+def obj_area(
+    obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion,
+    aperture_lkp: dict[str, tuple[str, list[str]]],
+) -> float:
+    """Return the exact area covered by a graphic object, regardless of its polarity.
+
+    :param obj: the graphic object
+    :param aperture_lkp: the aperture dictionary of the GrbrPlot that created the graphic object
+    """
+    if isinstance(obj, GrbrRegion):
+        return sum(abs(contour_area(contour)) for contour in obj.contours)
+    if isinstance(obj, GrbrFlash):
+        return flash_area(aperture_lkp.get(obj.aperture))
+    return stroke_area(obj, aperture_lkp.get(obj.aperture))
+
+
+def layer_area(grbr_plot: GrbrPlot) -> float:
+    """Return the copper area of a layer as the sum of the dark object areas less the clear object areas.
+
+    :param grbr_plot: the parsed gerber layer
+    :return: the area, in square units of the layer
+
+    Overlapping objects are counted once per object, use a density map for the area of their union.
+    """
+    area = 0.0
+    for obj in grbr_plot.graphic_objs:
+        sign = 1 if obj.polarity == "dark" else -1
+        area += sign * obj_area(obj, grbr_plot.aperture_lkp)
+    return area
+
+
+class CopperDensityMap:
+    """The fraction of each cell of a grid, overlaid on a layer, that is covered by copper."""
+
+    def __init__(self, origin_x: float, origin_y: float, cell_size: float, density: np.ndarray, object_area: float):
+        """Create a density map from its computed density array. Use build() to compute the map of a layer.
+
+        :param origin_x: the x coordinate of the lower left corner of the grid
+        :param origin_y: the y coordinate of the lower left corner of the grid
+        :param cell_size: the width (and height) of a cell
+        :param density: the copper fraction (0 to 1) of each cell, indexed by [row, col], row 0 at the bottom
+        :param object_area: the sum of the exact object areas of the layer (see layer_area)
+        """
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.cell_size = cell_size
+        self.density = density
+        self.object_area = object_area
+
+    @property
+    def cell_area(self) -> np.ndarray:
+        """The copper area of each cell."""
+        return self.density * self.cell_size**2
+
+    @property
+    def copper_area(self) -> float:
+        """The copper area of the whole layer, measured from the raster (overlaps are counted once)."""
+        return float(self.cell_area.sum())
+
+    def area_in(self, bbox: tuple[float, float, float, float]) -> float:
+        """Return the copper area of the cells whose centers fall within a bounding box.
+
+        :param bbox: the bounding box: x min, y min, x max, y max
+        """
+        rows, cols = self.density.shape
+        c0 = max(0, math.ceil((bbox[0] - self.origin_x) / self.cell_size - 0.5))
+        c1 = min(cols, math.floor((bbox[2] - self.origin_x) / self.cell_size - 0.5) + 1)
+        r0 = max(0, math.ceil((bbox[1] - self.origin_y) / self.cell_size - 0.5))
+        r1 = min(rows, math.floor((bbox[3] - self.origin_y) / self.cell_size - 0.5) + 1)
+        if c0 >= c1 or r0 >= r1:
+            return 0.0
+        return float(self.density[r0:r1, c0:c1].sum() * self.cell_size**2)
+
+    @classmethod
+    def build(
+        cls,
+        grbr_plot: GrbrPlot,
+        cell_size: float = 1.0,
+        samples: int = 16,
+        max_workers: int | None = None,
+        band_rows: int = 8,
+    ) -> "CopperDensityMap":
+        """Compute the density map of a parsed gerber layer.
+
+        :param grbr_plot: the parsed gerber layer
+        :param cell_size: the width (and height) of a cell of the density map
+        :param samples: the number of raster samples across a cell, the raster's pixel size is
+            cell_size / samples
+        :param max_workers: the number of worker processes, pass 1 to compute the map in this process and
+            None to use 1 worker per CPU
+        :param band_rows: the number of rows of cells computed by each worker task
+        :return: the computed density map
+        """
+        objs = grbr_plot.graphic_objs
+        object_area = layer_area(grbr_plot)
+        if not objs:
+            return cls(0.0, 0.0, cell_size, np.zeros((0, 0)), object_area)
+        bboxes = [obj_bbox(obj, grbr_plot.aperture_lkp) for obj in objs]
+        x0, y0 = min(b[0] for b in bboxes), min(b[1] for b in bboxes)
+        cols = max(1, math.ceil((max(b[2] for b in bboxes) - x0) / cell_size))
+        rows = max(1, math.ceil((max(b[3] for b in bboxes) - y0) / cell_size))
+
+        # each band only needs the objects that overlap it
+        tasks = []
+        for row0 in range(0, rows, band_rows):
+            n_rows = min(band_rows, rows - row0)
+            band_y0, band_y1 = y0 + row0 * cell_size, y0 + (row0 + n_rows) * cell_size
+            band_objs = [obj for obj, b in zip(objs, bboxes) if b[1] <= band_y1 and b[3] >= band_y0]
+            grid = RasterGrid(x0, band_y0, cell_size / samples, (n_rows * samples, cols * samples))
+            tasks.append((band_objs, grbr_plot.aperture_lkp, grid, samples))
+
+        if max_workers == 1:
+            bands = [band_density(*task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers) as executor:
+                bands = list(executor.map(band_density, *zip(*tasks)))
+        return cls(x0, y0, cell_size, np.vstack(bands), object_area)
+
+
+def band_density(
+    objs: list[GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion],
+    aperture_lkp: dict[str, tuple[str, list[str]]],
+    grid: RasterGrid,
+    samples: int,
+) -> np.ndarray:
+    """Compute the density of 1 band of cells of a density map (runs in a worker process).
+
+    :param objs: the graphic objects overlapping the band
+    :param aperture_lkp: the aperture dictionary of the layer
+    :param grid: the raster grid of the band, each cell of the band is samples x samples pixels
+    :param samples: the number of raster samples across a cell
+    :return: the copper fraction of each cell of the band
+    """
+    mask = rasterize_objs(objs, aperture_lkp, grid)
+    rows, cols = grid.shape[0] // samples, grid.shape[1] // samples
+    return mask.reshape(rows, samples, cols, samples).mean(axis=(1, 3))
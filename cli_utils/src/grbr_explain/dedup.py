@@ -0,0 +1,205 @@
+"""Deduplication of coincident and overlapping graphic objects of a parsed gerber layer.
+
+Some exporters write the same feature more than once, e.g. a pad written by both its footprint and a
+copper zone, or a panelizer that overlays identical strokes. Every duplicate costs time downstream.
+
+Each graphic object is reduced to a canonical key: its kind, the definition of its aperture (so 2 apertures
+with the same shape are equal), its coordinates snapped to a grid, and its polarity. Draws and arcs are
+keyed independently of their direction, regions independently of their starting point and orientation.
+A single pass with a dictionary of keys drops the exact duplicates, in O(n).
+
+A duplicate is only dropped when no object of the opposite polarity was created between it and the object
+it duplicates, otherwise dropping it would change the image of the layer.
+
+Objects that are not exact duplicates but are almost the same (same kind, aperture and polarity, with
+coordinates within a tolerance) are found through a grid spatial index and reported, but not dropped.
+"""
+import math
+from collections import namedtuple
+
+from grbr_explain.min_gerber_parser import GrbrArc, GrbrDraw, GrbrFlash, GrbrPlot, GrbrRegion
+from grbr_explain.spatial_index import GridIndex
+
+# Tuple with the results of deduplicating a layer
+#   objs       - the graphic objects that were kept, in their original order
+#   removed    - tuples of: the duplicate object that was dropped, and the kept object it duplicates
+#   near_dups  - tuples of: a kept object, a kept object that almost duplicates it, and the largest
+#                distance between their corresponding coordinates
+DedupResult = namedtuple("DedupResult", ["objs", "removed", "near_dups"])
+
+
+def snap(value: float, grid: float) -> int:
+    """Return a coordinate snapped to a grid, as an integer number of grid steps."""
+    return round(value / grid)
+
+
+def aperture_key(aperture_id: str | None, aperture_lkp: dict[str, tuple[str, list[str]]]) -> tuple | None:
+    """Return the definition of an aperture as a hashable key, the aperture's id is used for unknown apertures."""
+    aperture_def = aperture_lkp.get(aperture_id)
+    if not aperture_def:
+        return None if aperture_id is None else ("id", aperture_id)
+    return aperture_def[0], tuple(aperture_def[1])
+
+
+def obj_points(obj: GrbrFlash | GrbrDraw | GrbrArc) -> list[tuple[float, float]]:
+    """Return the coordinates of a flash, draw or arc in canonical order (the same for both directions).
+
+    The points of an arc are its end points followed by its center.
+    """
+    if isinstance(obj, GrbrFlash):
+        return [(obj.x, obj.y)]
+    ends = sorted([(obj.x1, obj.y1), (obj.x2, obj.y2)])
+    if isinstance(obj, GrbrArc):
+        return ends + [(obj.cx, obj.cy)]
+    return ends
+
+
+def region_key(region: GrbrRegion, grid: float) -> tuple:
+    """Return the canonical key of the contours of a region.
+
+    Each contour is keyed by its snapped vertices, each followed by the segment that starts at it: empty for a
+    draw, the snapped center and direction for an arc. The contour is rotated to start at the smallest vertex,
+    in the orientation with the smaller key. Reversing a contour moves each arc to its other end point and
+    flips its direction.
+    """
+    contours = []
+    for contour in region.contours:
+        vertices, segs = [], []
+        for seg in contour:
+            vertices.append((snap(seg.x1, grid), snap(seg.y1, grid)))
+            segs.append((snap(seg.cx, grid), snap(seg.cy, grid), seg.direction) if isinstance(seg, GrbrArc) else ())
+        if not vertices:
+            continue
+        forward = [vertex + (seg,) for vertex, seg in zip(vertices, segs)]
+        # the reversed contour starts at the same vertex, its segment k runs backwards along segment n - k - 1
+        backward = [vertices[-k] + (flip_seg(segs[-k - 1]),) for k in range(len(vertices))]
+        start = vertices.index(min(vertices))
+        forward = forward[start:] + forward[:start]
+        start = (len(vertices) - start) % len(vertices)
+        backward = backward[start:] + backward[:start]
+        contours.append(tuple(min(forward, backward)))
+    return tuple(sorted(contours))
+
+
+def flip_seg(seg: tuple) -> tuple:
+    """Return the key of a contour segment traversed in the other direction."""
+    if not seg:
+        return seg
+    cx, cy, direction = seg
+    return cx, cy, "clockwise" if direction == "counterclockwise" else "counterclockwise"
+
+
+def obj_key(
+    obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion,
+    aperture_lkp: dict[str, tuple[str, list[str]]],
+    grid: float,
+) -> tuple:
+    """Return the canonical key of a graphic object: equal keys mean the objects produce the same image.
+
+    :param obj: the graphic object
+    :param aperture_lkp: the aperture dictionary of the GrbrPlot that created the graphic object
+    :param grid: the coordinates are snapped to this grid size
+    """
+    if isinstance(obj, GrbrRegion):
+        return "region", region_key(obj, grid), obj.polarity
+    points = tuple((snap(x, grid), snap(y, grid)) for x, y in obj_points(obj))
+    kind = type(obj).__name__
+    if isinstance(obj, GrbrArc):
+        # an arc traversed in the other direction is the same arc, its end points are already sorted
+        sweeps_ccw = (obj.direction == "counterclockwise") == ((obj.x1, obj.y1) <= (obj.x2, obj.y2))
+        kind += "_ccw" if sweeps_ccw else "_cw"
+    return kind, aperture_key(obj.aperture, aperture_lkp), points, obj.polarity
+
+
+def dedup_objs(
+    objs: list[GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion],
+    aperture_lkp: dict[str, tuple[str, list[str]]],
+    grid: float = 1e-4,
+    near_tol: float | None = 0.01,
+) -> DedupResult:
+    """Drop the exact duplicates from a list of graphic objects and find the near duplicates.
+
+    :param objs: the graphic objects, in the order they were created
+    :param aperture_lkp: the aperture dictionary of the GrbrPlot that created the graphic objects
+    :param grid: coordinates are snapped to this grid size before they are compared
+    :param near_tol: the tolerance on the coordinates of near duplicates, None to skip the search
+    :return: the results of the deduplication
+    """
+    seen: dict[tuple, tuple[int, GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion]] = {}
+    kept, removed = [], []
+    # the epoch changes each time the polarity changes, a duplicate is only dropped within the same epoch
+    epoch, polarity = 0, None
+    for obj in objs:
+        if obj.polarity != polarity:
+            epoch, polarity = epoch + 1, obj.polarity
+        key = obj_key(obj, aperture_lkp, grid)
+        first = seen.get(key)
+        if first is not None and first[0] == epoch:
+            removed.append((obj, first[1]))
+            continue
+        seen[key] = (epoch, obj)
+        kept.append(obj)
+
+    near_dups = [] if near_tol is None else find_near_dups(kept, aperture_lkp, near_tol)
+    return DedupResult(kept, removed, near_dups)
+
+
+def find_near_dups(
+    objs: list[GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion],
+    aperture_lkp: dict[str, tuple[str, list[str]]],
+    tol: float,
+) -> list[tuple]:
+    """Return the pairs of flashes, draws or arcs that are within a tolerance of each other.
+
+    :param objs: the graphic objects, without exact duplicates
+    :param aperture_lkp: the aperture dictionary of the GrbrPlot that created the graphic objects
+    :param tol: the largest distance between the corresponding coordinates of near duplicates
+    :return: list of tuples of: the earlier object, the later object and the largest coordinate distance
+
+    Each object is indexed by its first canonical point, so only the objects in the neighbouring grid
+    cells are compared with it. Regions are not compared, nor are coincident objects (kept because an object
+    of the opposite polarity separates them).
+    """
+    index = GridIndex(tol)
+    near_dups = []
+    for obj in objs:
+        if isinstance(obj, GrbrRegion):
+            continue
+        points = obj_points(obj)
+        kind = (type(obj).__name__, aperture_key(obj.aperture, aperture_lkp), obj.polarity)
+        for _, other_nbr in index.query_radius(*points[0], tol):
+            other_kind, other, other_points = index.items[other_nbr]
+            if other_kind != kind or len(other_points) != len(points):
+                continue
+            dist = max(math.dist(p, q) for p, q in zip(points, other_points))
+            if 0 < dist <= tol:
+                near_dups.append((other, obj, dist))
+        index.insert(*points[0], (kind, obj, points))
+    return near_dups
+
+
+def dedup_plot(grbr_plot: GrbrPlot, grid: float = 1e-4, near_tol: float | None = 0.01) -> DedupResult:
+    """Drop the exact duplicate graphic objects of a parsed gerber layer, in place.
+
+    :param grbr_plot: the parsed gerber layer, its graphic_objs list is replaced by the kept objects
+    :param grid: coordinates are snapped to this grid size before they are compared
+    :param near_tol: the tolerance on the coordinates of near duplicates, None to skip the search
+    :return: the results of the deduplication
+    """
+    result = dedup_objs(grbr_plot.graphic_objs, grbr_plot.aperture_lkp, grid, near_tol)
+    grbr_plot.graphic_objs = result.objs
+    return result
+
+
+def output_dedup_report(result: DedupResult) -> None:
+    """Prints out the duplicate objects that were dropped and the near duplicates that were found.
+
+    :param result: the results returned by dedup_objs or dedup_plot
+    """
+    print(f"objects kept: {len(result.objs)}   duplicates removed: {len(result.removed)}")
+    for obj, first in result.removed:
+        print(f"[{obj.ln_nbr:0>3}] DUPLICATE of line [{first.ln_nbr:0>3}]: {type(obj).__name__}")
+    for first, obj, dist in result.near_dups:
+        print(
+            f"[{obj.ln_nbr:0>3}] NEAR DUPLICATE of line [{first.ln_nbr:0>3}]: {type(obj).__name__}   dist: {dist:.4f}"
+        )
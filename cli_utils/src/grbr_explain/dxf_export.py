@@ -0,0 +1,234 @@
+"""DXF export of the graphic objects of a parsed gerber layer.
+
+The layer is written as a minimal DXF in the AutoCAD R12 format (AC1009): a HEADER, the BLOCKS and the
+ENTITIES sections only. Unlike the later formats, R12 needs no tables, handles, owners or objects section:
+the layers are created by the entities that use them. The mapping is:
+    * each aperture becomes a BLOCK holding the closed outline of its shape (and of its hole), and each
+      flash becomes an INSERT of its aperture's block
+    * draws and arcs become POLYLINE entities along their centerline, with the aperture's diameter as the
+      polyline's width. Arcs are kept as true arcs, with the bulge value of the polyline vertex, and
+      chained draws & arcs of the same aperture are merged into 1 polyline
+    * each contour of a region becomes a closed POLYLINE (with bulges for its arcs)
+    * dark objects are written on the COPPER layer and clear objects on the CLEAR layer, as DXF has no
+      notion of polarity
+
+The entities are streamed to the file as the graphic objects are visited, through a buffered file, so only
+the vertices of the polyline being merged are held in memory.
+"""
+import math
+from typing import TextIO
+
+from grbr_explain.grbr_geom import COORD_EPS, arc_angles, stroke_width
+from grbr_explain.min_gerber_parser import GrbrArc, GrbrDraw, GrbrFlash, GrbrPlot, GrbrRegion
+
+# the DXF layer of each polarity
+POLARITY_LAYERS = {"dark": "COPPER", "clear": "CLEAR"}
+# the $INSUNITS header value of each gerber unit, not part of R12 but read by most importers
+INSUNITS = {"mm": 4, "in": 1}
+# a merged polyline is written out once it has this many vertices
+MAX_POLYLINE_VERTICES = 5000
+
+
+def fmt(value: float) -> str:
+    """Return a number formatted for DXF: 6 decimal places, without trailing zeros."""
+    text = f"{value:.6f}".rstrip("0").rstrip(".")
+    return "0" if text in ("", "-0") else text
+
+
+def bulge(segment: GrbrArc) -> float:
+    """Return the bulge of a polyline vertex that starts an arc: the tangent of a quarter of its sweep angle.
+
+    The bulge is positive for counterclockwise arcs. Full circles are split before this is called.
+    """
+    _, sweep = arc_angles(segment)
+    return math.tan(sweep / 4)
+
+
+def arc_vertices(segment: GrbrArc) -> list[tuple[float, float, float]]:
+    """Return the polyline vertices (x, y, bulge) of an arc, without its end point.
+
+    A full circle is split in 2 half circles, as a polyline vertex can not sweep a full circle.
+    """
+    _, sweep = arc_angles(segment)
+    if abs(sweep) >= 2 * math.pi - 1e-9:
+        half = math.copysign(1.0, sweep)
+        mid_x, mid_y = 2 * segment.cx - segment.x1, 2 * segment.cy - segment.y1
+        return [(segment.x1, segment.y1, half), (mid_x, mid_y, half)]
+    return [(segment.x1, segment.y1, bulge(segment))]
+
+
+def outline_vertices(aperture_def: tuple[str, list[str]] | None) -> list[list[tuple[float, float, float]]]:
+    """Return the closed outlines of an aperture's shape, centered on the origin, as polyline vertices.
+
+    :param aperture_def: the aperture's definition: (name, modifiers)
+    :return: list of outlines (the shape, then its hole if it has one), each a list of x, y, bulge vertices,
+        empty for aperture macros whose geometry is not known
+    """
+    if not aperture_def or not aperture_def[1]:
+        return []
+    aperture_type, params = aperture_def[0], [float(p) for p in aperture_def[1]]
+    if aperture_type == "C":
+        outlines, hole_idx = [circle_vertices(params[0] / 2)], 1
+    elif aperture_type == "R" and len(params) >= 2:
+        half_w, half_h = params[0] / 2, params[1] / 2
+        outlines = [[(-half_w, -half_h, 0.0), (half_w, -half_h, 0.0), (half_w, half_h, 0.0), (-half_w, half_h, 0.0)]]
+        hole_idx = 2
+    elif aperture_type == "O" and len(params) >= 2:
+        radius = min(params[0], params[1]) / 2
+        half_x, half_y = params[0] / 2 - radius, params[1] / 2 - radius
+        if params[0] >= params[1]:
+            # the bulge of 1 turns the ends into counterclockwise half circles
+            outline = [(-half_x, -radius, 0.0), (half_x, -radius, 1.0), (half_x, radius, 0.0), (-half_x, radius, 1.0)]
+        else:
+            outline = [(radius, -half_y, 0.0), (radius, half_y, 1.0), (-radius, half_y, 0.0), (-radius, -half_y, 1.0)]
+        outlines = [outline]
+        hole_idx = 2
+    elif aperture_type == "P" and len(params) >= 2:
+        vertices = int(params[1])
+        rotation = math.radians(params[2]) if len(params) > 2 else 0.0
+        outlines = [[
+            (params[0] / 2 * math.cos(rotation + 2 * math.pi * i / vertices),
+             params[0] / 2 * math.sin(rotation + 2 * math.pi * i / vertices), 0.0)
+            for i in range(vertices)
+        ]]
+        hole_idx = 3
+    else:
+        return []
+    if len(params) > hole_idx and params[hole_idx] > 0:
+        outlines.append(circle_vertices(params[hole_idx] / 2))
+    return outlines
+
+
+def circle_vertices(radius: float) -> list[tuple[float, float, float]]:
+    """Return the vertices of a closed polyline circle centered on the origin: 2 half circles."""
+    return [(radius, 0.0, 1.0), (-radius, 0.0, 1.0)]
+
+
+class DxfWriter:
+    """Writes the graphic objects of a gerber layer to a DXF file, one entity at a time."""
+
+    def __init__(self, dxf_fh: TextIO, aperture_lkp: dict[str, tuple[str, list[str]]], units: str | None = None):
+        """Write the header and the aperture blocks, and start the entities section.
+
+        :param dxf_fh: the text file the DXF is written to
+        :param aperture_lkp: the aperture dictionary of the parsed gerber layer
+        :param units: the units of the layer's coordinates: mm or in
+        """
+        self.dxf_fh = dxf_fh
+        self.aperture_lkp = aperture_lkp
+        self.polyline: list[tuple[float, float, float]] = []  # the vertices of the polyline being merged
+        self.polyline_key: tuple[str, str] | None = None  # the aperture & polarity of the polyline being merged
+        self.polyline_end: tuple[float, float] | None = None  # the end point of the polyline being merged
+        self.entity_count = 0
+
+        self.write_codes(0, "SECTION", 2, "HEADER", 9, "$ACADVER", 1, "AC1009")
+        self.write_codes(9, "$INSUNITS", 70, INSUNITS.get(units, 0), 0, "ENDSEC")
+        self.write_codes(0, "SECTION", 2, "BLOCKS")
+        for aperture_id, aperture_def in aperture_lkp.items():
+            self.write_block(aperture_id, aperture_def)
+        self.write_codes(0, "ENDSEC", 0, "SECTION", 2, "ENTITIES")
+
+    def write_codes(self, *pairs) -> None:
+        """Write group code & value pairs, given as a flat sequence: code, value, code, value, ..."""
+        values = [fmt(value) if isinstance(value, float) else value for value in pairs]
+        self.dxf_fh.write("".join(f"{value}\n" for value in values))
+
+    def write_block(self, aperture_id: str, aperture_def: tuple[str, list[str]]) -> None:
+        """Write the block of an aperture, with the outlines of its shape."""
+        name = f"AP_{aperture_id}"
+        self.write_codes(0, "BLOCK", 8, "0", 2, name, 70, 0, 10, 0.0, 20, 0.0, 30, 0.0, 3, name)
+        for vertices in outline_vertices(aperture_def):
+            self.write_polyline(vertices, "0", closed=True)
+        self.write_codes(0, "ENDBLK", 8, "0")
+
+    def write_polyline(
+        self,
+        vertices: list[tuple[float, float, float]],
+        layer: str,
+        closed: bool = False,
+        width: float = 0.0,
+    ) -> None:
+        """Write a POLYLINE entity: its header, a VERTEX entity per vertex and the closing SEQEND.
+
+        :param vertices: the x, y, bulge of each vertex, the bulge applies to the segment that starts at the vertex
+        :param layer: the DXF layer of the polyline
+        :param closed: pass True to close the polyline (the last vertex connects back to the first)
+        :param width: the constant width of the polyline
+        """
+        self.write_codes(0, "POLYLINE", 8, layer, 66, 1, 10, 0.0, 20, 0.0, 30, 0.0, 70, 1 if closed else 0)
+        self.write_codes(40, float(width), 41, float(width))
+        for x, y, vertex_bulge in vertices:
+            if vertex_bulge:
+                self.write_codes(0, "VERTEX", 8, layer, 10, float(x), 20, float(y), 30, 0.0, 42, float(vertex_bulge))
+            else:
+                self.write_codes(0, "VERTEX", 8, layer, 10, float(x), 20, float(y), 30, 0.0)
+        self.write_codes(0, "SEQEND", 8, layer)
+
+    def add_obj(self, obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion) -> None:
+        """Write the entity (or entities) of a graphic object, draws & arcs are merged with the ones chained to them.
+
+        :param obj: the graphic object
+        """
+        self.entity_count += 1
+        layer = POLARITY_LAYERS.get(obj.polarity, "COPPER")
+        if isinstance(obj, (GrbrDraw, GrbrArc)):
+            key = (obj.aperture, layer)
+            chained = (
+                key == self.polyline_key
+                and math.dist(self.polyline_end, (obj.x1, obj.y1)) <= COORD_EPS
+                and len(self.polyline) < MAX_POLYLINE_VERTICES
+            )
+            if not chained:
+                self.flush_polyline()
+                self.polyline_key = key
+            else:
+                # the end point of the polyline is replaced by the vertex that starts this segment
+                self.polyline.pop()
+            if isinstance(obj, GrbrArc):
+                self.polyline.extend(arc_vertices(obj))
+            else:
+                self.polyline.append((obj.x1, obj.y1, 0.0))
+            self.polyline.append((obj.x2, obj.y2, 0.0))
+            self.polyline_end = (obj.x2, obj.y2)
+            return
+
+        self.flush_polyline()
+        if isinstance(obj, GrbrFlash):
+            self.write_codes(0, "INSERT", 8, layer, 2, f"AP_{obj.aperture}", 10, obj.x, 20, obj.y, 30, 0.0)
+        else:
+            for contour in obj.contours:
+                vertices = []
+                for segment in contour:
+                    if isinstance(segment, GrbrArc):
+                        vertices.extend(arc_vertices(segment))
+                    else:
+                        vertices.append((segment.x1, segment.y1, 0.0))
+                self.write_polyline(vertices, layer, closed=True)
+
+    def flush_polyline(self) -> None:
+        """Write out the polyline being merged, if any."""
+        if self.polyline:
+            aperture, layer = self.polyline_key
+            self.write_polyline(self.polyline, layer, width=stroke_width(self.aperture_lkp.get(aperture)))
+        self.polyline, self.polyline_key, self.polyline_end = [], None, None
+
+    def close(self) -> None:
+        """Finish the DXF document."""
+        self.flush_polyline()
+        self.write_codes(0, "ENDSEC", 0, "EOF")
+
+
+def export_dxf(grbr_plot: GrbrPlot, dxf_fn: str) -> int:
+    """Write the graphic objects of a parsed gerber layer to a DXF file.
+
+    :param grbr_plot: the parsed gerber layer
+    :param dxf_fn: the file name path of the DXF file to write
+    :return: the number of graphic objects written
+    """
+    gcs = getattr(grbr_plot, "gcs", None)
+    with open(dxf_fn, "w", encoding="utf-8", buffering=1 << 16) as dxf_fh:
+        writer = DxfWriter(dxf_fh, grbr_plot.aperture_lkp, gcs.units if gcs else None)
+        for obj in grbr_plot.graphic_objs:
+            writer.add_obj(obj)
+        writer.close()
+    return writer.entity_count
@@ -0,0 +1,198 @@
+"""Geometry helpers for the graphic objects recorded by GrbrPlot (flashes, draws, arcs and regions).
+
+All coordinates and dimensions are in the units set by the gerber file's %MO command.
+"""
+import math
+
+from grbr_explain.min_gerber_parser import GrbrArc, GrbrDraw, GrbrFlash, GrbrRegion
+
+# tolerance used when comparing coordinates that should be equal (e.g., the start and end points of a full circle)
+COORD_EPS = 1e-9
+
+
+def arc_angles(arc: GrbrArc) -> tuple[float, float]:
+    """Return the starting angle and the signed sweep angle of an arc, in radians.
+
+    :param arc: the arc to calculate the angles for
+    :return: a tuple with the angle of the arc's starting point (measured from its center point) and the
+        sweep angle of the arc, the sweep is positive for counterclockwise arcs and negative for clockwise arcs
+
+    An arc whose starting and ending points are the same is a full circle (this is how multi quadrant
+    mode (G75) specifies a full circle).
+    """
+    start = math.atan2(arc.y1 - arc.cy, arc.x1 - arc.cx)
+    end = math.atan2(arc.y2 - arc.cy, arc.x2 - arc.cx)
+    full_circle = abs(arc.x1 - arc.x2) < COORD_EPS and abs(arc.y1 - arc.y2) < COORD_EPS
+    if arc.direction == "counterclockwise":
+        sweep = 2 * math.pi if full_circle else (end - start) % (2 * math.pi)
+    else:
+        sweep = -2 * math.pi if full_circle else -((start - end) % (2 * math.pi))
+    return start, sweep
+
+
+def arc_points(arc: GrbrArc, tol: float) -> list[tuple[float, float]]:
+    """Linearize an arc into a list of points, starting and ending with the arc's end points.
+
+    :param arc: the arc to linearize
+    :param tol: the maximum distance allowed between the arc and the chords that replace it
+    :return: list of x, y points along the arc
+
+    The number of chords is chosen so that the sagitta of each chord does not exceed the tolerance.
+    """
+    start, sweep = arc_angles(arc)
+    radius = arc.radius or calc_radius(arc)
+    if radius <= tol:
+        seg_cnt = 1
+    else:
+        # the sagitta of a chord spanning the angle a is: r * (1 - cos(a / 2))
+        max_step = 2 * math.acos(max(-1.0, 1 - tol / radius))
+        seg_cnt = max(1, math.ceil(abs(sweep) / max_step))
+    points = [(arc.x1, arc.y1)]
+    for step in range(1, seg_cnt):
+        angle = start + sweep * step / seg_cnt
+        points.append((arc.cx + radius * math.cos(angle), arc.cy + radius * math.sin(angle)))
+    points.append((arc.x2, arc.y2))
+    return points
+
+
+def calc_radius(arc: GrbrArc) -> float:
+    """Return the radius of an arc as the distance from its center point to its starting point.
+
+    :param arc: the arc whose radius is returned
+    """
+    return math.hypot(arc.x1 - arc.cx, arc.y1 - arc.cy)
+
+
+def arc_bbox(arc: GrbrArc) -> tuple[float, float, float, float]:
+    """Return the bounding box of an arc's centerline as a tuple of: x min, y min, x max, y max.
+
+    :param arc: the arc to calculate the bounding box for
+
+    The bounding box includes the end points and any of the 4 axis extreme points (at 0, 90, 180 and
+    270 degrees) that lie on the arc's sweep.
+    """
+    start, sweep = arc_angles(arc)
+    radius = arc.radius or calc_radius(arc)
+    xs, ys = [arc.x1, arc.x2], [arc.y1, arc.y2]
+    lo, hi = (start, start + sweep) if sweep >= 0 else (start + sweep, start)
+    for quarter in range(math.floor(lo / (math.pi / 2)), math.floor(hi / (math.pi / 2)) + 1):
+        angle = quarter * math.pi / 2
+        if lo <= angle <= hi:
+            xs.append(arc.cx + radius * math.cos(angle))
+            ys.append(arc.cy + radius * math.sin(angle))
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def aperture_extent(aperture_def: tuple[str, list[str]] | None) -> float:
+    """Return the radius of the circle, centered on the aperture's origin, that encloses the aperture.
+
+    :param aperture_def: the aperture's definition as stored in GrbrPlot.aperture_lkp: (name, modifiers)
+    :return: the radius of the enclosing circle
+
+    Aperture macros are not evaluated by the parser, so their size is not known and 0 is returned
+    for them (as well as for an undefined aperture).
+    """
+    if not aperture_def:
+        return 0.0
+    aperture_type, params = aperture_def
+    if aperture_type == "C" and params:
+        return float(params[0]) / 2
+    if aperture_type in ("R", "O") and len(params) >= 2:
+        return math.hypot(float(params[0]), float(params[1])) / 2
+    if aperture_type == "P" and params:
+        return float(params[0]) / 2
+    return 0.0
+
+
+def stroke_width(aperture_def: tuple[str, list[str]] | None) -> float:
+    """Return the width of the line drawn by an aperture when used in a draw or arc.
+
+    :param aperture_def: the aperture's definition as stored in GrbrPlot.aperture_lkp: (name, modifiers)
+
+    The gerber specification only allows circular apertures to be used in arcs, and recommends them for
+    draws, so the width is the diameter of the circle. For other standard apertures the smaller dimension
+    is used.
+    """
+    if not aperture_def:
+        return 0.0
+    aperture_type, params = aperture_def
+    if aperture_type in ("R", "O") and len(params) >= 2:
+        return min(float(params[0]), float(params[1]))
+    return aperture_extent(aperture_def) * 2
+
+
+def contour_points(contour: list[GrbrDraw | GrbrArc], tol: float) -> list[tuple[float, float]]:
+    """Return the points of a region's contour, with its arcs linearized.
+
+    :param contour: the segments that make up the contour
+    :param tol: the maximum distance allowed between an arc and the chords that replace it
+    :return: the contour's points, the first point is not repeated at the end of the list
+    """
+    points = [(contour[0].x1, contour[0].y1)]
+    for segment in contour:
+        if isinstance(segment, GrbrArc):
+            points.extend(arc_points(segment, tol)[1:])
+        else:
+            points.append((segment.x2, segment.y2))
+    if len(points) > 1 and math.dist(points[0], points[-1]) < COORD_EPS:
+        points.pop()
+    return points
+
+
+def obj_bbox(
+    obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion,
+    aperture_lkp: dict[str, tuple[str, list[str]]],
+) -> tuple[float, float, float, float]:
+    """Return the bounding box of a graphic object as a tuple of: x min, y min, x max, y max.
+
+    :param obj: the graphic object to calculate the bounding box for
+    :param aperture_lkp: the aperture dictionary of the GrbrPlot that created the graphic object
+
+    The bounding box of flashes, draws and arcs is grown by the extent of their aperture.
+    """
+    if isinstance(obj, GrbrRegion):
+        xs, ys = [], []
+        for contour in obj.contours:
+            for segment in contour:
+                x_min, y_min, x_max, y_max = seg_bbox(segment)
+                xs.extend((x_min, x_max))
+                ys.extend((y_min, y_max))
+        return min(xs), min(ys), max(xs), max(ys)
+
+    extent = aperture_extent(aperture_lkp.get(obj.aperture))
+    if isinstance(obj, GrbrFlash):
+        return obj.x - extent, obj.y - extent, obj.x + extent, obj.y + extent
+    x_min, y_min, x_max, y_max = seg_bbox(obj)
+    return x_min - extent, y_min - extent, x_max + extent, y_max + extent
+
+
+def seg_bbox(segment: GrbrDraw | GrbrArc) -> tuple[float, float, float, float]:
+    """Return the bounding box of a draw's or arc's centerline as a tuple of: x min, y min, x max, y max.
+
+    :param segment: the draw or arc to calculate the bounding box for
+    """
+    if isinstance(segment, GrbrArc):
+        return arc_bbox(segment)
+    return (
+        min(segment.x1, segment.x2),
+        min(segment.y1, segment.y2),
+        max(segment.x1, segment.x2),
+        max(segment.y1, segment.y2),
+    )
+
+
+def decimate_points(points: list[tuple[float, float]], tol: float) -> list[tuple[float, float]]:
+    """Drop the points of a polyline that lie within the tolerance of the previously kept point.
+
+    :param points: the points of the polyline
+    :param tol: points closer than this distance to the last kept point are dropped
+    :return: the decimated points, the first and last points are always kept
+    """
+    if len(points) <= 2:
+        return list(points)
+    kept = [points[0]]
+    for point in points[1:-1]:
+        if math.dist(kept[-1], point) >= tol:
+            kept.append(point)
+    kept.append(points[-1])
+    return kept
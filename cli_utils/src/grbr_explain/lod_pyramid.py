@@ -0,0 +1,302 @@
+"""Level-of-detail (LOD) pyramid of a parsed gerber layer, used to render zoomable previews quickly.
+
+The pyramid is a quadtree: level 0 is a single tile covering the whole layer, and each level below it
+splits every tile of the level above into 4. Each tile is drawn at a fixed resolution (tile_px pixels
+across), so every level has a pixel size (the width of one pixel in layer units) that is half the pixel
+size of the level above it.
+
+Each level holds its own copy of the layer's geometry, decimated to suit its pixel size:
+    * arcs and region contours are linearized with a chord tolerance of half a pixel, vertices closer
+      than half a pixel to each other are dropped and the polylines are simplified (Douglas-Peucker) to
+      within half a pixel
+    * features smaller than a couple of pixels are not drawn individually, instead they are merged into
+      bounding boxes (1 box per cell of a coarse grid overlaid on each tile). A box only merges
+      consecutive features of the same polarity and keeps their polarity, it takes the place of its first
+      feature in the drawing order. Flashes of aperture macros, whose size is not known (their bounding box
+      is a point), are always drawn individually.
+
+Only tiles that contain geometry are stored. The pyramid is built once, can be saved to and loaded from
+a JSON file and can be queried for the geometry visible within a bounding box at a given scale.
+"""
+import json
+import math
+from collections import namedtuple
+
+from grbr_explain.grbr_geom import arc_points, contour_points, decimate_points, obj_bbox
+from grbr_explain.min_gerber_parser import GrbrArc, GrbrDraw, GrbrFlash, GrbrPlot, GrbrRegion
+from grbr_explain.simplify import simplify_points
+
+# Tuple returned by the query method for each item of geometry
+#   kind - one of: "flash", "stroke", "region" or "box"
+#   bbox - the bounding box of the item: x min, y min, x max, y max
+#   data - the kind specific data of the item
+#       flash:  [x, y, aperture id, polarity]
+#       stroke: [aperture id, polarity, [x1, y1, x2, y2, ... xn, yn]]
+#       region: [polarity, [[x1, y1, ... xn, yn], ...]] - 1 flat list of points per contour
+#       box:    [number of features merged into the box, polarity]
+LodItem = namedtuple("LodItem", ["kind", "bbox", "data"])
+
+
+class LodPyramid:
+    """Quadtree of tiles, holding a gerber layer's geometry decimated for each level of detail."""
+
+    def __init__(
+        self,
+        origin: tuple[float, float],
+        size: float,
+        tile_px: int,
+        levels: list[dict],
+        aperture_lkp: dict[str, tuple[str, list[str]]],
+    ):
+        """Create a LOD pyramid from its already built levels. Use build() or load() to create a pyramid.
+
+        :param origin: the x, y coordinates of the lower left corner of the level 0 tile
+        :param size: the width (and height) of the level 0 tile, in layer units
+        :param tile_px: the number of pixels across a tile, when it is drawn
+        :param levels: for each level, a dictionary with 2 keys:
+            items - the list of geometry items of the level, as [kind, x min, y min, x max, y max, data]
+            tiles - dictionary of tile keys ("ix,iy") to the list of item indexes that intersect the tile
+        :param aperture_lkp: the aperture dictionary of the layer, needed to draw flashes and strokes
+        """
+        self.origin = origin
+        self.size = size
+        self.tile_px = tile_px
+        self.levels = levels
+        self.aperture_lkp = aperture_lkp
+
+    @property
+    def max_level(self) -> int:
+        """The deepest (most detailed) level of the pyramid."""
+        return len(self.levels) - 1
+
+    def tile_size(self, level: int) -> float:
+        """Return the width (and height) of a tile of the given level, in layer units."""
+        return self.size / 2**level
+
+    def pixel_size(self, level: int) -> float:
+        """Return the width of 1 pixel of a tile of the given level, in layer units."""
+        return self.tile_size(level) / self.tile_px
+
+    def level_for_scale(self, units_per_px: float) -> int:
+        """Return the coarsest level whose pixels are no larger than the requested scale.
+
+        :param units_per_px: the scale of the view being drawn, in layer units per screen pixel
+        :return: the level to draw, the deepest level is returned when zoomed in past it
+        """
+        if units_per_px <= 0:
+            return self.max_level
+        level = math.ceil(math.log2(self.pixel_size(0) / units_per_px) - 1e-9)
+        return min(max(level, 0), self.max_level)
+
+    def tile_range(self, level: int, bbox: tuple[float, float, float, float]) -> tuple[range, range]:
+        """Return the ranges of tile column and row indexes of a level that intersect a bounding box.
+
+        :param level: the level of the tiles
+        :param bbox: the bounding box: x min, y min, x max, y max
+        """
+        tile_size = self.tile_size(level)
+        last = 2**level - 1
+        x_min, y_min, x_max, y_max = bbox
+
+        def clamp(value: float) -> int:
+            return min(max(math.floor(value / tile_size), 0), last)
+
+        return (
+            range(clamp(x_min - self.origin[0]), clamp(x_max - self.origin[0]) + 1),
+            range(clamp(y_min - self.origin[1]), clamp(y_max - self.origin[1]) + 1),
+        )
+
+    @classmethod
+    def build(
+        cls,
+        grbr_plot: GrbrPlot,
+        tile_px: int = 256,
+        max_level: int = 8,
+        tiny_px: float = 2.0,
+        merge_px: int = 8,
+    ) -> "LodPyramid":
+        """Build the LOD pyramid for the graphic objects of a parsed gerber layer.
+
+        :param grbr_plot: the parsed gerber layer (see load_grbr_plot)
+        :param tile_px: the number of pixels across a tile, when it is drawn
+        :param max_level: the deepest level that may be built. Fewer levels are built when the smallest
+            feature of the layer is already larger than a pixel at a coarser level.
+        :param tiny_px: features smaller than this number of pixels are merged into bounding boxes
+        :param merge_px: the width, in pixels, of the grid cells used to merge tiny features
+        :return: the built pyramid
+        """
+        objs = grbr_plot.graphic_objs
+        bboxes = [obj_bbox(obj, grbr_plot.aperture_lkp) for obj in objs]
+        if not objs:
+            return cls((0.0, 0.0), 1.0, tile_px, [{"items": [], "tiles": {}}], grbr_plot.aperture_lkp)
+
+        # the level 0 tile is the square enclosing all the graphic objects
+        x0, y0 = min(b[0] for b in bboxes), min(b[1] for b in bboxes)
+        size = max(max(b[2] for b in bboxes) - x0, max(b[3] for b in bboxes) - y0) or 1.0
+        pyramid = cls((x0, y0), size, tile_px, [], grbr_plot.aperture_lkp)
+
+        # there is no need to go deeper than the level where the smallest feature spans a few pixels, for
+        # arcs the level must also be deep enough for the arc to look round when linearized
+        feature_sizes = [max(b[2] - b[0], b[3] - b[1]) for b in bboxes]
+        detail_sizes = [obj.radius / 4 if isinstance(obj, GrbrArc) else s for obj, s in zip(objs, feature_sizes)]
+        min_feature = min((s for s in detail_sizes if s > 0), default=size)
+        level_cnt = 1
+        while level_cnt <= max_level and pyramid.pixel_size(level_cnt - 1) * tiny_px > min_feature:
+            level_cnt += 1
+
+        for level in range(level_cnt):
+            pyramid.levels.append(pyramid.build_level(level, objs, bboxes, feature_sizes, tiny_px, merge_px))
+        return pyramid
+
+    def build_level(
+        self,
+        level: int,
+        objs: list[GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion],
+        bboxes: list[tuple[float, float, float, float]],
+        feature_sizes: list[float],
+        tiny_px: float,
+        merge_px: int,
+    ) -> dict:
+        """Build the items and tiles of 1 level of the pyramid.
+
+        :param level: the level to build
+        :param objs: the graphic objects of the layer
+        :param bboxes: the bounding box of each graphic object
+        :param feature_sizes: the size (larger side of the bounding box) of each graphic object
+        :param tiny_px: features smaller than this number of pixels are merged into bounding boxes
+        :param merge_px: the width, in pixels, of the grid cells used to merge tiny features
+        :return: dictionary with the level's items and tiles (see __init__)
+        """
+        pixel = self.pixel_size(level)
+        tol = pixel / 2
+        cell_size = pixel * merge_px
+        ordered = []
+        merged: dict[tuple[int, int, str], list] = {}
+        polarity = None
+
+        for obj, bbox, feature_size in zip(objs, bboxes, feature_sizes):
+            # a change of polarity closes the open boxes: the features after it are drawn over them
+            if obj.polarity != polarity:
+                merged.clear()
+                polarity = obj.polarity
+            # tiny features are merged into the bounding box of the grid cell their center falls in, features
+            # of an unknown size (0, e.g. macro flashes) are not, they may be large
+            if 0 < feature_size < pixel * tiny_px:
+                key = (
+                    math.floor(((bbox[0] + bbox[2]) / 2 - self.origin[0]) / cell_size),
+                    math.floor(((bbox[1] + bbox[3]) / 2 - self.origin[1]) / cell_size),
+                    polarity,
+                )
+                if key in merged:
+                    box = merged[key]
+                    box[1:5] = min(box[1], bbox[0]), min(box[2], bbox[1]), max(box[3], bbox[2]), max(box[4], bbox[3])
+                    box[5][0] += 1
+                else:
+                    merged[key] = ["box", *bbox, [1, polarity]]
+                    ordered.append(merged[key])
+                continue
+            kind, data = self.decimate_obj(obj, tol)
+            ordered.append([kind, *bbox, data])
+
+        # the boxes grow after they are created, the items are indexed by tile once their bounding boxes are final
+        items = []
+        tiles: dict[str, list[int]] = {}
+        for item in ordered:
+            self.add_item(level, tiles, items, item)
+        return {"items": items, "tiles": tiles}
+
+    def add_item(self, level: int, tiles: dict[str, list[int]], items: list[list], item: list) -> None:
+        """Add an item to a level's item list and to the index of each tile its bounding box intersects.
+
+        :param level: the level the item is being added to
+        :param tiles: the tile index of the level
+        :param items: the item list of the level
+        :param item: the item to add: [kind, x min, y min, x max, y max, data]
+        """
+        items.append(item)
+        cols, rows = self.tile_range(level, item[1:5])
+        for ix in cols:
+            for iy in rows:
+                tiles.setdefault(f"{ix},{iy}", []).append(len(items) - 1)
+
+    @staticmethod
+    def decimate_obj(obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion, tol: float) -> tuple[str, list]:
+        """Return the kind and the decimated data of a graphic object, for a given tolerance.
+
+        :param obj: the graphic object to decimate
+        :param tol: the chord tolerance used to linearize arcs and the minimum distance between vertices
+        :return: a tuple with the kind of the item and its data (see LodItem)
+        """
+        if isinstance(obj, GrbrFlash):
+            return "flash", [obj.x, obj.y, obj.aperture, obj.polarity]
+        if isinstance(obj, GrbrDraw):
+            return "stroke", [obj.aperture, obj.polarity, [obj.x1, obj.y1, obj.x2, obj.y2]]
+        if isinstance(obj, GrbrArc):
+            points = decimate_points(arc_points(obj, tol), tol)
+            return "stroke", [obj.aperture, obj.polarity, LodPyramid.flat_simplified(points, tol)]
+        contours = []
+        for contour in obj.contours:
+            points = decimate_points(contour_points(contour, tol), tol)
+            contours.append(LodPyramid.flat_simplified(points, tol))
+        return "region", [obj.polarity, contours]
+
+    @staticmethod
+    def flat_simplified(points: list[tuple[float, float]], tol: float) -> list[float]:
+        """Return the points of a polyline simplified to within the tolerance, as a flat list of coordinates."""
+        if len(points) <= 2:
+            return [coord for point in points for coord in point]
+        kept = simplify_points(points, tol)
+        return [coord for point, keep in zip(points, kept) for coord in point if keep]
+
+    def query(self, bbox: tuple[float, float, float, float], units_per_px: float) -> list[LodItem]:
+        """Return the geometry visible within a bounding box, at the level of detail suited to the scale.
+
+        :param bbox: the area being viewed: x min, y min, x max, y max
+        :param units_per_px: the scale of the view being drawn, in layer units per screen pixel
+        :return: the items, in the order they were created, whose bounding box intersects the area
+        """
+        level = self.level_for_scale(units_per_px)
+        items, tiles = self.levels[level]["items"], self.levels[level]["tiles"]
+        cols, rows = self.tile_range(level, bbox)
+        indexes = set()
+        for ix in cols:
+            for iy in rows:
+                indexes.update(tiles.get(f"{ix},{iy}", ()))
+
+        x_min, y_min, x_max, y_max = bbox
+        visible = []
+        for index in sorted(indexes):
+            kind, i_x_min, i_y_min, i_x_max, i_y_max, data = items[index]
+            if i_x_min <= x_max and i_x_max >= x_min and i_y_min <= y_max and i_y_max >= y_min:
+                visible.append(LodItem(kind, (i_x_min, i_y_min, i_x_max, i_y_max), data))
+        return visible
+
+    def save(self, fn: str) -> None:
+        """Save the pyramid to a JSON file.
+
+        :param fn: file name path of the file to write
+        """
+        with open(fn, "w") as fh:
+            json.dump(
+                {
+                    "origin": self.origin,
+                    "size": self.size,
+                    "tile_px": self.tile_px,
+                    "aperture_lkp": self.aperture_lkp,
+                    "levels": self.levels,
+                },
+                fh,
+                separators=(",", ":"),
+            )
+
+    @classmethod
+    def load(cls, fn: str) -> "LodPyramid":
+        """Load a pyramid previously saved to a JSON file.
+
+        :param fn: file name path of the file to read
+        :return: the loaded pyramid
+        """
+        with open(fn) as fh:
+            data = json.load(fh)
+        aperture_lkp = {aperture_id: tuple(aperture_def) for aperture_id, aperture_def in data["aperture_lkp"].items()}
+        return cls(tuple(data["origin"]), data["size"], data["tile_px"], data["levels"], aperture_lkp)
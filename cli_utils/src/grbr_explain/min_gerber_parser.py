@@ -1,9 +1,10 @@
 import os
 import sys
 import argparse
+import contextlib
 import re
 from collections import namedtuple
-from typing import Iterable, Iterator, Any
+from typing import Callable, Iterable, Iterator, Any
 
 
 # TODO: A code number can be padded with leading zeros, but the resulting number record must not contain more
@@ -202,6 +203,20 @@ StepRepeatCmd = namedtuple(
     ],
 )
 
+# Tuples used to record the graphic objects created while parsing a gerber file
+#   - a flash of the given aperture (D03)
+#   - a linear draw (D01 in linear interpolation mode)
+#   - a circular arc (D01 in CW/CCW circular interpolation mode), direction is "clockwise" or "counterclockwise"
+#   - a region (G36/G37), made up of 1 or more contours, each contour being a list of GrbrDraw/GrbrArc segments
+# draws & arcs that are part of a region's contour do not have an aperture and will have an aperture of None
+GrbrFlash = namedtuple("GrbrFlash", ["ln_nbr", "x", "y", "aperture", "polarity"])
+GrbrDraw = namedtuple("GrbrDraw", ["ln_nbr", "x1", "y1", "x2", "y2", "aperture", "polarity"])
+GrbrArc = namedtuple(
+    "GrbrArc",
+    ["ln_nbr", "x1", "y1", "x2", "y2", "cx", "cy", "radius", "direction", "aperture", "polarity"],
+)
+GrbrRegion = namedtuple("GrbrRegion", ["ln_nbr", "contours", "polarity"])
+
 
 class GrbrPlot:
     """
@@ -360,6 +375,9 @@ class GrbrPlot:
         self.aperture_lkp: dict[
             str, tuple[str, list][str]
         ] = {}  # the aperture dictionary that stores apertures by aperture ID when added (%AD)
+        self.aperture_attribs: dict[  # the aperture attributes (%TA) in effect when each aperture was added (%AD)
+            str, dict[str, list[str]]
+        ] = {}
         self.macro_lkup: dict[str, Any]  # the dictionary to store aperture macro definitions by macro name
         self.curr_x: float = 0  # the current x coordinate
         self.curr_y: float = 0  # the current y coordinate
@@ -386,6 +404,15 @@ class GrbrPlot:
             "TA": {},
             "TO": {},
         }
+        self.graphic_objs: list[  # stores a list of all graphic objects (flashes, draws, arcs, regions) in order
+            GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion
+        ] = []
+        self.graphic_obj_handlers: list[  # callables called with each graphic object as soon as it is created
+            Callable[[GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion], None]
+        ] = []
+        self.region_contours: list[  # the contours of the region currently being defined (between G36 and G37)
+            list[GrbrDraw | GrbrArc]
+        ] = []
         self.grbr_fn = grbr_fn  # file name path of the gerber file to parse
         self.lines: list[str] = self.read_and_normalize_grbr()  # the normalized gerber commands
 
@@ -596,6 +623,8 @@ class GrbrPlot:
         aperture_params = aperture_params_str.split("X") if aperture_params_str else []
         # store the aperture definition as a tuple with the name and modifiers/parameters
         self.aperture_lkp[aperture_id] = (aperture_type, aperture_params)
+        # the aperture gets the aperture attributes in effect at the time it is created
+        self.aperture_attribs[aperture_id] = dict(self.curr_attribs["TA"])
 
         if APRTR_ADD_DISP:
             print(f"[{ln_nbr:0>3}] ADD aperture:  {aperture_id:>5} {aperture_type:>11}        {aperture_params}")
@@ -668,6 +697,7 @@ class GrbrPlot:
         # ######################################################################
         elif g_cmd == "G36":
             self.region_mode = True
+            self.region_contours = []
             print(f"[{ln_nbr:0>3}] REGION: start")
 
         # ######################################################################
@@ -675,6 +705,11 @@ class GrbrPlot:
         # ######################################################################
         elif g_cmd == "G37":
             self.region_mode = False
+            # a contour needs at least 1 segment, empty contours (a D02 not followed by a D01) are discarded
+            contours = [contour for contour in self.region_contours if contour]
+            if contours:
+                self.record_graphic_obj(GrbrRegion(ln_nbr, contours, self.polarity))
+            self.region_contours = []
             print(f"[{ln_nbr:0>3}] REGION: end")
 
         # ######################################################################
@@ -832,6 +867,9 @@ class GrbrPlot:
             delta_x, delta_y = x - self.curr_x, y - self.curr_y
             delta_len = round(calc_length(delta_x, delta_y), 3)
 
+            # record the graphic object created by the command before the current point is updated
+            self.add_graphic_obj(ln_nbr, d_cmd, x, y, cx, cy, radius)
+
             # only set the current point's x, y coordinates after all the above calculations are completed
             self.curr_x, self.curr_y = x, y
 
@@ -896,6 +934,79 @@ class GrbrPlot:
         else:
             raise Exception(f"D Command: {d_cmd} not implemented or not in aperture dictionary")
 
+    def add_graphic_obj(
+        self,
+        ln_nbr: int,
+        d_cmd: str,
+        x: float,
+        y: float,
+        cx: float | None,
+        cy: float | None,
+        radius: float | None,
+    ) -> None:
+        """Record the graphic object created by a D01, D02 or D03 command.
+
+        :param ln_nbr: line number of the command
+        :param d_cmd: the operation code of the command: D01, D02 or D03
+        :param x: the x coordinate specified by the command (the end point of a draw or arc)
+        :param y: the y coordinate specified by the command (the end point of a draw or arc)
+        :param cx: the x coordinate of an arc's center point, None when in linear interpolation mode
+        :param cy: the y coordinate of an arc's center point, None when in linear interpolation mode
+        :param radius: the radius of an arc, None when in linear interpolation mode
+
+        This method must be called before the current point is updated, as the current point is the
+        starting point of any draw or arc.
+
+        Outside a region, a D01 creates a draw or an arc and a D03 creates a flash. D02 does not create
+        any graphic object.
+
+        Inside a region (G36), D01 commands are collected as the segments of the current contour and a
+        D02 command starts a new contour. The region itself is recorded when the region is ended (G37).
+        """
+        if d_cmd == "D01":
+            aperture = None if self.region_mode else self.aperture
+            if self.interpolation_mode == "linear":
+                segment = GrbrDraw(ln_nbr, self.curr_x, self.curr_y, x, y, aperture, self.polarity)
+            else:
+                segment = GrbrArc(
+                    ln_nbr,
+                    self.curr_x,
+                    self.curr_y,
+                    x,
+                    y,
+                    cx,
+                    cy,
+                    radius,
+                    self.interpolation_mode,
+                    aperture,
+                    self.polarity,
+                )
+            if not self.region_mode:
+                self.record_graphic_obj(segment)
+            elif self.region_contours:
+                self.region_contours[-1].append(segment)
+            else:
+                # a contour may start at the current point without an explicit D02
+                self.region_contours.append([segment])
+
+        elif d_cmd == "D02":
+            if self.region_mode:
+                self.region_contours.append([])
+
+        elif d_cmd == "D03":
+            self.record_graphic_obj(GrbrFlash(ln_nbr, x, y, self.aperture, self.polarity))
+
+    def record_graphic_obj(self, obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion) -> None:
+        """Add a graphic object to the list of graphic objects and pass it on to the graphic object handlers.
+
+        :param obj: the graphic object that was created
+
+        The handlers let an output (e.g. an SVG writer) be streamed while the file is being parsed.
+        """
+        self.graphic_objs.append(obj)
+        for handler in self.graphic_obj_handlers:
+            handler(obj)
+
     def step_repeat(self, ln_nbr: int, line: str):
         """Process an opening or closing Step Repeat (%SR) command.
 
@@ -1335,6 +1446,13 @@ def get_args(args_list: list[str] | None = None) -> argparse.Namespace:
         dest="hist_comment_disp",
         help="pass --cmnt-hist to display the grbr file comment contents",
     )
+    parser.add_argument(
+        "-g",
+        "--svg",
+        dest="svg_filename",
+        metavar="SVG_FILENAME",
+        help="pass --svg followed by a file name to also write an SVG image of the gerber file's graphic objects",
+    )
     args = parser.parse_args(args_list)
 
     ATTRIB_DISP = args.attrib_disp
@@ -1373,17 +1491,54 @@ def main():
     print(f"Explaining gerber file: {os.path.basename(grbr_fn)}")
     print("-" * 100)
 
+    # the svg image is written while the gerber file is parsed
+    svg_fh, svg_writer = None, None
+    if args.svg_filename:
+        from grbr_explain.svg_export import attach_svg_writer
+
+        svg_fh = open(args.svg_filename, "w", encoding="utf-8", buffering=1 << 16)
+        svg_writer = attach_svg_writer(grbr_plot, svg_fh)
+
     # main loop to process each command in the gerber file
+    parse_grbr_lines(grbr_plot)
+
+    if svg_writer:
+        svg_writer.close()
+        svg_fh.close()
+        print(f"SVG image written to: {args.svg_filename} ({svg_writer.obj_count} graphic objects)")
+
+    # output various summaries
+    output_attrib_hist(grbr_plot)
+    output_comment_hist(grbr_plot)
+    output_final_attrib_state(grbr_plot)
+
+
+def parse_grbr_lines(grbr_plot: GrbrPlot) -> None:
+    """Process each of the normalized gerber commands of a GrbrPlot object in order.
+
+    :param grbr_plot: graphics state object holding the normalized gerber commands to process
+    """
     for ln_nbr, line in enumerate(grbr_plot.lines, 1):
         if not grbr_plot.step_repeat_flag:
             parse_cmds_non_sr_mode(grbr_plot, line, ln_nbr)
         else:
             parse_cmds_sr_mode(grbr_plot, line, ln_nbr)
 
-    # output various summaries
-    output_attrib_hist(grbr_plot)
-    output_comment_hist(grbr_plot)
-    output_final_attrib_state(grbr_plot)
+
+def load_grbr_plot(grbr_fn: str) -> GrbrPlot:
+    """Parse a gerber file without explaining it and return the resulting GrbrPlot object.
+
+    :param grbr_fn: The gerber file to be parsed
+    :return: the GrbrPlot object, with its graphic_objs list populated
+
+    This is the entry point used by the tools that work with the graphic objects of a layer rather than
+    its explanation. Some of the explain output is not controlled by the display options, so anything
+    printed while parsing is discarded.
+    """
+    grbr_plot = GrbrPlot(grbr_fn)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        parse_grbr_lines(grbr_plot)
+    return grbr_plot
 
 
 def parse_cmds_sr_mode(grbr_plot: GrbrPlot, line: str, ln_nbr: int) -> None:
@@ -0,0 +1,449 @@
+"""Rasterization of the graphic objects of a parsed gerber layer into NumPy boolean masks.
+
+The raster is a grid of square pixels. Row 0 of the raster is the bottom row (lowest y coordinates), so
+array indexes follow the gerber coordinate axes: mask[row, col] is the pixel whose center is at:
+    x = origin_x + (col + 0.5) * px
+    y = origin_y + (row + 0.5) * px
+
+A pixel is copper when its center point is inside the image of a graphic object. Graphic objects are
+drawn in the order they were created, dark polarity objects set pixels and clear polarity objects reset
+them, which gives the same image as the gerber specification's superimposition of the objects.
+"""
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from grbr_explain.grbr_geom import arc_angles, contour_points, obj_bbox
+from grbr_explain.min_gerber_parser import GrbrArc, GrbrDraw, GrbrFlash, GrbrRegion
+
+# Tuple describing the grid of a raster: the x, y coordinates of its lower left corner, its pixel size and
+# its shape as a tuple of: number of rows, number of columns
+RasterGrid = namedtuple("RasterGrid", ["origin_x", "origin_y", "px", "shape"])
+
+
+def grid_for_bbox(bbox: tuple[float, float, float, float], px: float, margin: float = 0.0) -> RasterGrid:
+    """Return the raster grid covering a bounding box.
+
+    :param bbox: the bounding box to cover: x min, y min, x max, y max
+    :param px: the pixel size
+    :param margin: additional distance to cover around the bounding box
+    """
+    x_min, y_min = bbox[0] - margin, bbox[1] - margin
+    cols = max(1, math.ceil((bbox[2] + margin - x_min) / px))
+    rows = max(1, math.ceil((bbox[3] + margin - y_min) / px))
+    return RasterGrid(x_min, y_min, px, (rows, cols))
+
+
+def pixel_window(
+    grid: RasterGrid,
+    bbox: tuple[float, float, float, float],
+) -> tuple[slice, slice, np.ndarray, np.ndarray] | None:
+    """Return the window of pixels whose centers fall within a bounding box.
+
+    :param grid: the raster grid
+    :param bbox: the bounding box: x min, y min, x max, y max
+    :return: a tuple with the row & column slices of the window and the x & y coordinates of the pixel
+        centers of the window (as a row and a column vector, ready to be broadcast), or None if the window
+        is empty
+    """
+    rows, cols = grid.shape
+    c0 = max(0, math.ceil((bbox[0] - grid.origin_x) / grid.px - 0.5))
+    c1 = min(cols, math.floor((bbox[2] - grid.origin_x) / grid.px - 0.5) + 1)
+    r0 = max(0, math.ceil((bbox[1] - grid.origin_y) / grid.px - 0.5))
+    r1 = min(rows, math.floor((bbox[3] - grid.origin_y) / grid.px - 0.5) + 1)
+    if c0 >= c1 or r0 >= r1:
+        return None
+    xs = grid.origin_x + (np.arange(c0, c1) + 0.5) * grid.px
+    ys = grid.origin_y + (np.arange(r0, r1) + 0.5) * grid.px
+    return slice(r0, r1), slice(c0, c1), xs[np.newaxis, :], ys[:, np.newaxis]
+
+
+def segment_dist(xs: np.ndarray, ys: np.ndarray, x1: float, y1: float, x2: float, y2: float) -> np.ndarray:
+    """Return the distance from each point to a line segment.
+
+    :param xs: x coordinates of the points (broadcast against ys)
+    :param ys: y coordinates of the points
+    :param x1: x coordinate of the segment's starting point
+    :param y1: y coordinate of the segment's starting point
+    :param x2: x coordinate of the segment's ending point
+    :param y2: y coordinate of the segment's ending point
+    """
+    dx, dy = x2 - x1, y2 - y1
+    len_sq = dx * dx + dy * dy
+    if len_sq == 0:
+        return np.hypot(xs - x1, ys - y1)
+    t = np.clip(((xs - x1) * dx + (ys - y1) * dy) / len_sq, 0.0, 1.0)
+    return np.hypot(xs - (x1 + t * dx), ys - (y1 + t * dy))
+
+
+def arc_dist(xs: np.ndarray, ys: np.ndarray, arc: GrbrArc) -> np.ndarray:
+    """Return the distance from each point to an arc's centerline.
+
+    :param xs: x coordinates of the points (broadcast against ys)
+    :param ys: y coordinates of the points
+    :param arc: the arc
+
+    For points whose angle (as seen from the arc's center) lies within the arc's sweep the distance is
+    measured radially, for all other points it is the distance to the nearest end point of the arc.
+    """
+    start, sweep = arc_angles(arc)
+    radius = math.hypot(arc.x1 - arc.cx, arc.y1 - arc.cy)
+    rel_x, rel_y = xs - arc.cx, ys - arc.cy
+    # the angle of each point, measured from the arc's start in the direction of the arc's sweep
+    angle = np.arctan2(rel_y, rel_x) - start
+    angle = np.mod(angle if sweep >= 0 else -angle, 2 * math.pi)
+    in_sweep = angle <= abs(sweep)
+    radial = np.abs(np.hypot(rel_x, rel_y) - radius)
+    to_ends = np.minimum(np.hypot(xs - arc.x1, ys - arc.y1), np.hypot(xs - arc.x2, ys - arc.y2))
+    return np.where(in_sweep, radial, to_ends)
+
+
+def polygon_mask(
+    grid: RasterGrid,
+    contours: list[list[tuple[float, float]]],
+) -> tuple[slice, slice, np.ndarray] | None:
+    """Return a mask of the pixels inside the union of closed polygons.
+
+    :param grid: the raster grid
+    :param contours: the polygons, each a list of points (the first point is not repeated at the end)
+    :return: a tuple with the row & column slices of the window covering the polygons and the mask of the
+        window, or None if the polygons do not cover any pixel
+
+    The polygons are scan converted: for each polygon, the crossings of its edges with each row of pixel
+    centers are computed all at once, sorted along the rows and paired into spans (even-odd rule). The
+    spans are accumulated into a difference array whose cumulative sum counts the polygons covering each
+    pixel. All of this is done with vectorized NumPy operations.
+    """
+    all_points = [point for contour in contours for point in contour]
+    bbox = (
+        min(p[0] for p in all_points),
+        min(p[1] for p in all_points),
+        max(p[0] for p in all_points),
+        max(p[1] for p in all_points),
+    )
+    window = pixel_window(grid, bbox)
+    if window is None:
+        return None
+    row_slice, col_slice, _, _ = window
+    n_rows, n_cols = row_slice.stop - row_slice.start, col_slice.stop - col_slice.start
+    counts = np.zeros((n_rows, n_cols + 1), dtype=np.int32)
+
+    for contour in contours:
+        if len(contour) < 3:
+            continue
+        pts = np.asarray(contour, dtype=float)
+        # edges in pixel units, relative to the window
+        px_x = (pts[:, 0] - grid.origin_x) / grid.px - 0.5 - col_slice.start
+        px_y = (pts[:, 1] - grid.origin_y) / grid.px - 0.5 - row_slice.start
+        x1, y1 = px_x, px_y
+        x2, y2 = np.roll(px_x, -1), np.roll(px_y, -1)
+        # each edge crosses the rows whose center y is in [min y, max y) - the half open interval makes sure
+        # a vertex shared by 2 edges is only counted once
+        row_lo = np.clip(np.ceil(np.minimum(y1, y2)), 0, n_rows).astype(np.int64)
+        row_hi = np.clip(np.ceil(np.maximum(y1, y2)), 0, n_rows).astype(np.int64)
+        row_cnt = row_hi - row_lo
+        if not row_cnt.sum():
+            continue
+        edge_nbr = np.repeat(np.arange(len(pts)), row_cnt)
+        first_crossing = np.repeat(np.cumsum(row_cnt) - row_cnt, row_cnt)
+        rows = np.repeat(row_lo, row_cnt) + np.arange(row_cnt.sum()) - first_crossing
+        e_x1, e_y1, e_x2, e_y2 = x1[edge_nbr], y1[edge_nbr], x2[edge_nbr], y2[edge_nbr]
+        cross_x = e_x1 + (rows - e_y1) * (e_x2 - e_x1) / (e_y2 - e_y1)
+        # sort the crossings by row, then by x, then pair them up into spans
+        order = np.lexsort((cross_x, rows))
+        rows, cross_x = rows[order], cross_x[order]
+        span_row = rows[0::2]
+        span_start = np.clip(np.ceil(cross_x[0::2]), 0, n_cols).astype(np.int64)
+        span_end = np.clip(np.ceil(cross_x[1::2]), 0, n_cols).astype(np.int64)
+        np.add.at(counts, (span_row, span_start), 1)
+        np.add.at(counts, (span_row, span_end), -1)
+
+    mask = np.cumsum(counts, axis=1)[:, :n_cols] > 0
+    return row_slice, col_slice, mask
+
+
+def polygon_outline(aperture_def: tuple[str, list[str]], x: float, y: float) -> list[tuple[float, float]] | None:
+    """Return the outline of a regular polygon aperture flashed at a point.
+
+    :param aperture_def: the aperture's definition: (name, modifiers)
+    :param x: the x coordinate of the flash
+    :param y: the y coordinate of the flash
+    :return: the vertices of the polygon, or None if the aperture is not a regular polygon
+    """
+    aperture_type, params = aperture_def
+    if aperture_type != "P" or len(params) < 2:
+        return None
+    radius, vertices = float(params[0]) / 2, int(float(params[1]))
+    rotation = math.radians(float(params[2])) if len(params) > 2 else 0.0
+    angles = [rotation + 2 * math.pi * i / vertices for i in range(vertices)]
+    return [(x + radius * math.cos(angle), y + radius * math.sin(angle)) for angle in angles]
+
+
+def draw_obj(
+    mask: np.ndarray,
+    grid: RasterGrid,
+    obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion,
+    aperture_lkp: dict[str, tuple[str, list[str]]],
+    value: bool | None = None,
+) -> None:
+    """Draw a graphic object into a raster mask.
+
+    :param mask: the raster mask to draw into, updated in place
+    :param grid: the raster grid of the mask
+    :param obj: the graphic object to draw
+    :param aperture_lkp: the aperture dictionary of the GrbrPlot that created the graphic object
+    :param value: the value to set the pixels covered by the object to, by default True for dark polarity
+        objects and False for clear polarity objects
+
+    Aperture macros are not evaluated by the parser, so flashes of macro apertures are not drawn.
+    """
+    if value is None:
+        value = obj.polarity == "dark"
+
+    if isinstance(obj, GrbrRegion):
+        tol = grid.px / 4
+        filled = polygon_mask(grid, [contour_points(contour, tol) for contour in obj.contours])
+        if filled is not None:
+            row_slice, col_slice, covered = filled
+            mask[row_slice, col_slice][covered] = value
+        return
+
+    aperture_def = aperture_lkp.get(obj.aperture)
+    if not aperture_def:
+        return
+    aperture_type, params = aperture_def
+    if isinstance(obj, GrbrFlash) and aperture_type == "P":
+        filled = polygon_mask(grid, [polygon_outline(aperture_def, obj.x, obj.y)])
+        if filled is not None:
+            row_slice, col_slice, covered = filled
+            hole_dia = float(params[3]) if len(params) > 3 else 0.0
+            if hole_dia:
+                xs = grid.origin_x + (np.arange(col_slice.start, col_slice.stop) + 0.5) * grid.px
+                ys = grid.origin_y + (np.arange(row_slice.start, row_slice.stop) + 0.5) * grid.px
+                covered &= np.hypot(xs[np.newaxis, :] - obj.x, ys[:, np.newaxis] - obj.y) > hole_dia / 2
+            mask[row_slice, col_slice][covered] = value
+        return
+
+    window = pixel_window(grid, obj_bbox(obj, aperture_lkp))
+    if window is None:
+        return
+    row_slice, col_slice, xs, ys = window
+    covered = shape_mask(obj, aperture_type, [float(p) for p in params], xs, ys)
+    if covered is not None:
+        mask[row_slice, col_slice][covered] = value
+
+
+def shape_mask(
+    obj: GrbrFlash | GrbrDraw | GrbrArc,
+    aperture_type: str,
+    params: list[float],
+    xs: np.ndarray,
+    ys: np.ndarray,
+) -> np.ndarray | None:
+    """Return the mask of the pixel centers covered by a flash, draw or arc of a standard aperture.
+
+    :param obj: the flash, draw or arc
+    :param aperture_type: the standard aperture name: C, R or O
+    :param params: the aperture's modifiers as floats
+    :param xs: the x coordinates of the pixel centers (row vector)
+    :param ys: the y coordinates of the pixel centers (column vector)
+    :return: the mask, or None for apertures that cannot be drawn (aperture macros)
+    """
+    if isinstance(obj, GrbrFlash):
+        rel_x, rel_y = xs - obj.x, ys - obj.y
+        if aperture_type == "C":
+            covered, hole_idx = np.hypot(rel_x, rel_y) <= params[0] / 2, 1
+        elif aperture_type == "R":
+            covered, hole_idx = (np.abs(rel_x) <= params[0] / 2) & (np.abs(rel_y) <= params[1] / 2), 2
+        elif aperture_type == "O":
+            width, height = params[0], params[1]
+            radius = min(width, height) / 2
+            half_x, half_y = (width / 2 - radius, 0.0) if width >= height else (0.0, height / 2 - radius)
+            covered, hole_idx = segment_dist(rel_x, rel_y, -half_x, -half_y, half_x, half_y) <= radius, 2
+        else:
+            return None
+        if len(params) > hole_idx and params[hole_idx]:
+            covered &= np.hypot(rel_x, rel_y) > params[hole_idx] / 2
+        return covered
+
+    if aperture_type == "C":
+        half_width = params[0] / 2
+        if isinstance(obj, GrbrArc):
+            return arc_dist(xs, ys, obj) <= half_width
+        return segment_dist(xs, ys, obj.x1, obj.y1, obj.x2, obj.y2) <= half_width
+
+    if aperture_type == "R" and isinstance(obj, GrbrDraw):
+        # a rectangle dragged along a segment: the pixel is covered if the rectangle, centered on the
+        # pixel, intersects the segment. The segment is clipped to the rectangle's slab in x, then in y.
+        half_x, half_y = params[0] / 2, params[1] / 2
+        dx, dy = obj.x2 - obj.x1, obj.y2 - obj.y1
+        t0, t1 = np.zeros(np.broadcast(xs, ys).shape), np.ones(np.broadcast(xs, ys).shape)
+        for start, delta, centers, half in ((obj.x1, dx, xs, half_x), (obj.y1, dy, ys, half_y)):
+            if delta == 0:
+                outside = np.abs(centers - start) > half
+                t0 = np.where(outside, 2.0, t0)
+            else:
+                ta, tb = (centers - half - start) / delta, (centers + half - start) / delta
+                t0, t1 = np.maximum(t0, np.minimum(ta, tb)), np.minimum(t1, np.maximum(ta, tb))
+        return t0 <= t1
+
+    # arcs and draws of other apertures are drawn with a circle of the aperture's smaller dimension
+    half_width = min(params[:2]) / 2 if len(params) >= 2 else (params[0] / 2 if params else 0.0)
+    if isinstance(obj, GrbrArc):
+        return arc_dist(xs, ys, obj) <= half_width
+    return segment_dist(xs, ys, obj.x1, obj.y1, obj.x2, obj.y2) <= half_width
+
+
+def round_stroke(obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion, aperture_lkp: dict) -> tuple | None:
+    """Return a flash or draw of a circle aperture without a hole as (x1, y1, x2, y2, radius), or None.
+
+    A flash is a stroke of 0 length, a pixel is covered by the stroke when its center is within the radius of the
+    stroke's segment, as in shape_mask.
+    """
+    if isinstance(obj, (GrbrArc, GrbrRegion)):
+        return None
+    aperture_def = aperture_lkp.get(obj.aperture)
+    if not aperture_def or aperture_def[0] != "C" or not aperture_def[1]:
+        return None
+    params = aperture_def[1]
+    if isinstance(obj, GrbrFlash):
+        if len(params) > 1 and float(params[1]):
+            return None
+        return obj.x, obj.y, obj.x, obj.y, float(params[0]) / 2
+    return obj.x1, obj.y1, obj.x2, obj.y2, float(params[0]) / 2
+
+
+def draw_round_strokes(
+    mask: np.ndarray,
+    grid: RasterGrid,
+    strokes: list[tuple],
+    value: bool,
+    max_window: int = 256,
+    chunk: int = 1 << 20,
+) -> None:
+    """Draw round strokes (see round_stroke) into a raster mask, the small ones all at once.
+
+    :param mask: the raster mask to draw into, updated in place
+    :param grid: the raster grid of the mask
+    :param strokes: the strokes, as tuples of: x1, y1, x2, y2, radius
+    :param value: the value to set the pixels covered by the strokes to
+    :param max_window: the strokes whose pixel window is larger than this number of pixels are drawn 1 by 1,
+        the per stroke overhead of NumPy only matters for the small ones
+    :param chunk: the largest number of candidate pixels tested in 1 batch
+
+    The candidate pixels of the small strokes (the pixel window of their bounding box) are generated with NumPy
+    repeats and tested with the same arithmetic as shape_mask, so the strokes are drawn exactly as 1 by 1.
+    """
+    rows, cols = grid.shape
+    x1, y1, x2, y2, radius = np.array(strokes, dtype=np.float64).T
+    # the pixel windows, as in pixel_window
+    c0 = np.maximum(0, np.ceil((np.minimum(x1, x2) - radius - grid.origin_x) / grid.px - 0.5)).astype(np.int64)
+    c1 = np.minimum(cols, np.floor((np.maximum(x1, x2) + radius - grid.origin_x) / grid.px - 0.5) + 1).astype(np.int64)
+    r0 = np.maximum(0, np.ceil((np.minimum(y1, y2) - radius - grid.origin_y) / grid.px - 0.5)).astype(np.int64)
+    r1 = np.minimum(rows, np.floor((np.maximum(y1, y2) + radius - grid.origin_y) / grid.px - 0.5) + 1).astype(np.int64)
+    width, height = np.maximum(c1 - c0, 0), np.maximum(r1 - r0, 0)
+    sizes = width * height
+    for nbr in np.flatnonzero(sizes > max_window).tolist():
+        row_slice, col_slice = slice(r0[nbr], r1[nbr]), slice(c0[nbr], c1[nbr])
+        xs = grid.origin_x + (np.arange(c0[nbr], c1[nbr]) + 0.5)[np.newaxis, :] * grid.px
+        ys = grid.origin_y + (np.arange(r0[nbr], r1[nbr]) + 0.5)[:, np.newaxis] * grid.px
+        covered = segment_dist(xs, ys, *strokes[nbr][:4]) <= strokes[nbr][4]
+        mask[row_slice, col_slice][covered] = value
+    sizes[sizes > max_window] = 0
+    dx, dy = x2 - x1, y2 - y1
+    len_sq = dx * dx + dy * dy
+
+    # batches of whole strokes, of about chunk candidate pixels
+    ends = np.cumsum(sizes)
+    batch_ends = np.unique(np.r_[np.searchsorted(ends, np.arange(chunk, ends[-1], chunk)) + 1, len(sizes)])
+    start = 0
+    for end in batch_ends.tolist():
+        batch_sizes = sizes[start:end]
+        stroke = np.repeat(np.arange(start, end), batch_sizes)
+        local = np.arange(len(stroke)) - np.repeat(np.cumsum(batch_sizes) - batch_sizes, batch_sizes)
+        row = r0[stroke] + local // width[stroke]
+        col = c0[stroke] + local % width[stroke]
+        xs = grid.origin_x + (col + 0.5) * grid.px
+        ys = grid.origin_y + (row + 0.5) * grid.px
+        s_x1, s_y1, s_dx, s_dy, s_len_sq = x1[stroke], y1[stroke], dx[stroke], dy[stroke], len_sq[stroke]
+        t = np.clip(((xs - s_x1) * s_dx + (ys - s_y1) * s_dy) / np.where(s_len_sq == 0, 1.0, s_len_sq), 0.0, 1.0)
+        dist = np.hypot(xs - (s_x1 + t * s_dx), ys - (s_y1 + t * s_dy))
+        covered = dist <= radius[stroke]
+        mask[row[covered], col[covered]] = value
+        start = end
+
+
+def rasterize_objs(
+    objs: list[GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion],
+    aperture_lkp: dict[str, tuple[str, list[str]]],
+    grid: RasterGrid,
+) -> np.ndarray:
+    """Rasterize graphic objects, in order and honoring their polarity.
+
+    :param objs: the graphic objects to rasterize
+    :param aperture_lkp: the aperture dictionary of the GrbrPlot that created the graphic objects
+    :param grid: the raster grid
+    :return: boolean mask of the copper pixels, with the grid's shape
+
+    The objects of the same polarity can be drawn in any order. Within each run of consecutive objects of the same
+    polarity, the round strokes (the flashes & draws of circle apertures, the bulk of the copper layers) are drawn
+    all at once with draw_round_strokes, the other objects 1 by 1.
+    """
+    mask = np.zeros(grid.shape, dtype=bool)
+    strokes: list[tuple] = []
+    polarity = None
+    for obj in objs:
+        if obj.polarity != polarity:
+            if strokes:
+                draw_round_strokes(mask, grid, strokes, polarity == "dark")
+            strokes, polarity = [], obj.polarity
+        stroke = round_stroke(obj, aperture_lkp)
+        if stroke is None:
+            draw_obj(mask, grid, obj, aperture_lkp)
+        else:
+            strokes.append(stroke)
+    if strokes:
+        draw_round_strokes(mask, grid, strokes, polarity == "dark")
+    return mask
+
+
+def distance_transform(mask: np.ndarray, max_dist: float) -> np.ndarray:
+    """Return the Euclidean distance, in pixels, from each pixel to the nearest True pixel of a mask.
+
+    :param mask: the boolean mask
+    :param max_dist: the largest distance of interest, in pixels. Pixels further than this distance from
+        any True pixel get a distance of infinity.
+    :return: float32 array of distances, with the mask's shape
+
+    The squared distance is computed in 2 separable passes:
+        1. along each column, the distance to the nearest True pixel of the column is found with running
+           maximum / minimum scans of the True pixel row indexes
+        2. along each row, the squared distance is the minimum over the horizontal offsets k (|k| <= max_dist)
+           of: column distance of the pixel k columns away + k^2
+
+    Limiting the 2nd pass to offsets within the maximum distance makes the cost proportional to the number
+    of pixels times the maximum distance, and every pass is a whole-array NumPy operation. Distances up to
+    the maximum distance are exact: the squared distances are integers, exact in float32 below 2^24.
+    """
+    rows = mask.shape[0]
+    reach = int(math.ceil(max_dist))
+    no_pixel = rows + reach + 1
+
+    # pass 1 - the distance to the nearest True pixel above or below, in the same column
+    row_idx = np.arange(rows, dtype=np.int32)[:, np.newaxis]
+    prev_true = np.maximum.accumulate(np.where(mask, row_idx, -no_pixel), axis=0)
+    next_true = np.minimum.accumulate(np.where(mask, row_idx, 2 * no_pixel)[::-1], axis=0)[::-1]
+    col_dist = np.minimum(row_idx - prev_true, next_true - row_idx).astype(np.float32)
+    col_dist_sq = np.where(col_dist <= reach, col_dist * col_dist, np.float32(np.inf))
+
+    # pass 2 - combine the column distances of the pixels within reach on the same row
+    dist_sq = col_dist_sq.copy()
+    for k in range(1, min(reach, mask.shape[1] - 1) + 1):
+        k_sq = np.float32(k * k)
+        np.minimum(dist_sq[:, k:], col_dist_sq[:, :-k] + k_sq, out=dist_sq[:, k:])
+        np.minimum(dist_sq[:, :-k], col_dist_sq[:, k:] + k_sq, out=dist_sq[:, :-k])
+
+    dist = np.sqrt(dist_sq)
+    dist[dist > max_dist] = np.inf
+    return dist
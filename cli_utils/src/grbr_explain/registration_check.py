@@ -0,0 +1,150 @@
+"""Cross-layer registration check between the pad flashes of copper layers and the drill hits of a board.
+
+Before a double-sided job, every through-hole pad flashed on the copper layers (e.g. F_Cu and B_Cu) must
+line up with a drill hit, and the layers must not have drifted relative to each other during export.
+
+The drill hits are loaded into a grid spatial index (with a cell size equal to the matching tolerance),
+so each pad is paired with its nearest drill hit by only looking at the neighbouring cells, rather
+than comparing every pad with every drill hit.
+
+For each copper layer the check reports:
+    * the pads paired with a drill hit, that are further from the hit's center than the centering tolerance
+    * the pads without any drill hit within the matching tolerance
+    * the drill hits without any pad within the matching tolerance
+    * the drift of the layer: the average x & y offset from the drill hits to the pads paired with them
+"""
+from collections import namedtuple
+
+from grbr_explain.min_gerber_parser import GrbrFlash, GrbrPlot, load_grbr_plot
+from grbr_explain.spatial_index import GridIndex
+
+# Tuple describing a pad flash and the drill hit it was paired with (drill_x, drill_y, dist are None if unpaired)
+PadHit = namedtuple("PadHit", ["layer", "ln_nbr", "x", "y", "aperture", "drill_x", "drill_y", "dist"])
+
+# Tuple with the results of checking the registration of one copper layer against the drill hits
+LayerRegistration = namedtuple(
+    "LayerRegistration",
+    ["layer", "matched", "off_center", "unmatched_pads", "unmatched_drills", "drift_x", "drift_y"],
+)
+
+# pads with these aperture functions (%TA.AperFunction) are surface mount pads and never have a drill hit
+SMD_APERTURE_FUNCTIONS = ("SMDPad", "BGAPad", "ConnectorPad", "FiducialPad", "HeatsinkPad")
+
+
+def drill_hits_from_grbr(grbr_plot: GrbrPlot) -> list[tuple[float, float]]:
+    """Return the drill hits of a drill file that was exported in gerber format (the flashes of the layer).
+
+    :param grbr_plot: the parsed gerber drill layer
+    :return: list of the x, y coordinates of the drill hits
+    """
+    return [(obj.x, obj.y) for obj in grbr_plot.graphic_objs if isinstance(obj, GrbrFlash)]
+
+
+def pad_flashes(grbr_plot: GrbrPlot, include_smd: bool = False) -> list[GrbrFlash]:
+    """Return the dark flashes of a copper layer that are expected to be drilled.
+
+    :param grbr_plot: the parsed gerber copper layer
+    :param include_smd: pass True to include the flashes of surface mount pads
+    :return: the list of pad flashes
+
+    Surface mount pads are recognized by the aperture function attribute of the flashed aperture. Flashes
+    of apertures without an aperture function are always included.
+    """
+    pads = []
+    for obj in grbr_plot.graphic_objs:
+        if not isinstance(obj, GrbrFlash) or obj.polarity != "dark":
+            continue
+        function = grbr_plot.aperture_attribs.get(obj.aperture, {}).get(".AperFunction", [""])[0]
+        if include_smd or function not in SMD_APERTURE_FUNCTIONS:
+            pads.append(obj)
+    return pads
+
+
+def check_layer_registration(
+    layer: str,
+    pads: list[GrbrFlash],
+    drill_index: GridIndex,
+    tol: float,
+    center_tol: float,
+) -> LayerRegistration:
+    """Pair each pad of a copper layer with its nearest drill hit and report the results.
+
+    :param layer: the name of the copper layer, used in the report
+    :param pads: the pad flashes of the copper layer
+    :param drill_index: the grid spatial index of the drill hits
+    :param tol: pads and drill hits further apart than this distance are not paired
+    :param center_tol: paired pads further than this distance from the drill hit's center are off-center
+    :return: the results of the check
+    """
+    matched, off_center, unmatched_pads = [], [], []
+    paired_drills = set()
+    for pad in pads:
+        nearest = drill_index.nearest(pad.x, pad.y, tol)
+        if nearest is None:
+            unmatched_pads.append(PadHit(layer, pad.ln_nbr, pad.x, pad.y, pad.aperture, None, None, None))
+            continue
+        dist, drill_nbr = nearest
+        drill_x, drill_y = drill_index.points[drill_nbr]
+        pad_hit = PadHit(layer, pad.ln_nbr, pad.x, pad.y, pad.aperture, drill_x, drill_y, dist)
+        matched.append(pad_hit)
+        if dist > center_tol:
+            off_center.append(pad_hit)
+        paired_drills.add(drill_nbr)
+
+    unmatched_drills = [point for drill_nbr, point in enumerate(drill_index.points) if drill_nbr not in paired_drills]
+
+    # a systematic offset of all the pads relative to their drill hits indicates the layer drifted during export
+    drift_x = sum(hit.x - hit.drill_x for hit in matched) / len(matched) if matched else 0.0
+    drift_y = sum(hit.y - hit.drill_y for hit in matched) / len(matched) if matched else 0.0
+
+    return LayerRegistration(layer, matched, off_center, unmatched_pads, unmatched_drills, drift_x, drift_y)
+
+
+def check_registration(
+    copper_fns: list[str],
+    drill_hits: list[tuple[float, float]],
+    tol: float = 0.25,
+    center_tol: float = 0.02,
+    include_smd: bool = False,
+) -> list[LayerRegistration]:
+    """Check the registration of the pad flashes of several copper layers against the drill hits of a board.
+
+    :param copper_fns: the file name paths of the gerber copper layers to check (e.g. F_Cu & B_Cu)
+    :param drill_hits: the x, y coordinates of the drill hits (see drill_hits_from_grbr)
+    :param tol: pads and drill hits further apart than this distance are not paired
+    :param center_tol: paired pads further than this distance from the drill hit's center are off-center
+    :param include_smd: pass True to also check the flashes of surface mount pads
+    :return: the results of the check, 1 per copper layer, in the order the layers were given
+    """
+    drill_index = GridIndex(tol)
+    for x, y in drill_hits:
+        drill_index.insert(x, y)
+
+    results = []
+    for copper_fn in copper_fns:
+        grbr_plot = load_grbr_plot(copper_fn)
+        pads = pad_flashes(grbr_plot, include_smd)
+        results.append(check_layer_registration(copper_fn, pads, drill_index, tol, center_tol))
+    return results
+
+
+def output_registration_report(results: list[LayerRegistration]) -> None:
+    """Prints out the results of a registration check.
+
+    :param results: the results returned by check_registration
+    """
+    for result in results:
+        print("-" * 100)
+        print(f"Registration of: {result.layer}")
+        print("-" * 100)
+        print(f"\tpads paired with a drill hit: {len(result.matched)}")
+        print(f"\tlayer drift: {result.drift_x:.4f}, {result.drift_y:.4f}")
+        for hit in result.off_center:
+            print(
+                f"[{hit.ln_nbr:0>3}] OFF-CENTER pad at: {hit.x:>10.3f}, {hit.y:>10.3f}"
+                f"   drill at: {hit.drill_x:>10.3f}, {hit.drill_y:>10.3f}   dist: {hit.dist:.4f}   {hit.aperture:>10}"
+            )
+        for hit in result.unmatched_pads:
+            print(f"[{hit.ln_nbr:0>3}] NO DRILL for pad at: {hit.x:>10.3f}, {hit.y:>10.3f}   {hit.aperture:>10}")
+        for x, y in result.unmatched_drills:
+            print(f"      NO PAD for drill at: {x:>10.3f}, {y:>10.3f}")
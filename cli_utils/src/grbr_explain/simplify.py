@@ -0,0 +1,269 @@
+"""Polyline simplification: the points of a polyline that do not change its shape beyond a tolerance are dropped.
+
+2 classic algorithms are available, both keep the first and last points (and any point flagged to keep):
+    * Douglas-Peucker ("dp"): a span between 2 kept points is split at its point furthest from the chord,
+      until every dropped point is within the tolerance of the chord that replaces it. The batch mode is
+      vectorized: each iteration splits every span of the polyline at once, with NumPy.
+    * Visvalingam-Whyatt ("vw"): the point whose triangle with its 2 neighbours has the smallest area is
+      dropped, repeatedly, while that area is smaller than tol * tol. It drops fewer points on smooth
+      curves but keeps their shape better (it does not bound the deviation, which is measured and reported).
+Points can have 2 (Gerber) or 3 (G-code x, y, z) coordinates.
+
+PolylineSimplifier streams a polyline through a window of points: each full window is simplified and
+written out, its last point is the anchor of the next window. DrawSimplifier chains the consecutive draws of
+a gerber layer, as they are created, and replaces each chain with its simplified draws.
+"""
+import heapq
+import math
+from collections import namedtuple
+from typing import Callable
+
+import numpy as np
+
+from grbr_explain.min_gerber_parser import GrbrArc, GrbrDraw, GrbrFlash, GrbrRegion
+
+# Tuple with the counts of a simplification
+#   points_in     - the number of points of the polylines before the simplification
+#   points_out    - the number of points kept
+#   max_deviation - the largest distance between a dropped point and the segment that replaced it
+SimplifyStats = namedtuple("SimplifyStats", ["points_in", "points_out", "max_deviation"])
+
+
+def seg_distances(points: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Return the distance of each point to its segment, in 2 or 3 dimensions.
+
+    :param points: the points, as a (n, d) array
+    :param starts: the start point of the segment of each point, as a (n, d) array (or a single point)
+    :param ends: the end point of the segment of each point, as a (n, d) array (or a single point)
+    """
+    seg = ends - starts
+    rel = points - starts
+    seg_sq = np.sum(seg * seg, axis=-1)
+    t = np.clip(np.sum(rel * seg, axis=-1) / np.where(seg_sq > 0, seg_sq, 1.0), 0.0, 1.0)
+    return np.linalg.norm(rel - t[..., None] * seg, axis=-1)
+
+
+def span_deviations(points: np.ndarray, kept: np.ndarray) -> np.ndarray:
+    """Return the distance of each point to the chord between the kept points before & after it, 0 if kept."""
+    idx = np.flatnonzero(kept)
+    span = np.cumsum(kept) - 1  # the index, in idx, of the kept point at or before each point
+    starts = points[idx[span]]
+    ends = points[idx[np.minimum(span + 1, len(idx) - 1)]]
+    dist = seg_distances(points, starts, ends)
+    dist[kept] = 0.0
+    return dist
+
+
+def douglas_peucker(points: np.ndarray, tol: float, keep: np.ndarray | None = None) -> np.ndarray:
+    """Simplify a polyline with the Douglas-Peucker algorithm, splitting all the spans at once.
+
+    :param points: the points of the polyline, as a (n, d) array
+    :param tol: the largest distance between a dropped point and the chord that replaces it
+    :param keep: optional boolean array of the points that must be kept
+    :return: boolean array of the points kept
+    """
+    count = len(points)
+    kept = np.zeros(count, dtype=bool) if keep is None else np.array(keep, dtype=bool)
+    if count:
+        kept[[0, -1]] = True
+    # the points not kept yet, in the spans that are not within the tolerance yet
+    active = np.flatnonzero(~kept)
+    while active.size:
+        idx = np.flatnonzero(kept)
+        span = np.searchsorted(idx, active) - 1  # the index, in idx, of the kept point before each point
+        dist = seg_distances(points[active], points[idx[span]], points[idx[span + 1]])
+        span_start = np.r_[True, span[1:] != span[:-1]]
+        group = np.cumsum(span_start) - 1
+        group_max = np.maximum.reduceat(dist, np.flatnonzero(span_start))[group]
+        # the furthest point of each span is kept when it is further than the tolerance, only 1 point per span
+        split = np.flatnonzero((dist > tol) & (dist == group_max))
+        split = split[np.r_[True, group[split][1:] != group[split][:-1]]] if split.size else split
+        kept[active[split]] = True
+        # the spans within the tolerance are done
+        active = active[(group_max > tol) & ~kept[active]]
+    return kept
+
+
+def triangle_area(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> float:
+    """Return the area of a triangle, in 2 or 3 dimensions."""
+    u, v = b - a, c - a
+    return 0.5 * math.sqrt(max(float(u @ u) * float(v @ v) - float(u @ v) ** 2, 0.0))
+
+
+def visvalingam(points: np.ndarray, min_area: float, keep: np.ndarray | None = None) -> np.ndarray:
+    """Simplify a polyline with the Visvalingam-Whyatt algorithm.
+
+    :param points: the points of the polyline, as a (n, d) array
+    :param min_area: points are dropped while the smallest triangle area is below this value
+    :param keep: optional boolean array of the points that must be kept
+    :return: boolean array of the points kept
+    """
+    count = len(points)
+    kept = np.ones(count, dtype=bool)
+    forced = np.zeros(count, dtype=bool) if keep is None else keep
+    prev_nbr, next_nbr = list(range(-1, count - 1)), list(range(1, count + 1))
+    areas = [math.inf] * count
+    heap = []
+    for nbr in range(1, count - 1):
+        if not forced[nbr]:
+            areas[nbr] = triangle_area(points[nbr - 1], points[nbr], points[nbr + 1])
+            heap.append((areas[nbr], nbr))
+    heapq.heapify(heap)
+    while heap:
+        area, nbr = heapq.heappop(heap)
+        if not kept[nbr] or area != areas[nbr]:
+            continue  # stale heap entry, the point was dropped or its area changed
+        if area >= min_area:
+            break
+        kept[nbr] = False
+        before, after = prev_nbr[nbr], next_nbr[nbr]
+        next_nbr[before], prev_nbr[after] = after, before
+        # the neighbours get new triangles, never smaller than the dropped one (the "effective area")
+        for other in (before, after):
+            if 0 < other < count - 1 and not forced[other]:
+                areas[other] = max(triangle_area(points[prev_nbr[other]], points[other], points[next_nbr[other]]), area)
+                heapq.heappush(heap, (areas[other], other))
+    return kept
+
+
+def simplify_points(
+    points: np.ndarray,
+    tol: float,
+    method: str = "dp",
+    keep: np.ndarray | None = None,
+) -> np.ndarray:
+    """Simplify a polyline, in memory.
+
+    :param points: the points of the polyline, as a (n, 2) or (n, 3) array
+    :param tol: the tolerance: the largest deviation (dp), or the square root of the smallest area kept (vw)
+    :param method: "dp" for Douglas-Peucker or "vw" for Visvalingam-Whyatt
+    :param keep: optional boolean array of the points that must be kept
+    :return: boolean array of the points kept
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if method == "dp":
+        return douglas_peucker(points, tol, keep)
+    if method == "vw":
+        return visvalingam(points, tol * tol, keep)
+    raise ValueError(f"Unknown simplification method: {method}, expected dp or vw")
+
+
+class PolylineSimplifier:
+    """Streaming polyline simplifier, holds at most a window of points."""
+
+    def __init__(self, tol: float, method: str = "dp", window: int = 1000):
+        """Create a simplifier.
+
+        :param tol: the tolerance (see simplify_points)
+        :param method: "dp" for Douglas-Peucker or "vw" for Visvalingam-Whyatt
+        :param window: the number of points simplified at a time
+        """
+        self.tol = tol
+        self.method = method
+        self.window = max(window, 3)
+        self.points: list[tuple] = []
+        self.items: list = []
+        self.keep: list[bool] = []
+        self.points_in = self.points_out = 0
+        self.max_deviation = 0.0
+
+    @property
+    def stats(self) -> SimplifyStats:
+        """Return the counts of the points processed so far."""
+        return SimplifyStats(self.points_in, self.points_out, self.max_deviation)
+
+    def push(self, point: tuple, item=None, keep: bool = False) -> list[tuple[tuple, object]]:
+        """Add the next point of the polyline.
+
+        :param point: the coordinates of the point
+        :param item: the data carried along with the point (e.g. its G-code line)
+        :param keep: True if the point must be kept
+        :return: the points kept and written out, as tuples of: the point, its item. The first point of the
+            polyline is written out as soon as it is pushed.
+        """
+        self.points_in += 1
+        self.points.append(point)
+        self.items.append(item)
+        self.keep.append(keep)
+        if len(self.points) == 1:
+            self.points_out += 1
+            return [(point, item)]
+        return self.simplify_window() if len(self.points) >= self.window else []
+
+    def finish(self) -> list[tuple[tuple, object]]:
+        """Write out the rest of the polyline, the simplifier is then ready for a new polyline."""
+        out = self.simplify_window() if len(self.points) > 1 else []
+        self.points, self.items, self.keep = [], [], []
+        return out
+
+    def simplify_window(self) -> list[tuple[tuple, object]]:
+        """Simplify the points of the window, write out the points kept after the anchor (the first point)."""
+        points = np.array(self.points, dtype=np.float64)
+        kept = simplify_points(points, self.tol, self.method, np.array(self.keep))
+        self.max_deviation = max(self.max_deviation, float(span_deviations(points, kept).max()))
+        out = [(self.points[nbr], self.items[nbr]) for nbr in np.flatnonzero(kept)[1:]]
+        self.points_out += len(out)
+        # the last point, always kept, is the anchor of the next window
+        self.points, self.items, self.keep = self.points[-1:], self.items[-1:], [True]
+        return out
+
+
+class DrawSimplifier:
+    """Simplifies the chains of draws of a gerber layer as they are created, passing on the other objects."""
+
+    def __init__(
+        self,
+        tol: float,
+        out: Callable[[GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion], None],
+        method: str = "dp",
+        window: int = 1000,
+    ):
+        """Create a draw simplifier.
+
+        :param tol: the tolerance (see simplify_points)
+        :param out: the callable called with each simplified draw and each other graphic object, in order
+            (e.g. an SvgWriter or the append method of a list)
+        :param method: "dp" for Douglas-Peucker or "vw" for Visvalingam-Whyatt
+        :param window: the number of points simplified at a time
+        """
+        self.out = out
+        self.simplifier = PolylineSimplifier(tol, method, window)
+        self.chain: GrbrDraw | None = None  # the first draw of the current chain
+        self.last: GrbrDraw | None = None  # the last draw of the current chain
+        self.start: tuple[float, float] | None = None  # the start of the next simplified draw
+
+    def __call__(self, obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion) -> None:
+        """Add a graphic object, this makes the simplifier usable as a graphic object handler of a GrbrPlot."""
+        if isinstance(obj, GrbrDraw):
+            last = self.last
+            chained = last and (obj.aperture, obj.polarity) == (last.aperture, last.polarity)
+            if chained and (obj.x1, obj.y1) == (last.x2, last.y2):
+                self.last = obj
+                self.write_points(self.simplifier.push((obj.x2, obj.y2), obj.ln_nbr))
+                return
+            self.close()
+            self.chain = self.last = obj
+            self.write_points(self.simplifier.push((obj.x1, obj.y1), obj.ln_nbr))
+            self.write_points(self.simplifier.push((obj.x2, obj.y2), obj.ln_nbr))
+            return
+        self.close()
+        self.out(obj)
+
+    def write_points(self, points: list[tuple[tuple, object]]) -> None:
+        """Pass on the draws between the kept points of the current chain."""
+        for point, ln_nbr in points:
+            if self.start is not None:
+                x1, y1 = self.start
+                self.out(GrbrDraw(ln_nbr, x1, y1, point[0], point[1], self.chain.aperture, self.chain.polarity))
+            self.start = point
+
+    def close(self) -> None:
+        """Pass on the end of the current chain, must be called after the last graphic object."""
+        if self.last:
+            self.write_points(self.simplifier.finish())
+        self.chain = self.last = self.start = None
+
+    @property
+    def stats(self) -> SimplifyStats:
+        """Return the counts of the draw end points processed so far."""
+        return self.simplifier.stats
@@ -0,0 +1,135 @@
+"""Uniform grid spatial index for points, used to find nearby features without pairwise comparison."""
+import math
+from collections import defaultdict
+from typing import Any
+
+
+class GridIndex:
+    """Spatial index that buckets points into the square cells of a uniform grid.
+
+    Inserting a point and finding the points within a radius of a location only look at the cells
+    around the location, so both are O(1) for points spread evenly relative to the cell size. The
+    cell size should be about the size of the radius used by the queries.
+    """
+
+    def __init__(self, cell_size: float):
+        """Create an empty grid index.
+
+        :param cell_size: the width (and height) of a grid cell, must be greater than 0
+        """
+        if cell_size <= 0:
+            raise ValueError(f"Grid cell size must be greater than 0, got: {cell_size}")
+        self.cell_size = cell_size
+        self.cells: dict[tuple[int, int], list[int]] = defaultdict(list)  # the point indexes in each cell
+        self.points: list[tuple[float, float]] = []  # the x, y coordinates of each point, by point index
+        self.items: list[Any] = []  # the item (any payload) stored with each point, by point index
+        self.removed: set[int] = set()  # the indexes of points that have been removed
+        self.cell_bounds: list[int] | None = None  # the min column, min row, max column & max row of used cells
+
+    def __len__(self) -> int:
+        """Return the number of points in the index, excluding the removed points."""
+        return len(self.points) - len(self.removed)
+
+    def cell_of(self, x: float, y: float) -> tuple[int, int]:
+        """Return the column and row of the grid cell containing a location."""
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def insert(self, x: float, y: float, item: Any = None) -> int:
+        """Add a point to the index.
+
+        :param x: the x coordinate of the point
+        :param y: the y coordinate of the point
+        :param item: optional payload to store with the point
+        :return: the index of the point, points are indexed in the order they are inserted starting at 0
+        """
+        index = len(self.points)
+        self.points.append((x, y))
+        self.items.append(item)
+        c_x, c_y = self.cell_of(x, y)
+        self.cells[(c_x, c_y)].append(index)
+        if self.cell_bounds is None:
+            self.cell_bounds = [c_x, c_y, c_x, c_y]
+        else:
+            bounds = self.cell_bounds
+            bounds[:] = min(bounds[0], c_x), min(bounds[1], c_y), max(bounds[2], c_x), max(bounds[3], c_y)
+        return index
+
+    def remove(self, index: int) -> None:
+        """Remove a point from the index, so it is no longer returned by queries.
+
+        :param index: the index of the point to remove
+        """
+        if index not in self.removed:
+            self.removed.add(index)
+            self.cells[self.cell_of(*self.points[index])].remove(index)
+
+    def query_radius(self, x: float, y: float, radius: float) -> list[tuple[float, int]]:
+        """Return the points within a distance of a location, nearest first.
+
+        :param x: the x coordinate of the location
+        :param y: the y coordinate of the location
+        :param radius: the maximum distance from the location
+        :return: list of tuples with the distance to and the index of each point found
+        """
+        c_x0, c_y0 = self.cell_of(x - radius, y - radius)
+        c_x1, c_y1 = self.cell_of(x + radius, y + radius)
+        found = []
+        for c_x in range(c_x0, c_x1 + 1):
+            for c_y in range(c_y0, c_y1 + 1):
+                for index in self.cells.get((c_x, c_y), ()):
+                    p_x, p_y = self.points[index]
+                    dist = math.hypot(p_x - x, p_y - y)
+                    if dist <= radius:
+                        found.append((dist, index))
+        found.sort()
+        return found
+
+    def nearest(self, x: float, y: float, max_dist: float = math.inf) -> tuple[float, int] | None:
+        """Return the point nearest to a location.
+
+        :param x: the x coordinate of the location
+        :param y: the y coordinate of the location
+        :param max_dist: only points within this distance of the location are considered
+        :return: a tuple with the distance to and the index of the nearest point, or None if there is no
+            point within the maximum distance
+
+        The search looks at rings of cells of increasing size around the location's cell, until a point
+        has been found and the next ring is further away than the nearest point found so far.
+        """
+        if len(self) == 0:
+            return None
+        c_x, c_y = self.cell_of(x, y)
+        best: tuple[float, int] | None = None
+        ring = 0
+        # the number of rings needed to cover the whole grid bounds the search when no point is close
+        max_ring = self.max_ring(c_x, c_y)
+        while ring <= max_ring:
+            # any point in this ring is at least (ring - 1) cells away from the location
+            ring_dist = (ring - 1) * self.cell_size
+            if ring_dist > max_dist or (best and ring_dist > best[0]):
+                break
+            for cell in self.ring_cells(c_x, c_y, ring):
+                for index in self.cells.get(cell, ()):
+                    p_x, p_y = self.points[index]
+                    dist = math.hypot(p_x - x, p_y - y)
+                    if dist <= max_dist and (best is None or dist < best[0]):
+                        best = (dist, index)
+            ring += 1
+        return best
+
+    def max_ring(self, c_x: int, c_y: int) -> int:
+        """Return the number of rings of cells around a cell needed to reach every cell that was ever used."""
+        x_min, y_min, x_max, y_max = self.cell_bounds
+        return max(abs(x_min - c_x), abs(x_max - c_x), abs(y_min - c_y), abs(y_max - c_y))
+
+    @staticmethod
+    def ring_cells(c_x: int, c_y: int, ring: int) -> list[tuple[int, int]]:
+        """Return the cells on the square ring, at the given distance in cells, around a cell."""
+        if ring == 0:
+            return [(c_x, c_y)]
+        cells = []
+        for d in range(-ring, ring + 1):
+            cells.extend(((c_x + d, c_y - ring), (c_x + d, c_y + ring)))
+        for d in range(-ring + 1, ring):
+            cells.extend(((c_x - ring, c_y + d), (c_x + ring, c_y + d)))
+        return cells
@@ -0,0 +1,282 @@
+"""Streaming SVG export of the graphic objects of a gerber layer, for quick visual checks in a browser.
+
+The SVG is written while the gerber file is being parsed: an SvgWriter is registered as a graphic object
+handler of the GrbrPlot, and each graphic object is written (or buffered briefly) as soon as it is created.
+To keep the size of the SVG, and the time a browser takes to render it, reasonable on large layers:
+    * each aperture is defined once, as a <symbol>, and each flash is a <use> of the aperture's symbol
+    * the draws and arcs of an aperture are merged into a single <path> (with round caps and joins), chained
+      segments continue the current sub-path and other segments start a new one
+    * numbers are written with only as many digits as needed
+
+Gerber images are built by superimposing dark and clear objects in order. Each run of dark objects is
+written as a group, masked by the clear objects that come after it. The clear objects of a run are
+written as a group in <defs>, and the masks, which reference them, are written at the end of the file once
+all the runs are known (SVG allows the references to come before the definitions).
+
+The gerber y axis points up and the SVG y axis points down, the whole image is flipped with a transform so
+the coordinates are written unchanged. The viewBox is only known at the end of the file: a placeholder is
+written in the <svg> element and overwritten once the file is complete, so the output must be seekable.
+"""
+import math
+from typing import TextIO
+
+from grbr_explain.grbr_geom import COORD_EPS, arc_angles, obj_bbox, stroke_width
+from grbr_explain.min_gerber_parser import GrbrArc, GrbrDraw, GrbrFlash, GrbrPlot, GrbrRegion
+
+DARK_COLOR = "black"
+# width, in characters, reserved for the viewBox, which is written once the file is complete
+VIEWBOX_WIDTH = 160
+# a merged path is written out once it has this many segments
+MAX_PATH_SEGMENTS = 2000
+
+
+def fmt(value: float) -> str:
+    """Return a number formatted for SVG: 4 decimal places, without trailing zeros."""
+    text = f"{value:.4f}".rstrip("0").rstrip(".")
+    return "0" if text in ("", "-0") else text
+
+
+class SvgWriter:
+    """Writes the graphic objects of a gerber layer to an SVG file, as they are created."""
+
+    def __init__(self, svg_fh: TextIO, aperture_lkp: dict[str, tuple[str, list[str]]]):
+        """Start the SVG document.
+
+        :param svg_fh: the seekable text file the SVG is written to
+        :param aperture_lkp: the aperture dictionary of the GrbrPlot, it may still be filled in while parsing
+        """
+        self.svg_fh = svg_fh
+        self.aperture_lkp = aperture_lkp
+        self.symbols: set[str] = set()  # the apertures whose symbol has been written
+        self.paths: dict[str, list[str]] = {}  # the path data of the merged draws & arcs of each aperture
+        self.path_ends: dict[str, tuple[float, float]] = {}  # the end point of each aperture's path
+        self.path_counts: dict[str, int] = {}  # the number of segments of each aperture's path
+        self.runs: list[str] = []  # the polarity of each run of objects written so far
+        self.bbox: list[float] | None = None  # x min, y min, x max, y max of all the objects
+        self.obj_count = 0
+
+        svg_fh.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        svg_fh.write('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" ')
+        self.viewbox_pos = svg_fh.tell()
+        svg_fh.write(" " * VIEWBOX_WIDTH + ">\n")
+        svg_fh.write(f'<g transform="scale(1,-1)" fill="{DARK_COLOR}" stroke="{DARK_COLOR}">\n')
+
+    def __call__(self, obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion) -> None:
+        """Write a graphic object, this makes the writer usable as a graphic object handler of a GrbrPlot."""
+        self.add_obj(obj)
+
+    def add_obj(self, obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion) -> None:
+        """Write a graphic object (the draws and arcs are buffered until their merged path is written).
+
+        :param obj: the graphic object
+        """
+        self.obj_count += 1
+        x_min, y_min, x_max, y_max = obj_bbox(obj, self.aperture_lkp)
+        if self.bbox is None:
+            self.bbox = [x_min, y_min, x_max, y_max]
+        else:
+            bbox = self.bbox
+            bbox[:] = min(bbox[0], x_min), min(bbox[1], y_min), max(bbox[2], x_max), max(bbox[3], y_max)
+
+        if not self.runs or self.runs[-1] != obj.polarity:
+            self.start_run(obj.polarity)
+
+        if isinstance(obj, GrbrFlash):
+            self.write_symbol(obj.aperture)
+            self.svg_fh.write(f'<use xlink:href="#ap{obj.aperture}" x="{fmt(obj.x)}" y="{fmt(obj.y)}"/>\n')
+        elif isinstance(obj, GrbrRegion):
+            data = " ".join(contour_data(contour) for contour in obj.contours)
+            self.svg_fh.write(f'<path stroke="none" d="{data}"/>\n')
+        else:
+            self.add_segment(obj)
+
+    def add_segment(self, segment: GrbrDraw | GrbrArc) -> None:
+        """Add a draw or arc to the merged path of its aperture.
+
+        :param segment: the draw or arc
+        """
+        aperture = segment.aperture
+        path = self.paths.setdefault(aperture, [])
+        end = self.path_ends.get(aperture)
+        if end is None or math.dist(end, (segment.x1, segment.y1)) > COORD_EPS:
+            path.append(f"M{fmt(segment.x1)} {fmt(segment.y1)}")
+        path.append(segment_data(segment))
+        self.path_ends[aperture] = (segment.x2, segment.y2)
+        self.path_counts[aperture] = self.path_counts.get(aperture, 0) + 1
+        if self.path_counts[aperture] >= MAX_PATH_SEGMENTS:
+            self.write_path(aperture)
+
+    def write_path(self, aperture: str) -> None:
+        """Write out the merged path of an aperture's draws and arcs."""
+        path = self.paths.pop(aperture, None)
+        self.path_ends.pop(aperture, None)
+        self.path_counts.pop(aperture, None)
+        if not path:
+            return
+        aperture_def = self.aperture_lkp.get(aperture)
+        width = stroke_width(aperture_def)
+        # draws of a rectangular aperture are approximated with square caps
+        cap = "square" if aperture_def and aperture_def[0] == "R" else "round"
+        self.svg_fh.write(
+            f'<path fill="none" stroke-width="{fmt(width)}" stroke-linecap="{cap}" stroke-linejoin="round" '
+            f'd="{"".join(path)}"/>\n'
+        )
+
+    def write_symbol(self, aperture: str) -> None:
+        """Write the symbol of an aperture, the first time it is flashed."""
+        if aperture in self.symbols:
+            return
+        self.symbols.add(aperture)
+        shape = aperture_shape(self.aperture_lkp.get(aperture))
+        self.svg_fh.write(f'<defs><symbol id="ap{aperture}" overflow="visible">{shape}</symbol></defs>\n')
+
+    def start_run(self, polarity: str) -> None:
+        """End the current run of objects and start a run of the given polarity."""
+        self.end_run()
+        self.runs.append(polarity)
+        run_nbr = len(self.runs)
+        if polarity == "dark":
+            self.svg_fh.write(f'<g id="run{run_nbr}" mask="url(#mask{run_nbr})">\n')
+        else:
+            self.svg_fh.write(f'<defs><g id="run{run_nbr}" fill="black" stroke="black">\n')
+
+    def end_run(self) -> None:
+        """Write out the merged paths of the current run and close its group."""
+        if not self.runs:
+            return
+        for aperture in list(self.paths):
+            self.write_path(aperture)
+        self.svg_fh.write("</g>\n" if self.runs[-1] == "dark" else "</g></defs>\n")
+
+    def close(self) -> None:
+        """Finish the SVG document: write the masks of the dark runs and fill in the viewBox."""
+        self.end_run()
+        x_min, y_min, x_max, y_max = self.bbox or (0.0, 0.0, 1.0, 1.0)
+        margin = max(x_max - x_min, y_max - y_min) * 0.02 or 1.0
+        x_min, y_min, x_max, y_max = x_min - margin, y_min - margin, x_max + margin, y_max + margin
+        rect = f'x="{fmt(x_min)}" y="{fmt(y_min)}" width="{fmt(x_max - x_min)}" height="{fmt(y_max - y_min)}"'
+
+        # each dark run is masked by the clear runs that come after it
+        self.svg_fh.write("<defs>\n")
+        for run_nbr, polarity in enumerate(self.runs, 1):
+            if polarity != "dark":
+                continue
+            self.svg_fh.write(f'<mask id="mask{run_nbr}" maskUnits="userSpaceOnUse" {rect}>')
+            self.svg_fh.write(f'<rect {rect} fill="white" stroke="none"/>')
+            for clear_nbr in range(run_nbr + 1, len(self.runs) + 1, 2):
+                self.svg_fh.write(f'<use xlink:href="#run{clear_nbr}"/>')
+            self.svg_fh.write("</mask>\n")
+        self.svg_fh.write("</defs>\n</g>\n</svg>\n")
+
+        # the svg's y axis points down, the flipped image spans from -y max to -y min
+        viewbox = (
+            f'width="{fmt(x_max - x_min)}mm" height="{fmt(y_max - y_min)}mm" '
+            f'viewBox="{fmt(x_min)} {fmt(-y_max)} {fmt(x_max - x_min)} {fmt(y_max - y_min)}"'
+        )
+        if len(viewbox) > VIEWBOX_WIDTH:
+            raise ValueError(f"The SVG viewBox does not fit in its placeholder: {viewbox}")
+        self.svg_fh.seek(self.viewbox_pos)
+        self.svg_fh.write(viewbox.ljust(VIEWBOX_WIDTH))
+        self.svg_fh.seek(0, 2)
+
+
+def segment_data(segment: GrbrDraw | GrbrArc) -> str:
+    """Return the path data that continues a path, from the start of a draw or arc, to its end."""
+    if isinstance(segment, GrbrDraw):
+        return f"L{fmt(segment.x2)} {fmt(segment.y2)}"
+    start, sweep = arc_angles(segment)
+    radius = fmt(segment.radius or math.dist((segment.cx, segment.cy), (segment.x1, segment.y1)))
+    # in the (unflipped) gerber coordinates, a positive angle direction is counterclockwise
+    sweep_flag = 1 if sweep > 0 else 0
+    if abs(sweep) >= 2 * math.pi - 1e-9:
+        # a full circle is written as 2 half circles, as an svg arc's end must differ from its start
+        mid_x, mid_y = 2 * segment.cx - segment.x1, 2 * segment.cy - segment.y1
+        return (
+            f"A{radius} {radius} 0 0 {sweep_flag} {fmt(mid_x)} {fmt(mid_y)}"
+            f"A{radius} {radius} 0 0 {sweep_flag} {fmt(segment.x2)} {fmt(segment.y2)}"
+        )
+    large_flag = 1 if abs(sweep) > math.pi else 0
+    return f"A{radius} {radius} 0 {large_flag} {sweep_flag} {fmt(segment.x2)} {fmt(segment.y2)}"
+
+
+def contour_data(contour: list[GrbrDraw | GrbrArc]) -> str:
+    """Return the path data of a closed region contour."""
+    return f"M{fmt(contour[0].x1)} {fmt(contour[0].y1)}" + "".join(segment_data(seg) for seg in contour) + "Z"
+
+
+def aperture_shape(aperture_def: tuple[str, list[str]] | None) -> str:
+    """Return the SVG shape of an aperture, centered on the origin.
+
+    :param aperture_def: the aperture's definition: (name, modifiers)
+    :return: the SVG element, or an empty string for aperture macros whose geometry is not known
+
+    Apertures with a hole are drawn as a path with the even-odd fill rule, so the hole is transparent.
+    """
+    if not aperture_def or not aperture_def[1]:
+        return ""
+    aperture_type, params = aperture_def[0], [float(p) for p in aperture_def[1]]
+    if aperture_type == "C":
+        outline, hole_idx = circle_data(params[0] / 2), 1
+    elif aperture_type == "R" and len(params) >= 2:
+        width, height = params[0], params[1]
+        outline, hole_idx = f"M{fmt(-width / 2)} {fmt(-height / 2)}h{fmt(width)}v{fmt(height)}h{fmt(-width)}Z", 2
+    elif aperture_type == "O" and len(params) >= 2:
+        radius = min(params[0], params[1]) / 2
+        half_x, half_y = params[0] / 2 - radius, params[1] / 2 - radius
+        r = fmt(radius)
+        if params[0] >= params[1]:
+            outline = (
+                f"M{fmt(-half_x)} {fmt(-radius)}L{fmt(half_x)} {fmt(-radius)}A{r} {r} 0 0 1 {fmt(half_x)} {r}"
+                f"L{fmt(-half_x)} {r}A{r} {r} 0 0 1 {fmt(-half_x)} {fmt(-radius)}Z"
+            )
+        else:
+            outline = (
+                f"M{r} {fmt(-half_y)}L{r} {fmt(half_y)}A{r} {r} 0 0 1 {fmt(-radius)} {fmt(half_y)}"
+                f"L{fmt(-radius)} {fmt(-half_y)}A{r} {r} 0 0 1 {r} {fmt(-half_y)}Z"
+            )
+        hole_idx = 2
+    elif aperture_type == "P" and len(params) >= 2:
+        vertices = int(params[1])
+        rotation = math.radians(params[2]) if len(params) > 2 else 0.0
+        points = [
+            (params[0] / 2 * math.cos(rotation + 2 * math.pi * i / vertices),
+             params[0] / 2 * math.sin(rotation + 2 * math.pi * i / vertices))
+            for i in range(vertices)
+        ]
+        outline, hole_idx = "M" + "L".join(f"{fmt(x)} {fmt(y)}" for x, y in points) + "Z", 3
+    else:
+        return ""
+    if len(params) > hole_idx and params[hole_idx] > 0:
+        outline += circle_data(params[hole_idx] / 2)
+    return f'<path stroke="none" fill-rule="evenodd" d="{outline}"/>'
+
+
+def circle_data(radius: float) -> str:
+    """Return the path data of a circle centered on the origin."""
+    r = fmt(radius)
+    return f"M{r} 0A{r} {r} 0 0 1 {fmt(-radius)} 0A{r} {r} 0 0 1 {r} 0Z"
+
+
+def attach_svg_writer(grbr_plot: GrbrPlot, svg_fh: TextIO) -> SvgWriter:
+    """Create an SVG writer and register it to receive the graphic objects of a GrbrPlot as they are parsed.
+
+    :param grbr_plot: the GrbrPlot, before its lines are parsed
+    :param svg_fh: the seekable text file the SVG is written to
+    :return: the SVG writer, call its close() method once the file is parsed
+    """
+    writer = SvgWriter(svg_fh, grbr_plot.aperture_lkp)
+    grbr_plot.graphic_obj_handlers.append(writer)
+    return writer
+
+
+def export_svg(grbr_plot: GrbrPlot, svg_fn: str) -> None:
+    """Write the graphic objects of an already parsed gerber layer to an SVG file.
+
+    :param grbr_plot: the parsed gerber layer
+    :param svg_fn: the file name path of the SVG file to write
+    """
+    with open(svg_fn, "w", encoding="utf-8", buffering=1 << 16) as svg_fh:
+        writer = SvgWriter(svg_fh, grbr_plot.aperture_lkp)
+        for obj in grbr_plot.graphic_objs:
+            writer.add_obj(obj)
+        writer.close()
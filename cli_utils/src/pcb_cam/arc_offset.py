@@ -0,0 +1,782 @@
+"""Arc preserving offset kernel: offsets closed contours made of lines and arcs into lines and arcs.
+
+Linearizing the copper outlines before offsetting them produces huge toolpaths, while the machine can
+cut true arcs (G2/G3) natively. This kernel keeps the arcs exact: lines offset into parallel lines and
+arcs offset into concentric arcs.
+
+The offset of a set of contours is computed in 4 steps:
+    1. raw offset: each segment is offset by the distance, to the right of its direction of travel.
+       Consecutive raw segments that no longer meet are joined: at a convex vertex by an arc centered on
+       the vertex (the round join of a tool going around a corner), at a concave vertex by 2 lines through
+       the vertex (these are always removed in step 3).
+    2. self-intersections: the raw segments are split at every point where 2 of them intersect. The
+       candidate pairs are found with a grid of segment bounding boxes, not by pairwise comparison.
+    3. validation: a piece is kept only if its midpoint is at least the offset distance away from the
+       original contours, and outside of them for an outward offset (inside for an inward offset). Both
+       tests go through grid indexes, the nearby segments and the edges in the midpoint's horizontal strip.
+    4. chaining: the kept pieces are chained back into closed contours by matching their end points.
+
+Contours are lists of Line and Arc segments, where the end of each segment is the start of the next and
+the end of the last segment is the start of the first.
+"""
+import math
+from collections import defaultdict, deque, namedtuple
+
+from grbr_explain.grbr_geom import arc_points
+from grbr_explain.min_gerber_parser import GrbrArc, GrbrDraw, GrbrFlash, GrbrRegion
+
+# a straight line segment from (x1, y1) to (x2, y2)
+Line = namedtuple("Line", ["x1", "y1", "x2", "y2"])
+# a circular arc from (x1, y1) to (x2, y2) around the center point (cx, cy), ccw is True for counterclockwise
+Arc = namedtuple("Arc", ["x1", "y1", "x2", "y2", "cx", "cy", "ccw"])
+
+# tolerance used to decide if 2 points are the same point, or if a value is 0
+EPS = 1e-9
+
+
+def arc_radius(arc: Arc) -> float:
+    """Return the radius of an arc."""
+    return math.hypot(arc.x1 - arc.cx, arc.y1 - arc.cy)
+
+
+def arc_sweep(arc: Arc) -> tuple[float, float]:
+    """Return the starting angle and the unsigned sweep angle of an arc, in radians.
+
+    An arc whose starting and ending points are the same is a full circle.
+    """
+    start = math.atan2(arc.y1 - arc.cy, arc.x1 - arc.cx)
+    end = math.atan2(arc.y2 - arc.cy, arc.x2 - arc.cx)
+    sweep = (end - start) % (2 * math.pi) if arc.ccw else (start - end) % (2 * math.pi)
+    if sweep < EPS and math.hypot(arc.x2 - arc.x1, arc.y2 - arc.y1) < EPS:
+        sweep = 2 * math.pi
+    return start, sweep
+
+
+def arc_param(arc: Arc, x: float, y: float) -> float:
+    """Return the position of a point, lying on an arc's circle, along the arc: 0 at its start, 1 at its end.
+
+    Points on the circle, but not on the arc, return a value greater than 1.
+    """
+    start, sweep = arc_sweep(arc)
+    angle = math.atan2(y - arc.cy, x - arc.cx)
+    offset = (angle - start) % (2 * math.pi) if arc.ccw else (start - angle) % (2 * math.pi)
+    # an offset just short of a full turn is the start point, seen from the other side
+    if offset > 2 * math.pi - 1e-12:
+        offset = 0.0
+    return offset / sweep
+
+
+def seg_point(seg: Line | Arc, t: float) -> tuple[float, float]:
+    """Return the point at the position t (0 at the start, 1 at the end) along a segment."""
+    if isinstance(seg, Line):
+        return seg.x1 + t * (seg.x2 - seg.x1), seg.y1 + t * (seg.y2 - seg.y1)
+    start, sweep = arc_sweep(seg)
+    angle = start + (sweep if seg.ccw else -sweep) * t
+    radius = arc_radius(seg)
+    return seg.cx + radius * math.cos(angle), seg.cy + radius * math.sin(angle)
+
+
+def seg_tangent(seg: Line | Arc, at_end: bool) -> tuple[float, float]:
+    """Return the unit tangent (direction of travel) of a segment at its start or at its end."""
+    if isinstance(seg, Line):
+        length = math.hypot(seg.x2 - seg.x1, seg.y2 - seg.y1) or 1.0
+        return (seg.x2 - seg.x1) / length, (seg.y2 - seg.y1) / length
+    x, y = (seg.x2, seg.y2) if at_end else (seg.x1, seg.y1)
+    radius = arc_radius(seg) or 1.0
+    rel_x, rel_y = (x - seg.cx) / radius, (y - seg.cy) / radius
+    return (-rel_y, rel_x) if seg.ccw else (rel_y, -rel_x)
+
+
+def seg_length(seg: Line | Arc) -> float:
+    """Return the length of a segment."""
+    if isinstance(seg, Line):
+        return math.hypot(seg.x2 - seg.x1, seg.y2 - seg.y1)
+    return arc_radius(seg) * arc_sweep(seg)[1]
+
+
+def reverse_seg(seg: Line | Arc) -> Line | Arc:
+    """Return a segment that runs in the opposite direction."""
+    if isinstance(seg, Line):
+        return Line(seg.x2, seg.y2, seg.x1, seg.y1)
+    return Arc(seg.x2, seg.y2, seg.x1, seg.y1, seg.cx, seg.cy, not seg.ccw)
+
+
+def reverse_contour(contour: list[Line | Arc]) -> list[Line | Arc]:
+    """Return a contour that runs in the opposite direction."""
+    return [reverse_seg(seg) for seg in reversed(contour)]
+
+
+def contour_area(contour: list[Line | Arc]) -> float:
+    """Return the signed area enclosed by a contour, positive for counterclockwise contours.
+
+    The area is the shoelace formula over the segment end points, plus the signed area of the circular
+    segment between each arc and its chord.
+    """
+    area = 0.0
+    for seg in contour:
+        area += (seg.x1 * seg.y2 - seg.x2 * seg.y1) / 2
+        if isinstance(seg, Arc):
+            _, sweep = arc_sweep(seg)
+            sign = 1 if seg.ccw else -1
+            area += sign * arc_radius(seg) ** 2 / 2 * (sweep - math.sin(sweep))
+    return area
+
+
+def seg_bbox(seg: Line | Arc) -> tuple[float, float, float, float]:
+    """Return the bounding box of a segment as a tuple of: x min, y min, x max, y max."""
+    if isinstance(seg, Line):
+        return min(seg.x1, seg.x2), min(seg.y1, seg.y2), max(seg.x1, seg.x2), max(seg.y1, seg.y2)
+    start, sweep = arc_sweep(seg)
+    radius = arc_radius(seg)
+    xs, ys = [seg.x1, seg.x2], [seg.y1, seg.y2]
+    for quarter in range(4):
+        angle = quarter * math.pi / 2
+        offset = (angle - start) % (2 * math.pi) if seg.ccw else (start - angle) % (2 * math.pi)
+        if offset <= sweep:
+            xs.append(seg.cx + radius * math.cos(angle))
+            ys.append(seg.cy + radius * math.sin(angle))
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def point_seg_dist(x: float, y: float, seg: Line | Arc) -> float:
+    """Return the distance from a point to a segment."""
+    if isinstance(seg, Line):
+        dx, dy = seg.x2 - seg.x1, seg.y2 - seg.y1
+        len_sq = dx * dx + dy * dy
+        t = 0.0 if len_sq == 0 else min(1.0, max(0.0, ((x - seg.x1) * dx + (y - seg.y1) * dy) / len_sq))
+        return math.hypot(x - (seg.x1 + t * dx), y - (seg.y1 + t * dy))
+    if math.hypot(x - seg.cx, y - seg.cy) > EPS and arc_param(seg, x, y) <= 1.0:
+        return abs(math.hypot(x - seg.cx, y - seg.cy) - arc_radius(seg))
+    return min(math.hypot(x - seg.x1, y - seg.y1), math.hypot(x - seg.x2, y - seg.y2))
+
+
+def closest_seg_point(x: float, y: float, seg: Line | Arc) -> tuple[float, float]:
+    """Return the point of a segment closest to a point."""
+    if isinstance(seg, Line):
+        dx, dy = seg.x2 - seg.x1, seg.y2 - seg.y1
+        len_sq = dx * dx + dy * dy
+        t = 0.0 if len_sq == 0 else min(1.0, max(0.0, ((x - seg.x1) * dx + (y - seg.y1) * dy) / len_sq))
+        return seg.x1 + t * dx, seg.y1 + t * dy
+    dist = math.hypot(x - seg.cx, y - seg.cy)
+    if dist > EPS and arc_param(seg, x, y) <= 1.0:
+        radius = arc_radius(seg)
+        return seg.cx + (x - seg.cx) * radius / dist, seg.cy + (y - seg.cy) * radius / dist
+    if math.hypot(x - seg.x1, y - seg.y1) <= math.hypot(x - seg.x2, y - seg.y2):
+        return seg.x1, seg.y1
+    return seg.x2, seg.y2
+
+
+def start_contour_near(contour: list[Line | Arc], x: float, y: float) -> list[Line | Arc]:
+    """Return a closed contour rotated (and split) so that it starts at its point closest to a point."""
+    seg_nbr = min(range(len(contour)), key=lambda nbr: point_seg_dist(x, y, contour[nbr]))
+    near_x, near_y = closest_seg_point(x, y, contour[seg_nbr])
+    pieces = split_seg(contour[seg_nbr], [(near_x, near_y)])
+    if len(pieces) == 2:
+        return [pieces[1]] + contour[seg_nbr + 1:] + contour[:seg_nbr] + [pieces[0]]
+    seg = contour[seg_nbr]
+    if math.hypot(near_x - seg.x1, near_y - seg.y1) <= math.hypot(near_x - seg.x2, near_y - seg.y2):
+        return contour[seg_nbr:] + contour[:seg_nbr]
+    return contour[seg_nbr + 1:] + contour[:seg_nbr + 1]
+
+
+def point_in_contours(x: float, y: float, polygons: list[list[tuple[float, float]]]) -> bool:
+    """Return True if a point is inside any of the polygons (even-odd rule within each polygon).
+
+    :param x: the x coordinate of the point
+    :param y: the y coordinate of the point
+    :param polygons: the linearized contours to test against
+    """
+    for polygon in polygons:
+        inside = False
+        x1, y1 = polygon[-1]
+        for x2, y2 in polygon:
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+            x1, y1 = x2, y2
+        if inside:
+            return True
+    return False
+
+
+def linearize_contour(contour: list[Line | Arc], tol: float) -> list[tuple[float, float]]:
+    """Return the points of a contour with its arcs replaced by chords (within the tolerance)."""
+    points = []
+    for seg in contour:
+        if isinstance(seg, Line):
+            points.append((seg.x1, seg.y1))
+        else:
+            points.extend(arc_points(to_grbr_arc(seg), tol)[:-1])
+    return points
+
+
+def to_grbr_arc(arc: Arc) -> GrbrArc:
+    """Return a GrbrArc, for an Arc, so the gerber geometry helpers can be used with it."""
+    direction = "counterclockwise" if arc.ccw else "clockwise"
+    return GrbrArc(None, arc.x1, arc.y1, arc.x2, arc.y2, arc.cx, arc.cy, arc_radius(arc), direction, None, None)
+
+
+def contour_from_grbr(segments: list[GrbrDraw | GrbrArc]) -> list[Line | Arc]:
+    """Return the contour of Line and Arc segments for a region contour of a parsed gerber layer.
+
+    :param segments: the draws and arcs that make up the region's contour
+
+    A contour that is not explicitly closed is closed with a line. Full circle arcs are split into 2 halves.
+    """
+    contour = []
+    for seg in segments:
+        if isinstance(seg, GrbrArc):
+            contour.extend(circle_halves(seg.cx, seg.cy, seg.x1, seg.y1, seg.direction == "counterclockwise"))
+            if math.hypot(seg.x2 - seg.x1, seg.y2 - seg.y1) >= EPS:
+                ccw = seg.direction == "counterclockwise"
+                contour[-2:] = [Arc(seg.x1, seg.y1, seg.x2, seg.y2, seg.cx, seg.cy, ccw)]
+        elif math.hypot(seg.x2 - seg.x1, seg.y2 - seg.y1) >= EPS:
+            contour.append(Line(seg.x1, seg.y1, seg.x2, seg.y2))
+    if contour and math.hypot(contour[-1].x2 - contour[0].x1, contour[-1].y2 - contour[0].y1) >= EPS:
+        contour.append(Line(contour[-1].x2, contour[-1].y2, contour[0].x1, contour[0].y1))
+    return contour
+
+
+def circle_halves(cx: float, cy: float, x: float, y: float, ccw: bool = True) -> list[Arc]:
+    """Return a full circle, starting and ending at the point x, y, as 2 half circle arcs."""
+    ox, oy = 2 * cx - x, 2 * cy - y
+    return [Arc(x, y, ox, oy, cx, cy, ccw), Arc(ox, oy, x, y, cx, cy, ccw)]
+
+
+def rect_contour(x_min: float, y_min: float, x_max: float, y_max: float) -> list[Line | Arc]:
+    """Return the counterclockwise contour of a rectangle."""
+    return [
+        Line(x_min, y_min, x_max, y_min),
+        Line(x_max, y_min, x_max, y_max),
+        Line(x_max, y_max, x_min, y_max),
+        Line(x_min, y_max, x_min, y_min),
+    ]
+
+
+def stadium_contour(x1: float, y1: float, x2: float, y2: float, radius: float) -> list[Line | Arc]:
+    """Return the counterclockwise contour of the area within a distance of a line segment (a stadium).
+
+    This is the outline of a draw of a circular aperture, or of an obround aperture.
+    """
+    length = math.hypot(x2 - x1, y2 - y1)
+    if length < EPS:
+        return circle_halves(x1, y1, x1 + radius, y1)
+    # n is the unit normal to the right of the segment's direction
+    nx, ny = (y2 - y1) / length * radius, -(x2 - x1) / length * radius
+    return [
+        Line(x1 + nx, y1 + ny, x2 + nx, y2 + ny),
+        Arc(x2 + nx, y2 + ny, x2 - nx, y2 - ny, x2, y2, True),
+        Line(x2 - nx, y2 - ny, x1 - nx, y1 - ny),
+        Arc(x1 - nx, y1 - ny, x1 + nx, y1 + ny, x1, y1, True),
+    ]
+
+
+def arc_stroke_contours(arc: GrbrArc, radius: float) -> list[list[Line | Arc]]:
+    """Return the contours of the area within a distance of an arc (a curved stadium).
+
+    :param arc: the arc drawn with a circular aperture
+    :param radius: half the aperture's diameter
+    :return: the counterclockwise contour of the stroke, for a full circle the stroke is a ring: its
+        counterclockwise outer contour and its clockwise hole
+
+    If the arc's radius is smaller than the stroke's half width, the stroke covers the arc's center, and
+    its outline is approximated by the stroke's outer arc and end caps.
+    """
+    ccw = arc.direction == "counterclockwise"
+    seg = Arc(arc.x1, arc.y1, arc.x2, arc.y2, arc.cx, arc.cy, ccw)
+    if not ccw:
+        seg = reverse_seg(seg)
+    arc_r = arc_radius(seg)
+    start, sweep = arc_sweep(seg)
+    end = start + sweep
+    outer_r, inner_r = arc_r + radius, arc_r - radius
+    s_cos, s_sin, e_cos, e_sin = math.cos(start), math.sin(start), math.cos(end), math.sin(end)
+    outer_s = (seg.cx + outer_r * s_cos, seg.cy + outer_r * s_sin)
+    outer_e = (seg.cx + outer_r * e_cos, seg.cy + outer_r * e_sin)
+    inner_s = (seg.cx + inner_r * s_cos, seg.cy + inner_r * s_sin)
+    inner_e = (seg.cx + inner_r * e_cos, seg.cy + inner_r * e_sin)
+    if sweep >= 2 * math.pi - EPS:
+        outer = circle_halves(seg.cx, seg.cy, *outer_s)
+        return [outer, reverse_contour(circle_halves(seg.cx, seg.cy, *inner_s))] if inner_r > EPS else [outer]
+    contour = [Arc(*outer_s, *outer_e, seg.cx, seg.cy, True), Arc(*outer_e, *inner_e, seg.x2, seg.y2, True)]
+    if inner_r > EPS:
+        contour.append(Arc(*inner_e, *inner_s, seg.cx, seg.cy, False))
+    else:
+        contour.append(Line(*inner_e, *inner_s))
+    contour.append(Arc(*inner_s, *outer_s, seg.x1, seg.y1, True))
+    return [contour]
+
+
+def obj_outline(
+    obj: GrbrFlash | GrbrDraw | GrbrArc | GrbrRegion,
+    aperture_lkp: dict[str, tuple[str, list[str]]],
+) -> list[list[Line | Arc]]:
+    """Return the exact outline of a graphic object of a parsed gerber layer, as counterclockwise contours.
+
+    :param obj: the graphic object
+    :param aperture_lkp: the aperture dictionary of the GrbrPlot that created the graphic object
+    :return: list of contours, empty for aperture macros whose geometry is not known
+
+    Aperture holes are ignored, as isolation toolpaths only follow the outside of the copper. Draws of
+    rectangular apertures are outlined as the hull of the rectangle at both ends of the draw. The stroke of
+    a full circle arc is a ring, returned as its outer contour and its clockwise hole (offset it with
+    with_holes=True).
+    """
+    if isinstance(obj, GrbrRegion):
+        contours = [contour_from_grbr(contour) for contour in obj.contours]
+        return [c if contour_area(c) >= 0 else reverse_contour(c) for c in contours if c]
+
+    aperture_def = aperture_lkp.get(obj.aperture)
+    if not aperture_def:
+        return []
+    aperture_type, params = aperture_def[0], [float(p) for p in aperture_def[1]]
+
+    if isinstance(obj, GrbrFlash):
+        if aperture_type == "C" and params:
+            return [circle_halves(obj.x, obj.y, obj.x + params[0] / 2, obj.y)]
+        if aperture_type == "R" and len(params) >= 2:
+            half_w, half_h = params[0] / 2, params[1] / 2
+            return [rect_contour(obj.x - half_w, obj.y - half_h, obj.x + half_w, obj.y + half_h)]
+        if aperture_type == "O" and len(params) >= 2:
+            radius = min(params[0], params[1]) / 2
+            half_x, half_y = (params[0] / 2 - radius, 0.0) if params[0] >= params[1] else (0.0, params[1] / 2 - radius)
+            return [stadium_contour(obj.x - half_x, obj.y - half_y, obj.x + half_x, obj.y + half_y, radius)]
+        if aperture_type == "P" and len(params) >= 2:
+            radius, vertices = params[0] / 2, int(params[1])
+            rotation = math.radians(params[2]) if len(params) > 2 else 0.0
+            points = [
+                (obj.x + radius * math.cos(rotation + 2 * math.pi * i / vertices),
+                 obj.y + radius * math.sin(rotation + 2 * math.pi * i / vertices))
+                for i in range(vertices)
+            ]
+            return [[Line(*points[i], *points[(i + 1) % vertices]) for i in range(vertices)]]
+        return []
+
+    if aperture_type == "R" and isinstance(obj, GrbrDraw) and len(params) >= 2:
+        half_w, half_h = params[0] / 2, params[1] / 2
+        corners = [
+            (x + sx * half_w, y + sy * half_h)
+            for x, y in ((obj.x1, obj.y1), (obj.x2, obj.y2))
+            for sx, sy in ((-1, -1), (1, -1), (1, 1), (-1, 1))
+        ]
+        hull = convex_hull(corners)
+        return [[Line(*hull[i], *hull[(i + 1) % len(hull)]) for i in range(len(hull))]]
+
+    radius = (min(params[:2]) if len(params) >= 2 and aperture_type != "C" else params[0]) / 2 if params else 0.0
+    if radius <= 0:
+        return []
+    if isinstance(obj, GrbrArc):
+        return arc_stroke_contours(obj, radius)
+    return [stadium_contour(obj.x1, obj.y1, obj.x2, obj.y2, radius)]
+
+
+def convex_hull(points: list[tuple[float, float]]) -> list[tuple[float, float]]:
+    """Return the counterclockwise convex hull of a set of points (Andrew's monotone chain)."""
+    points = sorted(set(points))
+    if len(points) <= 2:
+        return points
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    lower, upper = [], []
+    for point in points:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], point) <= 0:
+            lower.pop()
+        lower.append(point)
+    for point in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], point) <= 0:
+            upper.pop()
+        upper.append(point)
+    return lower[:-1] + upper[:-1]
+
+
+def offset_seg(seg: Line | Arc, dist: float) -> Line | Arc | None:
+    """Return a segment offset by a distance to the right of its direction of travel.
+
+    :param seg: the segment to offset
+    :param dist: the offset distance, negative values offset to the left
+    :return: the offset segment, or None if the offset collapses an arc through its center
+    """
+    if isinstance(seg, Line):
+        length = math.hypot(seg.x2 - seg.x1, seg.y2 - seg.y1)
+        nx, ny = (seg.y2 - seg.y1) / length * dist, -(seg.x2 - seg.x1) / length * dist
+        return Line(seg.x1 + nx, seg.y1 + ny, seg.x2 + nx, seg.y2 + ny)
+    radius = arc_radius(seg)
+    # the right side of a counterclockwise arc is away from its center
+    new_radius = radius + dist if seg.ccw else radius - dist
+    if new_radius <= EPS:
+        return None
+    scale = new_radius / radius
+    return Arc(
+        seg.cx + (seg.x1 - seg.cx) * scale,
+        seg.cy + (seg.y1 - seg.cy) * scale,
+        seg.cx + (seg.x2 - seg.cx) * scale,
+        seg.cy + (seg.y2 - seg.cy) * scale,
+        seg.cx,
+        seg.cy,
+        seg.ccw,
+    )
+
+
+def raw_offset(contour: list[Line | Arc], dist: float) -> list[Line | Arc]:
+    """Return the raw offset of a closed contour: its offset segments, joined at each vertex.
+
+    :param contour: the contour to offset
+    :param dist: the offset distance, to the right of the contour's direction of travel
+    :return: the raw offset segments, which may intersect each other
+    """
+    raw = []
+    count = len(contour)
+    offsets = [offset_seg(seg, dist) for seg in contour]
+    for i, seg in enumerate(contour):
+        off = offsets[i]
+        if off is None:
+            # an arc that collapsed, connect through its center (removed later as it is too close)
+            raw.append(Line(seg.x1, seg.y1, seg.cx, seg.cy))
+            raw.append(Line(seg.cx, seg.cy, seg.x2, seg.y2))
+        else:
+            raw.append(off)
+
+        # join the end of this segment's offset to the start of the next segment's offset
+        nxt_seg, nxt_off = contour[(i + 1) % count], offsets[(i + 1) % count]
+        end = (off.x2, off.y2) if off else (seg.x2, seg.y2)
+        start = (nxt_off.x1, nxt_off.y1) if nxt_off else (nxt_seg.x1, nxt_seg.y1)
+        if math.hypot(end[0] - start[0], end[1] - start[1]) < EPS:
+            continue
+        vx, vy = seg.x2, seg.y2
+        t_out, t_in = seg_tangent(seg, True), seg_tangent(nxt_seg, False)
+        turn = t_out[0] * t_in[1] - t_out[1] * t_in[0]
+        if off and nxt_off and turn * dist > 0:
+            # a convex vertex (on the offset side), round the corner with an arc around the vertex
+            raw.append(Arc(*end, *start, vx, vy, dist > 0))
+        else:
+            raw.append(Line(*end, vx, vy))
+            raw.append(Line(vx, vy, *start))
+    return raw
+
+
+class SegmentGrid:
+    """Uniform grid of segment bounding boxes, used to find the segments near a segment or a point."""
+
+    def __init__(self, cell_size: float):
+        """Create an empty grid.
+
+        :param cell_size: the width (and height) of a grid cell
+        """
+        self.cell_size = cell_size
+        self.cells: dict[tuple[int, int], list[int]] = defaultdict(list)
+
+    def cell_range(self, bbox: tuple[float, float, float, float]) -> tuple[range, range]:
+        """Return the ranges of cell columns and rows covered by a bounding box."""
+        size = self.cell_size
+        return (
+            range(math.floor(bbox[0] / size), math.floor(bbox[2] / size) + 1),
+            range(math.floor(bbox[1] / size), math.floor(bbox[3] / size) + 1),
+        )
+
+    def insert(self, index: int, bbox: tuple[float, float, float, float]) -> None:
+        """Add the segment with the given index to each cell its bounding box covers."""
+        cols, rows = self.cell_range(bbox)
+        for c_x in cols:
+            for c_y in rows:
+                self.cells[(c_x, c_y)].append(index)
+
+    def query(self, bbox: tuple[float, float, float, float]) -> set[int]:
+        """Return the indexes of the segments in the cells covered by a bounding box."""
+        found = set()
+        cols, rows = self.cell_range(bbox)
+        for c_x in cols:
+            for c_y in rows:
+                found.update(self.cells.get((c_x, c_y), ()))
+        return found
+
+
+def intersect_segs(seg_a: Line | Arc, seg_b: Line | Arc) -> list[tuple[float, float]]:
+    """Return the points where 2 segments intersect (touching end points included)."""
+    if isinstance(seg_a, Line) and isinstance(seg_b, Line):
+        return intersect_lines(seg_a, seg_b)
+    if isinstance(seg_a, Arc) and isinstance(seg_b, Arc):
+        return intersect_arcs(seg_a, seg_b)
+    line, arc = (seg_a, seg_b) if isinstance(seg_a, Line) else (seg_b, seg_a)
+    return intersect_line_arc(line, arc)
+
+
+def intersect_lines(line_a: Line, line_b: Line) -> list[tuple[float, float]]:
+    """Return the intersection point of 2 line segments (parallel segments do not intersect)."""
+    dax, day = line_a.x2 - line_a.x1, line_a.y2 - line_a.y1
+    dbx, dby = line_b.x2 - line_b.x1, line_b.y2 - line_b.y1
+    denom = dax * dby - day * dbx
+    if abs(denom) < EPS * EPS:
+        return []
+    ox, oy = line_b.x1 - line_a.x1, line_b.y1 - line_a.y1
+    t = (ox * dby - oy * dbx) / denom
+    u = (ox * day - oy * dax) / denom
+    if -EPS <= t <= 1 + EPS and -EPS <= u <= 1 + EPS:
+        return [(line_a.x1 + t * dax, line_a.y1 + t * day)]
+    return []
+
+
+def intersect_line_arc(line: Line, arc: Arc) -> list[tuple[float, float]]:
+    """Return the points where a line segment intersects an arc."""
+    dx, dy = line.x2 - line.x1, line.y2 - line.y1
+    fx, fy = line.x1 - arc.cx, line.y1 - arc.cy
+    radius = arc_radius(arc)
+    a = dx * dx + dy * dy
+    b = 2 * (fx * dx + fy * dy)
+    c = fx * fx + fy * fy - radius * radius
+    disc = b * b - 4 * a * c
+    if a < EPS * EPS or disc < 0:
+        return []
+    root = math.sqrt(disc)
+    points = []
+    for t in {(-b - root) / (2 * a), (-b + root) / (2 * a)}:
+        if -EPS <= t <= 1 + EPS:
+            x, y = line.x1 + t * dx, line.y1 + t * dy
+            if arc_param(arc, x, y) <= 1 + EPS:
+                points.append((x, y))
+    return points
+
+
+def intersect_arcs(arc_a: Arc, arc_b: Arc) -> list[tuple[float, float]]:
+    """Return the points where 2 arcs intersect (concentric arcs do not intersect)."""
+    r_a, r_b = arc_radius(arc_a), arc_radius(arc_b)
+    dx, dy = arc_b.cx - arc_a.cx, arc_b.cy - arc_a.cy
+    dist = math.hypot(dx, dy)
+    if dist < EPS or dist > r_a + r_b + EPS or dist < abs(r_a - r_b) - EPS:
+        return []
+    along = (dist * dist + r_a * r_a - r_b * r_b) / (2 * dist)
+    h = math.sqrt(max(0.0, r_a * r_a - along * along))
+    mx, my = arc_a.cx + along * dx / dist, arc_a.cy + along * dy / dist
+    points = []
+    for sign in (1, -1) if h > EPS else (1,):
+        x, y = mx - sign * h * dy / dist, my + sign * h * dx / dist
+        if arc_param(arc_a, x, y) <= 1 + EPS and arc_param(arc_b, x, y) <= 1 + EPS:
+            points.append((x, y))
+    return points
+
+
+def split_seg(seg: Line | Arc, points: list[tuple[float, float]]) -> list[Line | Arc]:
+    """Split a segment at the given points (which lie on the segment) and return the pieces in order."""
+    params = []
+    for x, y in points:
+        if isinstance(seg, Line):
+            dx, dy = seg.x2 - seg.x1, seg.y2 - seg.y1
+            t = ((x - seg.x1) * dx + (y - seg.y1) * dy) / (dx * dx + dy * dy)
+        else:
+            t = arc_param(seg, x, y)
+        if EPS < t < 1 - EPS:
+            params.append((t, x, y))
+    params.sort()
+    pieces = []
+    x1, y1 = seg.x1, seg.y1
+    for _, x, y in params + [(1.0, seg.x2, seg.y2)]:
+        if math.hypot(x - x1, y - y1) < EPS:
+            continue
+        pieces.append(Line(x1, y1, x, y) if isinstance(seg, Line) else Arc(x1, y1, x, y, seg.cx, seg.cy, seg.ccw))
+        x1, y1 = x, y
+    return pieces
+
+
+def offset_contours(
+    contours: list[list[Line | Arc]],
+    dist: float,
+    tol: float = 1e-6,
+    with_holes: bool = False,
+) -> list[list[Line | Arc]]:
+    """Offset a set of closed contours, keeping lines as lines and arcs as arcs.
+
+    :param contours: the contours to offset, they are treated as the outlines of filled areas
+    :param dist: the offset distance, positive values grow the areas (their outlines move outward) and
+        negative values shrink them
+    :param tol: the tolerance used to validate the pieces of the raw offset against the offset distance
+    :param with_holes: pass True when the clockwise contours are holes in the areas (as returned by this
+        function), rather than areas drawn clockwise
+    :return: the offset contours, outer contours are counterclockwise and holes clockwise
+
+    Overlapping areas are merged by an outward offset (the result is the offset of the union of the
+    areas). For an inward offset, and with holes, the contours should not overlap each other.
+    """
+    if with_holes:
+        contours = [c for c in contours if c]
+    else:
+        contours = [c if contour_area(c) >= 0 else reverse_contour(c) for c in contours if c]
+    if not contours or dist == 0:
+        return contours
+
+    # step 1 - raw offsets, for counterclockwise contours the outside is to the right of the direction of travel
+    raw = [seg for contour in contours for seg in raw_offset(contour, dist)]
+    raw = [seg for seg in raw if seg_length(seg) >= EPS]
+
+    # step 2 - split the raw segments where they intersect each other
+    bboxes = [seg_bbox(seg) for seg in raw]
+    cell_size = max(abs(dist), sum(max(b[2] - b[0], b[3] - b[1]) for b in bboxes) / len(bboxes))
+    grid = SegmentGrid(cell_size)
+    for index, bbox in enumerate(bboxes):
+        grid.insert(index, bbox)
+    split_points: list[list[tuple[float, float]]] = [[] for _ in raw]
+    for index, (seg, bbox) in enumerate(zip(raw, bboxes)):
+        for other in grid.query(bbox):
+            if other <= index:
+                continue
+            o_bbox = bboxes[other]
+            if o_bbox[0] > bbox[2] or o_bbox[2] < bbox[0] or o_bbox[1] > bbox[3] or o_bbox[3] < bbox[1]:
+                continue
+            for point in intersect_segs(seg, raw[other]):
+                split_points[index].append(point)
+                split_points[other].append(point)
+    pieces = [piece for seg, points in zip(raw, split_points) for piece in split_seg(seg, points)]
+
+    # step 3 - keep the pieces that are far enough from the original contours, and on the offset side
+    originals = [seg for contour in contours for seg in contour]
+    orig_grid = SegmentGrid(cell_size)
+    for index, seg in enumerate(originals):
+        x_min, y_min, x_max, y_max = seg_bbox(seg)
+        orig_grid.insert(index, (x_min - abs(dist), y_min - abs(dist), x_max + abs(dist), y_max + abs(dist)))
+    polygons = PolygonStrips([linearize_contour(contour, abs(dist) / 100) for contour in contours], cell_size)
+    min_dist = abs(dist) - tol
+    kept = []
+    for piece in pieces:
+        mid_x, mid_y = seg_point(piece, 0.5)
+        near = orig_grid.query((mid_x, mid_y, mid_x, mid_y))
+        if any(point_seg_dist(mid_x, mid_y, originals[index]) < min_dist for index in near):
+            continue
+        inside_polygons = polygons.containing(mid_x, mid_y)
+        # with holes: even-odd over all the contours, a point inside a hole is inside 2 of them
+        inside = len(inside_polygons) % 2 == 1 if with_holes else bool(inside_polygons)
+        if inside != (dist < 0):
+            continue
+        kept.append(piece)
+
+    # step 4 - chain the kept pieces into closed contours
+    return chain_contours(kept)
+
+
+class PolygonStrips:
+    """Polygon edges bucketed into horizontal strips, used to find the polygons a point is inside.
+
+    The even-odd test casts a horizontal ray from the point, so only the edges of the strip that holds the
+    point can cross it.
+    """
+
+    def __init__(self, polygons: list[list[tuple[float, float]]], strip_height: float):
+        """Index the edges of polygons.
+
+        :param polygons: the linearized contours
+        :param strip_height: the height of a strip
+        """
+        self.strip_height = strip_height
+        self.strips: dict[int, list[tuple[int, float, float, float, float]]] = defaultdict(list)
+        for poly_nbr, polygon in enumerate(polygons):
+            x1, y1 = polygon[-1]
+            for x2, y2 in polygon:
+                # horizontal edges never cross the ray
+                if y1 != y2:
+                    first, last = math.floor(min(y1, y2) / strip_height), math.floor(max(y1, y2) / strip_height)
+                    for strip in range(first, last + 1):
+                        self.strips[strip].append((poly_nbr, x1, y1, x2, y2))
+                x1, y1 = x2, y2
+
+    def containing(self, x: float, y: float) -> set[int]:
+        """Return the numbers of the polygons a point is inside (even-odd rule within each polygon)."""
+        inside = set()
+        for poly_nbr, x1, y1, x2, y2 in self.strips.get(math.floor(y / self.strip_height), ()):
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                inside ^= {poly_nbr}
+        return inside
+
+
+def chain_contours(pieces: list[Line | Arc], snap: float = 1e-6) -> list[list[Line | Arc]]:
+    """Chain segments into closed contours by matching the end of each segment with the start of another.
+
+    :param pieces: the segments to chain
+    :param snap: end points closer than this distance are treated as the same point
+    :return: the closed contours, pieces that do not form a closed contour are dropped
+    """
+
+    def key(x: float, y: float) -> tuple[int, int]:
+        return round(x / snap), round(y / snap)
+
+    starts: dict[tuple[int, int], list[int]] = defaultdict(list)
+    for index, piece in enumerate(pieces):
+        starts[key(piece.x1, piece.y1)].append(index)
+
+    used = [False] * len(pieces)
+    contours = []
+    for first in range(len(pieces)):
+        if used[first]:
+            continue
+        used[first] = True
+        contour = [pieces[first]]
+        closing_key = key(pieces[first].x1, pieces[first].y1)
+        while True:
+            end_key = key(contour[-1].x2, contour[-1].y2)
+            if end_key == closing_key:
+                contours.append(contour)
+                break
+            candidates = [i for i in neighbour_starts(starts, end_key) if not used[i]]
+            if not candidates:
+                break
+            used[candidates[0]] = True
+            contour.append(pieces[candidates[0]])
+    return contours
+
+
+def neighbour_starts(starts: dict[tuple[int, int], list[int]], end_key: tuple[int, int]) -> list[int]:
+    """Return the pieces starting at a snapped point, or at one of the 8 snapped points around it.
+
+    Looking at the neighbouring snapped points catches end points that rounded to different keys.
+    """
+    found = list(starts.get(end_key, ()))
+    if found:
+        return found
+    for d_x in (-1, 0, 1):
+        for d_y in (-1, 0, 1):
+            found.extend(starts.get((end_key[0] + d_x, end_key[1] + d_y), ()))
+    return found
+
+
+def chain_segments(segments: list[Line | Arc], snap: float = 1e-4) -> list[list[Line | Arc]]:
+    """Chain segments, in any direction, into paths that run between branch points (or dead ends).
+
+    :param segments: the segments to chain, they are reversed as needed
+    :param snap: end points closer than this distance are treated as the same point
+    :return: the paths, a closed path ends where it starts
+
+    The end points of the segments are hashed on a snapped grid: a dictionary maps each snapped point to the
+    segments ending there, so each segment's neighbours are found in constant time. A path is grown from
+    both ends of a starting segment, and stops at points where the number of segments is not 2.
+    """
+
+    def key(x: float, y: float) -> tuple[int, int]:
+        return round(x / snap), round(y / snap)
+
+    ends: dict[tuple[int, int], list[int]] = defaultdict(list)
+    for seg_nbr, seg in enumerate(segments):
+        ends[key(seg.x1, seg.y1)].append(seg_nbr)
+        ends[key(seg.x2, seg.y2)].append(seg_nbr)
+    used = [False] * len(segments)
+
+    def extend(path: deque[Line | Arc], at_end: bool) -> None:
+        while True:
+            x, y = (path[-1].x2, path[-1].y2) if at_end else (path[0].x1, path[0].y1)
+            point_segs = ends[key(x, y)]
+            seg_nbr = next((nbr for nbr in point_segs if not used[nbr]), None) if len(point_segs) == 2 else None
+            if seg_nbr is None:
+                return
+            used[seg_nbr] = True
+            seg = segments[seg_nbr]
+            if at_end:
+                path.append(seg if key(seg.x1, seg.y1) == key(x, y) else reverse_seg(seg))
+            else:
+                path.appendleft(seg if key(seg.x2, seg.y2) == key(x, y) else reverse_seg(seg))
+
+    paths = []
+    for seg_nbr, seg in enumerate(segments):
+        if used[seg_nbr]:
+            continue
+        used[seg_nbr] = True
+        path = deque([seg])
+        extend(path, True)
+        extend(path, False)
+        paths.append(list(path))
+    return paths
@@ -0,0 +1,358 @@
+"""Auto-leveling: the toolpaths bent to follow the probed surface of a PCB blank.
+
+The blanks are never flat: a warp of 0.05 mm is as deep as an isolation cut. The surface is probed on a grid
+of points, and the z of every move is corrected by the height of the surface under it:
+    * the height map is loaded from a CSV file (x, y, z per line, in work coordinates) or from the
+      controller's probe log (the [PRB:x,y,z:1] reports of the G38.2 probing moves), the points must form a
+      complete grid. The probe reports are machine coordinates: they are moved into work coordinates by
+      subtracting the work offset (G54), so the heights are relative to the work zero.
+    * the height between the probed points is interpolated, bilinear or bicubic (Catmull-Rom), a whole
+      column of points at a time
+    * the arcs are linearized within a tolerance, all the arcs of the toolpath at a time: an arc that follows
+      a surface which is not flat is not an arc anymore. The linear moves longer than a maximum length are
+      subdivided, so the toolpath follows the surface between the probed points.
+    * every point is corrected in 1 vectorized pass over the columns of the toolpath: z + height(x, y), the
+      heights being relative to the work zero the probing was done in. The rapid moves are corrected but not
+      subdivided.
+
+The probing program is written for the extents of the board's copper (see copper_extents), on the coarsest
+grid within a maximum spacing, probed row by row in a serpentine order along the longer side of the board.
+"""
+import math
+import re
+from collections import namedtuple
+from typing import TextIO
+
+import numpy as np
+
+from gcode_explain.min_gcode_parser import arc_sweeps
+from grbr_explain.grbr_geom import obj_bbox
+from grbr_explain.min_gerber_parser import GrbrPlot
+from pcb_cam.toolpath import (
+    CARVERA,
+    CW_ARC,
+    FORMAT_CHUNK,
+    LINEAR,
+    RAPID,
+    WRITE_BUFFER,
+    Machine,
+    Toolpath,
+    format_numbers,
+    write_header,
+)
+
+# a probe report of the controller, in machine coordinates: [PRB:x,y,z:1]
+PRB_RE = re.compile(r"PRB:([-+\d.]+),([-+\d.]+),([-+\d.]+)")
+# the G54 work offset reported by the controller ($# command): [G54:x,y,z]
+G54_RE = re.compile(r"\[G54:([-+\d.]+),([-+\d.]+),([-+\d.]+)")
+# a line of a CSV file: x, y, z separated by commas, semicolons or spaces
+CSV_RE = re.compile(r"\s*([-+\d.eE]+)[,;\s]\s*([-+\d.eE]+)[,;\s]\s*([-+\d.eE]+)\s*$")
+
+# Tuple describing the probed surface
+#   xs - the x of the columns of the grid, increasing
+#   ys - the y of the rows of the grid, increasing
+#   z  - the probed heights, as a (len(ys), len(xs)) array
+HeightMap = namedtuple("HeightMap", ["xs", "ys", "z"])
+
+
+def height_map_from_points(points: np.ndarray, snap: float = 0.01) -> HeightMap:
+    """Return the height map of probed points that form a complete grid, in any order.
+
+    :param points: the x, y, z of the probed points, as a (n, 3) array
+    :param snap: the x (and y) within this distance of each other are the same column (row) of the grid
+    :return: the height map
+    """
+    points = np.asarray(points, dtype=np.float64)
+    axes = []
+    for axis in (0, 1):
+        values = np.sort(points[:, axis])
+        # a new column starts where the sorted values jump by more than the snap distance
+        starts = np.r_[True, np.diff(values) > snap]
+        axes.append(values[starts])
+    xs, ys = axes
+    if len(xs) < 2 or len(ys) < 2:
+        raise ValueError(f"A height map needs at least 2 x 2 probed points, got: {len(xs)} x {len(ys)}")
+    if len(points) != len(xs) * len(ys):
+        raise ValueError(f"The {len(points)} probed points do not form a complete {len(xs)} x {len(ys)} grid")
+    cols = np.searchsorted(xs, points[:, 0] + snap) - 1
+    rows = np.searchsorted(ys, points[:, 1] + snap) - 1
+    z = np.full((len(ys), len(xs)), np.nan)
+    z[rows, cols] = points[:, 2]
+    if np.isnan(z).any():
+        raise ValueError("The probed points do not form a complete grid, some points were probed twice")
+    return HeightMap(xs, ys, z)
+
+
+def load_height_map(
+    map_fn: str,
+    snap: float = 0.01,
+    work_offset: tuple[float, float, float] | None = None,
+) -> HeightMap:
+    """Load a height map, in work coordinates, from a CSV file or a probe log.
+
+    :param map_fn: the file name path of a CSV file with the x, y, z of a probed point per line (the other
+        lines, e.g. a header, are skipped), or of a log with the probe reports of the controller
+    :param snap: see height_map_from_points
+    :param work_offset: the machine coordinates of the work zero (G54) the toolpaths are cut in, subtracted
+        from the probe reports. Defaults to the [G54:x,y,z] report of the log (the answer to $#).
+    :return: the height map
+    """
+    points, reports = [], []
+    with open(map_fn, buffering=1 << 16) as map_fh:
+        for line in map_fh:
+            if match := PRB_RE.search(line):
+                reports.append(tuple(map(float, match.groups())))
+            elif match := G54_RE.search(line):
+                work_offset = work_offset or tuple(map(float, match.groups()))
+            elif match := CSV_RE.match(line):
+                points.append(tuple(map(float, match.groups())))
+    if reports:
+        if work_offset is None:
+            raise ValueError(f"The probe reports of {map_fn} are machine coordinates, the work offset is needed")
+        points += (np.array(reports) - np.asarray(work_offset, dtype=np.float64)).tolist()
+    if not points:
+        raise ValueError(f"No probed points found in: {map_fn}")
+    return height_map_from_points(np.array(points), snap)
+
+
+def grid_cells(values: np.ndarray, axis: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the cell of the grid axis each value is in, and the fraction of the cell (0 to 1) it is at.
+
+    The values outside the grid are clamped to its first or last cell.
+    """
+    cells = np.clip(np.searchsorted(axis, values, "right") - 1, 0, len(axis) - 2)
+    fractions = np.clip((values - axis[cells]) / (axis[cells + 1] - axis[cells]), 0.0, 1.0)
+    return cells, fractions
+
+
+def cubic_weights(t: np.ndarray) -> np.ndarray:
+    """Return the Catmull-Rom weights of the 4 grid points around each fraction of a cell, as a (n, 4) array."""
+    t2, t3 = t * t, t * t * t
+    return 0.5 * np.column_stack((-t3 + 2 * t2 - t, 3 * t3 - 5 * t2 + 2, -3 * t3 + 4 * t2 + t, t3 - t2))
+
+
+def surface_heights(hmap: HeightMap, x: np.ndarray, y: np.ndarray, method: str = "bilinear") -> np.ndarray:
+    """Return the height of the surface at points, interpolated between the probed points.
+
+    :param hmap: the height map
+    :param x: the x of the points
+    :param y: the y of the points
+    :param method: "bilinear", or "bicubic" for a smooth surface through the probed points
+    :return: the heights, the points outside the grid get the height of its nearest edge
+    """
+    if method not in ("bilinear", "bicubic"):
+        raise ValueError(f"Unknown interpolation method: {method}, expected bilinear or bicubic")
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    heights = np.empty(len(x))
+    # the grid is indexed flat: row * columns + column
+    z, width = hmap.z.ravel(), len(hmap.xs)
+    # the points are interpolated a chunk at a time, bounding the memory of the 4 x 4 bicubic neighbourhoods
+    for first in range(0, len(x), FORMAT_CHUNK):
+        chunk = slice(first, first + FORMAT_CHUNK)
+        cols, tx = grid_cells(x[chunk], hmap.xs)
+        rows, ty = grid_cells(y[chunk], hmap.ys)
+        corners = rows * width + cols
+        if method == "bilinear":
+            bottom = z[corners] * (1 - tx) + z[corners + 1] * tx
+            top = z[corners + width] * (1 - tx) + z[corners + width + 1] * tx
+            heights[chunk] = bottom * (1 - ty) + top * ty
+            continue
+        steps = np.arange(-1, 3)
+        col_nbrs = np.clip(cols[:, None] + steps, 0, width - 1)
+        row_nbrs = np.clip(rows[:, None] + steps, 0, len(hmap.ys) - 1) * width
+        neighbourhoods = z[row_nbrs[:, :, None] + col_nbrs[:, None, :]]
+        heights[chunk] = np.einsum("nr,nrc,nc->n", cubic_weights(ty), neighbourhoods, cubic_weights(tx))
+    return heights
+
+
+def split_rows(counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the rows of the pieces a move is split into, for moves split in a number of pieces each.
+
+    :param counts: the number of pieces of each move
+    :return: tuple of: the index of the move of each piece, and the fraction of the move at the end of each
+        piece: 1 / n, 2 / n ... 1
+    """
+    rows = np.repeat(np.arange(len(counts)), counts)
+    steps = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    return rows, steps / counts[rows]
+
+
+def level_toolpath(
+    toolpath: Toolpath,
+    hmap: HeightMap,
+    start: tuple[float, float, float] = None,
+    max_seg: float = 1.0,
+    method: str = "bilinear",
+    tolerance: float = 0.002,
+) -> Toolpath:
+    """Return a copy of a toolpath with the z of its moves corrected by the height of the surface.
+
+    :param toolpath: the toolpath
+    :param hmap: the height map of the surface, in the work coordinates of the toolpath
+    :param start: the x, y, z position of the tool before the first move, an arc or a linear move from an
+        unknown position (nan) is corrected at its end point only
+    :param max_seg: the linear moves longer than this length (in x & y) are subdivided
+    :param method: the interpolation of the heights: "bilinear" or "bicubic"
+    :param tolerance: the largest distance between an arc and the linear moves it is replaced with
+    :return: the leveled toolpath, its arcs are linear moves
+    """
+    if max_seg <= 0:
+        raise ValueError(f"The maximum segment length must be greater than 0, got: {max_seg}")
+    start = np.array(start or (math.nan, math.nan, math.nan), dtype=np.float64)
+    moves = toolpath.arrays()
+    kinds = moves["kind"]
+    xyz = np.column_stack((moves["x"], moves["y"], moves["z"]))
+    starts = np.vstack((start[None, :], xyz[:-1]))
+
+    # the arcs (in the XY plane, helical or not) are replaced by linear moves, all the arcs at a time: the
+    # number of moves of each arc keeps their sagitta within the tolerance and their length within max_seg
+    arcs = np.flatnonzero((kinds >= CW_ARC) & ~np.isnan(starts).any(axis=1))
+    centers = starts[arcs, :2] + np.column_stack((moves["i"][arcs], moves["j"][arcs]))
+    radii = np.hypot(starts[arcs, 0] - centers[:, 0], starts[arcs, 1] - centers[:, 1])
+    start_angles = np.arctan2(starts[arcs, 1] - centers[:, 1], starts[arcs, 0] - centers[:, 0])
+    end_angles = np.arctan2(xyz[arcs, 1] - centers[:, 1], xyz[arcs, 0] - centers[:, 0])
+    clockwise = kinds[arcs] == CW_ARC
+    sweeps = arc_sweeps(start_angles, end_angles, ~clockwise)
+    sweeps = np.where(clockwise, -sweeps, sweeps)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        steps = 2 * np.arccos(np.clip(1 - tolerance / radii, -1.0, 1.0))
+        arc_counts = np.maximum(np.ceil(np.abs(sweeps) / steps), np.ceil(np.abs(sweeps) * radii / max_seg))
+    counts = np.ones(len(kinds), dtype=np.int64)
+    counts[arcs] = np.where(radii > 1e-9, np.nan_to_num(arc_counts, nan=1.0), 1)
+    source, t = split_rows(counts)
+    out_xyz = xyz[source]
+    out_kinds = np.where(kinds[source] == RAPID, RAPID, LINEAR).astype(np.int8)
+    pieces = np.flatnonzero(t < 1)
+    if len(pieces):
+        # the index of the arc of each piece, the last piece of an arc ends exactly at the arc's end
+        nbrs = np.searchsorted(arcs, source[pieces])
+        angles = start_angles[nbrs] + sweeps[nbrs] * t[pieces]
+        out_xyz[pieces, 0] = centers[nbrs, 0] + radii[nbrs] * np.cos(angles)
+        out_xyz[pieces, 1] = centers[nbrs, 1] + radii[nbrs] * np.sin(angles)
+        arc_starts = starts[arcs[nbrs], 2]
+        out_xyz[pieces, 2] = arc_starts + (xyz[arcs[nbrs], 2] - arc_starts) * t[pieces]
+
+    # the long linear moves are split into equal pieces, at the fractions 1 / n, 2 / n ... 1 of the move
+    seg_starts = np.vstack((start[None, :], out_xyz[:-1]))
+    deltas = out_xyz - seg_starts
+    lengths = np.nan_to_num(np.hypot(deltas[:, 0], deltas[:, 1]))
+    splits = np.where(out_kinds == LINEAR, np.maximum(np.ceil(lengths / max_seg), 1), 1).astype(np.int64)
+    rows, fractions = split_rows(splits)
+    ends = out_xyz[rows]
+    pieces = np.flatnonzero(fractions < 1)
+    ends[pieces] = seg_starts[rows[pieces]] + fractions[pieces, None] * deltas[rows[pieces]]
+
+    known = ~np.isnan(ends[:, 0]) & ~np.isnan(ends[:, 1])
+    ends[known, 2] += surface_heights(hmap, ends[known, 0], ends[known, 1], method)
+    leveled = Toolpath(toolpath.name, toolpath.tool, toolpath.spindle_speed, tuple(start))
+    zeros = np.zeros(len(rows))
+    leveled.add_moves(out_kinds[rows], ends[:, 0], ends[:, 1], ends[:, 2], zeros, zeros, moves["feed"][source[rows]])
+    return leveled
+
+
+def level_toolpaths(
+    toolpaths: list[Toolpath],
+    hmap: HeightMap,
+    **kwargs,
+) -> list[Toolpath]:
+    """Level toolpaths cut one after the other, each one starting where the one before it ended.
+
+    :param toolpaths: the toolpaths, in the order they are cut
+    :param hmap: the height map of the surface
+    :param kwargs: the other parameters of level_toolpath, but start
+    :return: the leveled toolpaths
+    """
+    leveled = []
+    start = None
+    for toolpath in toolpaths:
+        leveled.append(level_toolpath(toolpath, hmap, start, **kwargs))
+        start = toolpath.position
+    return leveled
+
+
+def copper_extents(grbr_plot: GrbrPlot) -> tuple[float, float, float, float]:
+    """Return the bounding box of the copper of a layer as a tuple of: x min, y min, x max, y max."""
+    objs = grbr_plot.graphic_objs
+    if not objs:
+        raise ValueError("The layer does not have any graphic objects")
+    bboxes = np.array([obj_bbox(obj, grbr_plot.aperture_lkp) for obj in objs])
+    return (*bboxes[:, :2].min(axis=0).tolist(), *bboxes[:, 2:].max(axis=0).tolist())
+
+
+def probe_points(
+    bbox: tuple[float, float, float, float],
+    max_spacing: float = 10.0,
+    margin: float = 1.0,
+) -> np.ndarray:
+    """Return the points of the probing grid of a box, in probing order.
+
+    The grid has the fewest rows & columns within the maximum spacing (at least 2 of each), spread evenly
+    over the box grown by the margin. The rows run along the longer side of the box, in a serpentine order:
+    each row is probed in the opposite direction of the one before it.
+
+    :param bbox: the box to probe: x min, y min, x max, y max
+    :param max_spacing: the largest distance between 2 probed points of a row or a column
+    :param margin: the distance the grid extends past the box
+    :return: the x, y of the points, as a (n, 2) array
+    """
+    x_min, y_min, x_max, y_max = bbox[0] - margin, bbox[1] - margin, bbox[2] + margin, bbox[3] + margin
+    xs = np.linspace(x_min, x_max, max(int(math.ceil((x_max - x_min) / max_spacing)) + 1, 2))
+    ys = np.linspace(y_min, y_max, max(int(math.ceil((y_max - y_min) / max_spacing)) + 1, 2))
+    along, across = (xs, ys) if x_max - x_min >= y_max - y_min else (ys, xs)
+    grid = np.tile(along, (len(across), 1))
+    grid[1::2] = grid[1::2, ::-1]
+    points = np.column_stack((grid.ravel(), np.repeat(across, len(along))))
+    return points if along is xs else points[:, ::-1]
+
+
+def write_probe_program(
+    gcode_fh: TextIO,
+    points: np.ndarray,
+    program_nbr: int = 1000,
+    clearance_z: float = 1.0,
+    safe_z: float = 15.0,
+    probe_z: float = -2.0,
+    probe_feed: float = 50.0,
+    machine: Machine = CARVERA,
+) -> None:
+    """Write the G-code program that probes the surface at points, the controller logs each probed height.
+
+    :param gcode_fh: the text file the G-code is written to
+    :param points: the x, y of the points, in probing order (see probe_points)
+    :param program_nbr: the program number, written as the first comment
+    :param clearance_z: the z the probe travels at between the points
+    :param safe_z: the z before the first point and after the last one
+    :param probe_z: the lowest z a probing move goes to, the probing fails if it does not touch the surface
+    :param probe_feed: the feed rate of the probing moves, in mm/min
+    :param machine: the machine, written in the header
+    """
+    write_header(gcode_fh, program_nbr, [], machine)
+    gcode_fh.write(f"\n(Probe {len(points)} points)\nG54\nG0 Z{safe_z:g}\n")
+    xs, ys = format_numbers(points[:, 0]), format_numbers(points[:, 1])
+    probe = f"G38.2 Z{probe_z:g} F{probe_feed:g}\nG0 Z{clearance_z:g}\n"
+    for first in range(0, len(points), FORMAT_CHUNK):
+        chunk = slice(first, first + FORMAT_CHUNK)
+        gcode_fh.write("".join(f"G0 X{x} Y{y}\n{probe}" for x, y in zip(xs[chunk].tolist(), ys[chunk].tolist())))
+    gcode_fh.write(f"G0 Z{safe_z:g}\nM30\n")
+
+
+def write_probe_gcode(
+    gcode_fn: str,
+    grbr_plot: GrbrPlot,
+    max_spacing: float = 10.0,
+    margin: float = 1.0,
+    **kwargs,
+) -> np.ndarray:
+    """Write the probing program of the copper extents of a layer.
+
+    :param gcode_fn: the file name path of the G-code file to write
+    :param grbr_plot: the parsed gerber copper layer
+    :param max_spacing: the largest distance between 2 probed points of a row or a column
+    :param margin: the distance the grid extends past the copper
+    :param kwargs: the other parameters of write_probe_program
+    :return: the probed points, in probing order
+    """
+    points = probe_points(copper_extents(grbr_plot), max_spacing, margin)
+    with open(gcode_fn, "w", buffering=WRITE_BUFFER) as gcode_fh:
+        write_probe_program(gcode_fh, points, **kwargs)
+    return points
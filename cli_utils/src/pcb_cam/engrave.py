@@ -0,0 +1,158 @@
+"""Centerline engraving toolpaths: the traces of a copper layer engraved along their centerline with a V-bit.
+
+For quick prototypes the traces are engraved rather than isolated: a V-bit follows the centerline of each
+draw and arc, at the depth where the width of its V matches the width of the trace's aperture:
+    depth = (aperture width - tip diameter) / 2 / tan(V angle / 2)
+
+The stage:
+    * takes the dark draws and arcs (D01 outside of regions) of a parsed layer
+    * chains them into paths, per aperture, by hashing their snapped end points, so a path is engraved in
+      a single plunge. Arcs are kept as arcs and are output as G2 / G3.
+    * orders the paths to minimize the travel between them: greedy nearest path end seeding, improved
+      with 2-opt & Or-opt moves (see pcb_cam.path_order)
+    * writes the toolpath as G-code, formatted in bulk by pcb_cam.toolpath
+"""
+import math
+from collections import defaultdict, namedtuple
+
+from grbr_explain.grbr_geom import stroke_width
+from grbr_explain.min_gerber_parser import GrbrArc, GrbrDraw, GrbrPlot
+from pcb_cam.arc_offset import Arc, Line, chain_segments
+from pcb_cam.path_order import order_toolpaths, visit_segments
+from pcb_cam.toolpath import Tool, Toolpath, write_gcode_file
+
+# Tuple describing a chained path of 1 aperture
+#   aperture - the aperture id of the draws & arcs of the path
+#   width    - the width of the aperture
+#   segments - the Line & Arc segments of the path, in order, each starting at the end of the previous one
+EngravePath = namedtuple("EngravePath", ["aperture", "width", "segments"])
+
+
+def seg_from_grbr(obj: GrbrDraw | GrbrArc) -> Line | Arc:
+    """Return the Line or Arc segment of a draw or arc."""
+    if isinstance(obj, GrbrArc):
+        return Arc(obj.x1, obj.y1, obj.x2, obj.y2, obj.cx, obj.cy, obj.direction == "counterclockwise")
+    return Line(obj.x1, obj.y1, obj.x2, obj.y2)
+
+
+def chain_paths(grbr_plot: GrbrPlot, snap: float = 1e-4) -> list[EngravePath]:
+    """Chain the dark draws and arcs of a layer into paths, 1 aperture at a time.
+
+    :param grbr_plot: the parsed gerber layer
+    :param snap: end points closer than this distance are treated as the same point
+    :return: the chained paths
+
+    Paths stop at branch points (see chain_segments), so T junctions are engraved as separate paths.
+    """
+    by_aperture = defaultdict(list)
+    for obj in grbr_plot.graphic_objs:
+        if isinstance(obj, (GrbrDraw, GrbrArc)) and obj.polarity == "dark" and obj.aperture:
+            if math.dist((obj.x1, obj.y1), (obj.x2, obj.y2)) > 0 or isinstance(obj, GrbrArc):
+                by_aperture[obj.aperture].append(seg_from_grbr(obj))
+
+    paths = []
+    for aperture, segments in by_aperture.items():
+        width = stroke_width(grbr_plot.aperture_lkp.get(aperture))
+        paths.extend(EngravePath(aperture, width, path) for path in chain_segments(segments, snap))
+    return paths
+
+
+def order_paths(
+    paths: list[EngravePath],
+    start: tuple[float, float] = (0.0, 0.0),
+    time_budget: float = 1.0,
+) -> list[EngravePath]:
+    """Order the paths to minimize the travel between them (see pcb_cam.path_order).
+
+    :param paths: the paths to order
+    :param start: the x, y position of the tool before the first path
+    :param time_budget: the time, in seconds, the ordering improvements are allowed to run for
+    :return: the ordered paths, open paths reversed and closed paths rotated to the start the tool enters them at
+    """
+    order = order_toolpaths([path.segments for path in paths], start, time_budget)
+    return [
+        paths[visit.index]._replace(segments=visit_segments(paths[visit.index].segments, visit))
+        for visit in order.visits
+    ]
+
+
+def engrave_depth(width: float, vbit_angle: float, tip_dia: float, max_depth: float) -> float:
+    """Return the depth a V-bit must reach to cut a groove of the given width.
+
+    :param width: the width of the groove
+    :param vbit_angle: the included angle of the V-bit, in degrees
+    :param tip_dia: the diameter of the V-bit's flat tip
+    :param max_depth: the depth is limited to this value
+    """
+    depth = max(width - tip_dia, 0.0) / 2 / math.tan(math.radians(vbit_angle) / 2)
+    return min(depth, max_depth)
+
+
+def engrave_toolpath(
+    grbr_plot: GrbrPlot,
+    tool: Tool,
+    feed: float = 300.0,
+    plunge_feed: float = 100.0,
+    safe_z: float = 15.0,
+    retract_z: float = 1.0,
+    max_depth: float = 0.2,
+    min_depth: float = 0.02,
+    spindle_speed: int = 10000,
+) -> Toolpath:
+    """Create the centerline engraving toolpath of the traces of a copper layer.
+
+    :param grbr_plot: the parsed gerber copper layer
+    :param tool: the V-bit, its diameter is the diameter of its tip and its taper_angle the V angle
+    :param feed: the engraving feed rate
+    :param plunge_feed: the feed rate of the plunges
+    :param safe_z: the height the tool moves to before the first path
+    :param retract_z: the height the tool retracts to between paths
+    :param max_depth: the deepest the V-bit may engrave, whatever the trace width
+    :param min_depth: the shallowest the V-bit engraves, so very thin traces still cut through the copper
+    :param spindle_speed: the spindle speed, in rpm
+    :return: the toolpath
+    """
+    if not tool.taper_angle:
+        raise ValueError(f"Engraving needs a V-bit, tool T{tool.number} does not have a taper angle")
+    toolpath = Toolpath("Engrave traces", tool, spindle_speed)
+    paths = order_paths(chain_paths(grbr_plot))
+    for path_nbr, path in enumerate(paths):
+        depth = max(engrave_depth(path.width, tool.taper_angle, tool.diameter, max_depth), min_depth)
+        first = path.segments[0]
+        if path_nbr == 0:
+            toolpath.rapid(first.x1, first.y1)
+            toolpath.rapid(z=safe_z)
+        else:
+            toolpath.rapid(z=retract_z)
+            toolpath.rapid(first.x1, first.y1)
+        toolpath.rapid(z=retract_z)
+        toolpath.linear(None, None, -depth, plunge_feed)
+        for seg in path.segments:
+            if isinstance(seg, Arc):
+                toolpath.arc(seg.x2, seg.y2, seg.cx, seg.cy, not seg.ccw, feed)
+            else:
+                toolpath.linear(seg.x2, seg.y2, None, feed)
+    if paths:
+        toolpath.rapid(z=retract_z)
+    return toolpath
+
+
+def write_engrave_gcode(
+    gcode_fn: str,
+    grbr_plot: GrbrPlot,
+    tool: Tool,
+    program_nbr: int = 1001,
+    **kwargs,
+) -> Toolpath:
+    """Write the centerline engraving G-code of a copper layer.
+
+    :param gcode_fn: the file name path of the G-code file to write
+    :param grbr_plot: the parsed gerber copper layer
+    :param tool: the V-bit
+    :param program_nbr: the program number written in the header
+    :param kwargs: the cutting parameters passed on to engrave_toolpath
+    :return: the toolpath that was written
+    """
+    toolpath = engrave_toolpath(grbr_plot, tool, **kwargs)
+    write_gcode_file(gcode_fn, program_nbr, [toolpath], safe_z=kwargs.get("safe_z", 15.0))
+    return toolpath
@@ -0,0 +1,276 @@
+"""Excellon drill files: the drill hits of a board, in drilling order, written as canned cycle G-code.
+
+The reader loads the hits of a drill file (as exported by KiCad, Eagle, ...) into 1 array per tool:
+    * the header (M48 to %) has the units (METRIC / INCH, or M71 / M72), the zero format (LZ: the leading
+      zeros are kept, TZ: the trailing zeros are kept), an optional number format (e.g. 000.000) and the tool
+      table (T1C0.8: the tool number & its diameter)
+    * the coordinates of the hits are modal, and are parsed like the gerber coordinates (see
+      grbr_explain.min_gerber_parser.GrbrCoordSys) unless they have a decimal point. Everything is converted
+      to mm.
+    * the routed slots (G85, and the hits of the route mode G00 / G01) are not drilled, they are only counted
+
+The hits of each tool are ordered to minimize the travel between them, with the seeding & improvements of
+the toolpath ordering (see pcb_cam.path_order): each hit is a path of 1 point, seeded with the nearest hit
+found in a grid spatial index. The program is written with canned drilling cycles, 1 short line per hit:
+G81 (drill) or G83 (peck drill), in the G99 mode (the tool retracts to the R plane between the hits), the
+coordinates formatted a whole column at a time.
+
+The hits of a drill file can also be checked against the pads of the copper layers, see excellon_drill_hits
+and grbr_explain.registration_check.check_registration.
+"""
+import re
+from collections import namedtuple
+from typing import Iterable, TextIO
+
+import numpy as np
+
+from grbr_explain.min_gerber_parser import GrbrCoordSys
+from pcb_cam.arc_offset import Line
+from pcb_cam.path_order import PathOrder, order_toolpaths
+from pcb_cam.toolpath import CARVERA, FORMAT_CHUNK, WRITE_BUFFER, Machine, Tool, format_numbers, write_header
+
+# the default number formats (integer digits, decimal digits) of the units, when the header has none
+DEFAULT_FORMATS = {"METRIC": (3, 3), "INCH": (2, 4)}
+UNITS_SCALE = {"METRIC": 1.0, "INCH": 25.4}
+# a unit line of the header: METRIC or INCH, the zero format and the number format
+UNITS_RE = re.compile(r"(METRIC|INCH)(?:,(LZ|TZ))?(?:,(0*)\.(0*))?$")
+# a tool definition (T1C0.8F200S65) or a tool selection (T1), the parameters are letters followed by numbers
+TOOL_RE = re.compile(r"T(\d+)((?:[A-Z][-+\d.]+)*)$")
+PARAM_RE = re.compile(r"([A-Z])([-+\d.]+)")
+HIT_RE = re.compile(r"(?:X([-+\d.]+))?(?:Y([-+\d.]+))?$")
+
+# Tuple with the contents of a drill file
+#   units       - the units of the file: METRIC or INCH, the hits & diameters are in mm whatever the units
+#   diameters   - dictionary of the diameter of each tool number, in mm
+#   hits        - dictionary of the hits of each tool number (with at least 1 hit), as (n, 2) arrays of x, y
+#   slots       - the number of routed slots, which are not in the hits
+ExcellonDrill = namedtuple("ExcellonDrill", ["units", "diameters", "hits", "slots"])
+
+# Tuple describing how the holes are drilled
+#   depth         - the z of the bottom of the holes, negative
+#   retract_z     - the z of the R plane, the tool starts each hole from & retracts to it
+#   clearance_z   - the z of the travel to the first hit of a tool and after the last one
+#   feed          - the plunge feed rate, in mm/min
+#   peck          - the depth of each peck of a G83 cycle, 0 to drill each hole in 1 plunge (G81)
+#   spindle_speed - the spindle speed, in rpm
+DrillCycle = namedtuple(
+    "DrillCycle",
+    ["depth", "retract_z", "clearance_z", "feed", "peck", "spindle_speed"],
+    defaults=[-1.8, 2.0, 15.0, 100.0, 0.0, 10000],
+)
+
+
+def parse_excellon_lines(lines: Iterable[str]) -> ExcellonDrill:
+    """Parse the lines of an Excellon drill file.
+
+    :param lines: the lines of the drill file
+    :return: the tools & hits of the file
+    """
+    # without a zero format the leading zeros are suppressed, as in the gerber files
+    units, zero_format, number_format = "METRIC", "TZ", None
+    in_header = False
+    gcs = None
+    diameters: dict[int, float] = {}
+    hits: dict[int, list[tuple[float, float]]] = {}
+    tool_hits = None
+    x = y = 0.0
+    incremental = route_mode = False
+    slots = 0
+
+    def coord(text: str) -> float:
+        if "." in text:
+            return float(text) * UNITS_SCALE[units]
+        return gcs.parse_grbr_coord(text) * UNITS_SCALE[units]
+
+    for ln_nbr, line in enumerate(lines, 1):
+        line = line.strip().upper()
+        if not line or line[0] == ";":
+            continue
+        if line in ("M48", "%", "M95"):
+            in_header = line == "M48"
+            continue
+        if line in ("G05", "G90", "M30", "M00"):
+            route_mode = route_mode and line != "G05"
+            continue
+        if line in ("M71", "M72"):
+            units = "METRIC" if line == "M71" else "INCH"
+            gcs = None
+            continue
+        if line in ("G91", "ICI,ON", "ICI"):
+            incremental = True
+            continue
+        if line == "ICI,OFF":
+            incremental = False
+            continue
+        match = UNITS_RE.match(line)
+        if match:
+            units, zero_format = match.group(1), match.group(2) or zero_format
+            if match.group(3) is not None:
+                number_format = (len(match.group(3)), len(match.group(4)))
+            gcs = None
+            continue
+        if gcs is None:
+            int_len, dec_len = number_format or DEFAULT_FORMATS[units]
+            # LZ keeps the leading zeros, so the trailing zeros are the ones suppressed
+            gcs = GrbrCoordSys(int_len, dec_len, "T" if zero_format == "LZ" else "L", units)
+        match = TOOL_RE.match(line)
+        if match:
+            tool_nbr = int(match.group(1))
+            params = dict(PARAM_RE.findall(match.group(2)))
+            if "C" in params:
+                diameters[tool_nbr] = float(params["C"]) * UNITS_SCALE[units]
+            if in_header and "C" in params:
+                continue
+            # a tool defined in the body is also selected
+            if tool_nbr == 0:
+                tool_hits = None
+            elif tool_nbr not in diameters:
+                raise ValueError(f"Excellon line {ln_nbr}: tool T{tool_nbr} is not defined in the header")
+            else:
+                tool_hits = hits.setdefault(tool_nbr, [])
+            continue
+        if line.startswith(("G00", "G01", "M15", "M16", "M17")):
+            route_mode = True
+            slots += line.startswith("G00")
+            # the coordinates of a G00 (move to the slot's start) or G01 (route to its end) move the tool
+            line = line[3:]
+            if not line:
+                continue
+        # a slot (start G85 end) is not drilled, it leaves the tool at its end
+        slot = "G85" in line
+        slots += slot
+        matches = [HIT_RE.match(part) for part in line.split("G85")]
+        matches = [match for match in matches if match and (match.group(1) or match.group(2))]
+        for match in matches:
+            new_x = coord(match.group(1)) if match.group(1) else 0.0 if incremental else x
+            new_y = coord(match.group(2)) if match.group(2) else 0.0 if incremental else y
+            x, y = (x + new_x, y + new_y) if incremental else (new_x, new_y)
+        if matches and not (route_mode or slot):
+            if tool_hits is None:
+                raise ValueError(f"Excellon line {ln_nbr}: drill hit before a tool was selected")
+            tool_hits.append((x, y))
+    arrays = {tool_nbr: np.array(points, dtype=np.float64) for tool_nbr, points in hits.items() if points}
+    return ExcellonDrill(units, diameters, arrays, slots)
+
+
+def parse_excellon(drl_fn: str) -> ExcellonDrill:
+    """Parse an Excellon drill file.
+
+    :param drl_fn: the file name path of the drill file
+    :return: the tools & hits of the file
+    """
+    with open(drl_fn, buffering=1 << 16) as drl_fh:
+        return parse_excellon_lines(drl_fh)
+
+
+def excellon_drill_hits(drill: ExcellonDrill) -> list[tuple[float, float]]:
+    """Return the x, y coordinates of the hits of every tool, for grbr_explain.registration_check."""
+    return [(float(x), float(y)) for points in drill.hits.values() for x, y in points]
+
+
+def order_drill_hits(
+    points: np.ndarray,
+    start: tuple[float, float] = (0.0, 0.0),
+    time_budget: float = 0.5,
+) -> tuple[np.ndarray, PathOrder]:
+    """Order the hits of a tool to minimize the travel between them.
+
+    :param points: the x, y of the hits, as a (n, 2) array
+    :param start: the x, y position of the tool before the first hit
+    :param time_budget: the time, in seconds, the ordering improvements are allowed to run for
+    :return: tuple of: the hits in drilling order, and the ordering (see pcb_cam.path_order)
+    """
+    order = order_toolpaths([[Line(x, y, x, y)] for x, y in points.tolist()], start, time_budget)
+    return points[[visit.index for visit in order.visits]], order
+
+
+def hit_lines(points: np.ndarray) -> list[str]:
+    """Format the hits after the first of a canned cycle: only the X & Y words that change, a column at a time."""
+    rounded = np.round(points, 3)
+    columns = []
+    for axis, letter in enumerate("XY"):
+        show = rounded[1:, axis] != rounded[:-1, axis]
+        text = np.char.add(f" {letter}", format_numbers(points[1:, axis][show]))
+        column = np.zeros(len(points) - 1, dtype=text.dtype)
+        column[show] = text
+        columns.append(column.tolist())
+    return [line[1:] for line in map("".join, zip(*columns)) if line]
+
+
+def write_drill_program(
+    gcode_fh: TextIO,
+    program_nbr: int,
+    drill: ExcellonDrill,
+    cycle: DrillCycle = DrillCycle(),
+    start: tuple[float, float] = (0.0, 0.0),
+    time_budget: float = 0.5,
+    machine: Machine = CARVERA,
+) -> dict[int, PathOrder]:
+    """Write the G-code program drilling the hits of a drill file, tool by tool in the order of the file.
+
+    :param gcode_fh: the text file the G-code is written to
+    :param program_nbr: the program number, written as the first comment
+    :param drill: the parsed drill file
+    :param cycle: how the holes are drilled
+    :param start: the x, y position of the tool before the first hit
+    :param time_budget: the time, in seconds, the ordering of all the tools' hits is allowed to run for, shared
+        between the tools by their number of hits
+    :param machine: the machine, written in the header
+    :return: the ordering of the hits of each tool
+    """
+    total = sum(len(points) for points in drill.hits.values())
+    tools = {nbr: Tool(nbr, drill.diameters[nbr], "drill") for nbr in drill.hits}
+    write_header(gcode_fh, program_nbr, [(tool, cycle.depth) for tool in tools.values()], machine)
+    # the words of the cycle, after the X & Y of the first hit
+    cycle_words = f"Z{cycle.depth:g} R{cycle.retract_z:g}" + (f" Q{cycle.peck:g}" if cycle.peck > 0 else "")
+    cycle_code = "G83" if cycle.peck > 0 else "G81"
+    orders = {}
+    for tool_nbr, points in drill.hits.items():
+        points, orders[tool_nbr] = order_drill_hits(points, start, time_budget * len(points) / total)
+        x, y = format_numbers(points[0])
+        gcode_fh.write(f"\n(Drill T{tool_nbr} D={drill.diameters[tool_nbr]:g})\nT{tool_nbr} M6\n")
+        gcode_fh.write(f"S{cycle.spindle_speed} M3\nG54\nG0 X{x} Y{y}\nZ{cycle.clearance_z:g}\n")
+        gcode_fh.write(f"G99 {cycle_code} X{x} Y{y} {cycle_words} F{cycle.feed:g}\n")
+        lines = hit_lines(points)
+        for first in range(0, len(lines), FORMAT_CHUNK):
+            gcode_fh.write("\n".join(lines[first:first + FORMAT_CHUNK]) + "\n")
+        gcode_fh.write(f"G80\nG0 Z{cycle.clearance_z:g}\n")
+        start = tuple(points[-1])
+    gcode_fh.write("M5\nG28\nM30\n")
+    return orders
+
+
+def write_drill_gcode(
+    gcode_fn: str,
+    drill: ExcellonDrill | str,
+    cycle: DrillCycle = DrillCycle(),
+    program_nbr: int = 1001,
+    **kwargs,
+) -> dict[int, PathOrder]:
+    """Write the drilling G-code of a drill file, through a large write buffer.
+
+    :param gcode_fn: the file name path of the G-code file to write
+    :param drill: the parsed drill file, or the file name path of the drill file
+    :param cycle: how the holes are drilled
+    :param program_nbr: the program number written in the header
+    :param kwargs: the other parameters of write_drill_program
+    :return: the ordering of the hits of each tool
+    """
+    if isinstance(drill, str):
+        drill = parse_excellon(drill)
+    with open(gcode_fn, "w", buffering=WRITE_BUFFER) as gcode_fh:
+        return write_drill_program(gcode_fh, program_nbr, drill, cycle, **kwargs)
+
+
+def output_drill_report(drill: ExcellonDrill, orders: dict[int, PathOrder]) -> None:
+    """Prints out the hits of each tool and the travel saved by ordering them.
+
+    :param drill: the parsed drill file
+    :param orders: the orderings returned by write_drill_gcode
+    """
+    for tool_nbr, order in orders.items():
+        saved = 1 - order.travel_after / order.travel_before if order.travel_before else 0.0
+        print(f"T{tool_nbr:<3} D={drill.diameters[tool_nbr]:<6g} hits: {len(order.visits):>6}", end="")
+        print(f"   travel: {order.travel_before:>10.1f} -> {order.travel_after:>10.1f} mm   ({saved:.1%} saved)")
+    if drill.slots:
+        print(f"\t{drill.slots} routed slots were not drilled")
@@ -0,0 +1,310 @@
+"""Maximum isolation: centerline toolpaths along the medial axis of the gaps between copper islands.
+
+Rather than cutting a fixed width around the copper, a single cut along the middle of every gap isolates
+each copper island from its neighbours. The cut follows the edges of the Voronoi diagram of the islands:
+the points that are equally distant from 2 different islands.
+
+The diagram is computed on a raster of the layer, with whole-array NumPy passes rather than pairwise geometry:
+    * the round strokes of the layer (the flashes & draws of circle apertures) are rasterized all at once,
+      see grbr_explain.raster.rasterize_objs
+    * the copper islands are labelled from the runs of copper pixels of the rows: each run is paired with the
+      touching runs of the row below, and the pairs are merged with a vectorized union-find
+    * each free pixel is assigned its nearest copper pixel's island with an exact separable distance
+      transform that carries the island labels along, in about as many passes as the widest gap between the
+      copper is wide in pixels
+    * the Voronoi edges are the pixel edges between 2 free pixels assigned to different islands. They are
+      chained into polylines, between their junctions, and all the polylines are simplified to about the pixel
+      size in 1 Douglas-Peucker call
+
+The cost is driven by the raster size, not by the number of segments and arcs of the layer: a 100 x 80 mm
+layer with 24,000 pads & trace segments takes about 4 seconds at the default resolution (0.05 mm).
+"""
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from grbr_explain.grbr_geom import obj_bbox
+from grbr_explain.min_gerber_parser import GrbrPlot
+from grbr_explain.raster import RasterGrid, grid_for_bbox, rasterize_objs
+from grbr_explain.simplify import simplify_points
+
+# Tuple describing 1 centerline toolpath
+#   points    - the x, y coordinates of the polyline
+#   clearance - the smallest distance from the polyline to the copper
+#   islands   - the labels of the 2 copper islands the toolpath separates
+IsolationPath = namedtuple("IsolationPath", ["points", "clearance", "islands"])
+
+# Tuple with the results of the stage
+#   grid    - the raster grid of the layer
+#   islands - the island label of each pixel (the label of its nearest copper pixel for free pixels)
+#   count   - the number of copper islands
+#   paths   - the centerline toolpaths
+MaxIsolation = namedtuple("MaxIsolation", ["grid", "islands", "count", "paths"])
+
+# Tuple with the Voronoi pixel edges of a raster, 1 row per edge
+#   starts    - the start point of each edge, as a (n, 2) array of col, row pixel corner coordinates
+#   ends      - the end point of each edge, as a (n, 2) array of col, row pixel corner coordinates
+#   clearance - the distance, in pixels, from each edge to its nearest copper pixel
+#   islands   - the 2 islands each edge separates, as a (n, 2) array
+VoronoiEdges = namedtuple("VoronoiEdges", ["starts", "ends", "clearance", "islands"])
+
+
+def label_islands(mask: np.ndarray) -> tuple[np.ndarray, int]:
+    """Label the 8-connected islands of a mask, from the runs of set pixels of its rows.
+
+    :param mask: the copper mask
+    :return: a tuple of: the label (0 to count - 1) of each pixel, -1 for the pixels not set in the mask,
+        and the number of islands, numbered in the order of their first run
+
+    The runs of each row are paired with the runs of the row below that they touch with sorted searches, then
+    merged with a union-find whose hooking & path compression steps are whole-array NumPy operations.
+    """
+    cols = mask.shape[1]
+    # the runs of set pixels of each row, in row major order, their ends are exclusive
+    steps = np.diff(np.pad(mask, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    run_rows, run_starts = np.nonzero(steps == 1)
+    run_ends = np.nonzero(steps == -1)[1]
+    count = len(run_rows)
+    if not count:
+        return np.full(mask.shape, -1, dtype=np.int32), 0
+
+    # the runs of the row below that touch each run: they end at or after its start (less the diagonal pixel)
+    # and start at or before its end
+    stride = cols + 2
+    below = (run_rows - 1) * stride
+    first = np.searchsorted(run_rows * stride + run_ends, below + run_starts, side="left")
+    last = np.searchsorted(run_rows * stride + run_starts, below + run_ends, side="right")
+    touch_cnt = np.where(run_rows > 0, np.maximum(last - first, 0), 0)
+    run_a = np.repeat(np.arange(count), touch_cnt)
+    run_b = np.repeat(first - (np.cumsum(touch_cnt) - touch_cnt), touch_cnt) + np.arange(touch_cnt.sum())
+
+    # hook the root of each pair of touching runs onto the smaller root, then compress the paths, until both
+    # runs of every pair have the same root: the first run of their island
+    parent = np.arange(count)
+    while True:
+        root_a, root_b = parent[run_a], parent[run_b]
+        if np.array_equal(root_a, root_b):
+            break
+        smaller = np.minimum(root_a, root_b)
+        np.minimum.at(parent, root_a, smaller)
+        np.minimum.at(parent, root_b, smaller)
+        grand = parent[parent]
+        while not np.array_equal(grand, parent):
+            parent, grand = grand, grand[grand]
+    roots, islands = np.unique(parent, return_inverse=True)
+
+    labels = np.full(mask.shape, -1, dtype=np.int32)
+    lengths = run_ends - run_starts
+    pixel_cols = np.repeat(run_starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    labels[np.repeat(run_rows, lengths), pixel_cols] = np.repeat(islands, lengths)
+    return labels, len(roots)
+
+
+def nearest_islands(labels: np.ndarray, dense_share: float = 0.125) -> tuple[np.ndarray, np.ndarray]:
+    """Assign each pixel the label of its nearest labelled pixel, with an exact separable distance transform.
+
+    :param labels: the label of each pixel, -1 for unlabelled pixels
+    :param dense_share: the share of the pixels that must still be waiting for a closer pixel for the whole
+        raster to be swept, below it only the waiting pixels are updated
+    :return: a tuple of: the label of each pixel's nearest labelled pixel (the smallest label on ties), and the
+        distance (in pixels) to it
+
+    Each pixel holds a key: its squared distance times the number of labels, plus its label. The minimum of 2
+    keys is both the nearest distance and its label, so 1 NumPy minimum updates both.
+        1. along each column, the nearest labelled pixel above or below is found with running maximum / minimum
+           scans of the labelled pixel row indexes
+        2. along each row, each pixel takes the minimum of its key and the column key of the pixels k columns
+           away plus k^2, for k = 1, 2, ... until k^2 is larger than every pixel's squared distance. The
+           whole raster is swept while most pixels are waiting, then only the waiting pixels are.
+    The cost is proportional to the number of pixels times the largest distance to the copper in pixels, and
+    the squared distances are exact integers.
+    """
+    rows, cols = labels.shape
+    labelled = labels >= 0
+    if not labelled.any():
+        return np.full(labels.shape, -1, dtype=np.int32), np.full(labels.shape, np.inf, dtype=np.float32)
+    label_cnt = int(labels.max()) + 1
+    no_pixel = (rows * rows + cols * cols + 1) * label_cnt
+
+    # pass 1 - the nearest labelled pixel above or below, in the same column
+    row_idx = np.arange(rows, dtype=np.int64)[:, np.newaxis]
+    prev_row = np.maximum.accumulate(np.where(labelled, row_idx, -2 * rows), axis=0)
+    next_row = np.minimum.accumulate(np.where(labelled, row_idx, 3 * rows)[::-1], axis=0)[::-1]
+    near_row = np.where(row_idx - prev_row <= next_row - row_idx, prev_row, next_row)
+    col_labels = labels[np.clip(near_row, 0, rows - 1), np.arange(cols)]
+    in_column = (near_row >= 0) & (near_row < rows)
+    col_key = np.where(in_column, (near_row - row_idx) ** 2 * label_cnt + col_labels, no_pixel)
+
+    # pass 2 - the pixels k columns away on the same row, first sweeping the whole raster
+    key = col_key.copy()
+    k = 1
+    while k < cols and np.count_nonzero(key >= k * k * label_cnt) >= dense_share * key.size:
+        k_key = k * k * label_cnt
+        np.minimum(key[:, k:], col_key[:, :-k] + k_key, out=key[:, k:])
+        np.minimum(key[:, :-k], col_key[:, k:] + k_key, out=key[:, :-k])
+        k += 1
+    # then only the pixels that can still get closer: those further than k
+    flat_key, flat_col_key = key.ravel(), col_key.ravel()
+    waiting = np.flatnonzero(flat_key >= k * k * label_cnt)
+    waiting_col = waiting % cols
+    while waiting.size and k < cols:
+        k_key = k * k * label_cnt
+        for offset in (-k, k):
+            idx = waiting[(waiting_col + offset >= 0) & (waiting_col + offset < cols)]
+            flat_key[idx] = np.minimum(flat_key[idx], flat_col_key[idx + offset] + k_key)
+        k += 1
+        still = flat_key[waiting] >= k * k * label_cnt
+        waiting, waiting_col = waiting[still], waiting_col[still]
+
+    dist_sq, nearest = np.divmod(key, label_cnt)
+    return nearest.astype(np.int32), np.sqrt(dist_sq).astype(np.float32)
+
+
+def voronoi_edges(nearest: np.ndarray, free: np.ndarray, dist: np.ndarray) -> VoronoiEdges:
+    """Return the pixel edges between 2 free pixels whose nearest islands differ.
+
+    :param nearest: the nearest island of each pixel
+    :param free: the mask of the pixels without copper
+    :param dist: the distance, in pixels, of each pixel to its nearest copper pixel
+    :return: the edges, the vertical pixel edges first
+    """
+    # vertical pixel edges, between a pixel and its right neighbour
+    v_rows, v_cols = np.nonzero(free[:, :-1] & free[:, 1:] & (nearest[:, :-1] != nearest[:, 1:]))
+    # horizontal pixel edges, between a pixel and its upper neighbour
+    h_rows, h_cols = np.nonzero(free[:-1, :] & free[1:, :] & (nearest[:-1, :] != nearest[1:, :]))
+    starts = np.concatenate((np.column_stack((v_cols + 1, v_rows)), np.column_stack((h_cols, h_rows + 1))))
+    ends = np.concatenate((np.column_stack((v_cols + 1, v_rows + 1)), np.column_stack((h_cols + 1, h_rows + 1))))
+    clearance = np.concatenate(
+        (
+            np.minimum(dist[v_rows, v_cols], dist[v_rows, v_cols + 1]),
+            np.minimum(dist[h_rows, h_cols], dist[h_rows + 1, h_cols]),
+        )
+    )
+    islands = np.concatenate(
+        (
+            np.column_stack((nearest[v_rows, v_cols], nearest[v_rows, v_cols + 1])),
+            np.column_stack((nearest[h_rows, h_cols], nearest[h_rows + 1, h_cols])),
+        )
+    )
+    return VoronoiEdges(starts, ends, clearance, islands)
+
+
+def chain_edges(edges: VoronoiEdges) -> list[tuple[np.ndarray, list[int]]]:
+    """Chain pixel edges into polylines that run between junctions (or end points) of the edge graph.
+
+    :param edges: the edges returned by voronoi_edges
+    :return: list of polylines, as tuples of: the pixel corner points (as a (n, 2) array of col, row) and the
+        indexes of their edges
+
+    The corners are matched with NumPy: each edge end is linked to the other edge of its corner when the corner
+    has exactly 2 edges. The walks along the links are plain loops over lists of integers.
+    """
+    count = len(edges.starts)
+    if not count:
+        return []
+    # the edge ends: end nbr (0 to 2 * count - 1) is the start of edge nbr if nbr < count, else the end of edge
+    # nbr - count
+    points = np.concatenate((edges.starts, edges.ends))
+    width = int(points[:, 0].max()) + 1
+    corners = points[:, 1].astype(np.int64) * width + points[:, 0]
+    order = np.argsort(corners, kind="stable")
+    sorted_corners = corners[order]
+    first = np.searchsorted(sorted_corners, corners, side="left")
+    degree = np.searchsorted(sorted_corners, corners, side="right") - first
+    links = np.full(2 * count, -1, dtype=np.int64)
+    pairs = degree == 2
+    end_nbrs = np.flatnonzero(pairs)
+    first_end = order[first[pairs]]
+    links[pairs] = np.where(first_end == end_nbrs, order[first[pairs] + 1], first_end)
+
+    corner_list, link_list, used = corners.tolist(), links.tolist(), [False] * count
+
+    def walk(end_nbr: int) -> tuple[list[int], list[int]]:
+        # enter the edge at 1 of its ends, leave it at the other, then enter the edge linked to that end
+        path_corners, edge_nbrs = [corner_list[end_nbr]], []
+        while True:
+            edge_nbr = end_nbr % count
+            used[edge_nbr] = True
+            edge_nbrs.append(edge_nbr)
+            exit_nbr = edge_nbr + count if end_nbr < count else edge_nbr
+            path_corners.append(corner_list[exit_nbr])
+            end_nbr = link_list[exit_nbr]
+            if end_nbr < 0 or used[end_nbr % count]:
+                return path_corners, edge_nbrs
+
+    chains = []
+    # first the chains that start at a junction or a dead end, then the closed loops that remain
+    for end_nbr in np.flatnonzero(~pairs).tolist():
+        if not used[end_nbr % count]:
+            chains.append(walk(end_nbr))
+    for edge_nbr in range(count):
+        if not used[edge_nbr]:
+            chains.append(walk(edge_nbr))
+    return [(np.column_stack(np.divmod(path_corners, width))[:, ::-1], edge_nbrs) for path_corners, edge_nbrs in chains]
+
+
+def max_isolation_paths(grbr_plot: GrbrPlot, px: float = 0.05, margin: float = 1.0) -> MaxIsolation:
+    """Compute the centerline toolpaths that isolate each copper island of a layer from its neighbours.
+
+    :param grbr_plot: the parsed gerber copper layer
+    :param px: the pixel size of the raster, the toolpaths are accurate to about 1 pixel
+    :param margin: the distance around the copper that is covered by the raster, the toolpaths between the
+        islands on the edge of the board run out to this margin
+    :return: the results of the stage
+    """
+    objs = grbr_plot.graphic_objs
+    if not objs:
+        raise ValueError("The layer does not have any graphic objects")
+    bboxes = [obj_bbox(obj, grbr_plot.aperture_lkp) for obj in objs]
+    bbox = (
+        min(b[0] for b in bboxes),
+        min(b[1] for b in bboxes),
+        max(b[2] for b in bboxes),
+        max(b[3] for b in bboxes),
+    )
+    grid = grid_for_bbox(bbox, px, margin)
+    copper = rasterize_objs(objs, grbr_plot.aperture_lkp, grid)
+
+    labels, count = label_islands(copper)
+    nearest, dist = nearest_islands(labels)
+    edges = voronoi_edges(nearest, ~copper, dist)
+    chains = chain_edges(edges)
+    if not chains:
+        return MaxIsolation(grid, nearest, count, [])
+
+    # Douglas-Peucker to the pixel size, the pixel staircases become straight lines. All the polylines are
+    # simplified in 1 call, their end points are kept so each span stays within its polyline.
+    points = np.concatenate([corners for corners, _ in chains]) * px + (grid.origin_x, grid.origin_y)
+    bounds = np.cumsum([0] + [len(corners) for corners, _ in chains])
+    keep = np.zeros(len(points), dtype=bool)
+    keep[bounds[:-1]] = keep[bounds[1:] - 1] = True
+    kept = simplify_points(points, px, keep=keep)
+    paths = []
+    for (_, edge_nbrs), start, end in zip(chains, bounds[:-1], bounds[1:]):
+        clearance = float(edges.clearance[edge_nbrs].min()) * px
+        islands = tuple(sorted(edges.islands[edge_nbrs[0]].tolist()))
+        path_points = [tuple(point) for point in points[start:end][kept[start:end]].tolist()]
+        paths.append(IsolationPath(path_points, clearance, islands))
+    return MaxIsolation(grid, nearest, count, paths)
+
+
+def output_isolation_report(isolation: MaxIsolation, tool_dia: float | None = None) -> None:
+    """Prints out the centerline toolpaths of the maximum isolation stage.
+
+    :param isolation: the results returned by max_isolation_paths
+    :param tool_dia: the diameter of the isolation tool, toolpaths with less clearance than the tool's
+        radius (they would cut into the copper) are flagged
+    """
+    grid: RasterGrid = isolation.grid
+    length = sum(math.dist(p1, p2) for path in isolation.paths for p1, p2 in zip(path.points, path.points[1:]))
+    print(f"copper islands: {isolation.count}   toolpaths: {len(isolation.paths)}   length: {length:.3f}")
+    print(f"\tresolution: {grid.px}   raster: {grid.shape[1]} x {grid.shape[0]}")
+    if tool_dia is not None:
+        for path in isolation.paths:
+            if path.clearance < tool_dia / 2:
+                x, y = path.points[0]
+                print(
+                    f"\tTOO NARROW between islands {path.islands[0]} & {path.islands[1]} at: {x:>10.3f}, {y:>10.3f}"
+                    f"   clearance: {path.clearance:.3f}"
+                )
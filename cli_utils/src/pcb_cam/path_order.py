@@ -0,0 +1,351 @@
+"""Travel minimizing ordering of toolpaths: the order, direction & start point the paths are cut in.
+
+Between 2 paths the tool retracts and travels to the start of the next path at the rapid speed, so the
+order of the paths sets the length of the G0 travel. Finding the best order is a travelling salesman
+problem (open: the tour starts at the tool's position and does not come back), solved with heuristics:
+    * the seeding is greedy: from the tool's position, always travel to the nearest path entry not cut yet,
+      found with a grid spatial index. An open path can be entered at either of its ends (it is then cut
+      in reverse), a closed path at any of its vertices (it is then cut from, and back to, that vertex).
+    * the 2-opt improvement reverses a block of the tour when that shortens the 2 travels at its ends (the
+      open paths of the block are cut in reverse), and the Or-opt improvement moves a block of 1 to 3 paths
+      to another place in the tour, in either direction. Both only try the paths that are spatial neighbours
+      of each other, so a pass is linear in the number of paths.
+    * the start vertex of each closed path is moved to the vertex that is the closest to the paths before &
+      after it
+The improvements are repeated until no move shortens the travel, or the time budget runs out.
+"""
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from grbr_explain.spatial_index import GridIndex
+from pcb_cam.arc_offset import Arc, Line, reverse_contour
+
+# Tuple describing how 1 path is cut
+#   index    - the index of the path in the list of paths that was ordered
+#   reversed - True if an open path is cut from its end to its start
+#   start    - the index of the segment a closed path is cut from, 0 for open paths
+PathVisit = namedtuple("PathVisit", ["index", "reversed", "start"])
+
+# Tuple with the results of the ordering
+#   visits        - the PathVisit of each path, in cutting order
+#   travel_before - the length of the travel between the paths, in their original order & direction
+#   travel_after  - the length of the travel between the paths, in the optimized order
+#   time_before   - the time of the travel before the ordering, in seconds, at the rapid speed
+#   time_after    - the time of the travel after the ordering, in seconds, at the rapid speed
+PathOrder = namedtuple("PathOrder", ["visits", "travel_before", "travel_after", "time_before", "time_after"])
+
+
+def is_closed(path: list[Line | Arc], snap: float = 1e-4) -> bool:
+    """Return True if a path ends where it starts, an empty path is not closed."""
+    return bool(path) and math.dist((path[0].x1, path[0].y1), (path[-1].x2, path[-1].y2)) <= snap
+
+
+class Tour:
+    """The order the paths are cut in, with the entry & exit point of each path, by position in the tour."""
+
+    def __init__(self, paths: list[list[Line | Arc]], start: tuple[float, float], closed: list[bool]):
+        """Create an empty tour.
+
+        :param paths: the paths to order
+        :param start: the x, y position of the tool before the first path
+        :param closed: the closed flag of each path
+        """
+        self.paths = paths
+        self.start = start
+        self.closed = closed
+        self.order: list[int] = []  # the index of the path at each position
+        self.entries: list[tuple[float, float]] = []  # the entry point of the path at each position
+        self.exits: list[tuple[float, float]] = []  # the exit point of the path at each position
+        self.pos: list[int] = [-1] * len(paths)  # the position of each path
+
+    def append(self, path_nbr: int, entry: tuple[float, float], exit_point: tuple[float, float]) -> None:
+        """Append a path to the tour, entered and exited at the given points."""
+        self.pos[path_nbr] = len(self.order)
+        self.order.append(path_nbr)
+        self.entries.append(entry)
+        self.exits.append(exit_point)
+
+    def exit_at(self, position: int) -> tuple[float, float]:
+        """Return the point the tool leaves the position from, the tool's start for the position -1."""
+        return self.start if position < 0 else self.exits[position]
+
+    def hop(self, from_pos: int, to_pos: int) -> float:
+        """Return the travel from the exit of a position to the entry of another, 0 past the end of the tour."""
+        if to_pos >= len(self.order):
+            return 0.0
+        return math.dist(self.exit_at(from_pos), self.entries[to_pos])
+
+    def travel(self) -> float:
+        """Return the length of the travel of the tour."""
+        return sum(self.hop(position - 1, position) for position in range(len(self.order)))
+
+    def reverse(self, first: int, last: int) -> None:
+        """Reverse the block of positions from first to last (included), swapping the entries & exits."""
+        self.order[first:last + 1] = self.order[first:last + 1][::-1]
+        entries = self.entries[first:last + 1]
+        self.entries[first:last + 1] = self.exits[first:last + 1][::-1]
+        self.exits[first:last + 1] = entries[::-1]
+        for position in range(first, last + 1):
+            self.pos[self.order[position]] = position
+
+    def move(self, first: int, last: int, after: int, flip: bool) -> None:
+        """Move the block of positions from first to last after another position, reversed if flip is True."""
+        block = slice(first, last + 1)
+        order, entries, exits = self.order[block], self.entries[block], self.exits[block]
+        if flip:
+            order, entries, exits = order[::-1], exits[::-1], entries[::-1]
+        del self.order[block], self.entries[block], self.exits[block]
+        at = after + 1 if after < first else after + 1 - len(order)
+        self.order[at:at] = order
+        self.entries[at:at] = entries
+        self.exits[at:at] = exits
+        for position in range(min(first, at), max(last, at + len(order) - 1) + 1):
+            self.pos[self.order[position]] = position
+
+
+def greedy_tour(paths: list[list[Line | Arc]], start: tuple[float, float], closed: list[bool]) -> Tour:
+    """Seed the tour by always travelling to the nearest path entry not cut yet.
+
+    :param paths: the paths to order
+    :param start: the x, y position of the tool before the first path
+    :param closed: the closed flag of each path
+    :return: the tour
+    """
+    tour = Tour(paths, start, closed)
+    if not paths:
+        return tour
+    # the grid cells are about the size of a path, so the nearest path entry is found in a few cells. Paths that
+    # are points (e.g. drill hits) get cells that hold about 1 path each, over the area of the paths & the start.
+    spans = [math.dist((p[0].x1, p[0].y1), (p[-1].x2, p[-1].y2)) or math.dist(*seg_bounds(p)) for p in paths]
+    spread = np.ptp(np.array([start] + [(p[0].x1, p[0].y1) for p in paths]), axis=0)
+    index = GridIndex(max(sum(spans) / len(spans), float(spread.max()) / math.sqrt(len(paths)), 1e-3))
+    point_ranges = []
+    for path_nbr, path in enumerate(paths):
+        first = len(index.points)
+        if closed[path_nbr]:
+            for seg_nbr, seg in enumerate(path):
+                index.insert(seg.x1, seg.y1, (path_nbr, seg_nbr))
+        else:
+            index.insert(path[0].x1, path[0].y1, (path_nbr, 0))
+            index.insert(path[-1].x2, path[-1].y2, (path_nbr, -1))
+        point_ranges.append(range(first, len(index.points)))
+
+    x, y = start
+    while len(index):
+        _, point_nbr = index.nearest(x, y)
+        path_nbr, seg_nbr = index.items[point_nbr]
+        for nbr in point_ranges[path_nbr]:
+            index.remove(nbr)
+        path = paths[path_nbr]
+        if closed[path_nbr]:
+            entry = exit_point = (path[seg_nbr].x1, path[seg_nbr].y1)
+        elif seg_nbr == 0:
+            entry, exit_point = (path[0].x1, path[0].y1), (path[-1].x2, path[-1].y2)
+        else:
+            entry, exit_point = (path[-1].x2, path[-1].y2), (path[0].x1, path[0].y1)
+        tour.append(path_nbr, entry, exit_point)
+        x, y = exit_point
+    return tour
+
+
+def seg_bounds(path: list[Line | Arc]) -> tuple[tuple[float, float], tuple[float, float]]:
+    """Return the lower left & upper right corners of the box around the segment end points of a path."""
+    xs = [seg.x1 for seg in path]
+    ys = [seg.y1 for seg in path]
+    return (min(xs), min(ys)), (max(xs), max(ys))
+
+
+def neighbour_lists(tour: Tour, count: int = 8) -> list[list[int]]:
+    """Return, for each path, the paths whose entry or exit is among the nearest to the path's entry or exit.
+
+    :param tour: the tour, the entries & exits of its paths are used as the paths' locations
+    :param count: the number of neighbours looked for around each point
+    """
+    points = np.array(tour.entries + tour.exits, dtype=np.float64).reshape(-1, 2)
+    spread = np.ptp(points, axis=0) if len(points) else np.zeros(2)
+    # cells that hold about 4 points, the neighbours are in the 3 x 3 cells around a point
+    cell = max(2 * math.sqrt(max(spread[0] * spread[1], 1e-6) / max(len(points), 1)), 1e-3)
+    index = GridIndex(cell)
+    for position, path_nbr in enumerate(tour.order):
+        index.insert(*tour.entries[position], path_nbr)
+        index.insert(*tour.exits[position], path_nbr)
+
+    neighbours = [[] for _ in tour.paths]
+    for position, path_nbr in enumerate(tour.order):
+        found = set()
+        for x, y in {tour.entries[position], tour.exits[position]}:
+            radius = cell
+            hits = index.query_radius(x, y, radius)
+            while len(hits) <= count and radius < 64 * cell:
+                radius *= 2
+                hits = index.query_radius(x, y, radius)
+            found.update(index.items[nbr] for _, nbr in hits[:count + 2])
+        found.discard(path_nbr)
+        neighbours[path_nbr] = list(found)
+    return neighbours
+
+
+def two_opt_pass(tour: Tour, neighbours: list[list[int]], deadline: float) -> bool:
+    """Make the 2-opt moves that shorten the travel, between neighbour paths.
+
+    The travels into the first and out of the last path of a block of the tour are replaced by reversing the
+    block: the travel into the block then goes to the exit of its last path, and the travel out of the block
+    leaves from the entry of its first path.
+
+    :return: True if the tour was improved
+    """
+    dist = math.dist
+    entries, exits, pos = tour.entries, tour.exits, tour.pos
+    size = len(tour.order)
+    improved = False
+    for position in range(size):
+        if not position % 64 and time.perf_counter() > deadline:
+            break
+        # the new travel into the block leaves the path before it, towards a neighbour of that path
+        for candidate in neighbours[tour.order[position - 1] if position else tour.order[position]]:
+            other = pos[candidate]
+            # the block starts at position and ends at the neighbour, or ends before position and starts after it
+            first, last = (position, other) if other > position else (other + 1, position - 1)
+            if last <= first:
+                continue
+            prev_exit = exits[first - 1] if first else tour.start
+            gain = dist(prev_exit, entries[first]) - dist(prev_exit, exits[last])
+            if last + 1 < size:
+                gain += dist(exits[last], entries[last + 1]) - dist(entries[first], entries[last + 1])
+            if gain > 1e-9:
+                tour.reverse(first, last)
+                improved = True
+    return improved
+
+
+def or_opt_pass(tour: Tour, neighbours: list[list[int]], deadline: float, max_block: int = 3) -> bool:
+    """Move blocks of 1 to max_block paths next to a neighbour path, when that shortens the travel.
+
+    :return: True if the tour was improved
+    """
+    dist = math.dist
+    entries, exits, pos = tour.entries, tour.exits, tour.pos
+    size = len(tour.order)
+    improved = False
+    for block_len in range(1, max_block + 1):
+        for first in range(size - block_len + 1):
+            if not first % 64 and time.perf_counter() > deadline:
+                return improved
+            last = first + block_len - 1
+            prev_exit = exits[first - 1] if first else tour.start
+            # the travel saved by taking the block out of the tour
+            removed = dist(prev_exit, entries[first])
+            if last + 1 < size:
+                removed += dist(exits[last], entries[last + 1]) - dist(prev_exit, entries[last + 1])
+            block_entry, block_exit = entries[first], exits[last]
+            best = None
+            # the block is tried before & after each neighbour of its first & last paths
+            candidates = neighbours[tour.order[first]] + neighbours[tour.order[last]]
+            afters = {pos[candidate] + shift for candidate in candidates for shift in (-1, 0)}
+            for after in afters:
+                if first - 1 <= after <= last:
+                    continue
+                after_exit = exits[after] if after >= 0 else tour.start
+                added = dist(after_exit, block_entry)
+                added_flip = dist(after_exit, block_exit)
+                if after + 1 < size:
+                    next_entry = entries[after + 1]
+                    old = dist(after_exit, next_entry)
+                    added += dist(block_exit, next_entry) - old
+                    added_flip += dist(block_entry, next_entry) - old
+                for cost, flip in ((added, False), (added_flip, True)):
+                    if cost < removed - 1e-9 and (best is None or cost < best[0]):
+                        best = (cost, after, flip)
+            if best:
+                tour.move(first, last, best[1], best[2])
+                improved = True
+    return improved
+
+
+def closed_start_pass(tour: Tour) -> bool:
+    """Move the start vertex of each closed path to the vertex closest to the paths before & after it.
+
+    :return: True if the tour was improved
+    """
+    improved = False
+    for position, path_nbr in enumerate(tour.order):
+        if not tour.closed[path_nbr]:
+            continue
+        path = tour.paths[path_nbr]
+        vertices = np.array([(seg.x1, seg.y1) for seg in path])
+        cost = np.hypot(*(vertices - tour.exit_at(position - 1)).T)
+        if position + 1 < len(tour.order):
+            cost += np.hypot(*(vertices - tour.entries[position + 1]).T)
+        best = tuple(vertices[int(np.argmin(cost))])
+        current = tour.hop(position - 1, position) + tour.hop(position, position + 1)
+        if cost.min() < current - 1e-9:
+            tour.entries[position] = tour.exits[position] = (float(best[0]), float(best[1]))
+            improved = True
+    return improved
+
+
+def order_toolpaths(
+    paths: list[list[Line | Arc]],
+    start: tuple[float, float] = (0.0, 0.0),
+    time_budget: float = 2.0,
+    rapid_speed: float = 4000.0,
+) -> PathOrder:
+    """Order the paths to minimize the travel between them.
+
+    :param paths: the paths to order, each a list of Line & Arc segments that start at the end of the one
+        before them, closed if they end where they start
+    :param start: the x, y position of the tool before the first path
+    :param time_budget: the time, in seconds, the ordering is allowed to run for, the improvements stop when it
+        runs out
+    :param rapid_speed: the speed of the travels, in mm/min, for the times of the report
+    :return: the ordering, the empty paths are left out of it
+    """
+    deadline = time.perf_counter() + time_budget
+    # the path numbers of the visits are the numbers in paths, with the empty paths skipped
+    path_nbrs = [path_nbr for path_nbr, path in enumerate(paths) if path]
+    paths = [paths[path_nbr] for path_nbr in path_nbrs]
+    closed = [is_closed(path) for path in paths]
+    original = Tour(paths, start, closed)
+    for path_nbr, path in enumerate(paths):
+        original.append(path_nbr, (path[0].x1, path[0].y1), (path[-1].x2, path[-1].y2))
+
+    tour = greedy_tour(paths, start, closed)
+    neighbours = neighbour_lists(tour)
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = closed_start_pass(tour)
+        improved |= two_opt_pass(tour, neighbours, deadline)
+        improved |= or_opt_pass(tour, neighbours, deadline)
+
+    visits = []
+    for position, path_nbr in enumerate(tour.order):
+        path = paths[path_nbr]
+        if closed[path_nbr]:
+            entry = tour.entries[position]
+            seg_nbr = min(range(len(path)), key=lambda nbr: math.dist((path[nbr].x1, path[nbr].y1), entry))
+            visits.append(PathVisit(path_nbrs[path_nbr], False, seg_nbr))
+        else:
+            visits.append(PathVisit(path_nbrs[path_nbr], tour.entries[position] != (path[0].x1, path[0].y1), 0))
+    before, after = original.travel(), tour.travel()
+    return PathOrder(visits, before, after, before / rapid_speed * 60, after / rapid_speed * 60)
+
+
+def visit_segments(path: list[Line | Arc], visit: PathVisit) -> list[Line | Arc]:
+    """Return the segments of a path in the order they are cut: rotated to their start, or reversed."""
+    if visit.reversed:
+        return reverse_contour(path)
+    return path[visit.start:] + path[:visit.start]
+
+
+def output_order_report(order: PathOrder) -> None:
+    """Prints out the travel before & after the ordering of the toolpaths.
+
+    :param order: the ordering returned by order_toolpaths
+    """
+    saved = 1 - order.travel_after / order.travel_before if order.travel_before else 0.0
+    print(f"paths: {len(order.visits)}   travel saved: {saved:.1%}")
+    print(f"\tbefore: {order.travel_before:>12.3f} mm   {order.time_before:>9.1f} s")
+    print(f"\tafter:  {order.travel_after:>12.3f} mm   {order.time_after:>9.1f} s")
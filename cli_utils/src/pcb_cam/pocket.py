@@ -0,0 +1,278 @@
+"""Copper clearing (pocketing) toolpaths for the large copper areas of a layer: pours and large pads.
+
+Fusion clears such areas with its "2D Adaptive" strategy (see gcode_files/1001.cnc): a helical entry down
+to the cutting depth, then paths that keep the tool's engagement constant. This stage generates the simpler
+contour-parallel clearing natively, from the parsed gerber layer:
+    * the areas to clear are the dark regions (G36/G37) and the flashes larger than a minimum area, merged
+      into their union
+    * the rings are the inward offsets of the areas by the tool radius plus 0, 1, 2, ... stepovers. Each ring
+      is offset directly from the areas (not from the previous ring), with the arc preserving offset kernel,
+      so errors do not accumulate and arcs stay G2 / G3.
+    * the rings form a tree, each ring is inside exactly one ring of the level before it. The tree is cut
+      inside out: each innermost ring is entered with a helix, and when a ring is done the tool feeds out
+      to the closest point of the ring around it, which is never further than a stepover away. The
+      contours around islands (holes in the areas) are cut after the outer contour of their ring.
+    * the moves of each ring are built as columns and appended to the toolpath in 1 batch
+"""
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from grbr_explain.min_gerber_parser import GrbrFlash, GrbrPlot, GrbrRegion
+from pcb_cam.arc_offset import (
+    Arc,
+    Line,
+    contour_area,
+    linearize_contour,
+    obj_outline,
+    offset_contours,
+    point_in_contours,
+    seg_point,
+    start_contour_near,
+)
+from pcb_cam.toolpath import CCW_ARC, CW_ARC, LINEAR, Tool, Toolpath, write_gcode_file
+
+# Tuple describing 1 ring of the clearing toolpath: the outline of 1 face of an offset of the areas
+#   contour  - the Line & Arc segments of the ring's outer contour, counterclockwise
+#   islands  - the contours, clockwise, around the islands inside the ring (holes of the areas, which are kept)
+#   level    - the number of stepovers the ring is offset by, 0 for the rings that finish the area's edges
+#   children - the rings of the next level that are inside this ring
+PocketRing = namedtuple("PocketRing", ["contour", "islands", "level", "children"])
+
+# the outward offset that merges the areas, the rings are offset inward by this much more to cancel it
+MERGE_DIST = 1e-4
+
+
+def pocket_areas(grbr_plot: GrbrPlot, min_area: float) -> list[list[Line | Arc]]:
+    """Return the outlines of the copper areas to clear: the union of the dark regions and large flashes.
+
+    :param grbr_plot: the parsed gerber layer
+    :param min_area: flashes whose outline encloses less than this area are not cleared
+    :return: the contours of the merged areas, counterclockwise for their outer outlines
+
+    Clear objects are not subtracted, the areas are the plain union of the dark objects.
+    """
+    contours = []
+    for obj in grbr_plot.graphic_objs:
+        if obj.polarity != "dark":
+            continue
+        if isinstance(obj, GrbrRegion):
+            contours.extend(obj_outline(obj, grbr_plot.aperture_lkp))
+        elif isinstance(obj, GrbrFlash):
+            outline = obj_outline(obj, grbr_plot.aperture_lkp)
+            if sum(contour_area(contour) for contour in outline) >= min_area:
+                contours.extend(outline)
+    # a tiny outward offset merges the overlapping areas (an inward offset needs disjoint contours), and opens
+    # the zero width cut-ins of the pours into separate islands. It must stay well above the offset's tolerance.
+    return offset_contours(contours, MERGE_DIST)
+
+
+def group_faces(contours: list[list[Line | Arc]], level: int, tol: float) -> list[tuple[PocketRing, list]]:
+    """Group the contours of 1 offset into rings: each outer contour with the islands inside it.
+
+    :param contours: the contours of the offset, outer contours counterclockwise and islands clockwise
+    :param level: the level of the rings
+    :param tol: the tolerance used to linearize the contours for the containment tests
+    :return: list of tuples of: the ring, and the linearized polygons of its outer contour and islands
+    """
+    outers = sorted((c for c in contours if contour_area(c) > 0), key=contour_area)
+    polygons = [linearize_contour(contour, tol) for contour in outers]
+    faces = [(PocketRing(contour, [], level, []), [polygon]) for contour, polygon in zip(outers, polygons)]
+    for contour in contours:
+        if contour_area(contour) > 0:
+            continue
+        # the smallest outer contour around the island (the outer contours are sorted by area)
+        x, y = seg_point(contour[0], 0.5)
+        face_nbr = next((nbr for nbr, polygon in enumerate(polygons) if point_in_contours(x, y, [polygon])), None)
+        if face_nbr is not None:
+            faces[face_nbr][0].islands.append(contour)
+            faces[face_nbr][1].append(linearize_contour(contour, tol))
+    return faces
+
+
+def in_face(x: float, y: float, polygons: list[list[tuple[float, float]]]) -> bool:
+    """Return True if a point is inside a face: inside its outer polygon (the first one) and not in an island."""
+    return point_in_contours(x, y, polygons[:1]) and not point_in_contours(x, y, polygons[1:])
+
+
+def ring_tree(
+    areas: list[list[Line | Arc]],
+    radius: float,
+    stepover: float,
+    max_rings: int = 10000,
+) -> list[PocketRing]:
+    """Offset the areas into rings and nest each ring in the ring of the level before it that contains it.
+
+    :param areas: the contours of the areas to clear
+    :param radius: the tool radius
+    :param stepover: the distance between the rings
+    :param max_rings: the largest number of levels, a guard against a tiny stepover
+    :return: the rings of level 0, the rings of the next levels are nested in their children
+    """
+    roots, parents = [], []
+    for level in range(max_rings):
+        contours = offset_contours(areas, -(radius + level * stepover), with_holes=True)
+        if not contours:
+            break
+        faces = group_faces(contours, level, stepover / 10)
+        for ring, _ in faces:
+            x, y = ring.contour[0].x1, ring.contour[0].y1
+            parent = next((p for p, polygons in parents if in_face(x, y, polygons)), None)
+            (parent.children if parent else roots).append(ring)
+        parents = faces
+    return roots
+
+
+def contour_moves(contour: list[Line | Arc], z: float, feed: float) -> tuple[np.ndarray, ...]:
+    """Return the moves that follow a contour, as columns: kind, x, y, z, i, j, feed."""
+    kinds = np.array([(CCW_ARC if seg.ccw else CW_ARC) if isinstance(seg, Arc) else LINEAR for seg in contour])
+    ends = np.array([(seg.x1, seg.y1, seg.x2, seg.y2) for seg in contour], dtype=np.float64)
+    centers = np.array([(seg.cx, seg.cy) if isinstance(seg, Arc) else (0.0, 0.0) for seg in contour])
+    is_arc = kinds != LINEAR
+    i = np.where(is_arc, centers[:, 0] - ends[:, 0], 0.0)
+    j = np.where(is_arc, centers[:, 1] - ends[:, 1], 0.0)
+    count = len(contour)
+    return kinds, ends[:, 2], ends[:, 3], np.full(count, z), i, j, np.full(count, feed)
+
+
+def helix_entry(
+    toolpath: Toolpath,
+    ring: PocketRing,
+    depth: float,
+    helix_radius: float,
+    helix_pitch: float,
+    retract_z: float,
+    feed: float,
+    plunge_feed: float,
+) -> None:
+    """Enter the material inside an innermost ring with a helix, ending at the cutting depth.
+
+    :param toolpath: the toolpath the moves are appended to
+    :param ring: the innermost ring
+    :param depth: the cutting depth, a positive value
+    :param helix_radius: the radius of the helix, reduced until the helix fits inside the ring
+    :param helix_pitch: the depth the helix descends per turn
+    :param retract_z: the height the helix starts from
+    :param feed: the feed rate of the helix
+    :param plunge_feed: the feed rate of the plunge, when not even a small helix fits
+    """
+    center = None
+    while helix_radius >= 0.05:
+        # the helix's center must be at least its radius inside the ring, and away from its islands
+        inner = offset_contours([ring.contour] + ring.islands, -helix_radius, with_holes=True)
+        if inner:
+            center = inner[0][0].x1, inner[0][0].y1
+            break
+        helix_radius /= 2
+    if center is None:
+        toolpath.rapid(ring.contour[0].x1, ring.contour[0].y1)
+        toolpath.rapid(z=retract_z)
+        toolpath.linear(None, None, -depth, plunge_feed)
+        return
+
+    cx, cy = center
+    toolpath.rapid(cx + helix_radius, cy)
+    toolpath.rapid(z=retract_z)
+    # the helix is made of half turns, each descending half a pitch, then a full turn at the cutting depth
+    half_turns = max(1, math.ceil((retract_z + depth) / helix_pitch * 2))
+    for turn in range(half_turns):
+        x = cx - helix_radius if turn % 2 == 0 else cx + helix_radius
+        toolpath.arc(x, cy, cx, cy, False, feed, retract_z - (retract_z + depth) * (turn + 1) / half_turns)
+    x = toolpath.position[0]
+    toolpath.arc(2 * cx - x, cy, cx, cy, False, feed)
+    toolpath.arc(x, cy, cx, cy, False, feed)
+
+
+def pocket_toolpath(
+    grbr_plot: GrbrPlot,
+    tool: Tool,
+    depth: float = 0.1,
+    stepover: float | None = None,
+    feed: float = 500.0,
+    plunge_feed: float = 100.0,
+    safe_z: float = 15.0,
+    retract_z: float = 0.5,
+    helix_radius: float | None = None,
+    helix_pitch: float = 0.1,
+    min_area: float | None = None,
+    spindle_speed: int = 10000,
+) -> Toolpath:
+    """Create the contour-parallel clearing toolpath of the copper areas of a layer.
+
+    :param grbr_plot: the parsed gerber layer
+    :param tool: the end mill
+    :param depth: the cutting depth (the copper thickness plus some overcut), a positive value
+    :param stepover: the distance between the rings, defaults to 40% of the tool diameter
+    :param feed: the cutting feed rate
+    :param plunge_feed: the feed rate of plunges, when there is no room for a helix
+    :param safe_z: the height the tool moves to before the first entry
+    :param retract_z: the height the tool retracts to between entries, and the helix starts from
+    :param helix_radius: the radius of the helical entries, defaults to 40% of the tool diameter
+    :param helix_pitch: the depth the helical entries descend per turn
+    :param min_area: flashes smaller than this area are not cleared, defaults to 4 times the tool's area
+    :param spindle_speed: the spindle speed, in rpm
+    :return: the toolpath
+    """
+    radius = tool.diameter / 2
+    stepover = stepover or 0.4 * tool.diameter
+    if stepover <= 0 or stepover > tool.diameter:
+        raise ValueError(f"The stepover must be between 0 and the tool diameter, got: {stepover}")
+    helix_radius = helix_radius or 0.4 * tool.diameter
+    min_area = 4 * math.pi * radius ** 2 if min_area is None else min_area
+
+    toolpath = Toolpath("Pocket clearing", tool, spindle_speed)
+    first = True
+
+    def cut(ring: PocketRing) -> None:
+        nonlocal first
+        if ring.children:
+            for child in ring.children:
+                cut(child)
+            # feed out to the closest point of this ring, at most a stepover away from the last child ring
+            contour = start_contour_near(ring.contour, *toolpath.position[:2])
+            toolpath.linear(contour[0].x1, contour[0].y1, None, feed)
+        else:
+            if first:
+                toolpath.rapid(z=safe_z)
+                first = False
+            else:
+                toolpath.rapid(z=retract_z)
+            helix_entry(toolpath, ring, depth, helix_radius, helix_pitch, retract_z, feed, plunge_feed)
+            contour = start_contour_near(ring.contour, *toolpath.position[:2])
+            if math.dist(toolpath.position[:2], (contour[0].x1, contour[0].y1)) > 1e-6:
+                toolpath.linear(contour[0].x1, contour[0].y1, None, feed)
+        toolpath.add_moves(*contour_moves(contour, -depth, feed))
+        # the islands are reached over the cleared material, the plunge only meets a stepover wide crescent
+        for island in ring.islands:
+            toolpath.rapid(z=retract_z)
+            toolpath.rapid(island[0].x1, island[0].y1)
+            toolpath.linear(None, None, -depth, plunge_feed)
+            toolpath.add_moves(*contour_moves(island, -depth, feed))
+
+    for root in ring_tree(pocket_areas(grbr_plot, min_area), radius + MERGE_DIST, stepover):
+        cut(root)
+    if not first:
+        toolpath.rapid(z=retract_z)
+    return toolpath
+
+
+def write_pocket_gcode(
+    gcode_fn: str,
+    grbr_plot: GrbrPlot,
+    tool: Tool,
+    program_nbr: int = 1001,
+    **kwargs,
+) -> Toolpath:
+    """Write the copper clearing G-code of a layer.
+
+    :param gcode_fn: the file name path of the G-code file to write
+    :param grbr_plot: the parsed gerber layer
+    :param tool: the end mill
+    :param program_nbr: the program number written in the header
+    :param kwargs: the cutting parameters passed on to pocket_toolpath
+    :return: the toolpath that was written
+    """
+    toolpath = pocket_toolpath(grbr_plot, tool, **kwargs)
+    write_gcode_file(gcode_fn, program_nbr, [toolpath], safe_z=kwargs.get("safe_z", 15.0))
+    return toolpath
@@ -0,0 +1,259 @@
+"""Post processor: a Fusion post dump (.dmp file) written as G-code for a machine, without going back to Fusion.
+
+A post dump records the calls Fusion makes to a post processor (see gcode_explain.dmp_parser): the operations
+(onSection), the kinds of moves (onMovement) and the moves themselves (onRapid, onLinear, onCircular), at full
+precision and independent of the machine. The post engine replays these calls into the toolpaths of a
+machine, and writes them with the bulk G-code writer of pcb_cam.toolpath:
+    * each section (operation) of the dump is a toolpath, with the tool & spindle speed of its operation
+      parameters. Its moves are converted a whole section at a time, with NumPy.
+    * the first move of a section is a positioning move, written as an XY rapid move then a Z rapid move
+    * the full circles are written as 2 half circles, and the moves too short to change the position written
+      with 3 decimals are dropped
+    * the arcs the machine can not cut are linearized, within a tolerance: the arcs out of the XY plane (the
+      G-code writer only writes XY arcs, helical or not), the arcs with a chord too short to be written
+      accurately with 3 decimals, and the arcs with a huge radius
+    * the machine's settings come from a PostProfile: the profiles are pluggable, a job can be re-posted with
+      a copy of a profile changing e.g. the tool numbers or the clearance height (PostProfile._replace)
+
+The dump is parsed once, re-posting it with another profile only formats its moves again: a fraction of a
+second for a large job.
+"""
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from gcode_explain.dmp_parser import DmpDump, parse_dmp
+from gcode_explain.min_gcode_parser import arc_sweeps
+from pcb_cam.toolpath import CARVERA, CCW_ARC, CW_ARC, LINEAR, RAPID, Tool, Toolpath, write_gcode_file
+
+# Tuple describing how a program is written for a machine
+#   machine           - the machine, written in the program header
+#   clearance_z       - the height the moves at the clearance height of an operation are moved to, None to keep
+#                       the operation's clearance height
+#   safe_z            - the height of the retract at the end of the program, None for the clearance height
+#   tool_numbers      - dictionary of the tool number written for a tool number of the dump, the others are kept
+#   spindle_speed     - the spindle speed of every operation, in rpm, None for the speed of each operation
+#   min_chord         - the arcs with a shorter chord are linearized, in mm
+#   max_radius        - the arcs with a larger radius are linearized, in mm
+#   tolerance         - the largest distance between a linearized arc and its straight moves, in mm
+#   split_positioning - True to write the first move of an operation as an XY rapid move then a Z rapid move
+#   split_circles     - True to write the full circles as 2 half circles
+PostProfile = namedtuple(
+    "PostProfile",
+    [
+        "machine",
+        "clearance_z",
+        "safe_z",
+        "tool_numbers",
+        "spindle_speed",
+        "min_chord",
+        "max_radius",
+        "tolerance",
+        "split_positioning",
+        "split_circles",
+    ],
+)
+# the settings of the Fusion 360 Carvera post (see gcode_files/1002.cnc, posted from gcode_files/1001.dmp)
+CARVERA_POST = PostProfile(CARVERA, None, None, {}, None, 0.25, 1000.0, 0.002, True, True)
+POST_PROFILES = {"carvera": CARVERA_POST}
+
+
+def linearize_arc(
+    start: np.ndarray,
+    center: np.ndarray,
+    end: np.ndarray,
+    normal: np.ndarray,
+    clockwise: bool,
+    tolerance: float,
+) -> np.ndarray:
+    """Return the end points of the straight moves that follow an arc within a tolerance.
+
+    :param start: the x, y, z of the start of the arc
+    :param center: the x, y, z of the arc's center
+    :param end: the x, y, z of the end of the arc
+    :param normal: the unit normal of the arc's plane, the arc turns counterclockwise around it (unless
+        clockwise), a helical arc rises along it
+    :param clockwise: True for a clockwise arc
+    :param tolerance: the largest distance between the arc and a straight move
+    :return: the end points, as a (n, 3) array, the last one is the end of the arc
+    """
+    rel_start, rel_end = start - center, end - center
+    height = float(rel_start @ normal)
+    radial = rel_start - height * normal
+    radius = float(np.linalg.norm(radial))
+    if radius < 1e-9:
+        return end[None, :]
+    axis_u = radial / radius
+    # normal x axis_u, written out: np.cross is slow on single vectors
+    axis_v = np.array(
+        (
+            normal[1] * axis_u[2] - normal[2] * axis_u[1],
+            normal[2] * axis_u[0] - normal[0] * axis_u[2],
+            normal[0] * axis_u[1] - normal[1] * axis_u[0],
+        )
+    )
+    angle = math.atan2(float(rel_end @ axis_v), float(rel_end @ axis_u))
+    sweep = float(arc_sweeps(0.0, angle, not clockwise))
+    if clockwise:
+        sweep = -sweep
+    # the sagitta of each chord is within the tolerance
+    step = 2 * math.acos(max(1 - tolerance / radius, -1.0))
+    count = max(int(math.ceil(abs(sweep) / step)), 1)
+    t = np.arange(1, count + 1) / count
+    angles = sweep * t
+    rise = float((end - start) @ normal)
+    points = (
+        center
+        + (height + rise * t)[:, None] * normal
+        + radius * (np.cos(angles)[:, None] * axis_u + np.sin(angles)[:, None] * axis_v)
+    )
+    points[-1] = end
+    return points
+
+
+def section_tool(parameters: dict, profile: PostProfile) -> Tool:
+    """Return the tool of an operation, from its parameters."""
+    number = int(parameters.get("operation:tool_number", 1))
+    taper_angle = parameters.get("operation:tool_taperAngle") or None
+    return Tool(
+        profile.tool_numbers.get(number, number),
+        float(parameters.get("operation:tool_diameter", 0.0)),
+        str(parameters.get("operation:tool_type", "")),
+        taper_angle,
+    )
+
+
+def section_toolpath(
+    dump: DmpDump,
+    section: int,
+    rows: slice,
+    start: tuple[float, float, float],
+    profile: PostProfile,
+) -> Toolpath:
+    """Return the toolpath of a section of a dump, its moves converted a whole column at a time.
+
+    :param dump: the parsed post dump
+    :param section: the index of the section
+    :param rows: the rows of the section's moves, in the columns of the dump
+    :param start: the x, y, z position before the section, nan when unknown
+    :param profile: the settings of the machine
+    :return: the toolpath
+    """
+    parameters = dump.section_parameters[section]
+    moves = {column: values[rows] for column, values in dump.moves.items()}
+    kinds = moves["motion"].astype(np.int8)
+    xyz = np.column_stack((moves["x"], moves["y"], moves["z"]))
+    starts = np.vstack((np.array(start, dtype=np.float64)[None, :], xyz[:-1]))
+    centers = starts + np.column_stack((moves["i"], moves["j"], moves["k"]))
+    normals = np.column_stack((moves["nx"], moves["ny"], moves["nz"]))
+    feeds = moves["feed"]
+
+    # the moves at the clearance height of the operation move to the profile's clearance height
+    clearance = parameters.get("operation:clearanceHeight_value")
+    if profile.clearance_z is not None and clearance is not None:
+        xyz[:, 2] = np.where(np.abs(xyz[:, 2] - clearance) < 1e-6, profile.clearance_z, xyz[:, 2])
+        starts = np.vstack((np.array(start, dtype=np.float64)[None, :], xyz[:-1]))
+
+    # the arcs the machine can not cut are linearized
+    arcs = (kinds == CW_ARC) | (kinds == CCW_ARC)
+    chords = np.linalg.norm((xyz - starts)[:, :2], axis=1)
+    radii = np.linalg.norm((starts - centers)[:, :2], axis=1)
+    full_circle = chords < 1e-9
+    linearize = arcs & (
+        (moves["plane"] != 17) | ((chords < profile.min_chord) & ~full_circle) | (radii > profile.max_radius)
+    )
+    linearize &= ~np.isnan(starts).any(axis=1)
+    # the rows of the moves written in place of a move: the points of a linearized arc, the 2 halves of a circle
+    pieces = {
+        int(nbr): linearize_arc(
+            starts[nbr], centers[nbr], xyz[nbr], normals[nbr], kinds[nbr] == CW_ARC, profile.tolerance
+        )
+        for nbr in np.flatnonzero(linearize)
+    }
+    circles = np.flatnonzero(arcs & full_circle & ~linearize) if profile.split_circles else []
+    for nbr in circles:
+        half = np.r_[2 * centers[nbr, :2] - starts[nbr, :2], (starts[nbr, 2] + xyz[nbr, 2]) / 2]
+        pieces[int(nbr)] = np.vstack((half, xyz[nbr]))
+    counts = np.ones(len(kinds), dtype=np.int64)
+    for nbr, points in pieces.items():
+        counts[nbr] = len(points)
+    # the first move of the operation is written as an XY then a Z move
+    split = profile.split_positioning and len(kinds) > 0 and not arcs[0]
+    if split:
+        counts[0] += 1
+    source = np.repeat(np.arange(len(kinds)), counts)
+    first_row = np.cumsum(counts) - counts
+    out_xyz = xyz[source]
+    out_kinds = kinds[source]
+    offsets = np.where(arcs[:, None], centers - starts, 0.0)[source][:, :2]
+    for nbr, points in pieces.items():
+        rows = slice(first_row[nbr], first_row[nbr] + len(points))
+        out_xyz[rows] = points
+        if linearize[nbr]:
+            out_kinds[rows] = LINEAR
+            offsets[rows] = 0.0
+        else:
+            offsets[first_row[nbr] + 1] = centers[nbr, :2] - points[0, :2]
+    if split:
+        out_xyz[0, 2] = start[2]
+        out_kinds[:2] = RAPID
+    # the straight moves that do not move at the precision of the program are dropped
+    rounded = np.round(out_xyz, 3)
+    before = np.vstack((np.round(np.array(start, dtype=np.float64), 3)[None, :], rounded[:-1]))
+    keep = (out_kinds >= CW_ARC) | ~np.all(rounded == before, axis=1)
+    out_xyz, out_kinds, offsets, source = out_xyz[keep], out_kinds[keep], offsets[keep], source[keep]
+
+    toolpath = Toolpath(
+        dump.sections[section],
+        section_tool(parameters, profile),
+        int(profile.spindle_speed or parameters.get("operation:tool_spindleSpeed", 10000)),
+        start,
+    )
+    xs, ys, zs = out_xyz.T
+    toolpath.add_moves(out_kinds, xs, ys, zs, offsets[:, 0], offsets[:, 1], feeds[source])
+    return toolpath
+
+
+def post_toolpaths(dump: DmpDump, profile: PostProfile = CARVERA_POST) -> list[Toolpath]:
+    """Replay the sections & moves of a post dump into the toolpaths of a machine.
+
+    :param dump: the parsed post dump
+    :param profile: the settings of the machine
+    :return: the toolpath of each section, in order
+    """
+    section_col = dump.moves["section"]
+    bounds = np.searchsorted(section_col, np.arange(len(dump.sections) + 1), "left")
+    toolpaths = []
+    position = (math.nan, math.nan, math.nan)
+    for section in range(len(dump.sections)):
+        rows = slice(int(bounds[section]), int(bounds[section + 1]))
+        toolpath = section_toolpath(dump, section, rows, position, profile)
+        position = toolpath.position
+        toolpaths.append(toolpath)
+    return toolpaths
+
+
+def write_post_gcode(
+    gcode_fn: str,
+    dump: DmpDump | str,
+    profile: PostProfile = CARVERA_POST,
+    program_nbr: int = 1001,
+) -> list[Toolpath]:
+    """Write the G-code program of a post dump for a machine.
+
+    :param gcode_fn: the file name path of the G-code file to write
+    :param dump: the parsed post dump, or the file name path of the .dmp file
+    :param profile: the settings of the machine
+    :param program_nbr: the program number written in the header
+    :return: the toolpaths that were written
+    """
+    if isinstance(dump, str):
+        dump = parse_dmp(dump)
+    toolpaths = post_toolpaths(dump, profile)
+    safe_z = profile.safe_z
+    if safe_z is None:
+        clearance = dump.section_parameters[-1].get("operation:clearanceHeight_value", 15.0) if toolpaths else 15.0
+        safe_z = clearance if profile.clearance_z is None else profile.clearance_z
+    write_gcode_file(gcode_fn, program_nbr, toolpaths, float(safe_z), profile.machine)
+    return toolpaths
@@ -0,0 +1,225 @@
+"""Board outline profile cut: the board cut out of the stock along its Edge_Cuts outline.
+
+This is the equivalent of Fusion's "2D contour" operation (see gcode_files/2dcfhp1_T2_15mm_2-5mm_flat.cnc),
+generated directly from the Edge_Cuts gerber layer:
+    * the draws and arcs of the layer are chained into closed loops by hashing their end points (see
+      chain_segments), so outlines made of thousands of small segments assemble in linear time
+    * each loop is classified by how many other loops contain it: loops at an even depth are outer
+      outlines, cut on their outside, and loops at an odd depth are inner cut-outs, cut on their inside
+    * the loops are offset by the tool radius with the arc preserving offset kernel, so arcs stay G2 / G3
+    * each loop is cut in passes, stepping down to the target depth
+    * the passes that go below the top of the tabs are lifted over the tabs, which are spread evenly along
+      the outer outlines, to hold the board in the stock until the end of the job
+"""
+import math
+from collections import namedtuple
+
+from grbr_explain.min_gerber_parser import GrbrArc, GrbrDraw, GrbrPlot
+from pcb_cam.arc_offset import (
+    EPS,
+    Arc,
+    Line,
+    chain_segments,
+    circle_halves,
+    contour_area,
+    linearize_contour,
+    offset_contours,
+    point_in_contours,
+    reverse_contour,
+    seg_length,
+    seg_point,
+)
+from pcb_cam.engrave import seg_from_grbr
+from pcb_cam.toolpath import Tool, Toolpath, write_gcode_file
+
+# Tuple describing a closed loop of the board outline
+#   contour - the Line & Arc segments of the loop, counterclockwise
+#   inner   - True for an inner cut-out, False for an outer outline
+#   depth   - the number of other loops that contain the loop
+OutlineLoop = namedtuple("OutlineLoop", ["contour", "inner", "depth"])
+
+
+def outline_loops(grbr_plot: GrbrPlot, snap: float = 1e-3) -> tuple[list[OutlineLoop], list[list[Line | Arc]]]:
+    """Assemble the draws and arcs of an Edge_Cuts layer into closed loops and classify them.
+
+    :param grbr_plot: the parsed gerber Edge_Cuts layer
+    :param snap: end points closer than this distance are treated as the same point
+    :return: tuple of: the closed loops, outer outlines first, and the chains that do not close (gaps in
+        the outline, which can not be cut)
+    """
+    segments = []
+    for obj in grbr_plot.graphic_objs:
+        if not isinstance(obj, (GrbrDraw, GrbrArc)):
+            continue
+        seg = seg_from_grbr(obj)
+        if isinstance(seg, Arc) and math.dist((seg.x1, seg.y1), (seg.x2, seg.y2)) <= EPS:
+            # a full circle (a round cut-out) is split in 2 halves, the offset kernel needs distinct end points
+            segments.extend(circle_halves(seg.cx, seg.cy, seg.x1, seg.y1, seg.ccw))
+        elif seg_length(seg) > 0:
+            segments.append(seg)
+
+    closed, open_chains = [], []
+    for chain in chain_segments(segments, snap):
+        if math.dist((chain[0].x1, chain[0].y1), (chain[-1].x2, chain[-1].y2)) <= snap:
+            closed.append(chain if contour_area(chain) >= 0 else reverse_contour(chain))
+        else:
+            open_chains.append(chain)
+
+    # a loop is inside another loop if any of its points is inside it (outlines do not cross each other)
+    polygons = [linearize_contour(contour, 0.01) for contour in closed]
+    loops = []
+    for loop_nbr, contour in enumerate(closed):
+        x, y = seg_point(contour[0], 0.5)
+        depth = sum(
+            point_in_contours(x, y, [polygon]) for other_nbr, polygon in enumerate(polygons) if other_nbr != loop_nbr
+        )
+        loops.append(OutlineLoop(contour, depth % 2 == 1, depth))
+    # the inner cut-outs are cut first, while the board is still held by its outer outline
+    loops.sort(key=lambda loop: (not loop.inner, loop.depth))
+    return loops, open_chains
+
+
+def split_at_lengths(contour: list[Line | Arc], lengths: list[float]) -> list[tuple[Line | Arc, float]]:
+    """Split the segments of a contour at the given distances along it.
+
+    :param contour: the contour
+    :param lengths: the distances along the contour to split at, in increasing order
+    :return: list of tuples of: a piece of a segment, and the distance along the contour of its midpoint
+    """
+    pieces = []
+    start_len = 0.0
+    split_nbr = 0
+    for seg in contour:
+        length = seg_length(seg)
+        params = []
+        while split_nbr < len(lengths) and lengths[split_nbr] < start_len + length:
+            if lengths[split_nbr] > start_len:
+                params.append((lengths[split_nbr] - start_len) / length)
+            split_nbr += 1
+        t0 = 0.0
+        for t1 in params + [1.0]:
+            x1, y1 = seg_point(seg, t0) if t0 else (seg.x1, seg.y1)
+            x2, y2 = seg_point(seg, t1) if t1 < 1.0 else (seg.x2, seg.y2)
+            piece = Line(x1, y1, x2, y2) if isinstance(seg, Line) else Arc(x1, y1, x2, y2, seg.cx, seg.cy, seg.ccw)
+            pieces.append((piece, start_len + (t0 + t1) / 2 * length))
+            t0 = t1
+        start_len += length
+    return pieces
+
+
+def tab_intervals(perimeter: float, tab_count: int, tab_width: float) -> list[tuple[float, float]]:
+    """Return the intervals, as distances along a loop, where the tool is lifted over the tabs.
+
+    :param perimeter: the length of the toolpath loop
+    :param tab_count: the number of tabs, spread evenly along the loop
+    :param tab_width: the length of the toolpath lifted over each tab (the tab's width plus the tool diameter)
+    """
+    if tab_count <= 0 or tab_width * tab_count >= perimeter:
+        return []
+    spacing = perimeter / tab_count
+    return [(spacing * (n + 0.5) - tab_width / 2, spacing * (n + 0.5) + tab_width / 2) for n in range(tab_count)]
+
+
+def profile_toolpath(
+    grbr_plot: GrbrPlot,
+    tool: Tool,
+    depth: float,
+    stepdown: float,
+    feed: float = 600.0,
+    plunge_feed: float = 300.0,
+    safe_z: float = 15.0,
+    retract_z: float = 5.0,
+    tab_count: int = 4,
+    tab_width: float = 3.0,
+    tab_height: float = 0.5,
+    climb: bool = True,
+    spindle_speed: int = 10000,
+) -> Toolpath:
+    """Create the toolpath that cuts a board out along its Edge_Cuts outline.
+
+    :param grbr_plot: the parsed gerber Edge_Cuts layer
+    :param tool: the end mill
+    :param depth: the final depth of the cut (the board thickness plus some overcut), a positive value
+    :param stepdown: the largest depth of cut of each pass
+    :param feed: the cutting feed rate
+    :param plunge_feed: the feed rate of the plunges
+    :param safe_z: the height the tool moves to before the first loop
+    :param retract_z: the height the tool retracts to between loops
+    :param tab_count: the number of tabs on each outer outline, 0 for no tabs
+    :param tab_width: the width of each tab
+    :param tab_height: the height of the tabs, above the bottom of the cut
+    :param climb: True to climb mill (clockwise around outer outlines), False for conventional milling
+    :param spindle_speed: the spindle speed, in rpm
+    :return: the toolpath
+    """
+    loops, open_chains = outline_loops(grbr_plot)
+    if open_chains:
+        x, y = open_chains[0][-1].x2, open_chains[0][-1].y2
+        raise ValueError(f"The outline has {len(open_chains)} open chain(s), the first one ends at: {x:.3f}, {y:.3f}")
+
+    radius = tool.diameter / 2
+    pass_count = max(1, math.ceil(depth / stepdown - 1e-9))
+    pass_depths = [-depth * (pass_nbr + 1) / pass_count for pass_nbr in range(pass_count)]
+    tab_z = -depth + tab_height
+
+    toolpath = Toolpath("2D Contour outline", tool, spindle_speed)
+    first = True
+    for loop in loops:
+        for contour in offset_contours([loop.contour], -radius if loop.inner else radius):
+            # the offset contours are counterclockwise, climb milling runs clockwise around outer outlines
+            if climb != loop.inner:
+                contour = reverse_contour(contour)
+            perimeter = sum(seg_length(seg) for seg in contour)
+            tabs = [] if loop.inner else tab_intervals(perimeter, tab_count, tab_width + tool.diameter)
+            pieces = split_at_lengths(contour, [length for tab in tabs for length in tab])
+
+            start = contour[0]
+            if first:
+                toolpath.rapid(start.x1, start.y1)
+                toolpath.rapid(z=safe_z)
+                first = False
+            else:
+                toolpath.rapid(z=retract_z)
+                toolpath.rapid(start.x1, start.y1)
+            toolpath.rapid(z=retract_z)
+
+            for pass_z in pass_depths:
+                toolpath.linear(None, None, pass_z, plunge_feed)
+                # only the passes below the top of the tabs are lifted over them
+                pass_pieces = pieces if tabs and pass_z < tab_z else [(seg, 0.0) for seg in contour]
+                for piece, mid_len in pass_pieces:
+                    over_tab = pass_z < tab_z and any(tab_start <= mid_len <= tab_end for tab_start, tab_end in tabs)
+                    z = tab_z if over_tab else pass_z
+                    if z != toolpath.position[2]:
+                        toolpath.linear(None, None, z, plunge_feed)
+                    if isinstance(piece, Arc):
+                        toolpath.arc(piece.x2, piece.y2, piece.cx, piece.cy, not piece.ccw, feed)
+                    else:
+                        toolpath.linear(piece.x2, piece.y2, None, feed)
+    toolpath.rapid(z=retract_z)
+    return toolpath
+
+
+def write_profile_gcode(
+    gcode_fn: str,
+    grbr_plot: GrbrPlot,
+    tool: Tool,
+    depth: float,
+    stepdown: float,
+    program_nbr: int = 1001,
+    **kwargs,
+) -> Toolpath:
+    """Write the board outline profile G-code of an Edge_Cuts layer.
+
+    :param gcode_fn: the file name path of the G-code file to write
+    :param grbr_plot: the parsed gerber Edge_Cuts layer
+    :param tool: the end mill
+    :param depth: the final depth of the cut
+    :param stepdown: the largest depth of cut of each pass
+    :param program_nbr: the program number written in the header
+    :param kwargs: the cutting parameters passed on to profile_toolpath
+    :return: the toolpath that was written
+    """
+    toolpath = profile_toolpath(grbr_plot, tool, depth, stepdown, **kwargs)
+    write_gcode_file(gcode_fn, program_nbr, [toolpath], safe_z=kwargs.get("safe_z", 15.0))
+    return toolpath
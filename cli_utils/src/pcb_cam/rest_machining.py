@@ -0,0 +1,228 @@
+"""Rest-machining region detection for multi-tool isolation of a copper layer.
+
+Isolation removes the material around the copper, out to the isolation width. When several tools are
+used (e.g. a 0.8 mm end mill, followed by a 0.2 mm V-bit), each tool only needs to cut the material that
+the tools before it could not reach, the narrow gaps between copper features and the inside corners.
+
+The stage works on a raster of the layer:
+    * the material to remove is the non-copper area within the isolation width of the copper
+    * a tool of radius r can be centered on any point at least r away from the copper, the tool's
+      reachable area is the set of points within r of such a center (the morphological opening of the
+      non-copper area by the tool's disk)
+    * each tool, in order, is assigned the material that is reachable by it and was not reachable by any
+      of the tools before it. Its toolpaths only need to be generated for the centers that cut into its
+      assigned material.
+    * whatever material none of the tools can reach is reported as unreached
+
+rest_toolpaths builds those toolpaths: the isolation contours of a tool (the outward offset of the copper
+by the tool radius, see pcb_cam.arc_offset) clipped to the centers of its region. The clipped paths keep
+their lines & arcs, split where they enter and leave the centers mask.
+"""
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from grbr_explain.grbr_geom import obj_bbox
+from grbr_explain.min_gerber_parser import GrbrPlot
+from grbr_explain.raster import RasterGrid, distance_transform, grid_for_bbox, rasterize_objs
+from pcb_cam.arc_offset import Arc, Line, arc_radius, arc_sweep, obj_outline, offset_contours, seg_length
+from pcb_cam.path_order import is_closed
+
+# Tuple with the results for 1 tool
+#   tool_dia - the diameter of the tool
+#   region   - mask of the material assigned to the tool (reachable by it and not by any previous tool)
+#   centers  - mask of the tool center positions whose cut touches the tool's region (to within a pixel), the
+#              only positions toolpaths need to be generated for
+#   area     - the area of the tool's region, in square units of the layer
+RestRegion = namedtuple("RestRegion", ["tool_dia", "region", "centers", "area"])
+
+# Tuple with the results of the stage
+#   grid      - the raster grid shared by all the masks
+#   target    - mask of all the material to remove
+#   tools     - the RestRegion of each tool, in the order the tools are used
+#   unreached - mask of the material that none of the tools can reach
+RestMachining = namedtuple("RestMachining", ["grid", "target", "tools", "unreached"])
+
+
+def rest_regions(
+    grbr_plot: GrbrPlot,
+    tool_dias: list[float],
+    isolation_width: float | None = None,
+    px: float | None = None,
+) -> RestMachining:
+    """Compute the region each tool of an ordered list of tools must machine to isolate a copper layer.
+
+    :param grbr_plot: the parsed gerber copper layer
+    :param tool_dias: the diameters of the tools, in the order they are used (largest first)
+    :param isolation_width: the width of the material to remove around the copper, defaults to the
+        diameter of the first tool (i.e., a single isolation pass)
+    :param px: the pixel size of the raster, the regions are accurate to about 1 pixel. Defaults to a tenth
+        of the smallest tool diameter.
+    :return: the results of the stage
+    """
+    if not tool_dias:
+        raise ValueError("At least 1 tool diameter is needed")
+    isolation_width = isolation_width if isolation_width is not None else tool_dias[0]
+    max_radius = max(tool_dias) / 2
+    px = px or min(tool_dias) / 10
+
+    objs = grbr_plot.graphic_objs
+    if not objs:
+        grid = grid_for_bbox((0.0, 0.0, 0.0, 0.0), px)
+        empty = np.zeros(grid.shape, dtype=bool)
+        return RestMachining(grid, empty, [RestRegion(tool_dia, empty, empty, 0.0) for tool_dia in tool_dias], empty)
+    bboxes = [obj_bbox(obj, grbr_plot.aperture_lkp) for obj in objs]
+    bbox = (
+        min(b[0] for b in bboxes),
+        min(b[1] for b in bboxes),
+        max(b[2] for b in bboxes),
+        max(b[3] for b in bboxes),
+    )
+    # the margin leaves room for the tools to be centered outside the isolated material
+    grid = grid_for_bbox(bbox, px, margin=isolation_width + 2 * max_radius + px)
+    copper = rasterize_objs(objs, grbr_plot.aperture_lkp, grid)
+
+    copper_dist = distance_transform(copper, (isolation_width + max_radius) / px + 1)
+    target = ~copper & (copper_dist * px <= isolation_width)
+
+    tools = []
+    reached = np.zeros(grid.shape, dtype=bool)
+    for tool_dia in tool_dias:
+        radius_px = tool_dia / 2 / px
+        # a tool center must be at least the tool radius away from the copper
+        centers = copper_dist >= radius_px
+        cut = distance_transform(centers, radius_px) <= radius_px
+        region = target & cut & ~reached
+        # the pixel of slack keeps the centers on the exact offset of the copper, which the raster rounds
+        needed = distance_transform(region, radius_px + 1) <= radius_px + 1
+        tools.append(RestRegion(tool_dia, region, needed, float(region.sum()) * px * px))
+        reached |= cut
+
+    return RestMachining(grid, target, tools, target & ~reached)
+
+
+def seg_samples(seg: Line | Arc, t: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the x & y coordinates of the points at the positions t (0 at the start, 1 at the end) of a segment."""
+    if isinstance(seg, Line):
+        return seg.x1 + t * (seg.x2 - seg.x1), seg.y1 + t * (seg.y2 - seg.y1)
+    start, sweep = arc_sweep(seg)
+    angles = start + (sweep if seg.ccw else -sweep) * t
+    radius = arc_radius(seg)
+    return seg.cx + radius * np.cos(angles), seg.cy + radius * np.sin(angles)
+
+
+def mask_values(grid: RasterGrid, mask: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Return the mask values of the pixels containing the points, False for the points outside the grid."""
+    cols = np.floor((x - grid.origin_x) / grid.px).astype(np.int64)
+    rows = np.floor((y - grid.origin_y) / grid.px).astype(np.int64)
+    on_grid = (rows >= 0) & (rows < grid.shape[0]) & (cols >= 0) & (cols < grid.shape[1])
+    values = np.zeros(len(x), dtype=bool)
+    values[on_grid] = mask[rows[on_grid], cols[on_grid]]
+    return values
+
+
+def sub_seg(seg: Line | Arc, t0: float, t1: float) -> Line | Arc:
+    """Return the part of a segment between the positions t0 and t1, the ends of the segment are kept exact."""
+    x1, y1 = (seg.x1, seg.y1) if t0 == 0.0 else tuple(float(v[0]) for v in seg_samples(seg, np.array([t0])))
+    x2, y2 = (seg.x2, seg.y2) if t1 == 1.0 else tuple(float(v[0]) for v in seg_samples(seg, np.array([t1])))
+    return Line(x1, y1, x2, y2) if isinstance(seg, Line) else Arc(x1, y1, x2, y2, seg.cx, seg.cy, seg.ccw)
+
+
+def clip_paths(paths: list[list[Line | Arc]], grid: RasterGrid, mask: np.ndarray) -> list[list[Line | Arc]]:
+    """Clip paths to the pixels set in a mask.
+
+    :param paths: the paths, each a list of Line & Arc segments that start at the end of the one before them
+    :param grid: the raster grid of the mask
+    :param mask: the mask of the positions the paths are kept at
+    :return: the parts of the paths inside the mask, split where the paths leave the mask. A closed path that
+        is inside the mask where it starts & ends is kept as 1 path, from its last entry into the mask.
+
+    Each segment is split into pieces of at most half a pixel, which are kept if their midpoint is in the mask.
+    """
+    clipped = []
+    for path in paths:
+        runs: list[list[Line | Arc]] = []
+        current = None
+        starts_inside = False
+        for seg_nbr, seg in enumerate(path):
+            count = max(1, math.ceil(seg_length(seg) / (grid.px / 2)))
+            inside = mask_values(grid, mask, *seg_samples(seg, (np.arange(count) + 0.5) / count))
+            if seg_nbr == 0:
+                starts_inside = bool(inside[0])
+            bounds = [0, *(np.flatnonzero(np.diff(inside)) + 1).tolist(), count]
+            for k0, k1 in zip(bounds[:-1], bounds[1:]):
+                if not inside[k0]:
+                    current = None
+                    continue
+                if current is None:
+                    current = []
+                    runs.append(current)
+                current.append(sub_seg(seg, k0 / count, k1 / count))
+        if len(runs) > 1 and starts_inside and current is not None and is_closed(path):
+            runs[0] = runs.pop() + runs[0]
+        clipped.extend(runs)
+    return clipped
+
+
+def isolation_contours(grbr_plot: GrbrPlot, tool_dia: float) -> list[list[Line | Arc]]:
+    """Return the isolation contours of a tool: the outward offset of the dark copper by the tool radius.
+
+    :param grbr_plot: the parsed gerber copper layer
+    :param tool_dia: the diameter of the tool
+    :return: the contours followed by the tool's center, counterclockwise around the copper
+    """
+    outlines = [
+        contour
+        for obj in grbr_plot.graphic_objs
+        if obj.polarity == "dark"
+        for contour in obj_outline(obj, grbr_plot.aperture_lkp)
+    ]
+    return offset_contours(outlines, tool_dia / 2)
+
+
+def rest_toolpaths(grbr_plot: GrbrPlot, rest: RestMachining, tool_nbr: int) -> list[list[Line | Arc]]:
+    """Return the isolation paths of a tool, limited to the centers that cut into the tool's region.
+
+    :param grbr_plot: the parsed gerber copper layer the rest machining regions were computed for
+    :param rest: the results returned by rest_regions
+    :param tool_nbr: the index of the tool in the tools of rest
+    :return: the paths, each a list of Line & Arc segments, ready for pcb_cam.path_order.order_toolpaths
+    """
+    tool = rest.tools[tool_nbr]
+    if not tool.centers.any():
+        return []
+    return clip_paths(isolation_contours(grbr_plot, tool.tool_dia), rest.grid, tool.centers)
+
+
+def mask_bbox(grid: RasterGrid, mask: np.ndarray) -> tuple[float, float, float, float] | None:
+    """Return the bounding box of the pixels set in a mask, or None if no pixel is set.
+
+    :param grid: the raster grid of the mask
+    :param mask: the mask
+    """
+    rows, cols = np.nonzero(mask)
+    if not len(rows):
+        return None
+    return (
+        grid.origin_x + cols.min() * grid.px,
+        grid.origin_y + rows.min() * grid.px,
+        grid.origin_x + (cols.max() + 1) * grid.px,
+        grid.origin_y + (rows.max() + 1) * grid.px,
+    )
+
+
+def output_rest_report(rest: RestMachining) -> None:
+    """Prints out the area of the material assigned to each tool and the material no tool can reach.
+
+    :param rest: the results returned by rest_regions
+    """
+    px_area = rest.grid.px**2
+    print(f"material to remove: {rest.target.sum() * px_area:.3f}")
+    for tool in rest.tools:
+        bbox = mask_bbox(rest.grid, tool.region)
+        extent = "" if bbox is None else f"   within: {', '.join(f'{v:.3f}' for v in bbox)}"
+        print(f"\ttool dia: {tool.tool_dia:>6.3f}   area: {tool.area:.3f}{extent}")
+    unreached = rest.unreached.sum() * px_area
+    if not math.isclose(unreached, 0.0):
+        print(f"\tunreached by any tool: {unreached:.3f}")
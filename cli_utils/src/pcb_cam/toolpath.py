@@ -0,0 +1,383 @@
+"""Toolpath representation and G-code output shared by the toolpath generators.
+
+A Toolpath holds the moves of 1 operation (1 tool) as parallel columns: the move type, the x, y, z end
+point, the i, j arc center offsets and the feed rate. The generators append moves one at a time, or whole
+batches of columns (kept as NumPy blocks). The G-code is then formatted a whole column at a time with NumPy,
+rather than one formatted string per move:
+    * numbers are rounded to fixed point integers whose integer parts & fractions are looked up in tables
+    * each word is only formatted for the moves that show it, the words of a line are joined at the end
+    * long toolpaths are formatted in chunks, carrying the modal state over, and written through a large
+      buffer (write_gcode_file), so a million moves are written in a couple of seconds
+
+The G-code follows the conventions of the Fusion 360 Carvera post (see gcode_files/*.cnc):
+    * a header with the program number, the machine and 1 comment per tool, then G90 G94 / G17 / G21
+    * each operation starts with its name as a comment, the tool change (T1 M6), the spindle start and G54
+    * motion words (G0 / G1 / G2 / G3), axis words and the feed are modal: they are only written when they
+      change. Arcs always have their X, Y, I and J words.
+    * coordinates have 3 decimal places, without trailing zeros
+    * the program ends by retracting to the safe height, stopping the spindle, returning home (G28) & M30
+"""
+import math
+from collections import namedtuple
+from functools import lru_cache
+from typing import TextIO
+
+import numpy as np
+
+from gcode_explain.min_gcode_parser import arc_sweeps
+
+# move types
+RAPID, LINEAR, CW_ARC, CCW_ARC = 0, 1, 2, 3
+MOTION_WORDS = np.array(["G0", "G1", "G2", "G3"])
+# the columns of the moves of a toolpath
+COLUMNS = ("kind", "x", "y", "z", "i", "j", "feed")
+# the integer parts of formatted numbers below this value are looked up in a table of their text
+INT_TABLE_SIZE = 100000
+# the number of moves formatted at a time, bounds the memory used by the text of the moves
+FORMAT_CHUNK = 1 << 17
+# the size of the buffer G-code files are written through
+WRITE_BUFFER = 1 << 20
+
+# Tuple describing a cutting tool
+#   number      - the tool number (T word)
+#   diameter    - the tool's diameter, for a V-bit its tip diameter
+#   description - the kind of tool, e.g. flat end mill, engrave
+#   taper_angle - the included angle of a V-bit, in degrees, None for other tools
+Tool = namedtuple("Tool", ["number", "diameter", "description", "taper_angle"], defaults=[None])
+
+# Tuple describing the machine the G-code is written for, used in the program header
+Machine = namedtuple("Machine", ["vendor", "model", "description"])
+CARVERA = Machine("Makera", "Carvera 3-axis", "Makera Carvera 3-axis")
+
+
+class Toolpath:
+    """The moves of 1 operation, stored as parallel columns."""
+
+    def __init__(self, name: str, tool: Tool, spindle_speed: int = 10000, start: tuple[float, float, float] = None):
+        """Create an empty toolpath.
+
+        :param name: the name of the operation, written as a comment before its moves
+        :param tool: the tool used by the operation
+        :param spindle_speed: the spindle speed, in rpm
+        :param start: the x, y, z position of the tool before the first move, defaults to an unknown
+            position (nan), whose axes are only written once a move sets them
+        """
+        self.name = name
+        self.tool = tool
+        self.spindle_speed = spindle_speed
+        self.kinds: list[int] = []
+        self.xs: list[float] = []
+        self.ys: list[float] = []
+        self.zs: list[float] = []
+        self.i: list[float] = []
+        self.j: list[float] = []
+        self.feeds: list[float] = []
+        # the moves before the ones in the lists above, as blocks of NumPy columns (see arrays)
+        self.blocks: list[dict[str, np.ndarray]] = []
+        self.position = start or (math.nan, math.nan, math.nan)
+
+    def __len__(self) -> int:
+        """Return the number of moves."""
+        return sum(len(block["kind"]) for block in self.blocks) + len(self.kinds)
+
+    def add_move(self, kind: int, x: float, y: float, z: float, i: float = 0.0, j: float = 0.0, feed: float = 0.0):
+        """Append a move, all the coordinates are absolute.
+
+        :param kind: the move type: RAPID, LINEAR, CW_ARC or CCW_ARC
+        :param x: the x coordinate of the end point
+        :param y: the y coordinate of the end point
+        :param z: the z coordinate of the end point
+        :param i: the x offset from the start point to the arc's center
+        :param j: the y offset from the start point to the arc's center
+        :param feed: the feed rate, ignored for rapid moves
+        """
+        self.kinds.append(kind)
+        self.xs.append(x)
+        self.ys.append(y)
+        self.zs.append(z)
+        self.i.append(i)
+        self.j.append(j)
+        self.feeds.append(feed)
+        self.position = (x, y, z)
+
+    def rapid(self, x: float | None = None, y: float | None = None, z: float | None = None) -> None:
+        """Append a rapid move, the axes that are not given keep their current position."""
+        cur_x, cur_y, cur_z = self.position
+        self.add_move(RAPID, cur_x if x is None else x, cur_y if y is None else y, cur_z if z is None else z)
+
+    def linear(self, x: float | None, y: float | None, z: float | None, feed: float) -> None:
+        """Append a linear move at a feed rate, the axes that are None keep their current position."""
+        cur_x, cur_y, cur_z = self.position
+        x, y, z = cur_x if x is None else x, cur_y if y is None else y, cur_z if z is None else z
+        self.add_move(LINEAR, x, y, z, feed=feed)
+
+    def arc(self, x: float, y: float, cx: float, cy: float, clockwise: bool, feed: float, z: float | None = None):
+        """Append an arc from the current position, a helical arc if z differs from the current z.
+
+        :param x: the x coordinate of the end point
+        :param y: the y coordinate of the end point
+        :param cx: the x coordinate of the arc's center
+        :param cy: the y coordinate of the arc's center
+        :param clockwise: True for a clockwise arc (G2), False for a counterclockwise arc (G3)
+        :param feed: the feed rate
+        :param z: the z coordinate of the end point, None to stay at the current z
+        """
+        cur_x, cur_y, cur_z = self.position
+        kind = CW_ARC if clockwise else CCW_ARC
+        self.add_move(kind, x, y, cur_z if z is None else z, cx - cur_x, cy - cur_y, feed)
+
+    def add_moves(self, kinds, xs, ys, zs, i, j, feeds) -> None:
+        """Append a batch of moves given as columns (NumPy arrays or sequences), see add_move for their meaning.
+
+        The columns are stored as a block of arrays, without converting them to Python floats.
+        """
+        if len(kinds) == 0:
+            return
+        self.store_lists()
+        block = {"kind": np.array(kinds, dtype=np.int8)}
+        for column, values in zip(COLUMNS[1:], (xs, ys, zs, i, j, feeds)):
+            block[column] = np.array(values, dtype=np.float64)
+        self.blocks.append(block)
+        self.position = (float(block["x"][-1]), float(block["y"][-1]), float(block["z"][-1]))
+
+    def store_lists(self) -> None:
+        """Move the moves appended one at a time into a block of arrays."""
+        if not self.kinds:
+            return
+        block = {"kind": np.array(self.kinds, dtype=np.int8)}
+        lists = (self.xs, self.ys, self.zs, self.i, self.j, self.feeds)
+        for column, values in zip(COLUMNS[1:], lists):
+            block[column] = np.array(values, dtype=np.float64)
+            values.clear()
+        self.kinds.clear()
+        self.blocks.append(block)
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        """Return the moves as NumPy arrays, keyed by column name: kind, x, y, z, i, j, feed."""
+        self.store_lists()
+        if len(self.blocks) > 1:
+            self.blocks = [{column: np.concatenate([block[column] for block in self.blocks]) for column in COLUMNS}]
+        if self.blocks:
+            return dict(self.blocks[0])
+        return {column: np.zeros(0, dtype=np.int8 if column == "kind" else np.float64) for column in COLUMNS}
+
+    def cut_length(self) -> float:
+        """Return the length of the feed moves (arcs are measured along the arc)."""
+        return path_lengths(self.arrays())[1]
+
+
+def path_lengths(moves: dict[str, np.ndarray]) -> tuple[float, float]:
+    """Return the rapid and the feed length of a toolpath's moves.
+
+    :param moves: the moves, as returned by Toolpath.arrays
+    :return: tuple of: the length of the rapid moves and the length of the feed moves
+
+    The first move has no known start point and is not measured, nor are the axes of moves from an unknown
+    position.
+    """
+    x, y, z = moves["x"], moves["y"], moves["z"]
+    if not len(x):
+        return 0.0, 0.0
+    start_x, start_y, start_z = np.r_[0.0, x[:-1]], np.r_[0.0, y[:-1]], np.r_[0.0, z[:-1]]
+    lengths = np.sqrt((x - start_x) ** 2 + (y - start_y) ** 2 + (z - start_z) ** 2)
+    lengths[0] = 0.0
+    arcs = moves["kind"] >= CW_ARC
+    if arcs.any():
+        radius = np.hypot(moves["i"][arcs], moves["j"][arcs])
+        start_angle = np.arctan2(-moves["j"][arcs], -moves["i"][arcs])
+        end_angle = np.arctan2(
+            y[arcs] - (start_y[arcs] + moves["j"][arcs]), x[arcs] - (start_x[arcs] + moves["i"][arcs])
+        )
+        sweep = arc_sweeps(start_angle, end_angle, moves["kind"][arcs] == CCW_ARC)
+        lengths[arcs] = np.hypot(radius * sweep, z[arcs] - start_z[arcs])
+    rapids = moves["kind"] == RAPID
+    lengths = np.nan_to_num(lengths)
+    return float(lengths[rapids].sum()), float(lengths[~rapids].sum())
+
+
+@lru_cache(maxsize=None)
+def number_tables(decimals: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the text of the integer parts (positive & negative) and of the fractions of formatted numbers.
+
+    :param decimals: the number of decimal places
+    :return: tuple of: the text of the integer parts 0 to INT_TABLE_SIZE - 1, the same with a minus sign, and
+        the text of the fractions 0 to 10 ** decimals - 1, with their decimal point and without trailing zeros
+    """
+    ints = np.arange(INT_TABLE_SIZE).astype(str)
+    fractions = np.array([""] + [f".{fraction:0{decimals}d}".rstrip("0") for fraction in range(1, 10**decimals)])
+    return ints, np.char.add("-", ints), fractions
+
+
+def format_numbers(values: np.ndarray, decimals: int = 3) -> np.ndarray:
+    """Format an array of numbers with a fixed number of decimal places, without trailing zeros.
+
+    The numbers are rounded to integers of 10 ** -decimals units, whose integer parts & fractions are looked
+    up in tables of their text: a couple of array indexing & concatenation operations, instead of a string
+    formatting per number.
+
+    :param values: the numbers
+    :param decimals: the number of decimal places
+    :return: array of strings
+    """
+    scale = 10**decimals
+    fixed = np.rint(np.nan_to_num(np.asarray(values, dtype=np.float64)) * scale).astype(np.int64)
+    whole, fraction = np.divmod(np.abs(fixed), scale)
+    ints, neg_ints, fractions = number_tables(decimals)
+    if whole.size and whole.max() >= INT_TABLE_SIZE:
+        int_text = whole.astype(str)
+        int_text = np.where(fixed < 0, np.char.add("-", int_text), int_text)
+    else:
+        int_text = np.where(fixed < 0, neg_ints[whole], ints[whole])
+    return np.char.add(int_text, fractions[fraction])
+
+
+def format_moves(moves: dict[str, np.ndarray], prev: dict | None = None) -> list[str]:
+    """Format the moves of a toolpath into G-code lines, a whole column at a time.
+
+    :param moves: the moves, as returned by Toolpath.arrays
+    :param prev: the modal state before the first move (keys: kind, x, y, z, feed), updated in place
+    :return: the G-code lines
+    """
+    prev = prev if prev is not None else {}
+    count = len(moves["kind"])
+    if not count:
+        return []
+
+    def changed(column: str, values: np.ndarray, decimals: int = 3) -> np.ndarray:
+        rounded = np.round(values, decimals)
+        before = np.r_[prev.get(column, np.nan), rounded[:-1]]
+        return rounded != before
+
+    def word_column(letter: str, values: np.ndarray, show: np.ndarray) -> np.ndarray:
+        # the words of a column, with a leading space, only formatted where they are shown
+        text = np.char.add(f" {letter}", format_numbers(values[show]))
+        column = np.zeros(count, dtype=text.dtype)
+        column[show] = text
+        return column
+
+    kind = moves["kind"]
+    arcs = kind >= CW_ARC
+    columns = [np.where(changed("kind", kind.astype(np.float64)), np.char.add(" ", MOTION_WORDS[kind]), "")]
+    for axis in ("x", "y", "z"):
+        show = changed(axis, moves[axis])
+        if axis != "z":
+            show |= arcs
+        # an axis whose position is not known yet (nan) is not written
+        show &= ~np.isnan(moves[axis])
+        columns.append(word_column(axis.upper(), moves[axis], show))
+    for offset in ("i", "j"):
+        columns.append(word_column(offset.upper(), moves[offset], arcs))
+
+    # the feed is modal across rapid moves, it is compared with the feed of the previous feed move
+    feed_moves = kind != RAPID
+    feeds = np.round(moves["feed"], 3)
+    last_move = np.where(feed_moves, np.arange(count), -1)
+    np.maximum.accumulate(last_move, out=last_move)
+    filled = np.where(last_move >= 0, feeds[np.maximum(last_move, 0)], prev.get("feed", np.nan))
+    show_feed = feed_moves & (feeds != np.r_[prev.get("feed", np.nan), filled[:-1]])
+    columns.append(word_column("F", feeds, show_feed))
+
+    prev.update(
+        kind=float(kind[-1]),
+        x=float(np.round(moves["x"][-1], 3)),
+        y=float(np.round(moves["y"][-1], 3)),
+        z=float(np.round(moves["z"][-1], 3)),
+        feed=float(filled[-1]),
+    )
+    # the columns are joined a line at a time, which is faster than growing an array of wide strings
+    lines = map("".join, zip(*(column.tolist() for column in columns)))
+    return [line[1:] for line in lines if line]
+
+
+def tool_comment(tool: Tool, zmin: float) -> str:
+    """Return the header comment describing a tool, in the format of the Fusion 360 posts."""
+    taper = f" TAPER={tool.taper_angle:g}deg" if tool.taper_angle else ""
+    return f"(T{tool.number}  D={tool.diameter:g} CR=0{taper} - ZMIN={zmin:g} - {tool.description})"
+
+
+def write_header(
+    gcode_fh: TextIO,
+    program_nbr: int,
+    tools: list[tuple[Tool, float]],
+    machine: Machine = CARVERA,
+) -> None:
+    """Write the header of a G-code program: the program number, the machine, the tools and the modal setup.
+
+    :param gcode_fh: the text file the G-code is written to
+    :param program_nbr: the program number, written as the first comment
+    :param tools: the tools of the program, each with the lowest z it reaches
+    :param machine: the machine
+    """
+    gcode_fh.write(f"({program_nbr})\n(Machine)\n")
+    gcode_fh.write(f"(  vendor: {machine.vendor})\n(  model: {machine.model})\n")
+    gcode_fh.write(f"(  description: {machine.description})\n")
+    for tool, zmin in tools:
+        gcode_fh.write(tool_comment(tool, round(zmin, 3)) + "\n")
+    gcode_fh.write("G90 G94\nG17\nG21\n")
+
+
+def write_program(
+    gcode_fh: TextIO,
+    program_nbr: int,
+    toolpaths: list[Toolpath],
+    safe_z: float = 15.0,
+    machine: Machine = CARVERA,
+) -> None:
+    """Write a G-code program made of 1 or more toolpaths.
+
+    :param gcode_fh: the text file the G-code is written to
+    :param program_nbr: the program number, written as the first comment
+    :param toolpaths: the toolpaths, in the order they are cut
+    :param safe_z: the height the tool retracts to at the end of the program
+    :param machine: the machine, written in the header
+    """
+    zmins: dict[int, tuple[Tool, float]] = {}
+    for toolpath in toolpaths:
+        zs = toolpath.arrays()["z"]
+        zs = zs[~np.isnan(zs)]
+        zmin = float(zs.min()) if zs.size else 0.0
+        tool, prev_zmin = zmins.get(toolpath.tool.number, (toolpath.tool, zmin))
+        zmins[toolpath.tool.number] = (tool, min(zmin, prev_zmin))
+    write_header(gcode_fh, program_nbr, list(zmins.values()), machine)
+
+    modal: dict = {}
+    tool_nbr = None
+    for toolpath in toolpaths:
+        gcode_fh.write(f"\n({toolpath.name})\n")
+        if toolpath.tool.number != tool_nbr:
+            tool_nbr = toolpath.tool.number
+            gcode_fh.write(f"T{tool_nbr} M6\n")
+        gcode_fh.write(f"S{toolpath.spindle_speed} M3\nG54\n")
+        moves = toolpath.arrays()
+        # the moves are formatted a chunk at a time, the modal state carries over from 1 chunk to the next
+        for start in range(0, len(moves["kind"]), FORMAT_CHUNK):
+            chunk = {column: values[start:start + FORMAT_CHUNK] for column, values in moves.items()}
+            lines = format_moves(chunk, modal)
+            if lines:
+                gcode_fh.write("\n".join(lines) + "\n")
+    # the retract is only written when the tool is not at the safe height already
+    retract = [] if modal.get("z") == round(safe_z, 3) else format_moves(
+        {
+            "kind": np.array([RAPID], dtype=np.int8),
+            "x": np.array([modal.get("x", 0.0)]),
+            "y": np.array([modal.get("y", 0.0)]),
+            "z": np.array([float(safe_z)]),
+            "i": np.zeros(1),
+            "j": np.zeros(1),
+            "feed": np.zeros(1),
+        },
+        modal,
+    )
+    gcode_fh.write("".join(line + "\n" for line in retract) + "M5\nG28\nM30\n")
+
+
+def write_gcode_file(
+    gcode_fn: str,
+    program_nbr: int,
+    toolpaths: list[Toolpath],
+    safe_z: float = 15.0,
+    machine: Machine = CARVERA,
+) -> None:
+    """Write a G-code program to a file, through a large write buffer (see write_program for the parameters)."""
+    with open(gcode_fn, "w", buffering=WRITE_BUFFER) as gcode_fh:
+        write_program(gcode_fh, program_nbr, toolpaths, safe_z, machine)
@@ -0,0 +1,345 @@
+import contextlib
+import io
+import math
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from gcode_explain.arc_fit import ArcFitter
+from gcode_explain.gcode_simplify import GcodeSimplifier
+from gcode_explain.cycle_time import CARVERA_PROFILE, estimate_cycle_time, machine_profile_from_dmp
+from gcode_explain.dmp_parser import cross_check, parse_dmp
+from gcode_explain.explain import ExplainOptions, explain_gcode_file, get_args, options_from_args
+from gcode_explain.gcode_checker import CheckLimits, check_gcode_file, work_envelope
+from gcode_explain.material_sim import removal_diff, simulate_gcode_file
+from gcode_explain.min_gcode_parser import (
+    CCW_ARC,
+    CW_ARC,
+    GcodeParser,
+    GcodeProgram,
+    arc_sweeps,
+    moves_to_arrays,
+    parse_gcode_arrays,
+    plane_axes,
+)
+
+SAMPLE_CNC = os.path.join(os.path.dirname(__file__), "data", "sample.cnc")
+SAMPLE_DMP = os.path.join(os.path.dirname(__file__), "data", "sample.dmp")
+# the program a post writes from sample.dmp: the positioning move split, the short move dropped and the lead out
+# (an arc out of the XY, ZX & YZ planes) linearized
+SAMPLE_DMP_CNC = """G90 G17 G21
+(2D Contour1)
+T1 M6
+G0 X10 Y5
+Z15
+G1 Z0 F300
+G3 X10 Y5 Z-1 I0 J5 F500
+G1 X20 F1000
+X20.5 Y5.5 Z-0.707
+X20.707 Y5.707 Z0
+Z15"""
+
+
+class TestGcodeParser(unittest.TestCase):
+    def test_streaming_parser(self):
+        parser = GcodeParser()
+        with open(SAMPLE_CNC) as gcode_fh:
+            moves = list(parser.iter_moves(gcode_fh))
+        self.assertEqual(parser.sections, ["2D Contour1", "Drill1"])
+        self.assertEqual(parser.tool_changes, [(10, 1), (23, 2)])
+        helix = next(move for move in moves if move.motion == CCW_ARC)
+        self.assertEqual((helix.x, helix.y, helix.z, helix.i, helix.j), (20.0, 15.0, -1.5, 0.0, 5.0))
+        zx_arc = next(move for move in moves if move.motion == CW_ARC)
+        self.assertEqual((zx_arc.plane, zx_arc.x, zx_arc.z, zx_arc.i, zx_arc.k), (18, 25.0, -1.0, 2.5, 0.0))
+        # the inch coordinates of the 2nd section are converted to mm
+        self.assertEqual((moves[-2].z, moves[-2].feed, moves[-2].tool, moves[-2].section), (-2.54, 254.0, 2, 1))
+
+    def test_batch_mode_matches_streaming(self):
+        parser = GcodeParser()
+        with open(SAMPLE_CNC) as gcode_fh:
+            streamed = moves_to_arrays(parser.iter_moves(gcode_fh))
+        program = parse_gcode_arrays(SAMPLE_CNC)
+        self.assertEqual(program.sections, parser.sections)
+        self.assertEqual(program.tool_changes, parser.tool_changes)
+        for name, column in streamed.items():
+            np.testing.assert_array_equal(program.moves[name], column, err_msg=name)
+
+    def test_arc_sweeps_and_plane_axes(self):
+        # a quarter turn each way, and full circles in both directions
+        starts, ends = np.array([0.0, 0.0, 1.0, 1.0]) * math.pi, np.array([0.5, 0.5, 1.0, 1.0]) * math.pi
+        sweeps = arc_sweeps(starts, ends, np.array([True, False, True, False]))
+        np.testing.assert_allclose(sweeps, np.array([0.5, 1.5, 2.0, 2.0]) * math.pi)
+        p_axis, q_axis, n_axis = plane_axes(np.array([17, 18, 19]))
+        self.assertEqual((p_axis.tolist(), q_axis.tolist(), n_axis.tolist()), ([0, 2, 1], [1, 0, 2], [2, 1, 0]))
+
+
+def parse_program(text: str) -> GcodeProgram:
+    parser = GcodeParser()
+    moves = moves_to_arrays(parser.iter_moves(text.splitlines()))
+    return GcodeProgram(moves, parser.sections, parser.tool_changes)
+
+
+class TestCycleTime(unittest.TestCase):
+    def test_trapezoids_and_junctions(self):
+        profile = CARVERA_PROFILE._replace(max_feed=10000.0, acceleration=500.0)
+        # 100 mm at 100 mm/s: 10 mm to accelerate (0.2 s), 80 mm of cruise (0.8 s) and 10 mm to stop (0.2 s)
+        straight = estimate_cycle_time(parse_program("G0 X0 Y0 Z0\nG1 X100 F6000"), profile)
+        self.assertAlmostEqual(straight.total, 1.2)
+        # a collinear junction does not slow down, a right angle corner does
+        collinear = estimate_cycle_time(parse_program("G0 X0 Y0 Z0\nG1 X50 F6000\nX100"), profile)
+        self.assertAlmostEqual(collinear.total, 1.2)
+        corner = estimate_cycle_time(parse_program("G0 X0 Y0 Z0\nG1 X50 F6000\nY50"), profile)
+        self.assertGreater(corner.total, 1.2)
+        self.assertLess(corner.total, 1.4 + 1e-9)
+        # an arc of radius 5 is limited to the speed of its centripetal acceleration: sqrt(500 * 5) = 50 mm/s
+        arc = estimate_cycle_time(parse_program("G0 X0 Y0 Z0\nG1 X50 F6000\nG3 X50 Y10 I0 J5\nG1 X0"), profile)
+        self.assertAlmostEqual(arc.move_times[2], 5 * math.pi / 50)
+
+    def test_sections_and_tools(self):
+        cycle_time = estimate_cycle_time(parse_gcode_arrays(SAMPLE_CNC))
+        self.assertEqual(list(cycle_time.sections), ["2D Contour1", "Drill1"])
+        self.assertEqual(sorted(cycle_time.tools), [1, 2])
+        self.assertAlmostEqual(cycle_time.tool_changes, 2 * CARVERA_PROFILE.tool_change_time)
+        self.assertAlmostEqual(cycle_time.total, sum(cycle_time.tools.values()))
+        self.assertGreater(cycle_time.total - cycle_time.tool_changes, cycle_time.nominal)
+
+    def test_machine_profile_from_dmp(self):
+        # the sample dump only sets max_normal_speed: the rapids fall back to it, the other limits are the defaults
+        profile = machine_profile_from_dmp(SAMPLE_DMP)
+        self.assertEqual((profile.max_feed, profile.max_rapid), (3000.0, 3000.0))
+        self.assertEqual(profile.axis_max_speed, CARVERA_PROFILE.axis_max_speed)
+        self.assertEqual(profile.tool_change_time, CARVERA_PROFILE.tool_change_time)
+        self.assertEqual(profile.acceleration, CARVERA_PROFILE.acceleration)
+
+        with open(SAMPLE_DMP, "r") as dmp_fh:
+            dump = dmp_fh.read()
+        parts = '"X" : {"max_normal_speed" : 2500, "max_rapid_speed" : 0}, "Z" : {"max_normal_speed" : 0}'
+        dump = dump.replace('"max_normal_speed" : 3000', f'"max_normal_speed" : 3000, "parts" : {{{parts}}}')
+        machining = '"machining" : {"default" : {"tool_change_time" : 15}}'
+        dump = dump.replace('"controller" : {', f'{machining}, "controller" : {{')
+        defaults = CARVERA_PROFILE._replace(axis_max_speed=(0.0, 2000.0, 1000.0))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dmp_fn = os.path.join(tmp_dir, "parts.dmp")
+            with open(dmp_fn, "w") as dmp_fh:
+                dmp_fh.write(dump)
+            profile = machine_profile_from_dmp(dmp_fn, defaults)
+            # a max_rapid_speed of 0 is not set: the rapids still fall back to max_normal_speed
+            self.assertEqual((profile.max_feed, profile.max_rapid), (3000.0, 3000.0))
+            # the axes without a max_normal_speed (Y) or with 0 (Z) keep the default limits
+            self.assertEqual(profile.axis_max_speed, (2500.0, 2000.0, 1000.0))
+            self.assertEqual(profile.tool_change_time, 15.0)
+
+            with open(dmp_fn, "w") as dmp_fh:
+                dmp_fh.write(dump.replace('"max_rapid_speed" : 0', '"max_rapid_speed" : 5000'))
+            self.assertEqual(machine_profile_from_dmp(dmp_fn).max_rapid, 5000.0)
+            with open(dmp_fn, "w") as dmp_fh:
+                dmp_fh.write(dump.replace("machine-v2", "machine"))
+            with self.assertRaises(ValueError):
+                machine_profile_from_dmp(dmp_fn)
+
+
+class TestArcFit(unittest.TestCase):
+    def test_helical_run_becomes_an_arc(self):
+        # a quarter of a helix, radius 5 around 0, 0, linearized into 24 moves, then a straight run
+        lines = ["G90 G17 G21", "G0 X5 Y0", "Z0", "G1 Z-0.5 F300"]
+        for step in range(1, 25):
+            angle = math.pi / 2 * step / 24
+            line = f"X{5 * math.cos(angle):.4f} Y{5 * math.sin(angle):.4f} Z{-0.5 - 0.6 * step / 24:.4f}"
+            lines.append(line + (" F600" if step == 1 else ""))
+        lines += ["X-1 Y5", "X-2 Y5", "X-3 Y5", "G0 Z5"]
+        fitter = ArcFitter(tolerance=0.005)
+        out = list(fitter.process(lines))
+        self.assertEqual(out[:4], lines[:4])
+        self.assertEqual(out[4], "G3 X0 Y5 Z-1.1 I-5 J0 F600")
+        # the straight moves are kept, the first one gets back its G1
+        self.assertEqual(out[5:], ["G1 X-1 Y5", "X-2 Y5", "X-3 Y5", "G0 Z5"])
+        self.assertEqual(fitter.stats, (32, 9, 1, 24))
+
+    def test_corners_break_the_arcs(self):
+        # the same corner 2 times: a zigzag turns both ways, so none of it is replaced
+        lines = ["G90 G0 X0 Y0 Z0", "G1 X1 Y0.1 F500", "X2 Y0", "X3 Y0.1", "X4 Y0", "X5 Y0.1"]
+        fitter = ArcFitter()
+        self.assertEqual(list(fitter.process(lines)), lines)
+        self.assertEqual(fitter.stats.arcs, 0)
+
+
+class TestGcodeSimplify(unittest.TestCase):
+    def test_dropped_moves_keep_the_modal_axes(self):
+        lines = ["G90 G21 G0 X0 Y0 Z0", "G1 X1 Y0.0005 F500", "X2 Y0 Z-0.0005", "X3 Y0", "X3 Y1", "G0 Z5"]
+        simplifier = GcodeSimplifier(tol=0.002)
+        # the Z of the dropped move is added to the next move, which relied on it being modal
+        self.assertEqual(
+            list(simplifier.process(lines)),
+            ["G90 G21 G0 X0 Y0 Z0", "G1 X1 Y0.0005 F500", "X3 Y0 Z-0.0005", "X3 Y1", "G0 Z5"],
+        )
+        self.assertEqual(simplifier.stats[:3], (6, 5, 1))
+        self.assertLessEqual(simplifier.stats.max_deviation, 0.002)
+
+
+class TestDmpParser(unittest.TestCase):
+    def test_parse_dump(self):
+        dump = parse_dmp(SAMPLE_DMP)
+        self.assertTrue(dump.parameters["machine-v2"].startswith("{"))
+        self.assertEqual(dump.parameters["operation:tool_number"], 1.0)
+        self.assertEqual((dump.sections, dump.tool_changes), (["2D Contour1"], [(15, 1)]))
+        self.assertEqual(dump.movements, ["MOVEMENT_CUTTING", "MOVEMENT_RAMP_HELIX", "MOVEMENT_LEAD_OUT"])
+        moves = dump.moves
+        self.assertEqual(moves["ln_nbr"].tolist(), [19, 20, 22, 28, 29, 31, 36])
+        self.assertEqual(moves["motion"].tolist(), [1, 1, CCW_ARC, 1, 1, CCW_ARC, 1])
+        self.assertEqual(moves["movement"].tolist(), [0, 0, 1, 0, 0, 2, 2])
+        # the lead out is in a plane that G-code can not write
+        self.assertEqual(moves["plane"].tolist(), [17, 17, 17, 17, 17, 0, 17])
+        self.assertEqual((moves["i"][2], moves["j"][2]), (0.0, 5.0))
+        self.assertEqual(moves["feed"][1], 300.0)
+
+    def test_cross_check(self):
+        dump = parse_dmp(SAMPLE_DMP)
+        check = cross_check(dump, parse_program(SAMPLE_DMP_CNC))
+        self.assertEqual(check[:5], (7, 8, 7, 2, 1))
+        self.assertEqual(check.divergences, [])
+        # a move off by 0.01 mm is found, the moves after it match again
+        check = cross_check(dump, parse_program(SAMPLE_DMP_CNC.replace("G1 X20 F1000", "G1 X20.01 F1000")))
+        divergences = [(div.dmp_ln_nbr, div.gcode_ln_nbr, div.kind) for div in check.divergences]
+        self.assertEqual(divergences[:2], [(28, 8, "position"), (28, -1, "missing")])
+        self.assertAlmostEqual(check.divergences[0].deviation, 0.01)
+        self.assertEqual(check.divergences[-1].kind, "extra")
+        check = cross_check(dump, parse_program(SAMPLE_DMP_CNC.replace("F500", "F400")))
+        divergences = [(div.dmp_ln_nbr, div.gcode_ln_nbr, div.kind) for div in check.divergences]
+        self.assertEqual(divergences, [(22, 7, "feed")])
+
+
+class TestExplain(unittest.TestCase):
+    def test_explain_lines(self):
+        out = io.StringIO()
+        explain_gcode_file(SAMPLE_CNC, ExplainOptions(), out)
+        lines = out.getvalue().splitlines()
+        self.assertIn("[010] SECTION: 2D Contour1", lines)
+        self.assertIn("[023] TOOL: change to tool T2 (M6)", lines)
+        self.assertIn("[025] SET: units to inch (G20)", lines)
+        arc = next(line for line in lines if line.startswith("[017]"))
+        self.assertTrue(arc.startswith("[017] ARC CCW:"))
+        self.assertIn("center: 20.000, 10.000  radius: 5.000", arc)
+        # the arc in the ZX plane has its center in x, y & z
+        arc = next(line for line in lines if line.startswith("[018] ARC"))
+        self.assertIn("center: 22.500, 15.000, -1.500  radius: 2.500", arc)
+
+    def test_section_totals(self):
+        out = io.StringIO()
+        options = ExplainOptions(False, False, False, False, False, False, False)
+        # the totals are only kept when they are displayed
+        self.assertEqual(explain_gcode_file(SAMPLE_CNC, options, out).section_totals, [])
+        explainer = explain_gcode_file(SAMPLE_CNC, options._replace(section_sum=True), out)
+        self.assertEqual(out.getvalue(), "")
+        totals = explainer.section_totals
+        self.assertEqual([section.name for section in totals], ["2D Contour1", "Drill1"])
+        self.assertEqual([section.tool for section in totals], [1, 2])
+        self.assertEqual([(section.moves, section.rapid_moves) for section in totals], [(7, 2), (3, 2)])
+        self.assertAlmostEqual(totals[1].rapid_length, 18.0277, places=3)
+
+    def test_short_flags(self):
+        # the letters grbr-exp uses for other options (-f --no-flash, -t --with-attr, -S --attr-sum) are not reused
+        options = options_from_args(get_args(["-e", "-m", "-O", "sample.cnc"]))
+        self.assertFalse(options.feed_disp)
+        self.assertFalse(options.tool_disp)
+        self.assertTrue(options.section_sum)
+        for flag in ("-f", "-t", "-S"):
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                get_args([flag, "sample.cnc"])
+
+
+class TestGcodeChecker(unittest.TestCase):
+    LIMITS = CheckLimits((0.0, 0.0, -5.0), (25.0, 20.0, 10.0), (0.0, 0.0, -2.0), (30.0, 30.0, 0.0), 1.0)
+
+    def test_envelope_and_zmin(self):
+        result = check_gcode_file(SAMPLE_CNC, self.LIMITS)
+        self.assertEqual(result.lines, 31)
+        zmin = [(vio.ln_nbr, vio.value) for vio in result.violations if vio.kind == "zmin"]
+        # the arc in the ZX plane dips below its end points
+        self.assertEqual(zmin, [(17, -1.5), (18, -4.0)])
+        envelope = [(vio.ln_nbr, vio.axis) for vio in result.violations if vio.kind == "envelope"]
+        self.assertEqual(envelope[0], (14, "Z"))
+        # the moves in inch are converted to mm
+        self.assertIn((26, "X"), envelope)
+        self.assertAlmostEqual(result.violations[-1].value, 25.4)
+
+    def test_rapid_over_stock(self):
+        with open(SAMPLE_CNC) as gcode_fh:
+            program = gcode_fh.read().replace("\nZ15\n", "\nZ0.5\n")
+        limits = self.LIMITS._replace(envelope_min=None, envelope_max=None)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gcode_fn = os.path.join(tmp_dir, "low_rapid.cnc")
+            with open(gcode_fn, "w") as gcode_fh:
+                gcode_fh.write(program)
+            result = check_gcode_file(gcode_fn, limits)
+        rapids = [(vio.ln_nbr, vio.value) for vio in result.violations if vio.kind == "rapid"]
+        self.assertEqual(rapids, [(14, 0.5)])
+
+    def test_work_envelope(self):
+        low, high = work_envelope((10.0, 20.0, 30.0), (360.0, 240.0, 140.0))
+        self.assertEqual(tuple(low), (-10.0, -20.0, -110.0))
+        self.assertEqual(tuple(high), (350.0, 220.0, 30.0))
+
+
+# a helix of 2 turns around (1, 0), clockwise from (0, 0), down from z 0 to z -1
+HELIX_CNC = """(T1  D=2 CR=0 - ZMIN=-1 - flat end mill)
+G90 G17 G21
+T1 M6
+G0 X0 Y0 Z1
+G1 Z0 F300
+G2 X0 Y0 Z-0.5 I1 J0
+X0 Y0 Z-1 I1 J0
+G0 Z5
+"""
+
+
+def sim_pixel(result, x: float, y: float) -> tuple[int, int]:
+    grid = result.grid
+    return int((y - grid.origin_y) / grid.px), int((x - grid.origin_x) / grid.px)
+
+
+def sim_height(result, x: float, y: float) -> float:
+    return float(result.heights[sim_pixel(result, x, y)])
+
+
+class TestMaterialSim(unittest.TestCase):
+    def test_sample(self):
+        with self.assertRaises(ValueError):
+            simulate_gcode_file(SAMPLE_CNC, px=0.05, max_workers=1)
+        result = simulate_gcode_file(SAMPLE_CNC, px=0.05, tool_dias={2: 1.0}, band_rows=64, max_workers=1)
+        self.assertEqual(result.tool_dias, {1: 3.175, 2: 1.0})
+        self.assertEqual(result.heights.shape, result.grid.shape)
+        # the contour at z -1 cuts out to the radius of the tool
+        self.assertEqual(sim_height(result, 15.0, 6.5), -1.0)
+        self.assertEqual(sim_height(result, 15.0, 6.7), 0.0)
+        # the arc in the ZX plane dips to z -4, the hole of T2 is drilled in inch
+        self.assertAlmostEqual(sim_height(result, 22.5, 15.0), -4.0, delta=0.02)
+        self.assertAlmostEqual(sim_height(result, 25.4, 25.4), -2.54, places=5)
+
+    def test_helix(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gcode_fn = os.path.join(tmp_dir, "helix.cnc")
+            with open(gcode_fn, "w") as gcode_fh:
+                gcode_fh.write(HELIX_CNC)
+            result = simulate_gcode_file(gcode_fn, px=0.02, band_rows=32, max_workers=1)
+        # the 2nd turn passes (1, 1) at z -0.625, (2, 0) at z -0.75 and (1, -1) at z -0.875
+        self.assertAlmostEqual(sim_height(result, 1.0, 1.9), -0.625, delta=0.03)
+        self.assertAlmostEqual(sim_height(result, 2.9, 0.0), -0.75, delta=0.03)
+        self.assertAlmostEqual(sim_height(result, 1.0, -1.9), -0.875, delta=0.03)
+        self.assertEqual(sim_height(result, -0.9, 0.0), -1.0)
+
+    def test_removal_diff(self):
+        result = simulate_gcode_file(SAMPLE_CNC, px=0.05, tool_dias={2: 1.0}, max_workers=1)
+        grid = result.grid
+        xs = grid.origin_x + (np.arange(grid.shape[1]) + 0.5) * grid.px
+        ys = grid.origin_y + (np.arange(grid.shape[0]) + 0.5) * grid.px
+        dist = np.hypot(xs[None, :] - 25.4, ys[:, None] - 25.4)
+        # the hole to drill is larger than the tool, and the contour was not expected
+        missed, extra = removal_diff(result, dist <= 0.8, depth=0.1)
+        self.assertTrue(missed.any())
+        self.assertFalse(missed[dist <= 0.45].any())
+        self.assertTrue(np.all(missed == (dist <= 0.8) & (result.heights >= -0.1)))
+        self.assertTrue(extra[sim_pixel(result, 15.0, 5.0)])
+        with self.assertRaises(ValueError):
+            removal_diff(result, np.zeros((2, 2), dtype=bool))
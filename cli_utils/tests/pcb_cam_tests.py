@@ -0,0 +1,461 @@
+import math
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from gcode_explain.dmp_parser import cross_check, parse_dmp
+from gcode_explain.min_gcode_parser import GcodeParser, GcodeProgram, moves_to_arrays
+from grbr_explain.min_gerber_parser import GrbrArc, load_grbr_plot
+from grbr_explain.raster import distance_transform
+from pcb_cam.autolevel import (
+    height_map_from_points,
+    level_toolpath,
+    load_height_map,
+    probe_points,
+    surface_heights,
+    write_probe_program,
+)
+from pcb_cam.arc_offset import (
+    Arc,
+    Line,
+    circle_halves,
+    contour_area,
+    obj_outline,
+    offset_contours,
+    rect_contour,
+    reverse_contour,
+    seg_length,
+)
+from pcb_cam.engrave import chain_paths, engrave_depth, engrave_toolpath
+from pcb_cam.excellon import DrillCycle, order_drill_hits, parse_excellon_lines, write_drill_program
+from pcb_cam.max_isolation import label_islands, max_isolation_paths, nearest_islands
+from pcb_cam.path_order import order_toolpaths, visit_segments
+from pcb_cam.pocket import pocket_toolpath, ring_tree
+from pcb_cam.post_engine import CARVERA_POST, linearize_arc, post_toolpaths
+from pcb_cam.profile import outline_loops, profile_toolpath
+from pcb_cam.rest_machining import isolation_contours, mask_values, rest_regions, rest_toolpaths, seg_samples
+from pcb_cam import toolpath as toolpath_module
+from pcb_cam.toolpath import RAPID, Tool, Toolpath, format_numbers, write_program
+
+SAMPLE_F_CU = os.path.join(os.path.dirname(__file__), "data", "sample-F_Cu.gbr")
+SAMPLE_EDGE_CUTS = os.path.join(os.path.dirname(__file__), "data", "sample-Edge_Cuts.gbr")
+SAMPLE_DMP = os.path.join(os.path.dirname(__file__), "data", "sample.dmp")
+# a drill file in inch, with the leading zeros kept (the trailing zeros suppressed), a tool defined in the body and
+# a routed slot
+SAMPLE_DRL = """M48
+INCH,LZ
+T1C0.0315
+T2C0.04
+%
+G05
+T1
+X0050Y0025
+X01
+Y0125
+T2
+X02Y-01
+X0205Y-01G85X0215Y-01
+T3C0.125
+X03Y03
+T0
+M30"""
+
+
+class TestRestMachining(unittest.TestCase):
+    def test_fine_tool_only_gets_what_the_large_tool_missed(self):
+        rest = rest_regions(load_grbr_plot(SAMPLE_F_CU), [0.8, 0.2], px=0.02)
+        large, fine = rest.tools
+        self.assertFalse(np.any(large.region & fine.region))
+        self.assertGreater(fine.area, 0.0)
+        self.assertLess(fine.area, large.area / 50)
+        self.assertLess(rest.unreached.sum(), fine.region.sum())
+
+    def test_fine_tool_paths_only_enter_its_region(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        rest = rest_regions(grbr_plot, [0.8, 0.2], px=0.02)
+        fine = rest.tools[1]
+        paths = rest_toolpaths(grbr_plot, rest, 1)
+        self.assertTrue(paths)
+        # everywhere along the paths, the tool cuts into its region, to within the clipping's 2 pixels
+        radius_px = 0.1 / rest.grid.px
+        near_region = distance_transform(fine.region, radius_px + 3) <= radius_px + 2
+        t = np.linspace(0.0, 1.0, 11)
+        for path in paths:
+            for seg in path:
+                self.assertTrue(mask_values(rest.grid, near_region, *seg_samples(seg, t)).all())
+            self.assertTrue(all(math.dist(a[2:4], b[:2]) < 1e-9 for a, b in zip(path, path[1:])))
+        full_length = sum(seg_length(seg) for path in isolation_contours(grbr_plot, 0.2) for seg in path)
+        self.assertLess(sum(seg_length(seg) for path in paths for seg in path), full_length / 10)
+        # the large tool's paths are not clipped: its region is all the material it reaches
+        self.assertAlmostEqual(
+            sum(seg_length(seg) for path in rest_toolpaths(grbr_plot, rest, 0) for seg in path),
+            sum(seg_length(seg) for path in isolation_contours(grbr_plot, 0.8) for seg in path),
+        )
+
+    def test_default_pixel_size_and_empty_layer(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        self.assertAlmostEqual(rest_regions(grbr_plot, [0.8, 0.2]).grid.px, 0.02)
+        grbr_plot.graphic_objs = []
+        rest = rest_regions(grbr_plot, [0.8, 0.2])
+        self.assertEqual([tool.area for tool in rest.tools], [0.0, 0.0])
+        self.assertFalse(rest.target.any())
+
+
+class TestArcOffset(unittest.TestCase):
+    def test_square_offsets_keep_lines_and_round_corners(self):
+        (outer,) = offset_contours([rect_contour(0, 0, 10, 10)], 1)
+        self.assertEqual(sum(isinstance(seg, Arc) for seg in outer), 4)
+        self.assertAlmostEqual(contour_area(outer), 100 + 40 + math.pi)
+        (inner,) = offset_contours([rect_contour(0, 0, 10, 10)], -1)
+        self.assertTrue(all(isinstance(seg, Line) for seg in inner))
+        self.assertAlmostEqual(contour_area(inner), 64)
+
+    def test_overlapping_circles_merge(self):
+        contours = offset_contours([circle_halves(0, 0, 1, 0), circle_halves(1.5, 0, 2.5, 0)], 0.5)
+        self.assertEqual(len(contours), 1)
+        self.assertTrue(all(isinstance(seg, Arc) for seg in contours[0]))
+        # 2 circles of radius 1.5, 1.5 apart, less the lens where they overlap
+        lens = 2 * 1.5**2 * math.acos(0.5) - 0.75 * math.sqrt(9 - 1.5**2)
+        self.assertAlmostEqual(contour_area(contours[0]), 2 * math.pi * 1.5**2 - lens)
+
+    def test_full_circle_stroke_offsets_into_a_ring(self):
+        circle = GrbrArc(1, 15.0, 10.0, 15.0, 10.0, 10.0, 10.0, 5.0, "clockwise", "D10", "dark")
+        outline = obj_outline(circle, {"D10": ("C", ["2"])})
+        self.assertEqual(len(outline), 2)
+        areas = sorted((contour_area(c) for c in offset_contours(outline, 0.5, with_holes=True)), reverse=True)
+        self.assertEqual(len(areas), 2)
+        self.assertAlmostEqual(areas[0], math.pi * 6.5**2, places=3)
+        self.assertAlmostEqual(areas[1], -math.pi * 3.5**2, places=3)
+
+
+class TestMaxIsolation(unittest.TestCase):
+    def test_label_islands_is_8_connected(self):
+        mask = np.array([[1, 0, 0, 1], [0, 1, 0, 1], [0, 0, 0, 0], [1, 1, 0, 1]], dtype=bool)
+        labels, count = label_islands(mask)
+        self.assertEqual(count, 4)
+        self.assertEqual(labels[0, 0], labels[1, 1])
+        self.assertEqual(labels[2, 2], -1)
+
+    def test_nearest_islands_is_exact(self):
+        rng = np.random.default_rng(4)
+        labels, _ = label_islands(rng.random((40, 300)) < 0.003)
+        nearest, dist = nearest_islands(labels)
+        seed_rows, seed_cols = np.nonzero(labels >= 0)
+        rows, cols = np.indices(labels.shape)
+        dist_sq = (rows[..., np.newaxis] - seed_rows) ** 2 + (cols[..., np.newaxis] - seed_cols) ** 2
+        np.testing.assert_allclose(dist, np.sqrt(dist_sq.min(axis=-1)))
+        # the label is the one of a pixel at the nearest distance
+        at_nearest = dist_sq == dist_sq.min(axis=-1, keepdims=True)
+        same_label = labels[seed_rows, seed_cols] == nearest[..., np.newaxis]
+        self.assertTrue(np.all(np.any(at_nearest & same_label, axis=-1)))
+
+    def test_centerlines_separate_the_islands(self):
+        isolation = max_isolation_paths(load_grbr_plot(SAMPLE_F_CU), px=0.05)
+        self.assertGreater(isolation.count, 1)
+        self.assertTrue(isolation.paths)
+        for path in isolation.paths:
+            self.assertNotEqual(path.islands[0], path.islands[1])
+            self.assertGreater(path.clearance, 0.0)
+
+
+class TestEngrave(unittest.TestCase):
+    def test_traces_are_chained_and_engraved(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        # the 3 chained draws and the arc of the 0.25 mm aperture
+        self.assertEqual(sorted(len(path.segments) for path in chain_paths(grbr_plot)), [1, 3])
+        self.assertAlmostEqual(engrave_depth(0.3, 60, 0.1, 1.0), 0.1 / math.tan(math.radians(30)))
+
+        vbit = Tool(3, 0.1, "engrave", 30)
+        toolpath = engrave_toolpath(grbr_plot, vbit, max_depth=0.2)
+        gcode_fh = io.StringIO()
+        write_program(gcode_fh, 1001, [toolpath])
+        lines = gcode_fh.getvalue().splitlines()
+        self.assertIn("(T3  D=0.1 CR=0 TAPER=30deg - ZMIN=-0.2 - engrave)", lines)
+        self.assertEqual(sum(line.startswith("G1 Z-0.2") for line in lines), 2)
+        self.assertTrue(any(line.startswith("G3 X12 Y7 I2 J0") for line in lines))
+        self.assertEqual(lines[-3:], ["M5", "G28", "M30"])
+
+
+class TestProfile(unittest.TestCase):
+    def test_outline_is_cut_in_passes_with_tabs(self):
+        grbr_plot = load_grbr_plot(SAMPLE_EDGE_CUTS)
+        loops, open_chains = outline_loops(grbr_plot)
+        # the round & the rectangular cut-outs, then the outer outline with its rounded corner
+        self.assertEqual([loop.inner for loop in loops], [True, True, False])
+        self.assertEqual(open_chains, [])
+
+        end_mill = Tool(2, 3.175, "flat end mill")
+        toolpath = profile_toolpath(grbr_plot, end_mill, depth=1.8, stepdown=0.7, tab_count=4, tab_height=0.5)
+        gcode_fh = io.StringIO()
+        write_program(gcode_fh, 1001, [toolpath])
+        lines = gcode_fh.getvalue().splitlines()
+        # 3 passes of 0.6 mm on each of the 3 loops
+        self.assertEqual(sum(line.startswith("G1 Z-0.6") for line in lines), 3)
+        # the cut-outs are climb milled counterclockwise, the outer outline clockwise
+        self.assertIn("G3 X8.588 Y10 I-1.412 J0 F600", lines)
+        self.assertIn("G2 X31.588 Y18 I0 J-3.587", lines)
+        # the last pass is lifted over the 4 tabs
+        self.assertEqual(sum(line.startswith("Z-1.3") for line in lines), 4)
+
+
+class TestPocket(unittest.TestCase):
+    def test_rings_nest_around_islands(self):
+        areas = [rect_contour(0, 0, 10, 10), reverse_contour(rect_contour(4, 4, 6, 6))]
+        roots = ring_tree(areas, 0.5, 0.4)
+        self.assertEqual(len(roots), 1)
+        self.assertEqual(len(roots[0].islands), 1)
+        self.assertAlmostEqual(contour_area(roots[0].contour), 81.0)
+        # the island's ring is grown by the tool radius, its rounded corners keep it 0.5 away from the island
+        self.assertAlmostEqual(contour_area(roots[0].islands[0]), -(4 + 4 * 2 * 0.5 + math.pi * 0.25))
+
+    def test_region_is_cleared_from_a_helix(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        toolpath = pocket_toolpath(grbr_plot, Tool(1, 1.0, "flat end mill"), depth=0.1, stepover=0.4)
+        gcode_fh = io.StringIO()
+        write_program(gcode_fh, 1001, [toolpath])
+        lines = gcode_fh.getvalue().splitlines()
+        # the helix into the 3 x 3 mm region is shrunk to fit in its innermost ring, and ends at the cutting depth
+        self.assertIn("X2.5 Y2.4 Z-0.1 I0.1 J0", lines)
+        moves = toolpath.arrays()
+        self.assertAlmostEqual(float(np.nanmin(moves["z"])), -0.1)
+        # the last ring of the region finishes its edges, a tool radius inside them
+        in_region = (moves["z"] == -0.1) & (moves["x"] < 10)
+        self.assertAlmostEqual(float(moves["x"][in_region].min()), 1.5)
+        self.assertAlmostEqual(float(moves["y"][in_region].max()), 3.5)
+
+
+class TestPathOrder(unittest.TestCase):
+    def test_paths_are_reversed_and_loops_entered_near_the_tool(self):
+        # 4 dashes along the x axis, shuffled and pointing left, and a square to the right of them
+        dashes = [[Line(x + 1, 0, x, 0)] for x in (6, 0, 4, 2)]
+        paths = dashes + [rect_contour(8, -0.5, 10, 1.5)]
+        order = order_toolpaths(paths, start=(0.0, 0.0), rapid_speed=600.0)
+        self.assertEqual([visit.index for visit in order.visits], [1, 3, 2, 0, 4])
+        self.assertTrue(all(visit.reversed for visit in order.visits[:4]))
+        # the square is entered at its lower left corner, the one nearest the end of the last dash
+        self.assertEqual(order.visits[4].start, 0)
+        self.assertEqual(visit_segments(paths[4], order.visits[4])[0], paths[4][0])
+        self.assertAlmostEqual(order.travel_after, 3 + math.dist((7, 0), (8, -0.5)))
+        self.assertAlmostEqual(order.time_after, order.travel_after / 10)
+        self.assertGreater(order.travel_before, order.travel_after)
+
+    def test_improvement_beats_the_greedy_seed(self):
+        rng = np.random.default_rng(5)
+        paths = [[Line(x, y, x + 0.5, y)] for x, y in rng.uniform(0, 50, (500, 2))]
+        greedy = order_toolpaths(paths, time_budget=0.0)
+        improved = order_toolpaths(paths, time_budget=5.0)
+        self.assertEqual(sorted(visit.index for visit in improved.visits), list(range(500)))
+        self.assertLess(improved.travel_after, greedy.travel_after)
+
+    def test_empty_paths_are_skipped(self):
+        paths = [[], [Line(2, 0, 3, 0)], [], [Line(0, 0, 1, 0)]]
+        order = order_toolpaths(paths, start=(0.0, 0.0))
+        self.assertEqual([visit.index for visit in order.visits], [3, 1])
+        self.assertAlmostEqual(order.travel_after, 1.0)
+
+
+class TestToolpathWriter(unittest.TestCase):
+    def test_numbers_are_formatted_from_tables(self):
+        values = np.array([0.0004, -0.0004, -0.0006, 1.5, -2.0, 10.125, 123456.7891, -123456.0])
+        self.assertEqual(
+            format_numbers(values).tolist(), ["0", "0", "-0.001", "1.5", "-2", "10.125", "123456.789", "-123456"]
+        )
+
+    def test_batches_and_chunks_keep_the_modal_state(self):
+        toolpath = Toolpath("batch", Tool(1, 1.0, "flat end mill"))
+        toolpath.rapid(0, 0, 5)
+        count = 1000
+        xs = np.arange(count) * 0.5
+        zeros = np.zeros(count)
+        toolpath.add_moves(np.ones(count), xs, zeros, np.full(count, -0.1), zeros, zeros, np.full(count, 600))
+        toolpath.linear(None, 1, None, 600)
+        self.assertEqual(len(toolpath), count + 2)
+        self.assertEqual(toolpath.arrays()["kind"].tolist(), [RAPID] + [1] * (count + 1))
+
+        whole_fh, chunked_fh = io.StringIO(), io.StringIO()
+        write_program(whole_fh, 1001, [toolpath])
+        chunk = toolpath_module.FORMAT_CHUNK
+        toolpath_module.FORMAT_CHUNK = 7
+        try:
+            write_program(chunked_fh, 1001, [toolpath])
+        finally:
+            toolpath_module.FORMAT_CHUNK = chunk
+        self.assertEqual(chunked_fh.getvalue(), whole_fh.getvalue())
+        lines = whole_fh.getvalue().splitlines()
+        self.assertEqual(lines[lines.index("G0 X0 Y0 Z5") + 1 :][:3], ["G1 Z-0.1 F600", "X0.5", "X1"])
+        self.assertIn("Y1", lines)
+
+
+class TestPostEngine(unittest.TestCase):
+    def test_post_dump(self):
+        dump = parse_dmp(SAMPLE_DMP)
+        gcode_fh = io.StringIO()
+        write_program(gcode_fh, 1001, post_toolpaths(dump), safe_z=15.0)
+        lines = gcode_fh.getvalue().splitlines()
+        self.assertIn("(T1  D=0 CR=0 - ZMIN=-1 - )", lines)
+        moves = lines[lines.index("G54") + 1 :]
+        # the positioning is split, the full circle written as 2 halves, the 0.0004 mm move dropped and the
+        # lead out (out of the XY plane) linearized
+        self.assertEqual(
+            moves[:6],
+            ["G0 X10 Y5", "Z15", "G1 Z0 F300", "G3 X10 Y15 Z-0.5 I0 J5 F500", "X10 Y5 Z-1 I0 J-5", "G1 X20 F1000"],
+        )
+        self.assertTrue(all(line.startswith("X") for line in moves[6:-4]))
+        self.assertEqual(moves[-4:], ["Z15", "M5", "G28", "M30"])
+        parser = GcodeParser()
+        program = GcodeProgram(moves_to_arrays(parser.iter_moves(lines)), parser.sections, parser.tool_changes)
+        self.assertEqual(cross_check(dump, program).divergences, [])
+
+    def test_repost_with_another_tool_and_clearance(self):
+        profile = CARVERA_POST._replace(clearance_z=20.0, tool_numbers={1: 4}, split_positioning=False)
+        (toolpath,) = post_toolpaths(parse_dmp(SAMPLE_DMP), profile)
+        self.assertEqual(toolpath.tool.number, 4)
+        moves = toolpath.arrays()
+        self.assertEqual((moves["z"][0], moves["z"][-1]), (20.0, 20.0))
+
+    def test_linearize_full_circle(self):
+        start, center, end = np.array([0.0, 0.0, 0.0]), np.array([1.0, 0.0, 0.0]), np.array([0.0, 0.0, -1.0])
+        # a full clockwise helical turn, from the left of its center over the top first
+        points = linearize_arc(start, center, end, np.array([0.0, 0.0, 1.0]), True, 0.01)
+        self.assertGreater(len(points), 10)
+        self.assertGreater(points[0, 1], 0.0)
+        np.testing.assert_allclose(np.hypot(points[:, 0] - 1.0, points[:, 1]), 1.0)
+        np.testing.assert_array_equal(points[-1], end)
+
+
+class TestExcellon(unittest.TestCase):
+    def test_parse_inch_leading_zeros(self):
+        drill = parse_excellon_lines(SAMPLE_DRL.splitlines())
+        self.assertEqual(drill.units, "INCH")
+        self.assertAlmostEqual(drill.diameters[1], 0.8001)
+        self.assertAlmostEqual(drill.diameters[3], 3.175)
+        # X01 keeps the last Y, Y0125 keeps the last X
+        np.testing.assert_allclose(drill.hits[1], [[12.7, 6.35], [25.4, 6.35], [25.4, 31.75]])
+        np.testing.assert_allclose(drill.hits[2], [[50.8, -25.4]])
+        np.testing.assert_allclose(drill.hits[3], [[76.2, 76.2]])
+        self.assertEqual(drill.slots, 1)
+
+    def test_undefined_tool(self):
+        with self.assertRaises(ValueError):
+            parse_excellon_lines(["M48", "METRIC", "T1C0.8", "%", "T2", "X1.0Y1.0"])
+
+    def test_route_moves_update_the_position(self):
+        lines = ["M48", "METRIC", "T1C0.8", "%", "T1", "G00X1.0Y2.0", "M15", "G01X3.0", "M16", "G05", "Y5.0"]
+        lines += ["G00X7.0Y1.0", "G05", "Y4.0"]
+        drill = parse_excellon_lines(lines)
+        # the hits after the routes keep the x the routes left the tool at
+        np.testing.assert_allclose(drill.hits[1], [[3.0, 5.0], [7.0, 4.0]])
+        self.assertEqual(drill.slots, 2)
+
+    def test_slots_leave_the_tool_at_their_end(self):
+        drill = parse_excellon_lines(["M48", "METRIC", "T1C0.8", "%", "T1", "X1.0Y1.0G85X5.0Y1.0", "Y3.0"])
+        np.testing.assert_allclose(drill.hits[1], [[5.0, 3.0]])
+        self.assertEqual(drill.slots, 1)
+
+    def test_order_hits_of_a_grid(self):
+        # a 20 x 20 grid of hits, in a shuffled order, is drilled row by row or column by column
+        points = np.array([(x * 2.54, y * 2.54) for x in range(20) for y in range(20)])
+        points = points[np.random.default_rng(1).permutation(len(points))]
+        ordered, order = order_drill_hits(points, time_budget=2.0)
+        self.assertEqual(len(np.unique(ordered, axis=0)), len(points))
+        self.assertLess(order.travel_after, 1.1 * 399 * 2.54)
+        self.assertLess(order.travel_after, order.travel_before / 10)
+
+    def test_canned_cycles(self):
+        drill = parse_excellon_lines(SAMPLE_DRL.splitlines())
+        out = io.StringIO()
+        write_drill_program(out, 1001, drill, DrillCycle(peck=0.5))
+        lines = out.getvalue().splitlines()
+        self.assertIn("(T1  D=0.8001 CR=0 - ZMIN=-1.8 - drill)", lines)
+        # the hits of T1 are drilled from the nearest to the start (0, 0), only the words that change are written
+        first = lines.index("G99 G83 X12.7 Y6.35 Z-1.8 R2 Q0.5 F100")
+        self.assertEqual(lines[first + 1:first + 4], ["X25.4", "Y31.75", "G80"])
+        self.assertEqual(lines.count("G80"), 3)
+        self.assertEqual(lines[-3:], ["M5", "G28", "M30"])
+
+
+class TestAutolevel(unittest.TestCase):
+    def setUp(self):
+        # a surface probed every 10 mm, tilted in x and warped in y
+        xs, ys = np.meshgrid(np.linspace(0.0, 100.0, 11), np.linspace(0.0, 80.0, 9))
+        self.points = np.column_stack((xs.ravel(), ys.ravel(), self.surface(xs, ys).ravel()))
+
+    @staticmethod
+    def surface(x, y):
+        return 0.001 * x + 0.00002 * (y - 40.0) ** 2
+
+    def test_load_probe_log(self):
+        # the probe reports are machine coordinates, the work zero is at -250, -180, -40 in the machine
+        work_offset = (-250.0, -180.0, -40.0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_fn = os.path.join(tmp_dir, "probe.log")
+            with open(log_fn, "w") as log_fh:
+                log_fh.write("$#\n[G54:-250.000,-180.000,-40.000]\nok\n")
+                for x, y, z in self.points[::-1] + work_offset:
+                    log_fh.write(f"G38.2 Z-2 F50\n[PRB:{x:.3f},{y:.3f},{z:.5f}:1]\nok\n")
+            hmap = load_height_map(log_fn)
+            np.testing.assert_allclose(load_height_map(log_fn, work_offset=work_offset).z, hmap.z)
+            with open(log_fn) as log_fh:
+                reports = [line for line in log_fh if not line.startswith("[G54")]
+            with open(log_fn, "w") as log_fh:
+                log_fh.writelines(reports)
+            with self.assertRaises(ValueError):
+                load_height_map(log_fn)
+        self.assertEqual(hmap.z.shape, (9, 11))
+        np.testing.assert_allclose(hmap.xs, np.linspace(0.0, 100.0, 11))
+        np.testing.assert_allclose(hmap.ys, np.linspace(0.0, 80.0, 9))
+        np.testing.assert_allclose(hmap.z, self.points[:, 2].reshape(9, 11), atol=1e-5)
+        with self.assertRaises(ValueError):
+            height_map_from_points(self.points[1:])
+
+    def test_interpolation(self):
+        hmap = height_map_from_points(self.points)
+        x, y = np.array([15.0, 52.5, 85.0]), np.array([15.0, 41.0, 67.5])
+        # away from the border cells of the grid, the bicubic interpolation follows a quadratic surface exactly
+        np.testing.assert_allclose(surface_heights(hmap, x, y, "bicubic"), self.surface(x, y), atol=1e-12)
+        self.assertLess(np.abs(surface_heights(hmap, x, y) - self.surface(x, y)).max(), 0.0006)
+
+    def test_level_toolpath(self):
+        hmap = height_map_from_points(self.points)
+        toolpath = Toolpath("Isolation", Tool(1, 0.2, "engrave"))
+        toolpath.add_move(RAPID, 10.0, 10.0, 1.0)
+        toolpath.linear(None, None, -0.05, 100.0)
+        toolpath.linear(20.0, 10.0, None, 300.0)
+        toolpath.arc(20.0, 30.0, 20.0, 20.0, False, 300.0)
+        leveled = level_toolpath(toolpath, hmap, max_seg=0.5, method="bicubic", tolerance=0.001).arrays()
+        self.assertTrue(np.all(leveled["kind"][1:] == 1))
+        xs, ys = leveled["x"], leveled["y"]
+        steps = np.hypot(np.diff(xs), np.diff(ys))
+        self.assertLessEqual(steps.max(), 0.5 + 1e-9)
+        # the linear moves of the arc stay on its circle
+        arc = slice(22, None)
+        np.testing.assert_allclose(np.hypot(xs[arc] - 20.0, ys[arc] - 20.0), 10.0)
+        np.testing.assert_allclose(leveled["z"][1:], -0.05 + self.surface(xs[1:], ys[1:]), atol=1e-12)
+        self.assertEqual((xs[-1], ys[-1]), (20.0, 30.0))
+
+    def test_level_full_circle(self):
+        hmap = height_map_from_points(self.points)
+        toolpath = Toolpath("Isolation", Tool(1, 0.2, "engrave"))
+        toolpath.add_move(RAPID, 30.0, 20.0, -0.05)
+        toolpath.arc(30.0, 20.0, 40.0, 20.0, True, 300.0)
+        leveled = level_toolpath(toolpath, hmap, max_seg=1.0).arrays()
+        xs, ys = leveled["x"][1:], leveled["y"][1:]
+        # the clockwise circle from the left of its center goes over the top first, all the way around
+        self.assertGreater(ys[0], 20.0)
+        self.assertGreater(len(xs), 60)
+        np.testing.assert_allclose(np.hypot(xs - 40.0, ys - 20.0), 10.0)
+
+    def test_probe_program(self):
+        points = probe_points((0.0, 0.0, 38.0, 18.0), max_spacing=10.0, margin=1.0)
+        # 5 columns along x (the longer side), 3 rows, in a serpentine order
+        self.assertEqual(len(points), 15)
+        np.testing.assert_allclose(points[:6, 0], [-1.0, 9.0, 19.0, 29.0, 39.0, 39.0])
+        np.testing.assert_allclose(points[4:6, 1], [-1.0, 9.0])
+        out = io.StringIO()
+        write_probe_program(out, points)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines.count("G38.2 Z-2 F50"), 15)
+        self.assertEqual(lines[lines.index("G38.2 Z-2 F50") - 1], "G0 X-1 Y-1")
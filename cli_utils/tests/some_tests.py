@@ -1,9 +1,230 @@
+import math
+import os
+import tempfile
 import unittest
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from grbr_explain.min_gerber_parser import GrbrCoordSys, GrbrArc, GrbrDraw, GrbrFlash, GrbrRegion, load_grbr_plot
+from grbr_explain.copper_density import CopperDensityMap, layer_area
+from grbr_explain.dedup import dedup_objs
+from grbr_explain.dxf_export import export_dxf
+from grbr_explain.lod_pyramid import LodItem, LodPyramid
+from grbr_explain.raster import draw_obj, grid_for_bbox, rasterize_objs
+from grbr_explain.registration_check import check_registration
+from grbr_explain.simplify import DrawSimplifier, PolylineSimplifier, simplify_points, span_deviations
+from grbr_explain.spatial_index import GridIndex
+from grbr_explain.svg_export import export_svg
+
+SAMPLE_F_CU = os.path.join(os.path.dirname(__file__), "data", "sample-F_Cu.gbr")
 
-from grbr_explain.min_gerber_parser import GrbrCoordSys
 
 class TestModuleDemo(unittest.TestCase):
     def test_gerber_coordinate_system_parse_coord(self):
         gcs = GrbrCoordSys(4, 6)
         val = gcs.parse_grbr_coord("123456000")
         self.assertEqual(val, 123.456)
+
+    def test_load_grbr_plot_graphic_objs(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        kinds = [type(obj) for obj in grbr_plot.graphic_objs]
+        self.assertEqual(kinds.count(GrbrFlash), 4)
+        self.assertEqual(kinds.count(GrbrArc), 1)
+        regions = [obj for obj in grbr_plot.graphic_objs if isinstance(obj, GrbrRegion)]
+        self.assertEqual([region.polarity for region in regions], ["dark", "clear"])
+
+
+class TestLodPyramid(unittest.TestCase):
+    def test_query_and_round_trip(self):
+        pyramid = LodPyramid.build(load_grbr_plot(SAMPLE_F_CU), tile_px=16)
+        self.assertGreater(pyramid.max_level, 0)
+        # zoomed out, the small regions are merged into boxes
+        self.assertIn("box", [item.kind for item in pyramid.query((0, 0, 30, 30), 2.0)])
+        # zoomed in, only the arc is visible in this area and it is finely linearized
+        items = pyramid.query((9, 4, 13, 8), 0.01)
+        self.assertEqual([item.kind for item in items], ["stroke"])
+        self.assertGreater(len(items[0].data[2]), 8)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fn = os.path.join(tmp_dir, "pyramid.json")
+            pyramid.save(fn)
+            self.assertEqual(LodPyramid.load(fn).query((0, 0, 30, 30), 0.5), pyramid.query((0, 0, 30, 30), 0.5))
+
+    def test_macro_flashes_are_never_merged(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        grbr_plot.aperture_lkp["D99"] = ("THERMAL80", [])
+        grbr_plot.graphic_objs.append(GrbrFlash(1, 20.0, 20.0, "D99", "dark"))
+        pyramid = LodPyramid.build(grbr_plot, tile_px=16)
+        # the macro's size is not known, it is drawn as a flash at every level, zoomed out too
+        for level in range(pyramid.max_level + 1):
+            items = pyramid.query((19, 19, 21, 21), pyramid.pixel_size(level))
+            self.assertIn(LodItem("flash", (20.0, 20.0, 20.0, 20.0), [20.0, 20.0, "D99", "dark"]), items)
+
+    def test_tiny_clear_features_keep_their_polarity_and_order(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        grbr_plot.aperture_lkp["D98"] = ("C", ["0.01"])
+        # a tiny dark pad with a tiny clear hole in it, then another tiny dark pad over the hole
+        for polarity in ("dark", "clear", "dark"):
+            grbr_plot.graphic_objs.append(GrbrFlash(1, 40.0, 40.0, "D98", polarity))
+        pyramid = LodPyramid.build(grbr_plot, tile_px=16)
+        items = pyramid.query((39, 39, 41, 41), pyramid.pixel_size(0))
+        self.assertEqual([item.data for item in items if item.kind == "box"], [[1, "dark"], [1, "clear"], [1, "dark"]])
+
+
+class TestRegistrationCheck(unittest.TestCase):
+    def test_pads_paired_with_drill_hits(self):
+        drill_hits = [(18.5, 10.16), (18.53, 7.62), (6.5, 10.16), (30.0, 30.0)]
+        (result,) = check_registration([SAMPLE_F_CU], drill_hits, tol=0.25, center_tol=0.02)
+        self.assertEqual(len(result.matched), 3)
+        self.assertEqual([(hit.x, hit.y) for hit in result.off_center], [(18.5, 7.62)])
+        self.assertAlmostEqual(result.off_center[0].dist, 0.03)
+        self.assertEqual([(hit.x, hit.y) for hit in result.unmatched_pads], [(6.5, 5.46)])
+        self.assertEqual(result.unmatched_drills, [(30.0, 30.0)])
+
+    def test_grid_index_nearest(self):
+        index = GridIndex(1.0)
+        for i in range(100):
+            index.insert(i * 0.5, (i * 7 % 13) * 0.5)
+        brute = min((math.hypot(x - 20.2, y - 3.1), i) for i, (x, y) in enumerate(index.points))
+        self.assertEqual(index.nearest(20.2, 3.1), brute)
+        self.assertIsNone(index.nearest(200, 200, max_dist=5))
+
+
+class TestCopperDensity(unittest.TestCase):
+    def test_layer_area_and_density_map(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        # the dark 3x3 region less its clear 1x1 hole is 8 square mm, both measures must agree on it
+        density_map = CopperDensityMap.build(grbr_plot, cell_size=1.0, samples=32, max_workers=1)
+        self.assertAlmostEqual(density_map.area_in((0, 0, 5, 5)), 8.0)
+        self.assertEqual(density_map.density[1, 1], 0.0)
+        # overlapping objects are counted once by the density map, but once per object by the layer area
+        self.assertLess(density_map.copper_area, layer_area(grbr_plot))
+        self.assertAlmostEqual(density_map.copper_area, layer_area(grbr_plot), delta=1.0)
+
+
+class TestRaster(unittest.TestCase):
+    def test_round_strokes_are_drawn_as_1_by_1(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        grbr_plot.aperture_lkp["D98"] = ("C", ["0.3"])
+        rng = np.random.default_rng(2)
+        for x1, y1, x2, y2 in rng.uniform(0, 20, (200, 4)):
+            grbr_plot.graphic_objs.append(GrbrDraw(1, x1, y1, x1 + (x2 - x1) / 20, y1 + (y2 - y1) / 20, "D98", "dark"))
+        grbr_plot.graphic_objs.append(GrbrFlash(1, 5.0, 5.0, "D98", "clear"))
+        # a long stroke, drawn 1 by 1 within the batch
+        grbr_plot.graphic_objs.append(GrbrDraw(1, 0.0, 0.0, 20.0, 15.0, "D98", "dark"))
+        grid = grid_for_bbox((0.0, 0.0, 20.0, 20.0), 0.05, 1.0)
+        expected = np.zeros(grid.shape, dtype=bool)
+        for obj in grbr_plot.graphic_objs:
+            draw_obj(expected, grid, obj, grbr_plot.aperture_lkp)
+        np.testing.assert_array_equal(rasterize_objs(grbr_plot.graphic_objs, grbr_plot.aperture_lkp, grid), expected)
+
+
+class TestDedup(unittest.TestCase):
+    def test_exact_duplicates_dropped_within_polarity(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        objs = grbr_plot.graphic_objs
+        draw = next(obj for obj in objs if type(obj).__name__ == "GrbrDraw")
+        reversed_draw = draw._replace(x1=draw.x2, y1=draw.y2, x2=draw.x1, y2=draw.y1)
+        moved_flash = objs[1]._replace(x=objs[1].x + 0.005)
+        # the last object is a clear region, the duplicate after it must be kept
+        dups = objs[:-1] + [objs[0], reversed_draw, moved_flash] + objs[-1:] + [objs[0]]
+        result = dedup_objs(dups, grbr_plot.aperture_lkp)
+        self.assertEqual([first for _, first in result.removed], [objs[0], draw])
+        self.assertEqual(len(result.objs), len(objs) + 2)
+        self.assertEqual([(first, obj) for first, obj, _ in result.near_dups], [(objs[1], moved_flash)])
+
+    def test_regions_keep_the_direction_of_their_arcs(self):
+        def half_disc(direction, reverse=False):
+            arc = GrbrArc(1, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 1.0, direction, None, "dark")
+            draw = GrbrDraw(1, -1.0, 0.0, 1.0, 0.0, None, "dark")
+            if reverse:
+                flipped = "clockwise" if direction == "counterclockwise" else "counterclockwise"
+                arc = arc._replace(x1=arc.x2, y1=arc.y2, x2=arc.x1, y2=arc.y1, direction=flipped)
+                draw = draw._replace(x1=draw.x2, y1=draw.y2, x2=draw.x1, y2=draw.y1)
+                return GrbrRegion(1, [[draw, arc]], "dark")
+            return GrbrRegion(1, [[arc, draw]], "dark")
+
+        upper, lower = half_disc("counterclockwise"), half_disc("clockwise")
+        result = dedup_objs([upper, lower, half_disc("counterclockwise", reverse=True)], {}, near_tol=None)
+        self.assertEqual(result.objs, [upper, lower])
+        self.assertEqual([first for _, first in result.removed], [upper])
+
+
+class TestSvgExport(unittest.TestCase):
+    def test_flashes_use_symbols_and_draws_are_merged(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            svg_fn = os.path.join(tmp_dir, "sample.svg")
+            export_svg(grbr_plot, svg_fn)
+            root = ET.parse(svg_fn).getroot()
+        ns = {"svg": "http://www.w3.org/2000/svg"}
+        flashes = [obj for obj in grbr_plot.graphic_objs if isinstance(obj, GrbrFlash)]
+        self.assertEqual(len(root.findall(".//svg:use[@x]", ns)), len(flashes))
+        self.assertEqual(len(root.findall(".//svg:symbol", ns)), len({flash.aperture for flash in flashes}))
+        # the draws & arcs of the only stroked aperture are written as 1 path
+        self.assertEqual(len(root.findall(".//svg:path[@stroke-width]", ns)), 1)
+        # the dark objects are masked by the clear region that follows them
+        self.assertEqual(len(root.findall(".//svg:mask", ns)), 1)
+        self.assertTrue(root.get("viewBox"))
+
+
+class TestDxfExport(unittest.TestCase):
+    def test_entities_of_sample_layer(self):
+        grbr_plot = load_grbr_plot(SAMPLE_F_CU)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dxf_fn = os.path.join(tmp_dir, "sample.dxf")
+            export_dxf(grbr_plot, dxf_fn)
+            with open(dxf_fn) as dxf_fh:
+                lines = dxf_fh.read().splitlines()
+        pairs = list(zip(lines[::2], lines[1::2]))
+        entities = [value for code, value in pairs[pairs.index(("2", "ENTITIES")):] if code == "0"]
+        flashes = [obj for obj in grbr_plot.graphic_objs if isinstance(obj, GrbrFlash)]
+        self.assertEqual(entities.count("INSERT"), len(flashes))
+        self.assertEqual(pairs[-1], ("0", "EOF"))
+        # an R12 file: sections without handles, each polyline closed by a SEQEND
+        self.assertEqual(pairs[2:4], [("9", "$ACADVER"), ("1", "AC1009")])
+        sections = [name for (code, value), (_, name) in zip(pairs, pairs[1:]) if (code, value) == ("0", "SECTION")]
+        self.assertEqual(sections, ["HEADER", "BLOCKS", "ENTITIES"])
+        self.assertNotIn("5", [code for code, _ in pairs])
+        self.assertEqual(entities.count("POLYLINE"), entities.count("SEQEND"))
+        # the 270 degree counterclockwise arc is kept as a bulge: tan(270 / 4)
+        bulges = [float(value) for code, value in pairs if code == "42"]
+        self.assertTrue(any(math.isclose(value, math.tan(math.radians(67.5)), rel_tol=1e-5) for value in bulges))
+
+
+class TestSimplify(unittest.TestCase):
+    def test_batch_and_streaming_stay_within_tolerance(self):
+        angles = np.linspace(0, math.pi, 2001)
+        points = np.c_[10 * np.cos(angles), 10 * np.sin(angles), np.linspace(0, -1, 2001)]
+        kept = simplify_points(points, 0.01)
+        # a 10 mm radius needs a chord of about 0.89 mm to bulge 0.01 mm: 35 chords over the half circle
+        self.assertTrue(kept[0] and kept[-1])
+        self.assertLess(kept.sum(), 100)
+        self.assertLessEqual(span_deviations(points, kept).max(), 0.01)
+        # Visvalingam keeps more points on the smooth curve, each dropped point still within the tolerance
+        kept_vw = simplify_points(points, 0.01, "vw")
+        self.assertTrue(kept_vw[0] and kept_vw[-1])
+        self.assertEqual(kept_vw.sum(), 183)
+        self.assertLessEqual(span_deviations(points, kept_vw).max(), 0.001)
+        simplifier = PolylineSimplifier(0.01, window=500)
+        out = [pt for point in points for pt, _ in simplifier.push(tuple(point))]
+        out += [pt for pt, _ in simplifier.finish()]
+        self.assertEqual((out[0], out[-1]), (tuple(points[0]), tuple(points[-1])))
+        self.assertEqual(simplifier.stats.points_in, 2001)
+        self.assertEqual(simplifier.stats.points_out, len(out))
+        self.assertLessEqual(simplifier.stats.max_deviation, 0.01)
+        with self.assertRaises(ValueError):
+            simplify_points(points, 0.01, "rdp")
+
+    def test_chained_draws_are_replaced(self):
+        objs = []
+        simplifier = DrawSimplifier(0.01, objs.append)
+        # a chain of 3 collinear draws, then a turn, then a flash ends the chain
+        for x1, y1, x2, y2 in [(0, 0, 1, 0), (1, 0, 2, 0.001), (2, 0.001, 3, 0), (3, 0, 3, 1)]:
+            simplifier(GrbrDraw(1, x1, y1, x2, y2, "D10", "dark"))
+        flash = GrbrFlash(5, 0.0, 0.0, "D11", "dark")
+        simplifier(flash)
+        simplifier.close()
+        self.assertEqual(objs, [GrbrDraw(1, 0, 0, 3, 0, "D10", "dark"), GrbrDraw(1, 3, 0, 3, 1, "D10", "dark"), flash])
+        self.assertEqual(simplifier.stats[:2], (5, 3))